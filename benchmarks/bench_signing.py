@@ -0,0 +1,382 @@
+"""
+Benchmark of the ZATCA invoice XML builders and signing helpers.
+
+Builds and signs synthetic Sales and POS invoices of 1 to 1,000 lines against an
+in-memory stand-in for the Frappe doc layer and a self-signed EC test certificate,
+and records the time and memory allocated by every stage of the pipeline
+as run by zatca_call. No site, database or network is needed.
+
+    python benchmarks/bench_signing.py --lines 1 10 100 1000 --output results.json
+    python benchmarks/bench_signing.py --compare results.json --threshold 0.2
+"""
+
+import argparse
+import base64
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.frappe_standin import DocStore, install  # noqa: E402
+from benchmarks import fixtures  # noqa: E402
+
+STORE = DocStore()
+frappe = install(STORE)
+fixtures.create_site(STORE)
+
+# the app modules import frappe at import time, so they come after install()
+import cryptography  # noqa: E402
+from lxml import etree  # noqa: E402
+from zatca_erpgulf.zatca_erpgulf import createxml, posxml, pos_final  # noqa: E402
+from zatca_erpgulf.zatca_erpgulf import xml_tax_data, create_xml_final_part  # noqa: E402
+from zatca_erpgulf.zatca_erpgulf import sign_invoice_first as signing  # noqa: E402
+from zatca_erpgulf.zatca_erpgulf.signing_identity import get_signing_identity  # noqa: E402
+
+DEFAULT_LINES = [1, 10, 100, 1000]
+
+
+def get_builders(doctype):
+    """builder functions zatca_call uses for the doctype"""
+    if doctype == "POS Invoice":
+        return {
+            "xml_tags": posxml.xml_tags,
+            "salesinvoice_data": posxml.salesinvoice_data,
+            "invoice_typecode_simplified": posxml.invoice_typecode_simplified,
+            "doc_reference": posxml.doc_reference,
+            "additional_reference": posxml.additional_reference,
+            "company_data": posxml.company_data,
+            "customer_data": posxml.customer_data,
+            "delivery_and_payment_means": posxml.delivery_and_paymentmeans,
+            "discount": posxml.add_document_level_discount_with_tax,
+            "discount_with_template": posxml.add_document_level_discount_with_tax_template,
+            "tax_data": posxml.tax_data,
+            "tax_data_with_template": pos_final.tax_data_with_template,
+            "item_data": pos_final.item_data,
+            "item_data_with_template": pos_final.item_data_with_template,
+            "xml_structuring_tree": pos_final.xml_structuring_tree,
+        }
+    return {
+        "xml_tags": createxml.xml_tags,
+        "salesinvoice_data": createxml.salesinvoice_data,
+        "invoice_typecode_simplified": createxml.invoice_typecode_simplified,
+        "doc_reference": createxml.doc_reference,
+        "additional_reference": createxml.additional_reference,
+        "company_data": createxml.company_data,
+        "customer_data": createxml.customer_data,
+        "delivery_and_payment_means": createxml.delivery_and_payment_means,
+        "discount": createxml.add_document_level_discount_with_tax,
+        "discount_with_template": createxml.add_document_level_discount_with_tax_template,
+        "nominal_discount": createxml.add_nominal_discount_tax,
+        "tax_data": xml_tax_data.tax_data,
+        "tax_data_with_template": xml_tax_data.tax_data_with_template,
+        "tax_data_nominal": create_xml_final_part.tax_data_nominal,
+        "tax_data_with_template_nominal": create_xml_final_part.tax_data_with_template_nominal,
+        "item_data": create_xml_final_part.item_data,
+        "item_data_with_template": create_xml_final_part.item_data_with_template,
+        "xml_structuring_tree": create_xml_final_part.xml_structuring_tree,
+    }
+
+
+def get_stages(shape, invoice_doc):
+    """ordered (stage, function) pairs building and signing the invoice like zatca_call.
+    Every function takes the state dict of the run and adds its results to it"""
+    spec = fixtures.SHAPES[shape]
+    builders = get_builders(spec["doctype"])
+    invoice_number = invoice_doc.name
+    company_abbr = fixtures.COMPANY_ABBR
+    with_template = spec["tax_template"]
+    nominal = spec["nominal"]
+
+    def header(state):
+        invoice = builders["xml_tags"]()
+        invoice, state["uuid"], doc = builders["salesinvoice_data"](invoice, invoice_number)
+        invoice = builders["invoice_typecode_simplified"](invoice, doc)
+        invoice = builders["doc_reference"](invoice, doc, invoice_number)
+        invoice = builders["additional_reference"](invoice, company_abbr, doc)
+        state.update(invoice=invoice, doc=doc)
+
+    def parties(state):
+        invoice, doc = state["invoice"], state["doc"]
+        invoice = builders["company_data"](invoice, doc)
+        invoice = builders["customer_data"](invoice, doc)
+        state["invoice"] = builders["delivery_and_payment_means"](invoice, doc, doc.is_return)
+
+    def discount(state):
+        if nominal:
+            builder = builders["nominal_discount"]
+        elif with_template:
+            builder = builders["discount_with_template"]
+        else:
+            builder = builders["discount"]
+        state["invoice"] = builder(state["invoice"], state["doc"])
+
+    def tax_data(state):
+        name = "tax_data_with_template" if with_template else "tax_data"
+        if nominal:
+            name += "_nominal"
+        state["invoice"] = builders[name](state["invoice"], state["doc"])
+
+    def item_data(state):
+        name = "item_data_with_template" if with_template else "item_data"
+        state["invoice"] = builders[name](state["invoice"], state["doc"])
+
+    def structuring(state):
+        state["root"] = builders["xml_structuring_tree"](state["invoice"])
+
+    def identity(state):
+        frappe.local.zatca_signing_identities = {}
+        identity = get_signing_identity(company_abbr, state["doc"])
+        # load the key and parse the certificate here rather than in the first stage using them
+        identity.private_key, identity.certificate_hash, identity.issuer_name
+        state["identity"] = identity
+
+    def removetags(state):
+        state["tag_removed_xml"] = signing.removetags(state["root"])
+
+    def canonicalize(state):
+        state["canonicalized_xml"] = signing.canonicalize_xml(state["tag_removed_xml"])
+
+    def invoice_hash(state):
+        state["hash"], state["encoded_hash"] = signing.getinvoicehash(
+            state["canonicalized_xml"]
+        )
+
+    def digital_signature(state):
+        state["signature"] = signing.digital_signature(
+            state["hash"], company_abbr, state["doc"]
+        )
+
+    def signed_properties(state):
+        identity = state["identity"]
+        signing_time = signing.set_signing_properties(
+            state["root"],
+            identity.certificate_hash,
+            identity.issuer_name,
+            identity.serial_number,
+        )
+        state["signed_properties"] = signing.generate_signed_properties_hash(
+            signing_time,
+            identity.issuer_name,
+            identity.serial_number,
+            identity.certificate_hash,
+        )
+
+    def signature_values(state):
+        signing.set_signature_values(
+            state["root"],
+            state["signature"],
+            state["identity"].certificate_content,
+            state["signed_properties"],
+            state["encoded_hash"],
+        )
+
+    def qr(state):
+        tlv_data = signing.extract_tlv_data(state["root"], company_abbr, state["doc"])
+        qrcodebuf = b"".join(
+            signing.get_tlv_for_value(tag_num, tag_value)
+            for tag_num, tag_value in tlv_data.items()
+        )
+        state["qrcodeb64"] = base64.b64encode(qrcodebuf).decode("utf-8")
+        signing.set_qr_value(state["root"], state["qrcodeb64"], company_abbr)
+
+    def serialize(state):
+        state["updated_xml_string"] = signing.serialize_xml_tree(state["root"])
+
+    def structuring_signed(state):
+        state["signed_xml"] = signing.structuring_signedxml(
+            invoice_number, state["updated_xml_string"]
+        )
+
+    return [
+        ("header", header),
+        ("parties", parties),
+        ("discount", discount),
+        ("tax_data", tax_data),
+        ("item_data", item_data),
+        ("xml_structuring_tree", structuring),
+        ("signing_identity", identity),
+        ("removetags", removetags),
+        ("canonicalize_xml", canonicalize),
+        ("getinvoicehash", invoice_hash),
+        ("digital_signature", digital_signature),
+        ("signed_properties", signed_properties),
+        ("set_signature_values", signature_values),
+        ("qr", qr),
+        ("serialize_xml_tree", serialize),
+        ("structuring_signedxml", structuring_signed),
+    ]
+
+
+def run_once(invoice_doc, stages, trace=False):
+    """run every stage once on a fresh state. Returns seconds per stage, and with
+    trace the net and peak KiB allocated by every stage and by the whole run"""
+    # a real request loads the invoice afresh, so no flags are carried between runs
+    invoice_doc.flags = type(invoice_doc.flags)()
+    state = {}
+    timings = {}
+    allocations = {}
+    if trace:
+        start, _peak = tracemalloc.get_traced_memory()
+        run_peak = start
+    for stage, function in stages:
+        if trace:
+            before, _peak = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+        started = time.perf_counter()
+        function(state)
+        timings[stage] = time.perf_counter() - started
+        if trace:
+            after, peak = tracemalloc.get_traced_memory()
+            run_peak = max(run_peak, peak)
+            allocations[stage] = ((after - before) / 1024, (peak - before) / 1024)
+    if trace:
+        allocations["total"] = ((after - start) / 1024, (run_peak - start) / 1024)
+    return timings, allocations, state
+
+
+def bench_shape(shape, lines, repeat, warmup):
+    """timing and allocation rows of every stage for one invoice shape and size"""
+    invoice_doc = fixtures.create_invoice(STORE, shape, lines)
+    stages = get_stages(shape, invoice_doc)
+    for _ in range(warmup):
+        run_once(invoice_doc, stages)
+
+    samples = {stage: [] for stage, _function in stages}
+    totals = []
+    for _ in range(repeat):
+        timings, _allocations, state = run_once(invoice_doc, stages)
+        for stage, seconds in timings.items():
+            samples[stage].append(seconds)
+        totals.append(sum(timings.values()))
+    signed_xml = state["signed_xml"]
+    # signed output must still parse, a broken stage should not pass as a fast one
+    etree.fromstring(signed_xml)
+
+    tracemalloc.start()
+    try:
+        _timings, allocations, _state = run_once(invoice_doc, stages, trace=True)
+    finally:
+        tracemalloc.stop()
+
+    rows = []
+    for stage, seconds in list(samples.items()) + [("total", totals)]:
+        net_kib, peak_kib = allocations[stage]
+        rows.append(
+            {
+                "shape": shape,
+                "lines": lines,
+                "stage": stage,
+                "runs": len(seconds),
+                "mean_ms": round(statistics.mean(seconds) * 1000, 4),
+                "median_ms": round(statistics.median(seconds) * 1000, 4),
+                "min_ms": round(min(seconds) * 1000, 4),
+                "max_ms": round(max(seconds) * 1000, 4),
+                "net_alloc_kib": round(net_kib, 2),
+                "peak_alloc_kib": round(peak_kib, 2),
+                "signed_xml_bytes": len(signed_xml) if stage == "total" else None,
+            }
+        )
+    return rows
+
+
+def compare(results, baseline_path, threshold, min_ms):
+    """rows whose median time grew by more than the threshold over the baseline.
+    Stages faster than min_ms in the baseline are too noisy to compare"""
+    with open(baseline_path, "r", encoding="utf-8") as file:
+        baseline = {
+            (row["shape"], row["lines"], row["stage"]): row
+            for row in json.load(file)["results"]
+        }
+    regressions = []
+    for row in results:
+        before = baseline.get((row["shape"], row["lines"], row["stage"]))
+        if not before or before["median_ms"] < max(min_ms, 1e-9):
+            continue
+        ratio = row["median_ms"] / before["median_ms"] - 1
+        if ratio > threshold:
+            regressions.append(
+                {
+                    "shape": row["shape"],
+                    "lines": row["lines"],
+                    "stage": row["stage"],
+                    "baseline_median_ms": before["median_ms"],
+                    "median_ms": row["median_ms"],
+                    "change": round(ratio, 4),
+                }
+            )
+    return regressions
+
+
+def print_summary(results):
+    """human readable table of the totals on stderr"""
+    for row in results:
+        if row["stage"] == "total":
+            print(
+                f"{row['shape']:<20}{row['lines']:>6} lines"
+                f"{row['median_ms']:>12.2f} ms{row['peak_alloc_kib']:>12.1f} KiB peak",
+                file=sys.stderr,
+            )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--lines", type=int, nargs="+", default=DEFAULT_LINES)
+    parser.add_argument(
+        "--shapes", nargs="+", choices=list(fixtures.SHAPES), default=list(fixtures.SHAPES)
+    )
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--output", help="write the results to this json file")
+    parser.add_argument("--compare", help="baseline json from an earlier run")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.2,
+        help="relative median slowdown reported as a regression, 0.2 is 20%%",
+    )
+    parser.add_argument(
+        "--min-ms",
+        type=float,
+        default=1.0,
+        help="only compare stages whose baseline median is at least this many ms",
+    )
+    args = parser.parse_args(argv)
+
+    results = []
+    for shape in args.shapes:
+        for lines in args.lines:
+            results.extend(bench_shape(shape, lines, args.repeat, args.warmup))
+
+    output = {
+        "meta": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "lxml": ".".join(str(part) for part in etree.LXML_VERSION),
+            "cryptography": cryptography.__version__,
+            "repeat": args.repeat,
+            "warmup": args.warmup,
+        },
+        "results": results,
+    }
+    regressions = []
+    if args.compare:
+        regressions = compare(results, args.compare, args.threshold, args.min_ms)
+        output["regressions"] = regressions
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(output, file, indent=1)
+    else:
+        json.dump(output, sys.stdout, indent=1)
+        sys.stdout.write("\n")
+    print_summary(results)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
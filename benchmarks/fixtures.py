@@ -0,0 +1,216 @@
+"""
+Synthetic company, parties and invoices for the signing benchmarks.
+The company signs with a self-signed secp256k1 test certificate generated on the fly
+"""
+
+import base64
+import datetime
+import json
+from cryptography import x509
+from cryptography.x509.oid import NameOID
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from benchmarks.frappe_standin import StandInDoc
+
+COMPANY = "Benchmark Trading Co"
+COMPANY_ABBR = "BTC"
+B2C_CUSTOMER = "Walk In Customer"
+TAX_TEMPLATE = "KSA VAT 15%"
+SALES_TAX_TEMPLATE = "KSA VAT 15% - BTC"
+POS_PROFILE = "Benchmark POS"
+VAT_RATE = 15.0
+# PIH of the first invoice of a new EGS unit
+INITIAL_PIH = "NWZlY2ViNjZmZmM4NmYzOGQ5NTI3ODZjNmQ2OTZjNzljMmRiYzIzOWRkNGU5MWI0NjcyOWQ3M2EyN2ZiNTdlOQ=="
+
+SHAPES = {
+    "sales": {"doctype": "Sales Invoice", "tax_template": False, "nominal": False},
+    "sales_tax_template": {"doctype": "Sales Invoice", "tax_template": True, "nominal": False},
+    "sales_nominal": {"doctype": "Sales Invoice", "tax_template": False, "nominal": True},
+    "pos": {"doctype": "POS Invoice", "tax_template": False, "nominal": False},
+    "pos_tax_template": {"doctype": "POS Invoice", "tax_template": True, "nominal": False},
+}
+
+
+def create_test_certificate():
+    """self-signed EC certificate as stored on the Company, base64 DER and PEM private key"""
+    private_key = ec.generate_private_key(ec.SECP256K1())
+    name = x509.Name(
+        [
+            x509.NameAttribute(NameOID.COMMON_NAME, "TST-886431145-399999999900003"),
+            x509.NameAttribute(NameOID.ORGANIZATION_NAME, COMPANY),
+            x509.NameAttribute(NameOID.COUNTRY_NAME, "SA"),
+        ]
+    )
+    certificate = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(private_key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(datetime.datetime(2024, 1, 1))
+        .not_valid_after(datetime.datetime(2034, 1, 1))
+        .sign(private_key, hashes.SHA256())
+    )
+    certificate_content = base64.b64encode(
+        certificate.public_bytes(serialization.Encoding.DER)
+    ).decode("utf-8")
+    private_key_pem = private_key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.TraditionalOpenSSL,
+        serialization.NoEncryption(),
+    ).decode("utf-8")
+    return certificate_content, private_key_pem
+
+
+def create_site(store):
+    """add the company, addresses, customer and tax templates shared by every invoice"""
+    certificate_content, private_key_pem = create_test_certificate()
+    store.add(
+        StandInDoc(
+            "Company",
+            name=COMPANY,
+            abbr=COMPANY_ABBR,
+            tax_id="399999999900003",
+            custom_registration_type="CRN",
+            custom_company_registration="1010010000",
+            custom_costcenter=0,
+            custom_certificate=certificate_content,
+            custom_private_key=private_key_pem,
+            custom_pih=INITIAL_PIH,
+            custom_select="Sandbox",
+            custom_sandbox_url="https://gw-fatoora.zatca.gov.sa/e-invoicing/developer-portal/",
+        )
+    )
+    store.add(
+        StandInDoc(
+            "Address",
+            name="Benchmark Trading Co-Billing",
+            address_line1="King Fahd Road",
+            address_line2="Al Olaya",
+            custom_building_number="1234",
+            city="Riyadh",
+            pincode="12345",
+            state="Riyadh",
+            country="Saudi Arabia",
+            is_your_company_address=1,
+            link_name=COMPANY,
+        )
+    )
+    store.add(
+        StandInDoc(
+            "Address",
+            name="Walk In Customer-Billing",
+            address_line1="Prince Sultan Street",
+            address_line2="Al Rawdah",
+            custom_building_number="5678",
+            city="Jeddah",
+            pincode="23434",
+            state="Makkah",
+            country="Saudi Arabia",
+            is_your_company_address=0,
+        )
+    )
+    store.add(
+        StandInDoc(
+            "Customer",
+            name=B2C_CUSTOMER,
+            customer_name=B2C_CUSTOMER,
+            custom_b2c=1,
+            customer_primary_address="Walk In Customer-Billing",
+        )
+    )
+    store.add(
+        StandInDoc(
+            "Item Tax Template",
+            name=TAX_TEMPLATE,
+            custom_zatca_tax_category="Standard",
+            taxes=[StandInDoc("Item Tax Template Detail", tax_rate=VAT_RATE)],
+        )
+    )
+    store.add(
+        StandInDoc(
+            "Sales Taxes and Charges Template",
+            name=SALES_TAX_TEMPLATE,
+            taxes=[
+                StandInDoc("Sales Taxes and Charges", rate=VAT_RATE, included_in_print_rate=0)
+            ],
+        )
+    )
+    store.add(
+        StandInDoc("POS Profile", name=POS_PROFILE, taxes_and_charges=SALES_TAX_TEMPLATE)
+    )
+
+
+def create_invoice(store, shape, lines, sequence=1):
+    """add a submitted invoice of the given shape and number of lines and return it"""
+    spec = SHAPES[shape]
+    items = []
+    for idx in range(1, lines + 1):
+        qty = 1 + idx % 5
+        rate = round(10 + (idx * 7.3) % 90, 2)
+        amount = round(qty * rate, 2)
+        items.append(
+            StandInDoc(
+                f"{spec['doctype']} Item",
+                idx=idx,
+                item_code=f"BENCH-ITEM-{idx:05d}",
+                item_name=f"Benchmark item {idx}",
+                uom="Nos",
+                qty=qty,
+                rate=rate,
+                price_list_rate=rate,
+                discount_amount=0.0,
+                amount=amount,
+                base_amount=amount,
+                net_amount=amount,
+                base_net_amount=amount,
+                item_tax_template=TAX_TEMPLATE if spec["tax_template"] else None,
+            )
+        )
+    total = round(sum(item.amount for item in items), 2)
+    tax_amount = round(total * VAT_RATE / 100, 2)
+    item_wise_tax_detail = json.dumps(
+        {item.item_code: [VAT_RATE, round(item.amount * VAT_RATE / 100, 4)] for item in items}
+    )
+    prefix = "ACC-PSINV" if spec["doctype"] == "POS Invoice" else "ACC-SINV"
+    invoice = StandInDoc(
+        spec["doctype"],
+        name=f"{prefix}-2025-{sequence:05d}",
+        company=COMPANY,
+        customer=B2C_CUSTOMER,
+        currency="SAR",
+        posting_date=datetime.date(2025, 1, 15),
+        posting_time="10:15:30",
+        due_date=datetime.date(2025, 1, 15),
+        is_return=0,
+        is_debit_note=0,
+        docstatus=1,
+        pos_profile=POS_PROFILE if spec["doctype"] == "POS Invoice" else None,
+        custom_zatca_tax_category="Standard",
+        custom_zatca_nominal_invoice=1 if spec["nominal"] else 0,
+        custom_submit_line_item_discount_to_zatca=0,
+        custom_zatca_discount_reason="Discount",
+        custom_zatca_discount_reason_code="95",
+        items=items,
+        taxes=[
+            StandInDoc(
+                "Sales Taxes and Charges",
+                rate=VAT_RATE,
+                included_in_print_rate=0,
+                tax_amount=tax_amount,
+                base_tax_amount=tax_amount,
+                item_wise_tax_detail=item_wise_tax_detail,
+            )
+        ],
+        total=total,
+        base_total=total,
+        net_total=total,
+        base_net_total=total,
+        discount_amount=total if spec["nominal"] else 0.0,
+        base_discount_amount=total if spec["nominal"] else 0.0,
+        total_taxes_and_charges=tax_amount,
+        base_total_taxes_and_charges=tax_amount,
+        grand_total=round(total + tax_amount, 2),
+        base_grand_total=round(total + tax_amount, 2),
+    )
+    return store.add(invoice)
@@ -0,0 +1,268 @@
+"""
+In-memory stand-in for the parts of the Frappe API used by the ZATCA XML builders
+and signing helpers. It is only meant for the benchmarks: install() registers it as
+the frappe module before any zatca_erpgulf module is imported, so the builders run
+against plain Python documents instead of a site database
+"""
+
+import sys
+import types
+import datetime
+
+FRAPPE_VERSION = "15.0.0"
+
+
+class ValidationError(Exception):
+    """stand-in for frappe.ValidationError"""
+
+
+class DoesNotExistError(ValidationError):
+    """stand-in for frappe.DoesNotExistError"""
+
+
+class StandInDoc:
+    """document with attribute access, unset fields read as None like on a frappe Document"""
+
+    def __init__(self, doctype=None, **fields):
+        self.__dict__["doctype"] = doctype
+        self.__dict__["flags"] = _Flags()
+        self.__dict__.update(fields)
+
+    def __getattr__(self, key):
+        if key.startswith("__"):
+            raise AttributeError(key)
+        return None
+
+    def get(self, key, default=None):
+        """field value or the default"""
+        return self.__dict__.get(key, default)
+
+    def set(self, key, value):
+        """set a field"""
+        self.__dict__[key] = value
+
+    def db_set(self, key, value=None, **kwargs):
+        """set one field or a dict of fields, nothing is written anywhere"""
+        if isinstance(key, dict):
+            self.__dict__.update(key)
+        else:
+            self.__dict__[key] = value
+
+    def save(self, **kwargs):
+        """saving is a no-op"""
+        return self
+
+    def reload(self):
+        """reloading is a no-op"""
+        return self
+
+
+class _Flags(types.SimpleNamespace):
+    """flags namespace that reads unset flags as None like frappe._dict"""
+
+    def __getattr__(self, key):
+        if key.startswith("__"):
+            raise AttributeError(key)
+        return None
+
+
+class DocStore:
+    """documents of the stand-in site, keyed by doctype and name"""
+
+    def __init__(self):
+        self.docs = {}
+
+    def add(self, doc):
+        """add a document"""
+        self.docs[(doc.doctype, doc.name)] = doc
+        return doc
+
+    def get(self, doctype, name=None):
+        """get a document by name or by a dict of field filters"""
+        if isinstance(doctype, dict):
+            return StandInDoc(**doctype)
+        if isinstance(name, dict):
+            for (dt, _name), doc in self.docs.items():
+                if dt == doctype and all(doc.get(k) == v for k, v in name.items()):
+                    return doc
+            raise DoesNotExistError(f"{doctype} {name} not found")
+        try:
+            return self.docs[(doctype, name)]
+        except KeyError as e:
+            raise DoesNotExistError(f"{doctype} {name} not found") from e
+
+    def get_all(self, doctype, filters=None, fields=None, **kwargs):
+        """documents of a doctype matching the filters. Filters are a dict or a list of
+        [field, operator, value] with child table filters read from the document itself"""
+        if isinstance(filters, dict):
+            filters = [
+                [key, *value] if isinstance(value, list) else [key, "=", value]
+                for key, value in filters.items()
+            ]
+        result = []
+        for (dt, _name), doc in self.docs.items():
+            if dt != doctype:
+                continue
+            if filters and not all(_matches(doc, *condition[-3:]) for condition in filters):
+                continue
+            result.append(doc)
+        return result
+
+
+def _matches(doc, field, operator, value):
+    actual = doc.get(field)
+    if operator == "in":
+        return actual in value
+    if operator == "!=":
+        return str(actual) != str(value)
+    return str(actual) == str(value)
+
+
+class StandInDB:
+    """frappe.db over a DocStore"""
+
+    def __init__(self, store):
+        self.store = store
+
+    def get_value(self, doctype, filters, fieldname, as_dict=False, **kwargs):
+        """field or list of fields of the matching document, None when there is none"""
+        try:
+            doc = self.store.get(doctype, filters)
+        except DoesNotExistError:
+            return None
+        if isinstance(fieldname, (list, tuple)):
+            values = {field: doc.get(field) for field in fieldname}
+            return StandInDoc(doctype, **values) if as_dict else list(values.values())
+        return doc.get(fieldname)
+
+    def exists(self, doctype, name=None):
+        """whether the document exists"""
+        try:
+            self.store.get(doctype, name)
+            return True
+        except DoesNotExistError:
+            return False
+
+    def set_value(self, doctype, name, field, value=None, **kwargs):
+        """set a field on the stored document"""
+        self.store.get(doctype, name).db_set(field, value)
+
+    def commit(self):
+        """transactions are a no-op"""
+
+    def rollback(self):
+        """transactions are a no-op"""
+
+
+class StandInCache:
+    """frappe.cache() kept in a dict, enough for the hash values the app caches"""
+
+    def __init__(self):
+        self.data = {}
+
+    def hget(self, name, key, generator=None, shared=False):
+        """value of a hash field, generated and stored on a miss"""
+        values = self.data.setdefault(name, {})
+        if key not in values and generator:
+            values[key] = generator()
+        return values.get(key)
+
+    def hset(self, name, key, value, shared=False):
+        """set a hash field"""
+        self.data.setdefault(name, {})[key] = value
+
+    def hdel(self, name, key, shared=False):
+        """delete a hash field"""
+        self.data.get(name, {}).pop(key, None)
+
+    def delete_value(self, name, *args, **kwargs):
+        """delete a key"""
+        self.data.pop(name, None)
+
+    def get_value(self, key, *args, **kwargs):
+        """value of a key"""
+        return self.data.get(key)
+
+    def set_value(self, key, value, *args, **kwargs):
+        """set a key, expiry is ignored"""
+        self.data[key] = value
+
+    def make_key(self, key, *args, **kwargs):
+        """raw redis key, the stand-in has no site prefix"""
+        return key
+
+    def hincrby(self, name, key, amount=1):
+        """increment an integer hash field"""
+        values = self.data.setdefault(name, {})
+        values[key] = values.get(key, 0) + amount
+        return values[key]
+
+    hincrbyfloat = hincrby
+
+    def hmget(self, name, keys):
+        """values of several hash fields"""
+        values = self.data.get(name, {})
+        return [values.get(key) for key in keys]
+
+
+def get_time(value):
+    """frappe.utils.data.get_time for the string and time values used by the fixtures"""
+    if isinstance(value, datetime.time):
+        return value
+    if isinstance(value, datetime.timedelta):
+        return (datetime.datetime.min + value).time()
+    return datetime.datetime.strptime(str(value).split(".", 1)[0], "%H:%M:%S").time()
+
+
+def add_to_date(date, hours=0, **kwargs):
+    """frappe.utils.add_to_date for the hour offsets used by the submission queue"""
+    return date + datetime.timedelta(hours=hours)
+
+
+def _throw(msg, exc=ValidationError, *args, **kwargs):
+    raise exc(msg)
+
+
+def install(store, site="benchmark.local"):
+    """register the stand-in as the frappe module backed by the given store"""
+    if "frappe" in sys.modules and not getattr(sys.modules["frappe"], "is_stand_in", False):
+        raise RuntimeError("frappe is already imported, run the benchmark in its own process")
+
+    frappe = types.ModuleType("frappe")
+    frappe.is_stand_in = True
+    frappe.__version__ = FRAPPE_VERSION
+    frappe.ValidationError = ValidationError
+    frappe.DoesNotExistError = DoesNotExistError
+    frappe._ = lambda msg, *args, **kwargs: msg
+    frappe.throw = _throw
+    frappe.msgprint = lambda *args, **kwargs: None
+    frappe.log_error = lambda *args, **kwargs: None
+    frappe.publish_realtime = lambda *args, **kwargs: None
+    frappe.whitelist = lambda *args, **kwargs: (
+        args[0] if args and callable(args[0]) else (lambda fn: fn)
+    )
+    frappe.get_doc = store.get
+    frappe.get_all = store.get_all
+    frappe.get_list = store.get_all
+    frappe.get_installed_apps = lambda: ["frappe", "erpnext", "zatca_erpgulf"]
+    frappe.db = StandInDB(store)
+    cache = StandInCache()
+    frappe.cache = lambda: cache
+    frappe.local = types.SimpleNamespace(site=site)
+    frappe.session = types.SimpleNamespace(user="Administrator")
+
+    utils = types.ModuleType("frappe.utils")
+    data = types.ModuleType("frappe.utils.data")
+    data.get_time = get_time
+    utils.data = data
+    utils.get_time = get_time
+    utils.now_datetime = datetime.datetime.now
+    utils.add_to_date = add_to_date
+    utils.cint = lambda value: int(value or 0)
+    utils.flt = lambda value, precision=None: float(value or 0)
+    frappe.utils = utils
+
+    sys.modules.update(
+        {"frappe": frappe, "frappe.utils": utils, "frappe.utils.data": data}
+    )
+    return frappe
@@ -19,12 +19,26 @@ add_to_apps_screen = [
     }
 ]
 
+after_install = "zatca_erpgulf.zatca_erpgulf.submission_queue.add_pending_invoice_indexes"
+after_migrate = [
+    "zatca_erpgulf.zatca_erpgulf.submission_queue.add_pending_invoice_indexes",
+    "zatca_erpgulf.zatca_erpgulf.zatca_config.clear_all_config",
+    "zatca_erpgulf.zatca_erpgulf.party_data.clear_all_parties",
+]
+
+after_request = ["zatca_erpgulf.zatca_erpgulf.event_log.flush_zatca_events"]
+after_job = ["zatca_erpgulf.zatca_erpgulf.event_log.flush_zatca_events"]
+
+default_log_clearing_doctypes = {"ZATCA ERPGulf Event Log": 90}
 
 scheduler_events = {
     "cron": {
         "*/30 * * * *": [
             "zatca_erpgulf.zatca_erpgulf.scheduler_event.submit_invoices_to_zatca_background_process"
-        ]
+        ],
+        "*/5 * * * *": [
+            "zatca_erpgulf.zatca_erpgulf.batch_dispatcher.dispatch_batched_invoices"
+        ],
     }
 }
 
@@ -46,6 +60,35 @@ doc_events = {
         "after_insert": "zatca_erpgulf.zatca_erpgulf.validations.duplicating_invoice",
         "on_submit": "zatca_erpgulf.zatca_erpgulf.pos_sign.zatca_background_on_submit",
     },
+    "Company": {
+        "validate": "zatca_erpgulf.zatca_erpgulf.signing_identity.refresh_public_key",
+        "on_update": [
+            "zatca_erpgulf.zatca_erpgulf.signing_identity.clear_signing_identity_cache",
+            "zatca_erpgulf.zatca_erpgulf.zatca_config.clear_config",
+            "zatca_erpgulf.zatca_erpgulf.party_data.clear_supplier_parties",
+        ],
+    },
+    "Cost Center": {
+        "on_update": "zatca_erpgulf.zatca_erpgulf.party_data.clear_supplier_parties",
+        "on_trash": "zatca_erpgulf.zatca_erpgulf.party_data.clear_supplier_parties",
+        "after_rename": "zatca_erpgulf.zatca_erpgulf.party_data.clear_supplier_parties",
+    },
+    "Customer": {
+        "on_update": "zatca_erpgulf.zatca_erpgulf.party_data.clear_customer_party",
+        "on_trash": "zatca_erpgulf.zatca_erpgulf.party_data.clear_customer_party",
+        "after_rename": "zatca_erpgulf.zatca_erpgulf.party_data.clear_customer_party",
+    },
+    "Address": {
+        "on_update": "zatca_erpgulf.zatca_erpgulf.party_data.clear_address_parties",
+        "on_trash": "zatca_erpgulf.zatca_erpgulf.party_data.clear_address_parties",
+    },
+    "ZATCA Multiple Setting": {
+        "validate": "zatca_erpgulf.zatca_erpgulf.signing_identity.refresh_public_key",
+        "on_update": [
+            "zatca_erpgulf.zatca_erpgulf.signing_identity.clear_signing_identity_cache",
+            "zatca_erpgulf.zatca_erpgulf.zatca_config.clear_config",
+        ],
+    },
 }
 
 
@@ -71,8 +114,8 @@ doctype_js = {
 }
 
 doctype_list_js = {
-    "Sales Invoice": "public/js/resubmit.js",
-    "POS Invoice": "public/js/resubmitpos.js",
+    "Sales Invoice": ["public/js/zatca_resubmission.js", "public/js/resubmit.js"],
+    "POS Invoice": ["public/js/zatca_resubmission.js", "public/js/resubmitpos.js"],
 }
 
 
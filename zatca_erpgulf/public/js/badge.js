@@ -115,6 +115,13 @@ frappe.ui.form.on('Sales Invoice', {
         console.log("Form refreshed!");
         frm.set_df_property('custom_zatca_status_notification', 'options', ' ');
 
+        // Batched: signed and queued for the batch dispatcher, no ZATCA response yet.
+        // Rejected (ZATCA 4xx) and Failed (error on our side) get the Failed badge from the response below
+        if (frm.doc.custom_zatca_status === 'Batched') {
+            frm.refresh_field('custom_zatca_status_notification');
+            return;
+        }
+
         if (frm.doc.custom_zatca_full_response) {
             try {
                 console.log("custom_zatca_full_response found:", frm.doc.custom_zatca_full_response);
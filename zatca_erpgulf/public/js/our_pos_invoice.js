@@ -19,6 +19,28 @@ frappe.realtime.on('show_gif', (data) => {
         </div>`;
     $('body').append(gifHtml);
 });
+
+frappe.realtime.on('zatca_submission_progress', (data) => {
+    if (data.doctype !== 'POS Invoice') return;
+    const indicator = {
+        Queued: 'blue',
+        Processing: 'orange',
+        Completed: 'green',
+        Failed: 'red',
+    }[data.status];
+    frappe.show_alert({
+        message: __('ZATCA {0}: {1}', [data.name, data.message || __(data.status)]),
+        indicator: indicator,
+    }, ['Completed', 'Failed'].includes(data.status) ? 10 : 5);
+    if (
+        ['Completed', 'Failed'].includes(data.status)
+        && cur_frm
+        && cur_frm.doctype === data.doctype
+        && cur_frm.docname === data.name
+    ) {
+        cur_frm.reload_doc();
+    }
+});
 frappe.ui.form.on('POS Invoice', {
     refresh(frm) {
         const response = frm.doc.custom_zatca_full_response;
@@ -236,7 +258,8 @@ frappe.ui.form.on("POS Invoice", {
 
                     if (
                         frm.doc.docstatus === 1 &&
-                        !["CLEARED", "REPORTED"].includes(frm.doc.custom_zatca_status) &&
+                        // Batched, Rejected and Failed invoices are signed already and chained on
+                        !["CLEARED", "REPORTED", "Batched", "Rejected", "Failed"].includes(frm.doc.custom_zatca_status) &&
                         phase === "Phase-2"
                     ) {
                         frm.add_custom_button(
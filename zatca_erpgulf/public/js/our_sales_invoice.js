@@ -73,6 +73,28 @@ frappe.realtime.on('hide_gif', () => {
     $('#custom-gif-overlay').remove();
 });
 
+frappe.realtime.on('zatca_submission_progress', (data) => {
+    if (data.doctype !== 'Sales Invoice') return;
+    const indicator = {
+        Queued: 'blue',
+        Processing: 'orange',
+        Completed: 'green',
+        Failed: 'red',
+    }[data.status];
+    frappe.show_alert({
+        message: __('ZATCA {0}: {1}', [data.name, data.message || __(data.status)]),
+        indicator: indicator,
+    }, ['Completed', 'Failed'].includes(data.status) ? 10 : 5);
+    if (
+        ['Completed', 'Failed'].includes(data.status)
+        && cur_frm
+        && cur_frm.doctype === data.doctype
+        && cur_frm.docname === data.name
+    ) {
+        cur_frm.reload_doc();
+    }
+});
+
 // frappe.ui.form.on("Sales Invoice", {
 //     refresh: function (frm) {
 //         if (frm.doc.docstatus === 1 && !["CLEARED", "REPORTED"].includes(frm.doc.custom_zatca_status)) {
@@ -106,7 +128,8 @@ frappe.ui.form.on("Sales Invoice", {
 
                     if (
                         frm.doc.docstatus === 1 &&
-                        !["CLEARED", "REPORTED"].includes(frm.doc.custom_zatca_status) &&
+                        // Batched, Rejected and Failed invoices are signed already and chained on
+                        !["CLEARED", "REPORTED", "Batched", "Rejected", "Failed"].includes(frm.doc.custom_zatca_status) &&
                         phase === "Phase-2"
                     ) {
                         frm.add_custom_button(
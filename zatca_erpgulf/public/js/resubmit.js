@@ -60,11 +60,9 @@ extend_listview_event("Sales Invoice", "onload", function (listview) {
             },
             callback: function (response) {
                 if (response.message) {
-                    // Refresh the list view and uncheck all items
-                    listview.refresh();
+                    // Uncheck all items and follow the resubmission job
                     listview.check_all(false);
-                } else {
-                    frappe.msgprint(__('Failed to resubmit some invoices. Please check logs for details.'));
+                    follow_zatca_resubmission(listview, response.message);
                 }
             }
         });
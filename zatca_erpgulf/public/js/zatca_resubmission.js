@@ -0,0 +1,62 @@
+// Shared by the Sales Invoice and POS Invoice list views, loaded ahead of resubmit.js and resubmitpos.js
+
+// Follow a resubmission job: progress bar from the realtime events, summary at the end
+function follow_zatca_resubmission(listview, job) {
+    const title = __('Sending invoices to ZATCA');
+    const progress_method = "zatca_erpgulf.zatca_erpgulf.bulk_resubmission.get_resubmission_progress";
+    let finished = false;
+
+    const finish = () => {
+        if (finished) return;
+        finished = true;
+        frappe.realtime.off('zatca_resubmission_progress', on_progress);
+        frappe.call({
+            method: progress_method,
+            args: { job_id: job.job_id },
+            callback: function (response) {
+                frappe.hide_progress();
+                const outcomes = response.message.outcomes;
+                const counts = {};
+                Object.values(outcomes).forEach((outcome) => {
+                    counts[outcome.status] = (counts[outcome.status] || 0) + 1;
+                });
+                const failed = Object.entries(outcomes).filter(([, outcome]) => outcome.status === 'Failed');
+                let message = Object.entries(counts)
+                    .map(([status, count]) => `${__(status)}: ${count}`)
+                    .join('<br>');
+                if (failed.length) {
+                    message += '<br><br>' + failed.slice(0, 20)
+                        .map(([name, outcome]) => `${name}: ${frappe.utils.escape_html(outcome.message || '')}`)
+                        .join('<br>');
+                }
+                frappe.msgprint({
+                    title: __('ZATCA resubmission finished'),
+                    message: message,
+                    indicator: failed.length ? 'orange' : 'green',
+                });
+                listview.refresh();
+            }
+        });
+    };
+
+    const on_progress = (data) => {
+        if (data.job_id !== job.job_id) return;
+        frappe.show_progress(title, data.done, data.total, `${data.name}: ${data.message || __(data.status)}`);
+        if (data.done >= data.total) finish();
+    };
+
+    frappe.realtime.on('zatca_resubmission_progress', on_progress);
+    frappe.show_progress(title, 0, job.total, __('Queued'));
+    // outcomes recorded before the handle came back, such as invoices that were not found
+    frappe.call({
+        method: progress_method,
+        args: { job_id: job.job_id },
+        callback: function (response) {
+            if (response.message.done >= response.message.total) {
+                finish();
+            } else if (!finished) {
+                frappe.show_progress(title, response.message.done, response.message.total, __('Queued'));
+            }
+        }
+    });
+}
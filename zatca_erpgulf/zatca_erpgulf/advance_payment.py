@@ -1,7 +1,6 @@
 """this module is used to populate the Advance Payment data in the XML file."""
 
 import os
-import io
 import base64
 import json
 import uuid
@@ -12,10 +11,10 @@ from datetime import datetime
 import xml.etree.ElementTree as ET
 from frappe.utils.data import get_time
 import frappe
-import requests
+from zatca_erpgulf.zatca_erpgulf.zatca_session import zatca_post
 from decimal import Decimal, ROUND_HALF_UP
 from frappe import _
-from pyqrcode import create as qr_create
+from zatca_erpgulf.zatca_erpgulf.qr_image import render_qr_png
 from frappe.custom.doctype.custom_field.custom_field import create_custom_fields
 from zatca_erpgulf.zatca_erpgulf.xml_tax_data import (
     get_exemption_reason_map,
@@ -40,15 +39,16 @@ from zatca_erpgulf.zatca_erpgulf.createxml_advance import (
     generate_signed_properties_hash,
     populate_the_ubl_extensions_output,
     generate_tlv_xml,
-    structuring_signedxml,
     get_tlv_for_value,
     update_qr_toxml,
     compliance_api_call,
 )
 
+from zatca_erpgulf.zatca_erpgulf.sign_invoice_first import structuring_signedxml
 from zatca_erpgulf.zatca_erpgulf.sign_invoice import get_api_url, attach_qr_image
 
 from zatca_erpgulf.zatca_erpgulf.create_qr import create_qr_code
+from zatca_erpgulf.zatca_erpgulf.pih_chain import get_unit_pih, set_unit_pih
 
 ITEM_TAX_TEMPLATE = "Item Tax Template"
 CAC_TAX_TOTAL = "cac:TaxTotal"
@@ -77,10 +77,11 @@ def get_issue_time(invoice_number):
 
 def get_tax_for_item(full_string, item):
     """
-    Extracts the tax amount and tax percentage for a specific item from a JSON-encoded string.
+    Extracts the tax amount and tax percentage for a specific item from a JSON-encoded string
+    or from an already parsed item tax index.
     """
     try:  # getting tax percentage and tax amount
-        data = json.loads(full_string)
+        data = full_string if isinstance(full_string, dict) else json.loads(full_string)
         tax_percentage = data.get(item, [0, 0])[0]
         tax_amount = data.get(item, [0, 0])[1]
         return tax_amount, tax_percentage
@@ -127,7 +128,7 @@ def get_tax_total_from_items(sales_invoice_doc):
     """Getting tax total for items"""
     try:
         total_tax = 0
-        tax_detail = generate_item_wise_tax_detail(sales_invoice_doc)
+        tax_detail = json.loads(generate_item_wise_tax_detail(sales_invoice_doc))
         for single_item in sales_invoice_doc.custom_item:
             _item_tax_amount, tax_percent = get_tax_for_item(
                 tax_detail, single_item.item_code
@@ -392,8 +393,6 @@ def additional_reference_advanve(invoice, company_abbr, sales_invoice_doc):
         if not company_name:
             frappe.throw(_(f"Company with abbreviation {company_abbr} not found."))
 
-        company_doc = frappe.get_doc("Company", company_name)
-
         # Create the first AdditionalDocumentReference element for PIH
         cac_additionaldocumentreference2 = ET.SubElement(
             invoice, "cac:AdditionalDocumentReference"
@@ -407,7 +406,7 @@ def additional_reference_advanve(invoice, company_abbr, sales_invoice_doc):
             cac_attachment, "cbc:EmbeddedDocumentBinaryObject"
         )
         cbc_embeddeddocumentbinaryobject.set("mimeCode", "text/plain")
-        pih = company_doc.custom_pih
+        pih = get_unit_pih(sales_invoice_doc)
         cbc_embeddeddocumentbinaryobject.text = pih
         cac_additionaldocumentreference22 = ET.SubElement(
             invoice, "cac:AdditionalDocumentReference"
@@ -651,7 +650,7 @@ def item_data_advance(invoice, sales_invoice_doc, invoice_number):
     The function defines the xml creating without item tax template
     """
     try:
-        tax_detail = generate_item_wise_tax_detail(sales_invoice_doc)
+        tax_detail = json.loads(generate_item_wise_tax_detail(sales_invoice_doc))
         for single_item in sales_invoice_doc.custom_item:
             _item_tax_amount, item_tax_percentage = get_tax_for_item(
                 tax_detail, single_item.item_code
@@ -804,11 +803,13 @@ def xml_structuring_advance(invoice, sales_invoice_doc):
         )
 
 
-def xml_base64_decode(signed_xmlfile_name):
-    """xml base64 decode"""
+def xml_base64_decode(signed_xml):
+    """base64 of the signed xml, given as bytes from structuring_signedxml or as a file path"""
     try:
+        if isinstance(signed_xml, bytes):
+            return base64.b64encode(signed_xml).decode("utf-8")
         # nosemgrep: frappe-semgrep-rules.rules.security.frappe-security-file-traversal
-        with open(signed_xmlfile_name, "r", encoding="utf-8") as file: 
+        with open(signed_xml, "r", encoding="utf-8") as file: 
             xml = file.read().lstrip()
             base64_encoded = base64.b64encode(xml.encode("utf-8"))
             base64_decoded = base64_encoded.decode("utf-8")
@@ -851,7 +852,7 @@ def error_log():
 
 
 def clearance_api(
-    uuid1, encoded_hash, signed_xmlfile_name, invoice_number, sales_invoice_doc
+    uuid1, encoded_hash, signed_xml, invoice_number, sales_invoice_doc
 ):
     """The clearance api with payload and headeders aand signed xml data"""
     try:
@@ -869,7 +870,7 @@ def clearance_api(
         payload = {
             "invoiceHash": encoded_hash,
             "uuid": uuid1,
-            "invoice": xml_base64_decode(signed_xmlfile_name),
+            "invoice": xml_base64_decode(signed_xml),
         }
 
         if production_csid:
@@ -891,7 +892,7 @@ def clearance_api(
             user=frappe.session.user,
         )
 
-        response = requests.post(
+        response = zatca_post(
             url=get_api_url(company_abbr, base_url="invoices/clearance/single"),
             headers=headers,
             json=payload,
@@ -977,8 +978,7 @@ def clearance_api(
                 frappe.msgprint(msg)
 
                 # Update PIH data without JSON formatting
-            company_doc.custom_pih = encoded_hash
-            company_doc.save(ignore_permissions=True)
+            set_unit_pih(sales_invoice_doc, encoded_hash)
 
             invoice_doc = frappe.get_doc("Advance Sales Invoice", invoice_number)
             invoice_doc.db_set(
@@ -1133,9 +1133,7 @@ def attach_qr_image_advance(qrcodeb64, sales_invoice_doc):
         qr_code = sales_invoice_doc.get("ksa_einv_qr")
         if qr_code and frappe.db.exists({"doctype": "File", "file_url": qr_code}):
             return
-        qr_image = io.BytesIO()
-        qr = qr_create(qrcodeb64, error="L")
-        qr.png(qr_image, scale=8, quiet_zone=1)
+        qr_image = render_qr_png(qrcodeb64)
 
         file_doc = frappe.get_doc(
             {
@@ -1146,7 +1144,7 @@ def attach_qr_image_advance(qrcodeb64, sales_invoice_doc):
                 "attached_to_doctype": sales_invoice_doc.doctype,
                 "attached_to_name": sales_invoice_doc.name,
                 "is_private": 1,
-                "content": qr_image.getvalue(),
+                "content": qr_image,
                 "attached_to_field": "ksa_einv_qr",
             }
         )
@@ -1225,14 +1223,14 @@ def zatca_call(
         qrcodebuf = b"".join(tagsbufsarray)
         qrcodeb64 = base64.b64encode(qrcodebuf).decode("utf-8")
         updated_xml_string= update_qr_toxml(final_xml_string,qrcodeb64, company_abbr)
-        signed_xmlfile_name = structuring_signedxml(invoice_number,updated_xml_string)
+        signed_xml = structuring_signedxml(invoice_number,updated_xml_string)
         if compliance_type == "0":
             # if customer_doc.custom_b2c != 1:
 
             clearance_api(
                 uuid1,
                 encoded_hash,
-                signed_xmlfile_name,
+                signed_xml,
                 invoice_number,
                 sales_invoice_doc,
             )
@@ -1241,7 +1239,7 @@ def zatca_call(
             compliance_api_call(
                 uuid1,
                 encoded_hash,
-                signed_xmlfile_name,
+                signed_xml,
                 company_abbr,
                 source_doc,
             )
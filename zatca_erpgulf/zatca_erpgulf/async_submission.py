@@ -0,0 +1,142 @@
+"""
+Asynchronous submission of invoices to ZATCA on submit.
+When a company submits in a background job, the on_submit hook still validates the
+invoice in the request, then hands signing, clearance or reporting and the PDF/A-3
+to a job enqueued after the commit. One job per invoice is queued at a time and the
+user follows its progress over realtime instead of the loading overlay
+"""
+
+import frappe
+from frappe import _
+from zatca_erpgulf.zatca_erpgulf.event_log import flush_zatca_events
+
+SUBMISSION_QUEUE = "default"
+SUBMISSION_JOB_TIMEOUT = 10 * 60
+PROGRESS_EVENT = "zatca_submission_progress"
+LOADING_GIF_URL = "/assets/zatca_erpgulf/js/loading.gif"
+
+ON_SUBMIT_METHODS = {
+    "Sales Invoice": "zatca_erpgulf.zatca_erpgulf.sign_invoice.zatca_background_on_submit",
+    "POS Invoice": "zatca_erpgulf.zatca_erpgulf.pos_sign.zatca_background_on_submit",
+}
+
+
+def in_submission_job():
+    """whether the current code runs inside the asynchronous submission job"""
+    return bool(frappe.flags.in_zatca_submission_job)
+
+
+def show_gif():
+    """show the loading overlay to the user waiting on the request"""
+    if not in_submission_job():
+        frappe.publish_realtime(
+            "show_gif", {"gif_url": LOADING_GIF_URL}, user=frappe.session.user
+        )
+
+
+def hide_gif():
+    """hide the loading overlay"""
+    if not in_submission_job():
+        frappe.publish_realtime("hide_gif", user=frappe.session.user)
+
+
+def publish_progress(doctype, invoice_name, status, message=None, after_commit=False):
+    """push the state of the submission job of an invoice to the user"""
+    frappe.publish_realtime(
+        PROGRESS_EVENT,
+        {
+            "doctype": doctype,
+            "name": invoice_name,
+            "status": status,
+            "message": message,
+        },
+        user=frappe.session.user,
+        after_commit=after_commit,
+    )
+
+
+def get_submission_job_id(doctype, invoice_name):
+    """job id deduplicating the submission jobs of an invoice"""
+    return f"zatca_submission::{doctype}::{invoice_name}"
+
+
+def enqueue_once(method, job_id, **kwargs):
+    """enqueue a job unless one with the same id is queued or running. Frappe v14 has
+    no job_id or deduplicate on enqueue, the job is named and looked up by name there"""
+    if int(frappe.__version__.split(".", maxsplit=1)[0]) >= 15:
+        return frappe.enqueue(method, job_id=job_id, deduplicate=True, **kwargs)
+    from frappe.utils.background_jobs import is_job_queued
+
+    if is_job_queued(job_id, queue=kwargs.get("queue", "default")):
+        return None
+    return frappe.enqueue(method, job_name=job_id, **kwargs)
+
+
+def enqueue_submission_job(doctype, invoice_name, bypass_background_check=False):
+    """queue the submission job of an invoice to start once the request commits"""
+    enqueue_once(
+        "zatca_erpgulf.zatca_erpgulf.async_submission.submit_invoice",
+        get_submission_job_id(doctype, invoice_name),
+        queue=SUBMISSION_QUEUE,
+        timeout=SUBMISSION_JOB_TIMEOUT,
+        enqueue_after_commit=True,
+        doctype=doctype,
+        invoice_name=invoice_name,
+        bypass_background_check=bypass_background_check,
+    )
+
+
+def enqueue_invoice_submission(invoice_doc, company_doc, bypass_background_check=False):
+    """enqueue the submission of a validated invoice when its company submits in a
+    background job. Returns False when the submission has to run in the request"""
+    if company_doc.custom_zatca_async_submission != 1 or in_submission_job():
+        return False
+    try:
+        enqueue_submission_job(
+            invoice_doc.doctype, invoice_doc.name, bypass_background_check
+        )
+        publish_progress(
+            invoice_doc.doctype,
+            invoice_doc.name,
+            "Queued",
+            _("Invoice queued for submission to ZATCA"),
+            after_commit=True,
+        )
+        return True
+    except (ValueError, TypeError, KeyError, frappe.ValidationError) as e:
+        frappe.throw(_(f"Error in queueing invoice for ZATCA submission: {str(e)}"))
+        return False
+
+
+def submit_invoice(doctype, invoice_name, bypass_background_check=False):
+    """Background job running the on_submit submission of one invoice."""
+    publish_progress(
+        doctype, invoice_name, "Processing", _("Submitting invoice to ZATCA")
+    )
+    frappe.flags.in_zatca_submission_job = True
+    try:
+        invoice_doc = frappe.get_doc(doctype, invoice_name)
+        if invoice_doc.custom_zatca_status in ["REPORTED", "CLEARED"]:
+            publish_progress(doctype, invoice_name, "Completed", invoice_doc.custom_zatca_status)
+            return
+        frappe.get_attr(ON_SUBMIT_METHODS[doctype])(
+            invoice_doc, bypass_background_check=bypass_background_check
+        )
+        frappe.db.commit()
+        zatca_status = frappe.db.get_value(doctype, invoice_name, "custom_zatca_status")
+        publish_progress(doctype, invoice_name, "Completed", zatca_status)
+    except Exception:
+        frappe.db.rollback()
+        frappe.log_error(
+            frappe.get_traceback(), f"ZATCA submission failed for {invoice_name}"
+        )
+        publish_progress(
+            doctype,
+            invoice_name,
+            "Failed",
+            _("ZATCA submission failed, see the Error Log for details"),
+        )
+    finally:
+        frappe.flags.in_zatca_submission_job = False
+        # after_job is not there on Frappe v14
+        flush_zatca_events()
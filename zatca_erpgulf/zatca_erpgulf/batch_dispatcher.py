@@ -0,0 +1,256 @@
+"""
+Batch dispatcher for companies submitting B2C invoices to ZATCA in "Batches" mode.
+Invoices are signed at checkout and queued with the status Batched. The PIH of their
+signing unit moves on at signing time, so the chain is fixed in signing order. The
+dispatcher then reports the queued invoices unit by unit, in that order, in batches
+of the configured size with bounded concurrency and a per-unit rate limit.
+As the invoices after it are already chained to its hash, an invoice that cannot be
+reported is never signed again. One ZATCA rejects keeps its signed xml with the status
+Rejected, to be corrected with a credit or debit note. One that fails on this side has
+the status Failed, and a resubmission puts it back in the queue as it was signed
+"""
+
+import base64
+import time
+import frappe
+from frappe import _
+from frappe.utils import cint, flt
+from lxml import etree
+import requests
+from zatca_erpgulf.zatca_erpgulf.event_log import flush_zatca_events, log_zatca_event
+from zatca_erpgulf.zatca_erpgulf.pih_chain import set_unit_pih
+from zatca_erpgulf.zatca_erpgulf.sign_invoice_first import (
+    SIGNATURE_NAMESPACES,
+    XPATH_INVOICE_DIGEST,
+    get_api_url,
+)
+from zatca_erpgulf.zatca_erpgulf.signing_identity import (
+    SUPPORTED_INVOICES,
+    get_signing_identity,
+)
+from zatca_erpgulf.zatca_erpgulf.submission_queue import (
+    acquire_unit_drain,
+    enqueue_signing_units,
+    get_signing_units,
+)
+from zatca_erpgulf.zatca_erpgulf.zatca_session import zatca_post
+
+BATCHED = "Batched"
+BATCH_REJECTED = "Rejected"
+BATCH_FAILED = "Failed"
+BATCH_STATUSES = [BATCHED, BATCH_REJECTED, BATCH_FAILED]
+DEFAULT_BATCH_SIZE = 50
+
+
+def queue_invoice_for_batch(invoice_doc, company_abbr, uuid1, encoded_hash):
+    """queue a signed simplified invoice for the batch dispatcher and chain the next
+    invoice of its signing unit to it"""
+    try:
+        invoice_doc.db_set({"custom_uuid": uuid1, "custom_zatca_status": BATCHED})
+        set_unit_pih(invoice_doc, encoded_hash)
+        frappe.db.commit()
+    except (ValueError, TypeError, KeyError, frappe.ValidationError) as e:
+        frappe.throw(_(f"Error in queueing invoice for batch submission: {str(e)}"))
+
+
+def dispatch_batched_invoices():
+    """Scheduler entry point, hands the batched invoices of every Batches company to unit jobs."""
+    try:
+        companies = frappe.get_all(
+            "Company",
+            filters={"custom_send_invoice_to_zatca": "Batches"},
+            fields=[
+                "name",
+                "custom_zatca_submission_workers",
+                "custom_zatca_batch_size",
+                "custom_zatca_batch_rate_limit",
+            ],
+        )
+        if not companies:
+            return
+
+        workers_by_company = {
+            company.name: max(cint(company.custom_zatca_submission_workers), 1)
+            for company in companies
+        }
+        for doctype in SUPPORTED_INVOICES:
+            for company in companies:
+                batch_size = cint(company.custom_zatca_batch_size) or DEFAULT_BATCH_SIZE
+                invoices = frappe.get_all(
+                    doctype,
+                    filters={
+                        "company": company.name,
+                        "docstatus": 1,
+                        "custom_zatca_status": BATCHED,
+                    },
+                    fields=["name", "company", "custom_zatca_pos_name"],
+                    order_by="creation asc",
+                )
+                if not invoices:
+                    continue
+                units = {
+                    key: invoice_names[:batch_size]
+                    for key, invoice_names in get_signing_units(invoices).items()
+                }
+                enqueue_signing_units(
+                    "zatca_erpgulf.zatca_erpgulf.batch_dispatcher.submit_batches",
+                    units,
+                    workers_by_company,
+                    doctype=doctype,
+                    rate_limit=flt(company.custom_zatca_batch_rate_limit),
+                )
+    except Exception:
+        frappe.log_error(frappe.get_traceback(), "ZATCA Batch Dispatcher Error")
+
+
+def submit_batches(units, doctype, rate_limit=0):
+    """Background job reporting one batch for each of its signing units.
+    The PIH of a batched invoice is stored when it is signed, so reporting it leaves the
+    signing unit free for the invoices signed meanwhile"""
+    try:
+        for unit, invoice_names in units.items():
+            drain = acquire_unit_drain(unit)
+            if not drain:
+                continue
+            try:
+                submit_batch(doctype, unit, invoice_names, rate_limit)
+            finally:
+                drain.release()
+    finally:
+        # after_job is not there on Frappe v14
+        flush_zatca_events()
+
+
+def submit_batch(doctype, unit, invoice_names, rate_limit=0):
+    """report the invoices of one signing unit in order and record the batch metrics.
+    A transport error or 5xx stops the batch so the rest is retried in order next run,
+    any other error fails only its invoice"""
+    min_interval = 1 / rate_limit if rate_limit > 0 else 0
+    started = time.monotonic()
+    latencies = []
+    reported = rejected = failed = 0
+    deferred = False
+    for invoice_name in invoice_names:
+        request_started = time.monotonic()
+        try:
+            status_code = report_batched_invoice(doctype, invoice_name)
+            if status_code in (200, 202, 409):
+                reported += 1
+            elif status_code < 500:
+                rejected += 1
+            else:
+                deferred = True
+        except requests.exceptions.RequestException:
+            deferred = True
+        except Exception as e:
+            frappe.db.rollback()
+            frappe.log_error(
+                frappe.get_traceback(), f"Error processing invoice {invoice_name}"
+            )
+            hold_back_invoice(
+                doctype, invoice_name, f"Error: {str(e)}", BATCH_FAILED, "Failed"
+            )
+            failed += 1
+        latency = time.monotonic() - request_started
+        latencies.append(latency)
+        frappe.db.commit()
+
+        if deferred:
+            break
+        if latency < min_interval:
+            time.sleep(min_interval - latency)
+
+    elapsed = time.monotonic() - started
+    sent = len(latencies)
+    msg = (
+        f"Signing unit: {unit}<br>"
+        f"Invoices sent: {sent} of {len(invoice_names)}<br>"
+        f"Reported: {reported}<br>"
+        f"Rejected: {rejected}<br>"
+        f"Failed: {failed}<br>"
+        f"Deferred to next run: {len(invoice_names) - reported - rejected - failed}<br>"
+        f"Elapsed: {elapsed:.2f} s<br>"
+        f"Throughput: {sent / elapsed if elapsed else 0:.2f} invoices/s<br>"
+        f"Average latency: {sum(latencies) / sent if sent else 0:.3f} s<br>"
+        f"Max latency: {max(latencies, default=0):.3f} s"
+    )
+    log_zatca_event(
+        invoice_number=f"{doctype} batch {unit}",
+        response_text=msg,
+        status="Batch Failed" if deferred or rejected or failed else "Batch Success",
+        title=f"ZATCA Batch - {unit}",
+    )
+
+
+def report_batched_invoice(doctype, invoice_name):
+    """report one batched invoice from its stored signed xml and return the status code"""
+    invoice_doc = frappe.get_doc(doctype, invoice_name)
+    company_abbr = frappe.db.get_value("Company", invoice_doc.company, "abbr")
+    production_csid = get_signing_identity(company_abbr, invoice_doc).csid
+    if not production_csid:
+        frappe.throw(_(f"Production CSID for company {company_abbr} not found."))
+
+    file_doc = frappe.get_doc("File", {"file_url": invoice_doc.custom_ksa_einvoicing_xml})
+    xml_content = file_doc.get_content()
+    if isinstance(xml_content, str):
+        xml_content = xml_content.encode("utf-8")
+    encoded_hash = etree.fromstring(xml_content).find(
+        XPATH_INVOICE_DIGEST, SIGNATURE_NAMESPACES
+    ).text
+    payload = {
+        "invoiceHash": encoded_hash,
+        "uuid": invoice_doc.custom_uuid,
+        "invoice": base64.b64encode(xml_content).decode("utf-8"),
+    }
+    headers = {
+        "accept": "application/json",
+        "accept-language": "en",
+        "Clearance-Status": "0",
+        "Accept-Version": "V2",
+        "Authorization": "Basic " + production_csid,
+        "Content-Type": "application/json",
+    }
+    response = zatca_post(
+        url=get_api_url(company_abbr, base_url="invoices/reporting/single"),
+        headers=headers,
+        json=payload,
+        timeout=300,
+    )
+    msg = f"Status Code: {response.status_code}<br>ZATCA Response: {response.text}"
+    if response.status_code in (200, 202, 409):
+        invoice_doc.db_set(
+            {"custom_zatca_full_response": msg, "custom_zatca_status": "REPORTED"}
+        )
+        log_zatca_event(
+            invoice_number=invoice_name,
+            response_text=msg,
+            status="Success" if response.status_code == 200 else "Warning",
+            uuid=invoice_doc.custom_uuid,
+            title=f"ZATCA Batch Success - {invoice_name}",
+        )
+    elif response.status_code < 500:
+        hold_back_invoice(
+            doctype,
+            invoice_name,
+            msg,
+            BATCH_REJECTED,
+            f"Failed (HTTP {response.status_code})",
+        )
+    return response.status_code
+
+
+def hold_back_invoice(doctype, invoice_name, msg, zatca_status, event_status):
+    """take an invoice that could not be reported out of the batch queue. Its uuid and
+    signed xml are kept, the invoices signed after it are chained to its hash"""
+    frappe.db.set_value(
+        doctype,
+        invoice_name,
+        {"custom_zatca_full_response": msg, "custom_zatca_status": zatca_status},
+    )
+    log_zatca_event(
+        invoice_number=invoice_name,
+        response_text=msg,
+        status=event_status,
+        uuid=frappe.db.get_value(doctype, invoice_name, "custom_uuid"),
+        title=f"ZATCA Batch Failed - {invoice_name}",
+    )
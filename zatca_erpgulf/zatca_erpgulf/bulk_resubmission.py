@@ -0,0 +1,275 @@
+"""
+Bulk resubmission of selected invoices to ZATCA from the list view.
+The selected invoices are grouped into signing units and handed to background jobs,
+at most the company's number of submission workers at a time, each unit in creation
+order so its ICV/PIH chain stays ordered. Every outcome is recorded under a job handle
+and pushed to the user, so the list view can follow thousands of invoices
+"""
+
+import frappe
+from frappe import _
+from frappe.utils import cint
+from zatca_erpgulf.zatca_erpgulf.async_submission import ON_SUBMIT_METHODS
+from zatca_erpgulf.zatca_erpgulf.batch_dispatcher import (
+    BATCHED,
+    BATCH_FAILED,
+    BATCH_REJECTED,
+)
+from zatca_erpgulf.zatca_erpgulf.event_log import flush_zatca_events
+from zatca_erpgulf.zatca_erpgulf.signing_identity import SUPPORTED_INVOICES
+from zatca_erpgulf.zatca_erpgulf.zatca_config import get_company_config
+from zatca_erpgulf.zatca_erpgulf.submission_queue import (
+    UNIT_WAIT,
+    acquire_signing_unit,
+    acquire_unit_drain,
+    enqueue_signing_units,
+    get_signing_units,
+    hand_over_signing_unit,
+    release_signing_unit,
+    SUBMISSION_JOB_TIMEOUT,
+)
+
+PROGRESS_EVENT = "zatca_resubmission_progress"
+# a clearance or reporting call may take up to its 300 s timeout, most take a second
+INVOICE_TIMEOUT = 30
+UNIT_LOCK_WAIT = 5 * 60
+RESULT_EXPIRY = 24 * 60 * 60
+
+
+def get_result_key(job_id):
+    """cache key of the outcomes recorded for a resubmission job"""
+    return f"zatca_resubmission|{job_id}"
+
+
+def enqueue_resubmission(doctype, invoice_numbers, bypass_background_check=True):
+    """queue the resubmission of the given invoices and return the job handle"""
+    if doctype not in SUPPORTED_INVOICES:
+        frappe.throw(_(f"Resubmission is not supported for {doctype}"))
+    return enqueue_invoice_units(
+        "zatca_erpgulf.zatca_erpgulf.bulk_resubmission.resubmit_units",
+        doctype,
+        invoice_numbers,
+        bypass_background_check=bypass_background_check,
+    )
+
+
+def enqueue_invoice_units(method, doctype, invoice_numbers, **kwargs):
+    """group the given invoices into signing units, queue method over them and return
+    the job handle. The job gets the handle as resubmission_id to record its outcomes"""
+    if isinstance(invoice_numbers, str):
+        invoice_numbers = frappe.parse_json(invoice_numbers)
+    invoice_numbers = list(dict.fromkeys(invoice_numbers))
+    if not invoice_numbers:
+        frappe.throw(_("Please select at least one invoice."))
+
+    job_id = frappe.generate_hash(length=12)
+    invoices = frappe.get_all(
+        doctype,
+        filters={"name": ["in", invoice_numbers]},
+        fields=["name", "company", "custom_zatca_pos_name"],
+        order_by="creation asc",
+    )
+    frappe.cache().set_value(
+        get_result_key(job_id),
+        {"doctype": doctype, "total": len(invoice_numbers), "user": frappe.session.user},
+        expires_in_sec=RESULT_EXPIRY,
+    )
+    found = {invoice.name for invoice in invoices}
+    for invoice_name in invoice_numbers:
+        if invoice_name not in found:
+            record_outcome(job_id, doctype, invoice_name, "Failed", _("Invoice not found"))
+
+    if invoices:
+        companies = list({invoice.company for invoice in invoices})
+        workers_by_company = {
+            company.name: max(cint(company.custom_zatca_submission_workers), 1)
+            for company in frappe.get_all(
+                "Company",
+                filters={"name": ["in", companies]},
+                fields=["name", "custom_zatca_submission_workers"],
+            )
+        }
+        enqueue_signing_units(
+            method,
+            get_signing_units(invoices),
+            workers_by_company,
+            timeout=max(SUBMISSION_JOB_TIMEOUT, len(invoices) * INVOICE_TIMEOUT),
+            doctype=doctype,
+            resubmission_id=job_id,
+            **kwargs,
+        )
+    return {"job_id": job_id, "total": len(invoice_numbers)}
+
+
+@frappe.whitelist()
+def get_resubmission_progress(job_id: str):
+    """outcomes recorded so far for a resubmission job"""
+    meta = frappe.cache().get_value(get_result_key(job_id))
+    if not meta:
+        frappe.throw(_(f"Resubmission job {job_id} not found or expired."))
+    if meta["user"] != frappe.session.user and "System Manager" not in frappe.get_roles():
+        frappe.throw(_("Not permitted to view this resubmission job."), frappe.PermissionError)
+    outcomes = {
+        frappe.safe_decode(invoice_name): outcome
+        for invoice_name, outcome in (
+            frappe.cache().hgetall(get_result_key(job_id) + "|outcomes") or {}
+        ).items()
+    }
+    return {
+        "job_id": job_id,
+        "doctype": meta["doctype"],
+        "total": meta["total"],
+        "done": len(outcomes),
+        "outcomes": outcomes,
+    }
+
+
+def record_outcome(job_id, doctype, invoice_name, status, message=None):
+    """record the outcome of one invoice and push it with the job progress to the user"""
+    key = get_result_key(job_id) + "|outcomes"
+    cache = frappe.cache()
+    cache.hset(key, invoice_name, {"status": status, "message": message})
+    cache.expire(cache.make_key(key), RESULT_EXPIRY)
+    meta = cache.get_value(get_result_key(job_id)) or {}
+    frappe.publish_realtime(
+        PROGRESS_EVENT,
+        {
+            "job_id": job_id,
+            "doctype": doctype,
+            "name": invoice_name,
+            "status": status,
+            "message": message,
+            "done": cache.hlen(cache.make_key(key)),
+            "total": meta.get("total"),
+        },
+        user=frappe.session.user,
+    )
+
+
+def acquire_unit_lock(unit, invoice_names, doctype, resubmission_id):
+    """take a signing unit to drain for the time its invoices take, None with every
+    invoice failed when another job keeps draining the unit"""
+    drain = acquire_unit_drain(
+        unit,
+        timeout=len(invoice_names) * INVOICE_TIMEOUT + SUBMISSION_JOB_TIMEOUT,
+        blocking_timeout=UNIT_LOCK_WAIT,
+    )
+    if drain:
+        return drain
+    fail_unit_invoices(
+        invoice_names,
+        doctype,
+        resubmission_id,
+        _(f"Signing unit {unit} is busy with another submission, try again later"),
+    )
+    return None
+
+
+def fail_unit_invoices(invoice_names, doctype, resubmission_id, reason):
+    """record the invoices of a signing unit that could not be submitted as failed"""
+    for invoice_name in invoice_names:
+        record_outcome(resubmission_id, doctype, invoice_name, "Failed", reason)
+
+
+def drain_unit_invoices(unit, invoice_names, doctype, resubmission_id, submit):
+    """run submit(invoice_name) for the invoices of a signing unit in order, holding the
+    unit one invoice at a time so submissions from requests are not held up"""
+    for position, invoice_name in enumerate(invoice_names):
+        if not acquire_signing_unit(unit, blocking_timeout=UNIT_WAIT):
+            fail_unit_invoices(
+                invoice_names[position:],
+                doctype,
+                resubmission_id,
+                _(f"Signing unit {unit} is busy with another submission, try again later"),
+            )
+            return
+        try:
+            submit(invoice_name)
+        finally:
+            release_signing_unit(unit)
+        hand_over_signing_unit(unit)
+
+
+def resubmit_units(units, doctype, resubmission_id, bypass_background_check=True):
+    """Background job resubmitting the invoices of its signing units in order."""
+    frappe.flags.in_zatca_submission_job = True
+    try:
+        for unit, invoice_names in units.items():
+            drain = acquire_unit_lock(unit, invoice_names, doctype, resubmission_id)
+            if not drain:
+                continue
+            try:
+                drain_unit_invoices(
+                    unit,
+                    invoice_names,
+                    doctype,
+                    resubmission_id,
+                    lambda invoice_name: resubmit_invoice(
+                        doctype, invoice_name, resubmission_id, bypass_background_check
+                    ),
+                )
+            finally:
+                drain.release()
+    finally:
+        frappe.flags.in_zatca_submission_job = False
+        # after_job is not there on Frappe v14
+        flush_zatca_events()
+
+
+def resubmit_invoice(doctype, invoice_name, resubmission_id, bypass_background_check=True):
+    """submit a draft or resend a submitted invoice, an error only fails this invoice"""
+    try:
+        invoice_doc = frappe.get_doc(doctype, invoice_name)
+        if invoice_doc.custom_zatca_status in ["REPORTED", "CLEARED"]:
+            record_outcome(
+                resubmission_id,
+                doctype,
+                invoice_name,
+                "Skipped",
+                invoice_doc.custom_zatca_status,
+            )
+            return
+        if invoice_doc.custom_zatca_status == BATCH_REJECTED:
+            record_outcome(
+                resubmission_id,
+                doctype,
+                invoice_name,
+                "Skipped",
+                _("Rejected in a batch, correct it with a credit or debit note"),
+            )
+            return
+        if invoice_doc.custom_zatca_status == BATCH_FAILED:
+            # signed already, the invoices after it are chained to its hash
+            invoice_doc.db_set("custom_zatca_status", BATCHED)
+            frappe.db.commit()
+            record_outcome(resubmission_id, doctype, invoice_name, "Completed", BATCHED)
+            return
+        if invoice_doc.docstatus == 1:
+            frappe.get_attr(ON_SUBMIT_METHODS[doctype])(
+                invoice_doc, bypass_background_check=bypass_background_check
+            )
+        elif (
+            invoice_doc.docstatus == 0
+            and get_company_config(invoice_doc.company).custom_submit_or_not == 1
+            and frappe.get_cached_value("Customer", invoice_doc.customer, "custom_b2c") == 1
+        ):
+            invoice_doc.submit()
+        else:
+            record_outcome(
+                resubmission_id, doctype, invoice_name, "Skipped", _("Invoice is not submitted")
+            )
+            return
+        frappe.db.commit()
+        record_outcome(
+            resubmission_id,
+            doctype,
+            invoice_name,
+            "Completed",
+            frappe.db.get_value(doctype, invoice_name, "custom_zatca_status"),
+        )
+    except Exception as e:
+        frappe.db.rollback()
+        frappe.log_error(
+            frappe.get_traceback(), f"Error processing invoice {invoice_name}"
+        )
+        record_outcome(resubmission_id, doctype, invoice_name, "Failed", str(e))
@@ -15,11 +15,10 @@ If not, it creates the custom field dynamically.
 - Ensure no duplicate QR code generation by checking if a QR code already exists.
 - Collect required invoice data, validate it, and encode it into the TLV format.
 - Convert the TLV data into a Base64 string.
-- Generate a QR code image using the `pyqrcode` library and attach it to the document.
+- Render the QR code image through the shared `qr_image` renderer and attach it to the document.
 
 """
 
-import io
 import os
 from base64 import b64encode
 
@@ -27,7 +26,7 @@ import frappe
 from frappe import _
 from frappe.custom.doctype.custom_field.custom_field import create_custom_fields
 from frappe.utils.data import add_to_date, get_time, getdate
-from pyqrcode import create as qr_create
+from zatca_erpgulf.zatca_erpgulf.qr_image import render_qr_png
 
 from erpnext import get_region
 
@@ -135,9 +134,7 @@ def create_qr_code(doc, method=None):  # pylint: disable=unused-argument
         # base64 conversion for QR Code
         base64_string = b64encode(bytes.fromhex(tlv_buff)).decode()
 
-        qr_image = io.BytesIO()
-        url = qr_create(base64_string, error="L")
-        url.png(qr_image, scale=8, quiet_zone=1)
+        qr_image = render_qr_png(base64_string)
         # making file
         filename = f"QR-Phase1-{doc.name}.png".replace(os.path.sep, "__")
         _file = frappe.get_doc(
@@ -145,7 +142,7 @@ def create_qr_code(doc, method=None):  # pylint: disable=unused-argument
                 "doctype": "File",
                 "file_name": filename,
                 "is_private": 0,
-                "content": qr_image.getvalue(),
+                "content": qr_image,
                 "attached_to_doctype": doc.get("doctype"),
                 "attached_to_name": doc.get("name"),
                 "attached_to_field": "ksa_einv_qr",
@@ -5,17 +5,23 @@ Includes functions for XML parsing, API interactions, and custom handling.
 
 from decimal import Decimal, ROUND_DOWN
 import xml.etree.ElementTree as ET
-from xml.dom import minidom
 from datetime import datetime
+from lxml import etree
 from frappe.utils.data import get_time
 from decimal import Decimal, ROUND_HALF_UP
 import frappe
-import json
 from frappe import _
 from zatca_erpgulf.zatca_erpgulf.xml_tax_data import (
+    get_item_tax_index,
+    get_item_tax_templates,
     get_tax_for_item,
     get_exemption_reason_map,
 )
+from zatca_erpgulf.zatca_erpgulf.line_amounts import (
+    get_sales_line_amounts,
+    get_sales_template_line_amounts,
+    get_tax_category_code,
+)
 
 
 ITEM_TAX_TEMPLATE = "Item Tax Template"
@@ -33,6 +39,7 @@ def tax_data_with_template_nominal(invoice, sales_invoice_doc):
     item tax template
     """
     try:
+        item_tax_templates = get_item_tax_templates(sales_invoice_doc)
         # For SAR currency
         if sales_invoice_doc.currency == "SAR":
             cac_taxtotal = ET.SubElement(invoice, CAC_TAX_TOTAL)
@@ -72,9 +79,7 @@ def tax_data_with_template_nominal(invoice, sales_invoice_doc):
         tax_category_totals = {}
 
         for item in sales_invoice_doc.items:
-            item_tax_template = frappe.get_doc(
-                ITEM_TAX_TEMPLATE, item.item_tax_template
-            )
+            item_tax_template = item_tax_templates[item.item_tax_template]
             zatca_tax_category = item_tax_template.custom_zatca_tax_category
 
             if zatca_tax_category not in tax_category_totals:
@@ -103,9 +108,7 @@ def tax_data_with_template_nominal(invoice, sales_invoice_doc):
         )
 
         for item in sales_invoice_doc.items:
-            item_tax_template = frappe.get_doc(
-                ITEM_TAX_TEMPLATE, item.item_tax_template
-            )
+            item_tax_template = item_tax_templates[item.item_tax_template]
             zatca_tax_category = item_tax_template.custom_zatca_tax_category
 
             if zatca_tax_category not in tax_category_totals:
@@ -613,32 +616,20 @@ def add_line_item_discount(cac_price, single_item, sales_invoice_doc):
         frappe.throw(_(f"Error occurred while adding line item discount: {str(error)}"))
         return None
 
-def get_tax_wise_detail(sales_invoice_doc,single_item):
-    """getting item wise tax"""
-    if int(frappe.__version__.split(".", 1)[0]) == 16 and sales_invoice_doc.item_wise_tax_details:
-                tax_rate = float(f"{sales_invoice_doc.item_wise_tax_details[0].rate:.1f}")
-                tax_amount = sales_invoice_doc.item_wise_tax_details[0].amount
-
-                # build JSON exactly like v15
-                tax_json = json.dumps({
-                    single_item.item_code: [tax_rate, float(tax_amount)]
-                })
-    else:
-        tax_json = sales_invoice_doc.taxes[0].item_wise_tax_detail
-    return tax_json
-
-def item_data(invoice, sales_invoice_doc):
+def iter_item_lines(sales_invoice_doc):
     """
-    The function defines the xml creating without item tax template
+    <cac:InvoiceLine> elements without item tax template, built one line at a time
     """
     try:
         qty = "cbc:BaseQuantity"
-        for single_item in sales_invoice_doc.items:
-            tax_json = get_tax_wise_detail(sales_invoice_doc,single_item)
-            _item_tax_amount, item_tax_percentage = get_tax_for_item(
-                tax_json , single_item.item_code
-            )
-            cac_invoiceline = ET.SubElement(invoice, "cac:InvoiceLine")
+        line_amounts = get_sales_line_amounts(sales_invoice_doc)
+        tax_category_code = get_tax_category_code(sales_invoice_doc.custom_zatca_tax_category)
+        submit_line_item_discount = (
+            sales_invoice_doc.custom_zatca_nominal_invoice != 1
+            and sales_invoice_doc.custom_submit_line_item_discount_to_zatca == 1
+        )
+        for single_item, amounts in zip(sales_invoice_doc.items, line_amounts):
+            cac_invoiceline = ET.Element("cac:InvoiceLine")
             cbc_id_10 = ET.SubElement(cac_invoiceline, "cbc:ID")
             cbc_id_10.text = str(single_item.idx)
             cbc_invoicedquantity = ET.SubElement(
@@ -650,70 +641,15 @@ def item_data(invoice, sales_invoice_doc):
                 cac_invoiceline, "cbc:LineExtensionAmount"
             )
             cbc_lineextensionamount_1.set("currencyID", sales_invoice_doc.currency)
-
-            if sales_invoice_doc.currency == "SAR":
-                if sales_invoice_doc.taxes[0].included_in_print_rate == 0:
-                    # Tax is not included in print rate
-                    cbc_lineextensionamount_1.text = str(abs(single_item.base_amount))
-                elif sales_invoice_doc.taxes[0].included_in_print_rate == 1:
-                    # Tax is included in print rate
-                    cbc_lineextensionamount_1.text = str(
-                        abs(
-                            round(
-                                single_item.base_amount
-                                / (1 + sales_invoice_doc.taxes[0].rate / 100),
-                                2,
-                            )
-                        )
-                    )
-                    
-            else:
-                # For other currencies
-                if sales_invoice_doc.taxes[0].included_in_print_rate == 0:
-                    cbc_lineextensionamount_1.text = str(abs(single_item.amount))
-                else:
-
-                    cbc_lineextensionamount_1.text = str(
-                        abs(
-                            round(
-                                single_item.amount
-                                / (1 + sales_invoice_doc.taxes[0].rate / 100),
-                                2,
-                            )
-                        )
-                    )
+            cbc_lineextensionamount_1.text = amounts.line_extension
 
             cac_taxtotal_2 = ET.SubElement(cac_invoiceline, CAC_TAX_TOTAL)
             cbc_taxamount_3 = ET.SubElement(cac_taxtotal_2, CBC_TAX_AMOUNT)
             cbc_taxamount_3.set("currencyID", sales_invoice_doc.currency)
-            if sales_invoice_doc.taxes[0].included_in_print_rate == 1:
-                cbc_taxamount_3.text = str(
-                    abs(
-                        round(
-                            single_item.base_amount
-                            * sales_invoice_doc.taxes[0].rate
-                            / (100 + sales_invoice_doc.taxes[0].rate),
-                            2,
-                        )
-                    )
-                )
-
-            else:
-                # cbc_taxamount_3.text = str(
-                #     abs(custom_round(item_tax_percentage * single_item.amount / 100))
-                # )
-
-                cbc_taxamount_3.text = str(
-                    Decimal(
-                        str(abs(item_tax_percentage * single_item.amount / 100))
-                    ).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
-                )
+            cbc_taxamount_3.text = amounts.tax_amount
             cbc_roundingamount = ET.SubElement(cac_taxtotal_2, "cbc:RoundingAmount")
             cbc_roundingamount.set("currencyID", sales_invoice_doc.currency)
-            lineextensionamount = float(cbc_lineextensionamount_1.text)
-            taxamount = float(cbc_taxamount_3.text)
-            # frappe.throw(f"Tax Amount1: {taxamount}")
-            cbc_roundingamount.text = str(round(lineextensionamount + taxamount, 2))
+            cbc_roundingamount.text = amounts.rounding_amount
             cac_item = ET.SubElement(cac_invoiceline, "cac:Item")
             cbc_name = ET.SubElement(cac_item, "cbc:Name")
             cbc_name.text = f"{single_item.item_code}:{single_item.item_name}"
@@ -722,90 +658,36 @@ def item_data(invoice, sales_invoice_doc):
                 cac_item, "cac:ClassifiedTaxCategory"
             )
             cbc_id_11 = ET.SubElement(cac_classifiedtaxcategory, "cbc:ID")
-            if sales_invoice_doc.custom_zatca_tax_category == "Standard":
-                cbc_id_11.text = "S"
-            elif sales_invoice_doc.custom_zatca_tax_category == ZERO_RATED:
-                cbc_id_11.text = "Z"
-            elif sales_invoice_doc.custom_zatca_tax_category == "Exempted":
-                cbc_id_11.text = "E"
-            elif sales_invoice_doc.custom_zatca_tax_category == OUTSIDE_SCOPE:
-                cbc_id_11.text = "O"
+            cbc_id_11.text = tax_category_code
             cbc_percent_2 = ET.SubElement(cac_classifiedtaxcategory, "cbc:Percent")
-            cbc_percent_2.text = f"{float(item_tax_percentage):.2f}"
+            cbc_percent_2.text = f"{float(amounts.tax_percentage):.2f}"
             cac_taxscheme_4 = ET.SubElement(cac_classifiedtaxcategory, "cac:TaxScheme")
             cbc_id_12 = ET.SubElement(cac_taxscheme_4, "cbc:ID")
             cbc_id_12.text = "VAT"
             cac_price = ET.SubElement(cac_invoiceline, "cac:Price")
             cbc_priceamount = ET.SubElement(cac_price, "cbc:PriceAmount")
             cbc_priceamount.set("currencyID", sales_invoice_doc.currency)
-            if sales_invoice_doc.custom_zatca_nominal_invoice == 1:
-                # Case 1: Nominal Invoice, Tax Not Included in Print Rate
-                if sales_invoice_doc.taxes[0].included_in_print_rate == 0:
-                    cbc_priceamount.text = str(abs(single_item.rate))
-                # Case 2: Nominal Invoice, Tax Included in Print Rate
-                elif sales_invoice_doc.taxes[0].included_in_print_rate == 1:
-                    cbc_priceamount.text = str(
-                        abs(
-                            round(
-                                single_item.rate
-                                / (1 + sales_invoice_doc.taxes[0].rate / 100),
-                                2,
-                            )
-                        )
-                    )
-            else:
-                # Handle other cases based on ZATCA line item discount submission
-                if sales_invoice_doc.custom_submit_line_item_discount_to_zatca != 1:
-                    # Case 3: No Discount Submission to ZATCA, Tax Not Included in Print Rate
-                    if sales_invoice_doc.taxes[0].included_in_print_rate == 0:
-                        cbc_priceamount.text = str(abs(single_item.rate))
-                    # Case 4: No Discount Submission to ZATCA, Tax Included in Print Rate
-                    elif sales_invoice_doc.taxes[0].included_in_print_rate == 1:
-                        cbc_priceamount.text = str(
-                            abs(
-                                round(
-                                    single_item.rate
-                                    / (1 + sales_invoice_doc.taxes[0].rate / 100),
-                                    2,
-                                )
-                            )
-                        )
-                else:
-                    # Case 5: Discount Submission to ZATCA, Tax Not Included in Print Rate
-                    if sales_invoice_doc.taxes[0].included_in_print_rate == 0:
-                        cbc_priceamount.text = str(abs(single_item.rate))
-                        cbc_basequantity = ET.SubElement(
-                            cac_price, qty, unitCode=str(single_item.uom)
-                        )
-                        cbc_basequantity.text = "1"
-                        add_line_item_discount(
-                            cac_price, single_item, sales_invoice_doc
-                        )
-                    # Case 6: Discount Submission to ZATCA, Tax Included in Print Rate
-                    elif sales_invoice_doc.taxes[0].included_in_print_rate == 1:
-                        cbc_priceamount.text = str(
-                            abs(
-                                round(
-                                    single_item.rate
-                                    / (1 + sales_invoice_doc.taxes[0].rate / 100),
-                                    2,
-                                )
-                            )
-                        )
-                        cbc_basequantity = ET.SubElement(
-                            cac_price, qty, unitCode=str(single_item.uom)
-                        )
-                        cbc_basequantity.text = "1"
-                        add_line_item_discount(
-                            cac_price, single_item, sales_invoice_doc
-                        )
-
-        return invoice
+            cbc_priceamount.text = amounts.price_amount
+            if submit_line_item_discount:
+                cbc_basequantity = ET.SubElement(
+                    cac_price, qty, unitCode=str(single_item.uom)
+                )
+                cbc_basequantity.text = "1"
+                add_line_item_discount(cac_price, single_item, sales_invoice_doc)
+            yield cac_invoiceline
     except (ValueError, KeyError, TypeError) as e:
         frappe.throw(_(f"Error occurred in item data processing: {str(e)}"))
         return None
 
 
+def item_data(invoice, sales_invoice_doc):
+    """
+    The function defines the xml creating without item tax template
+    """
+    invoice.extend(iter_item_lines(sales_invoice_doc))
+    return invoice
+
+
 def item_data_advance_invoice(invoice, sales_invoice_doc):
     """
     Generate <cac:InvoiceLine> XML nodes for standard and advance invoice items.
@@ -814,10 +696,10 @@ def item_data_advance_invoice(invoice, sales_invoice_doc):
         qty = "cbc:BaseQuantity"
 
         # Add regular item lines
+        tax_index = get_item_tax_index(sales_invoice_doc)
         for single_item in sales_invoice_doc.items:
-            tax_json = get_tax_wise_detail(sales_invoice_doc,single_item)
             _item_tax_amount, item_tax_percentage = get_tax_for_item(
-                tax_json , single_item.item_code
+                tax_index, single_item.item_code
             )
 
             # === Invoice Line ===
@@ -1039,19 +921,20 @@ def custom_round(value):
         return float(decimal_value.quantize(Decimal("0.01"), rounding=ROUND_DOWN))
 
 
-def item_data_with_template(invoice, sales_invoice_doc):
-    """The defining of xml item data according to the item tax template datas and feilds"""
+def iter_item_lines_with_template(sales_invoice_doc):
+    """<cac:InvoiceLine> elements with item tax template, built one line at a time"""
     try:
         qty = "cbc:BaseQuantity"
-        for single_item in sales_invoice_doc.items:
-            item_tax_template = frappe.get_doc(
-                ITEM_TAX_TEMPLATE, single_item.item_tax_template
-            )
-            item_tax_percentage = (
-                item_tax_template.taxes[0].tax_rate if item_tax_template.taxes else 15
-            )
+        item_tax_templates = get_item_tax_templates(sales_invoice_doc)
+        line_amounts = get_sales_template_line_amounts(sales_invoice_doc)
+        submit_line_item_discount = (
+            sales_invoice_doc.custom_zatca_nominal_invoice != 1
+            and sales_invoice_doc.custom_submit_line_item_discount_to_zatca == 1
+        )
+        for single_item, amounts in zip(sales_invoice_doc.items, line_amounts):
+            item_tax_template = item_tax_templates[single_item.item_tax_template]
 
-            cac_invoiceline = ET.SubElement(invoice, "cac:InvoiceLine")
+            cac_invoiceline = ET.Element("cac:InvoiceLine")
             cbc_id_10 = ET.SubElement(cac_invoiceline, "cbc:ID")
             cbc_id_10.text = str(single_item.idx)
             cbc_invoicedquantity = ET.SubElement(
@@ -1063,34 +946,15 @@ def item_data_with_template(invoice, sales_invoice_doc):
                 cac_invoiceline, "cbc:LineExtensionAmount"
             )
             cbc_lineextensionamount_1.set("currencyID", sales_invoice_doc.currency)
-            cbc_lineextensionamount_1.text = str(abs(single_item.amount))
+            cbc_lineextensionamount_1.text = amounts.line_extension
 
             cac_taxtotal_2 = ET.SubElement(cac_invoiceline, CAC_TAX_TOTAL)
             cbc_taxamount_3 = ET.SubElement(cac_taxtotal_2, CBC_TAX_AMOUNT)
             cbc_taxamount_3.set("currencyID", sales_invoice_doc.currency)
-            cbc_taxamount_3.text = str(
-                abs(
-                    (
-                        Decimal(str(item_tax_percentage))
-                        * Decimal(str(single_item.amount))
-                        / Decimal("100")
-                    ).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
-                )
-            )
+            cbc_taxamount_3.text = amounts.tax_amount
             cbc_roundingamount = ET.SubElement(cac_taxtotal_2, "cbc:RoundingAmount")
             cbc_roundingamount.set("currencyID", sales_invoice_doc.currency)
-            cbc_roundingamount.text = str(
-                abs(
-                    (
-                        Decimal(str(single_item.amount))
-                        + (
-                            Decimal(str(item_tax_percentage))
-                            * Decimal(str(single_item.amount))
-                            / Decimal("100")
-                        )
-                    ).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
-                )
-            )
+            cbc_roundingamount.text = amounts.rounding_amount
             cac_item = ET.SubElement(cac_invoiceline, "cac:Item")
             cbc_name = ET.SubElement(cac_item, "cbc:Name")
             cbc_name.text = f"{single_item.item_code}:{single_item.item_name}"
@@ -1099,18 +963,12 @@ def item_data_with_template(invoice, sales_invoice_doc):
                 cac_item, "cac:ClassifiedTaxCategory"
             )
             cbc_id_11 = ET.SubElement(cac_classifiedtaxcategory, "cbc:ID")
-            zatca_tax_category = item_tax_template.custom_zatca_tax_category
-            if zatca_tax_category == "Standard":
-                cbc_id_11.text = "S"
-            elif zatca_tax_category == ZERO_RATED:
-                cbc_id_11.text = "Z"
-            elif zatca_tax_category == "Exempted":
-                cbc_id_11.text = "E"
-            elif zatca_tax_category == OUTSIDE_SCOPE:
-                cbc_id_11.text = "O"
+            cbc_id_11.text = get_tax_category_code(
+                item_tax_template.custom_zatca_tax_category
+            )
 
             cbc_percent_2 = ET.SubElement(cac_classifiedtaxcategory, "cbc:Percent")
-            cbc_percent_2.text = f"{float(item_tax_percentage):.2f}"
+            cbc_percent_2.text = f"{float(amounts.tax_percentage):.2f}"
 
             cac_taxscheme_4 = ET.SubElement(cac_classifiedtaxcategory, "cac:TaxScheme")
             cbc_id_12 = ET.SubElement(cac_taxscheme_4, "cbc:ID")
@@ -1119,39 +977,33 @@ def item_data_with_template(invoice, sales_invoice_doc):
             cac_price = ET.SubElement(cac_invoiceline, "cac:Price")
             cbc_priceamount = ET.SubElement(cac_price, "cbc:PriceAmount")
             cbc_priceamount.set("currencyID", sales_invoice_doc.currency)
-
-            if sales_invoice_doc.custom_zatca_nominal_invoice == 1:
-                # If nominal invoice, only set cbc_PriceAmount
-                cbc_priceamount.text = f"{abs(single_item.rate):.6f}"
-            else:
-                # Check for line item discount submission to ZATCA
-                if sales_invoice_doc.custom_submit_line_item_discount_to_zatca != 1:
-                    # No discount submission to ZATCA
-                    cbc_priceamount.text = f"{abs(single_item.rate):.6f}"
-                elif sales_invoice_doc.custom_submit_line_item_discount_to_zatca == 1:
-                    # Discount submission to ZATCA
-                    cbc_priceamount.text = f"{abs(single_item.rate):.6f}"
-                    cbc_basequantity = ET.SubElement(
-                        cac_price, qty, unitCode=str(single_item.uom)
-                    )
-                    cbc_basequantity.text = "1"
-                    add_line_item_discount(cac_price, single_item, sales_invoice_doc)
-
-        return invoice
+            cbc_priceamount.text = amounts.price_amount
+            if submit_line_item_discount:
+                cbc_basequantity = ET.SubElement(
+                    cac_price, qty, unitCode=str(single_item.uom)
+                )
+                cbc_basequantity.text = "1"
+                add_line_item_discount(cac_price, single_item, sales_invoice_doc)
+            yield cac_invoiceline
     except (ValueError, KeyError, TypeError) as e:
         frappe.throw(_(f"Error occurred in item template data processing: {str(e)}"))
         return None
 
 
+def item_data_with_template(invoice, sales_invoice_doc):
+    """The defining of xml item data according to the item tax template datas and feilds"""
+    invoice.extend(iter_item_lines_with_template(sales_invoice_doc))
+    return invoice
+
+
 def item_data_with_template_advance_invoice(invoice, sales_invoice_doc):
     """The defining of xml item data according to the item tax template datas and feilds"""
     try:
+        item_tax_templates = get_item_tax_templates(sales_invoice_doc)
         qty = "cbc:BaseQuantity"
 
         for single_item in sales_invoice_doc.items:
-            item_tax_template = frappe.get_doc(
-                ITEM_TAX_TEMPLATE, single_item.item_tax_template
-            )
+            item_tax_template = item_tax_templates[single_item.item_tax_template]
             item_tax_percentage = (
                 item_tax_template.taxes[0].tax_rate if item_tax_template.taxes else 15
             )
@@ -1386,11 +1238,10 @@ def xml_structuring(invoice):
         # # Read the XML file and format it
         # with open(xml_file_path, "r", encoding="utf-8") as file:
             # xml_string = file.read()
-        xml_string = ET.tostring(invoice, encoding="utf-8", method="xml")
-
-        # Format the XML string to make it pretty
-        xml_dom = minidom.parseString(xml_string)
-        pretty_xml_string = xml_dom.toprettyxml(indent="  ")
+        # pretty-printed from the same lxml tree the signing steps use, no minidom copy
+        pretty_xml_string = etree.tostring(
+            xml_structuring_tree(invoice), encoding="unicode", pretty_print=True
+        )
 
         # Write the formatted XML to the final file
         # final_xml_path = f"{frappe.local.site}/private/files/finalzatcaxml_{invoice_number}.xml"
@@ -1421,3 +1272,23 @@ def xml_structuring(invoice):
                 "Please contact your system administrator."
             )
         )
+
+
+def xml_structuring_tree(invoice):
+    """
+    Xml structuring into a single lxml tree with the same layout as xml_structuring,
+    so the signing steps can work on it in place without re-parsing
+    """
+    try:
+        root = etree.fromstring(ET.tostring(invoice, encoding="utf-8", method="xml"))
+        etree.indent(root, space="  ")
+        return root
+    except etree.XMLSyntaxError:
+        frappe.throw(
+            _(
+                "Error occurred in XML parsing or formatting. "
+                "Please check the XML structure for errors. "
+                "If the problem persists, contact your system administrator."
+            )
+        )
+        return None
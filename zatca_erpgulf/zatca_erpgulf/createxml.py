@@ -10,9 +10,12 @@ from frappe import _
 import frappe
 from frappe.utils.data import get_time
 from zatca_erpgulf.zatca_erpgulf.country_code import country_code_mapping
+from zatca_erpgulf.zatca_erpgulf.ubl_skeleton import new_invoice
+from zatca_erpgulf.zatca_erpgulf.party_data import get_customer_party, get_supplier_party
+from zatca_erpgulf.zatca_erpgulf.zatca_config import get_company_config
+from zatca_erpgulf.zatca_erpgulf.pih_chain import get_unit_pih
 
 CBC_ID = "cbc:ID"
-DS_TRANSFORM = "ds:Transform"
 
 
 def get_icv_code(invoice_number):
@@ -71,131 +74,10 @@ def billing_reference_for_credit_and_debit_note(invoice, sales_invoice_doc):
 def xml_tags():
     """
     Creates an XML Invoice document with UBL, XAdES, and digital signature elements.
+    The signature scaffold is prebuilt once in ubl_skeleton and shared.
     """
     try:
-        invoice = ET.Element(
-            "Invoice", xmlns="urn:oasis:names:specification:ubl:schema:xsd:Invoice-2"
-        )
-        invoice.set(
-            "xmlns:cac",
-            "urn:oasis:names:specification:ubl:schema:xsd:CommonAggregateComponents-2",
-        )
-        invoice.set(
-            "xmlns:cbc",
-            "urn:oasis:names:specification:ubl:schema:xsd:CommonBasicComponents-2",
-        )
-        invoice.set(
-            "xmlns:ext",
-            "urn:oasis:names:specification:ubl:schema:xsd:CommonExtensionComponents-2",
-        )
-        ubl_extensions = ET.SubElement(invoice, "ext:UBLExtensions")
-        ubl_extension = ET.SubElement(ubl_extensions, "ext:UBLExtension")
-        extension_uri = ET.SubElement(ubl_extension, "ext:ExtensionURI")
-        extension_uri.text = "urn:oasis:names:specification:ubl:dsig:enveloped:xades"
-        extension_content = ET.SubElement(ubl_extension, "ext:ExtensionContent")
-        ubl_document_signatures = ET.SubElement(
-            extension_content, "sig:UBLDocumentSignatures"
-        )
-        ubl_document_signatures.set(
-            "xmlns:sig",
-            "urn:oasis:names:specification:ubl:schema:xsd:CommonSignatureComponents-2",
-        )
-        ubl_document_signatures.set(
-            "xmlns:sac",
-            "urn:oasis:names:specification:ubl:schema:xsd:SignatureAggregateComponents-2",
-        )
-        ubl_document_signatures.set(
-            "xmlns:sbc",
-            "urn:oasis:names:specification:ubl:schema:xsd:SignatureBasicComponents-2",
-        )
-        signature_information = ET.SubElement(
-            ubl_document_signatures, "sac:SignatureInformation"
-        )
-        invoice_id = ET.SubElement(signature_information, CBC_ID)
-        invoice_id.text = "urn:oasis:names:specification:ubl:signature:1"
-        referenced_signatureid = ET.SubElement(
-            signature_information, "sbc:ReferencedSignatureID"
-        )
-        referenced_signatureid.text = (
-            "urn:oasis:names:specification:ubl:signature:Invoice"
-        )
-        signature = ET.SubElement(signature_information, "ds:Signature")
-        signature.set("Id", "signature")
-        signature.set("xmlns:ds", "http://www.w3.org/2000/09/xmldsig#")
-        signed_info = ET.SubElement(signature, "ds:SignedInfo")
-        canonicalization_method = ET.SubElement(
-            signed_info, "ds:CanonicalizationMethod"
-        )
-        canonicalization_method.set("Algorithm", "http://www.w3.org/2006/12/xml-c14n11")
-        signature_method = ET.SubElement(signed_info, "ds:SignatureMethod")
-        signature_method.set(
-            "Algorithm", "http://www.w3.org/2001/04/xmldsig-more#ecdsa-sha256"
-        )
-        reference = ET.SubElement(signed_info, "ds:Reference")
-        reference.set("Id", "invoiceSignedData")
-        reference.set("URI", "")
-        transforms = ET.SubElement(reference, "ds:Transforms")
-        transform = ET.SubElement(transforms, DS_TRANSFORM)
-        transform.set("Algorithm", "http://www.w3.org/TR/1999/REC-xpath-19991116")
-        xpath = ET.SubElement(transform, "ds:XPath")
-        xpath.text = "not(//ancestor-or-self::ext:UBLExtensions)"
-        transform2 = ET.SubElement(transforms, DS_TRANSFORM)
-        transform2.set("Algorithm", "http://www.w3.org/TR/1999/REC-xpath-19991116")
-        xpath2 = ET.SubElement(transform2, "ds:XPath")
-        xpath2.text = "not(//ancestor-or-self::cac:Signature)"
-        transform3 = ET.SubElement(transforms, DS_TRANSFORM)
-        transform3.set("Algorithm", "http://www.w3.org/TR/1999/REC-xpath-19991116")
-        xpath3 = ET.SubElement(transform3, "ds:XPath")
-        xpath3.text = (
-            "not(//ancestor-or-self::cac:AdditionalDocumentReference[cbc:ID='QR'])"
-        )
-        transform4 = ET.SubElement(transforms, DS_TRANSFORM)
-        transform4.set("Algorithm", "http://www.w3.org/2006/12/xml-c14n11")
-        diges_method = ET.SubElement(reference, "ds:DigestMethod")
-        diges_method.set("Algorithm", "http://www.w3.org/2001/04/xmlenc#sha256")
-        diges_value = ET.SubElement(reference, "ds:DigestValue")
-        diges_value.text = "O/vEnAxjLAlw8kQUy8nq/5n8IEZ0YeIyBFvdQA8+iFM="
-        reference2 = ET.SubElement(signed_info, "ds:Reference")
-        reference2.set("URI", "#xadesSignedProperties")
-        reference2.set("Type", "http://www.w3.org/2000/09/xmldsig#SignatureProperties")
-        digest_method1 = ET.SubElement(reference2, "ds:DigestMethod")
-        digest_method1.set("Algorithm", "http://www.w3.org/2001/04/xmlenc#sha256")
-        digest_value1 = ET.SubElement(reference2, "ds:DigestValue")
-        digest_value1.text = "YjQwZmEyMjM2NDU1YjQwNjM5MTFmYmVkO="
-        signature_value = ET.SubElement(signature, "ds:SignatureValue")
-        signature_value.text = "MEQCIDGBRHiPo6yhXIQ9df6pMEkufcGnoqYaS+O8Jn"
-        keyinfo = ET.SubElement(signature, "ds:KeyInfo")
-        x509data = ET.SubElement(keyinfo, "ds:X509Data")
-        x509certificate = ET.SubElement(x509data, "ds:X509Certificate")
-        x509certificate.text = (
-            "MIID6TCCA5CgAwIBAgITbwAAf8tem6jngr16DwABAAB/yzAKBggqhkjOPQQ"
-        )
-        object_data = ET.SubElement(signature, "ds:Object")
-        qualifyingproperties = ET.SubElement(object_data, "xades:QualifyingProperties")
-        qualifyingproperties.set("Target", "signature")
-        qualifyingproperties.set("xmlns:xades", "http://uri.etsi.org/01903/v1.3.2#")
-        signedproperties = ET.SubElement(qualifyingproperties, "xades:SignedProperties")
-        signedproperties.set("Id", "xadesSignedProperties")
-        signedsignatureproperties = ET.SubElement(
-            signedproperties, "xades:SignedSignatureProperties"
-        )
-        signingtime = ET.SubElement(signedsignatureproperties, "xades:SigningTime")
-        signingtime.text = "2024-01-24T11:36:34Z"
-        signingcertificate = ET.SubElement(
-            signedsignatureproperties, "xades:SigningCertificate"
-        )
-        cert = ET.SubElement(signingcertificate, "xades:Cert")
-        certdigest = ET.SubElement(cert, "xades:CertDigest")
-        digest_method2 = ET.SubElement(certdigest, "ds:DigestMethod")
-        digest_value2 = ET.SubElement(certdigest, "ds:DigestValue")
-        digest_method2.set("Algorithm", "http://www.w3.org/2001/04/xmlenc#sha256")
-        digest_value2.text = "YTJkM2JhYTcwZTBhZTAxOGYwODMyNzY3"
-        issuerserial = ET.SubElement(cert, "xades:IssuerSerial")
-        x509issuername = ET.SubElement(issuerserial, "ds:X509IssuerName")
-        x509serialnumber = ET.SubElement(issuerserial, "ds:X509SerialNumber")
-        x509issuername.text = "CN=TSZEINVOICE-SubCA-1, DC=extgazt, DC=gov, DC=local"
-        x509serialnumber.text = "2475382886904809774818644480820936050208702411"
-        return invoice
+        return new_invoice()
     except (ET.ParseError, AttributeError, ValueError) as e:
         frappe.throw(_(f"Error in XML tags formation: {e}"))
         return None
@@ -222,7 +104,10 @@ def salesinvoice_data(invoice, invoice_number):
         cbc_issue_date.text = str(sales_invoice_doc.posting_date)
 
         cbc_issue_time = ET.SubElement(invoice, "cbc:IssueTime")
-        cbc_issue_time.text = get_issue_time(invoice_number)
+        # the invoice is already loaded, get_issue_time would load it again
+        cbc_issue_time.text = get_time(sales_invoice_doc.posting_time).strftime(
+            "%H:%M:%S"
+        )
 
         return invoice, uuid1, sales_invoice_doc
     except (AttributeError, ValueError, frappe.ValidationError) as e:
@@ -445,8 +330,6 @@ def additional_reference(invoice, company_abbr, sales_invoice_doc):
         if not company_name:
             frappe.throw(_(f"Company with abbreviation {company_abbr} not found."))
 
-        company_doc = frappe.get_doc("Company", company_name)
-
         # Create the first AdditionalDocumentReference element for PIH
         cac_additionaldocumentreference2 = ET.SubElement(
             invoice, "cac:AdditionalDocumentReference"
@@ -461,19 +344,7 @@ def additional_reference(invoice, company_abbr, sales_invoice_doc):
         )
         cbc_embeddeddocumentbinaryobject.set("mimeCode", "text/plain")
 
-        # Directly retrieve the PIH data without JSON parsing
-        # pih = company_doc.custom_pih  # Assuming this is already in the correct format
-        if sales_invoice_doc.custom_zatca_pos_name:
-            zatca_settings = frappe.get_doc(
-                "ZATCA Multiple Setting", sales_invoice_doc.custom_zatca_pos_name
-            )
-            if zatca_settings.custom__use_company_certificate__keys != 1:
-                pih = zatca_settings.custom_pih
-            else:
-                linked_doc = frappe.get_doc("Company", zatca_settings.custom_linked_doctype)
-                pih = linked_doc.custom_pih
-        else:
-            pih = company_doc.custom_pih
+        pih = get_unit_pih(sales_invoice_doc)
         cbc_embeddeddocumentbinaryobject.text = pih
 
         # Create the second AdditionalDocumentReference element for QR
@@ -566,15 +437,13 @@ def get_address(sales_invoice_doc, company_doc):
         return address
 
 
-def company_data(invoice, sales_invoice_doc):
+def build_supplier_party(sales_invoice_doc):
     """
-    Adds company data elements to the XML invoice, including supplier details, address,
-    and tax information.
+    Builds the detached <cac:AccountingSupplierParty> of the company or cost center
+    of the invoice. Cached by party_data, it only reads the company and cost center.
     """
     try:
         company_doc = frappe.get_doc("Company", sales_invoice_doc.company)
-        if company_doc.custom_costcenter == 1 and not sales_invoice_doc.cost_center:
-            frappe.throw(_("no Cost Center is set in the invoice.Give the feild"))
         # Determine whether to fetch data from Cost Center or Company
         if company_doc.custom_costcenter == 1 and sales_invoice_doc.cost_center:
             cost_center_doc = frappe.get_doc(
@@ -588,9 +457,7 @@ def company_data(invoice, sales_invoice_doc):
             custom_registration_type = company_doc.custom_registration_type
             custom_company_registration = company_doc.custom_company_registration
 
-        cac_accountingsupplierparty = ET.SubElement(
-            invoice, "cac:AccountingSupplierParty"
-        )
+        cac_accountingsupplierparty = ET.Element("cac:AccountingSupplierParty")
         cac_party_1 = ET.SubElement(cac_accountingsupplierparty, "cac:Party")
         cac_partyidentification = ET.SubElement(cac_party_1, "cac:PartyIdentification")
         cbc_id_2 = ET.SubElement(cac_partyidentification, CBC_ID)
@@ -638,22 +505,44 @@ def company_data(invoice, sales_invoice_doc):
         )
         cbc_registrationname.text = sales_invoice_doc.company
 
+        return cac_accountingsupplierparty
+    except (ET.ParseError, AttributeError, ValueError, frappe.DoesNotExistError) as e:
+        frappe.throw(_(f"Error occurred in company data: {e}"))
+        return None
+
+
+def company_data(invoice, sales_invoice_doc):
+    """
+    Adds company data elements to the XML invoice, including supplier details, address,
+    and tax information.
+    """
+    try:
+        company_config = get_company_config(sales_invoice_doc.company)
+        if company_config.custom_costcenter == 1 and not sales_invoice_doc.cost_center:
+            frappe.throw(_("no Cost Center is set in the invoice.Give the feild"))
+        invoice.append(
+            get_supplier_party(
+                sales_invoice_doc,
+                company_config.custom_costcenter == 1,
+                build_supplier_party,
+            )
+        )
         return invoice
     except (ET.ParseError, AttributeError, ValueError, frappe.DoesNotExistError) as e:
         frappe.throw(_(f"Error occurred in company data: {e}"))
         return None
 
 
-def customer_data(invoice, sales_invoice_doc):
+def build_customer_party(sales_invoice_doc):
     """
-    customer data of address and need values
+    Builds the detached <cac:AccountingCustomerParty> of the customer of the invoice.
+    Cached by party_data, it only reads the customer, the customer address on v13
+    and the export flag of the invoice.
     """
     try:
         customer_doc = frappe.get_doc("Customer", sales_invoice_doc.customer)
         # frappe.throw(str(customer_doc))
-        cac_accountingcustomerparty = ET.SubElement(
-            invoice, "cac:AccountingCustomerParty"
-        )
+        cac_accountingcustomerparty = ET.Element("cac:AccountingCustomerParty")
         cac_party_2 = ET.SubElement(cac_accountingcustomerparty, "cac:Party")
         
         # Only add PartyIdentification if NOT B2C or if the field custom_buyer_id is not empty, otherwise ZATCA gives BR-KSA-F-08 warning for empty tag
@@ -761,6 +650,18 @@ def customer_data(invoice, sales_invoice_doc):
         )
         cbc_registrationname_1.text = customer_doc.customer_name
 
+        return cac_accountingcustomerparty
+    except (ET.ParseError, AttributeError, ValueError, frappe.DoesNotExistError) as e:
+        frappe.throw(_(f"Error occurred in customer data: {e}"))
+        return None
+
+
+def customer_data(invoice, sales_invoice_doc):
+    """
+    customer data of address and need values
+    """
+    try:
+        invoice.append(get_customer_party(sales_invoice_doc, build_customer_party))
         return invoice
     except (ET.ParseError, AttributeError, ValueError, frappe.DoesNotExistError) as e:
         frappe.throw(_(f"Error occurred in customer data: {e}"))
@@ -7,7 +7,6 @@ using ERPNext
 import hashlib
 import base64
 import json
-import binascii
 from datetime import datetime
 from lxml import etree
 import lxml.etree as MyTree
@@ -20,7 +19,31 @@ from cryptography.hazmat.bindings._rust import ObjectIdentifier
 from cryptography.hazmat.primitives import serialization, hashes
 from cryptography.hazmat.primitives.asymmetric import ec
 import requests
+from zatca_erpgulf.zatca_erpgulf.zatca_session import zatca_post, zatca_request
 import asn1
+from zatca_erpgulf.zatca_erpgulf.signing_identity import (
+    get_signing_identity,
+    load_certificate,
+    load_private_key,
+)
+from zatca_erpgulf.zatca_erpgulf.sign_invoice_first import (
+    FIND_CERT_DIGEST_VALUE,
+    FIND_INVOICE_DIGEST,
+    FIND_ISSUE_DATE,
+    FIND_ISSUE_TIME,
+    FIND_ISSUER_NAME,
+    FIND_QR_BINARY_OBJECT,
+    FIND_SERIAL_NUMBER,
+    FIND_SIGNATURE_VALUE,
+    FIND_SIGNED_PROPERTIES_DIGEST,
+    FIND_SIGNING_TIME,
+    FIND_X509_CERTIFICATE,
+    REMOVE_TAGS_TRANSFORM,
+    TLV_TAG_FINDERS,
+    find_first,
+    find_signature_node,
+    xml_base64_decode,
+)
 
 SUPPORTED_INVOICES = ["Advance Sales Invoice", "POS Invoice"]
 
@@ -269,7 +292,7 @@ def create_csid(zatca_doc: dict | str, company_abbr:str):
             user=frappe.session.user,
         )
 
-        response = requests.post(
+        response = zatca_post(
             url=get_api_url(company_abbr, base_url="compliance"),
             headers=headers,
             data=payload,
@@ -300,69 +323,12 @@ def create_csid(zatca_doc: dict | str, company_abbr:str):
         return None
 
 
-def create_public_key(company_abbr, source_doc):
-    """Create a public key based on the company abbreviation and source document."""
-    try:
-        # Get the company name using the provided abbreviation
-        company_name = frappe.db.get_value("Company", {"abbr": company_abbr}, "name")
-        if not company_name:
-            frappe.throw(_(f"Company with abbreviation {company_abbr} not found."))
-
-        company_doc = frappe.get_doc("Company", company_name)
-        certificate_data_str = company_doc.get("custom_certificate", "")
-
-        if not certificate_data_str:
-            frappe.throw(_("No certificate data found."))
-
-        # Build the PEM certificate
-        cert_base64 = f"""
-        -----BEGIN CERTIFICATE-----
-        {certificate_data_str.strip()}
-        -----END CERTIFICATE-----
-        """
-        # Load the certificate and extract the public key
-        cert = x509.load_pem_x509_certificate(cert_base64.encode(), default_backend())
-        public_key = cert.public_key()
-        public_key_pem = public_key.public_bytes(
-            encoding=serialization.Encoding.PEM,
-            format=serialization.PublicFormat.SubjectPublicKeyInfo,
-        ).decode()
-
-        company_doc.custom_public_key = public_key_pem
-        company_doc.save(ignore_permissions=True)
-        frappe.db.commit()
-
-    except (ValueError, KeyError, TypeError, frappe.ValidationError) as e:
-        frappe.throw(_("Error occurred while creating public key: " + str(e)))
-
-
 def removetags(finalzatcaxml):
     """remove the unwanted tags from created xml"""
     try:
         # Code corrected by Farook K - ERPGulf
         xml_file = MyTree.fromstring(finalzatcaxml)
-        xsl_file = MyTree.fromstring(
-            """<xsl:stylesheet xmlns:xsl="http://www.w3.org/1999/XSL/Transform"
-                                    xmlns:xs="http://www.w3.org/2001/XMLSchema"
-                                    xmlns="urn:oasis:names:specification:ubl:schema:xsd:Invoice-2"
-                                    xmlns:cac="urn:oasis:names:specification:ubl:schema:xsd:CommonAggregateComponents-2"
-                                    xmlns:cbc="urn:oasis:names:specification:ubl:schema:xsd:CommonBasicComponents-2"
-                                    xmlns:ext="urn:oasis:names:specification:ubl:schema:xsd:CommonExtensionComponents-2"
-                                    exclude-result-prefixes="xs"
-                                    version="2.0">
-                                    <xsl:output omit-xml-declaration="yes" encoding="utf-8" indent="no"/>
-                                    <xsl:template match="node() | @*">
-                                        <xsl:copy>
-                                            <xsl:apply-templates select="node() | @*"/>
-                                        </xsl:copy>
-                                    </xsl:template>
-                                    <xsl:template match="//*[local-name()='Invoice']//*[local-name()='UBLExtensions']"></xsl:template>
-                                    <xsl:template match="//*[local-name()='AdditionalDocumentReference'][cbc:ID[normalize-space(text()) = 'QR']]"></xsl:template>
-                                        <xsl:template match="//*[local-name()='Invoice']/*[local-name()='Signature']"></xsl:template>
-                                    </xsl:stylesheet>"""
-        )
-        transform = MyTree.XSLT(xsl_file.getroottree())
-        transformed_xml = transform(xml_file.getroottree())
+        transformed_xml = REMOVE_TAGS_TRANSFORM(xml_file.getroottree())
         return transformed_xml
     except (ValueError, KeyError, TypeError, frappe.ValidationError) as e:
         frappe.throw(_("error occurred win removing tags " + str(e)))
@@ -405,10 +371,7 @@ def digital_signature(hash1, company_abbr, source_doc):
 
         if not private_key_data_str:
             frappe.throw(_("No private key data found for the company."))
-        private_key_bytes = private_key_data_str.encode("utf-8")
-        private_key = serialization.load_pem_private_key(
-            private_key_bytes, password=None, backend=default_backend()
-        )
+        private_key = load_private_key(private_key_data_str)
         hash_bytes = bytes.fromhex(hash1)
         signature = private_key.sign(hash_bytes, ec.ECDSA(hashes.SHA256()))
         encoded_signature = base64.b64encode(signature).decode()
@@ -440,16 +403,7 @@ def extract_certificate_details(company_abbr, source_doc):
             frappe.throw(_(
                 f"No valid certificate content found for company {company_name}"
             ))
-        # Format the certificate string to PEM format if not already in correct PEM format
-        formatted_certificate = "-----BEGIN CERTIFICATE-----\n"
-        formatted_certificate += "\n".join(
-            certificate_content[i : i + 64]
-            for i in range(0, len(certificate_content), 64)
-        )
-        formatted_certificate += "\n-----END CERTIFICATE-----\n"
-        # Load the certificate using cryptography
-        certificate_bytes = formatted_certificate.encode("utf-8")
-        cert = x509.load_pem_x509_certificate(certificate_bytes, default_backend())
+        cert = load_certificate(certificate_content)
         formatted_issuer_name = cert.issuer.rfc4514_string()
         issuer_name = ", ".join([x.strip() for x in formatted_issuer_name.split(",")])
         serial_number = cert.serial_number
@@ -495,20 +449,6 @@ def certificate_hash(company_abbr, source_doc):
         return None
 
 
-def xml_base64_decode(signed_xmlfile_name):
-    """xml base64 decode"""
-    try:
-        # nosemgrep: frappe-semgrep-rules.rules.security.frappe-security-file-traversal
-        with open(signed_xmlfile_name, "r", encoding="utf-8") as file:
-            xml = file.read().lstrip()
-            base64_encoded = base64.b64encode(xml.encode("utf-8"))
-            base64_decoded = base64_encoded.decode("utf-8")
-            return base64_decoded
-    except (ValueError, KeyError, TypeError, frappe.ValidationError) as e:
-        frappe.msgprint(_("Error in xml base64:  " + str(e)))
-        return None
-
-
 def signxml_modify(company_abbr,finalzatcaxml, source_doc):
     """modify the signed xml by adding the values like signing time,serial number etc"""
     try:
@@ -531,14 +471,10 @@ def signxml_modify(company_abbr,finalzatcaxml, source_doc):
             "ds": "http://www.w3.org/2000/09/xmldsig#",
         }
 
-        xpath_dv = "ext:UBLExtensions/ext:UBLExtension/ext:ExtensionContent/sig:UBLDocumentSignatures/sac:SignatureInformation/ds:Signature/ds:Object/xades:QualifyingProperties/xades:SignedProperties/xades:SignedSignatureProperties/xades:SigningCertificate/xades:Cert/xades:CertDigest/ds:DigestValue"
-        xpath_signtime = "ext:UBLExtensions/ext:UBLExtension/ext:ExtensionContent/sig:UBLDocumentSignatures/sac:SignatureInformation/ds:Signature/ds:Object/xades:QualifyingProperties/xades:SignedProperties/xades:SignedSignatureProperties/xades:SigningTime"
-        xpath_issuername = "ext:UBLExtensions/ext:UBLExtension/ext:ExtensionContent/sig:UBLDocumentSignatures/sac:SignatureInformation/ds:Signature/ds:Object/xades:QualifyingProperties/xades:SignedProperties/xades:SignedSignatureProperties/xades:SigningCertificate/xades:Cert/xades:IssuerSerial/ds:X509IssuerName"
-        xpath_serialnum = "ext:UBLExtensions/ext:UBLExtension/ext:ExtensionContent/sig:UBLDocumentSignatures/sac:SignatureInformation/ds:Signature/ds:Object/xades:QualifyingProperties/xades:SignedProperties//xades:SignedSignatureProperties/xades:SigningCertificate/xades:Cert/xades:IssuerSerial/ds:X509SerialNumber"
-        element_dv = root.find(xpath_dv, namespaces)
-        element_st = root.find(xpath_signtime, namespaces)
-        element_in = root.find(xpath_issuername, namespaces)
-        element_sn = root.find(xpath_serialnum, namespaces)
+        element_dv = find_signature_node(root, "cert_digest", FIND_CERT_DIGEST_VALUE)
+        element_st = find_signature_node(root, "signing_time", FIND_SIGNING_TIME)
+        element_in = find_signature_node(root, "issuer_name", FIND_ISSUER_NAME)
+        element_sn = find_signature_node(root, "serial_number", FIND_SERIAL_NUMBER)
         element_dv.text = encoded_certificate_hash
         element_st.text = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S")
         signing_time = element_st.text
@@ -638,15 +574,18 @@ def populate_the_ubl_extensions_output(
                 f"No valid certificate content found for company {company_name}"
             ))
 
-        xpath_signvalue = "ext:UBLExtensions/ext:UBLExtension/ext:ExtensionContent/sig:UBLDocumentSignatures/sac:SignatureInformation/ds:Signature/ds:SignatureValue"
-        xpath_x509certi = "ext:UBLExtensions/ext:UBLExtension/ext:ExtensionContent/sig:UBLDocumentSignatures/sac:SignatureInformation/ds:Signature/ds:KeyInfo/ds:X509Data/ds:X509Certificate"
-        xpath_digvalue = "ext:UBLExtensions/ext:UBLExtension/ext:ExtensionContent/sig:UBLDocumentSignatures/sac:SignatureInformation/ds:Signature/ds:SignedInfo/ds:Reference[@URI='#xadesSignedProperties']/ds:DigestValue"
-        xpath_digvalue2 = "ext:UBLExtensions/ext:UBLExtension/ext:ExtensionContent/sig:UBLDocumentSignatures/sac:SignatureInformation/ds:Signature/ds:SignedInfo/ds:Reference[@Id='invoiceSignedData']/ds:DigestValue"
-
-        signvalue6 = root3.find(xpath_signvalue, namespaces)
-        x509certificate6 = root3.find(xpath_x509certi, namespaces)
-        digestvalue6 = root3.find(xpath_digvalue, namespaces)
-        digestvalue6_2 = root3.find(xpath_digvalue2, namespaces)
+        signvalue6 = find_signature_node(
+            root3, "signature_value", FIND_SIGNATURE_VALUE
+        )
+        x509certificate6 = find_signature_node(
+            root3, "x509_certificate", FIND_X509_CERTIFICATE
+        )
+        digestvalue6 = find_signature_node(
+            root3, "signed_properties_digest", FIND_SIGNED_PROPERTIES_DIGEST
+        )
+        digestvalue6_2 = find_signature_node(
+            root3, "invoice_digest", FIND_INVOICE_DIGEST
+        )
 
         signvalue6.text = encoded_signature
         x509certificate6.text = content
@@ -671,24 +610,8 @@ def populate_the_ubl_extensions_output(
 def extract_public_key_data(company_abbr, source_doc):
     """extract public key"""
     try:
-        company_name = frappe.db.get_value("Company", {"abbr": company_abbr}, "name")
-        if not company_name:
-            frappe.throw(_(f"Company with abbreviation {company_abbr} not found."))
-
-        company_doc = frappe.get_doc("Company", company_name)
-
-        public_key_pem = company_doc.get("custom_public_key", "")
-        if not public_key_pem:
-            frappe.throw(f"No public key found for company {company_name}")
-
-        lines = public_key_pem.splitlines()
-        key_data = "".join(lines[1:-1])
-        key_data = key_data.replace("-----BEGIN PUBLIC KEY-----", "").replace(
-            "-----END PUBLIC KEY-----", ""
-        )
-        key_data = key_data.replace(" ", "").replace("\n", "")
-
-        return key_data
+        public_key_der = get_signing_identity(company_abbr, source_doc).public_key_der
+        return base64.b64encode(public_key_der).decode("utf-8")
 
     except (ValueError, KeyError, TypeError, frappe.ValidationError) as e:
         frappe.throw(_("Error in extracting public key data: " + str(e)))
@@ -718,16 +641,9 @@ def get_tlv_for_value(tag_num, tag_value):
 
 
 def tag8_publickey(company_abbr, source_doc):
-    """tag 8 of qr from public key"""
+    """tag 8 of qr from public key, derived from the certificate in memory"""
     try:
-        create_public_key(company_abbr, source_doc)
-        base64_encoded = extract_public_key_data(company_abbr, source_doc)
-        byte_data = base64.b64decode(base64_encoded)
-        hex_data = binascii.hexlify(byte_data).decode("utf-8")
-        chunks = [hex_data[i : i + 2] for i in range(0, len(hex_data), 2)]
-        value = "".join(chunks)
-        binary_data = bytes.fromhex(value)
-        return binary_data
+        return get_signing_identity(company_abbr, source_doc).public_key_der
     except (ValueError, KeyError, TypeError, frappe.ValidationError) as e:
         frappe.throw(_("Error in tag 8 from public key: " + str(e)))
         return None
@@ -742,20 +658,12 @@ def tag9_signature_ecdsa(company_abbr, source_doc):
 
         company_doc = frappe.get_doc("Company", company_name)
 
-        certificate_content = company_doc.custom_certificate or ""
+        certificate_content = (company_doc.custom_certificate or "").strip()
 
         if not certificate_content:
             frappe.throw(_(f"No certificate found for company in tag9 {company_abbr}"))
 
-        formatted_certificate = "-----BEGIN CERTIFICATE-----\n"
-        formatted_certificate += "\n".join(
-            certificate_content[i : i + 64]
-            for i in range(0, len(certificate_content), 64)
-        )
-        formatted_certificate += "\n-----END CERTIFICATE-----\n"
-
-        certificate_bytes = formatted_certificate.encode("utf-8")
-        cert = x509.load_pem_x509_certificate(certificate_bytes, default_backend())
+        cert = load_certificate(certificate_content)
         signature = cert.signature
         signature_hex = "".join("{:02x}".format(byte) for byte in signature)
         signature_bytes = bytes.fromhex(signature_hex)
@@ -776,19 +684,8 @@ def generate_tlv_xml(final_xml_string,company_abbr, source_doc):
         # ) as file:
         #     xml_data = file.read()
         # root = etree.fromstring(xml_data)
-        namespaces = {
-            "ubl": "urn:oasis:names:specification:ubl:schema:xsd:Invoice-2",
-            "cac": "urn:oasis:names:specification:ubl:schema:xsd:CommonAggregateComponents-2",
-            "cbc": "urn:oasis:names:specification:ubl:schema:xsd:CommonBasicComponents-2",
-            "ext": "urn:oasis:names:specification:ubl:schema:xsd:CommonExtensionComponents-2",
-            "sig": "urn:oasis:names:specification:ubl:schema:xsd:CommonSignatureComponents-2",
-            "sac": "urn:oasis:names:specification:ubl:schema:xsd:SignatureAggregateComponents-2",
-            "ds": "http://www.w3.org/2000/09/xmldsig#",
-        }
-        issue_date_xpath = "/ubl:Invoice/cbc:IssueDate"
-        issue_time_xpath = "/ubl:Invoice/cbc:IssueTime"
-        issue_date_results = root.xpath(issue_date_xpath, namespaces=namespaces)
-        issue_time_results = root.xpath(issue_time_xpath, namespaces=namespaces)
+        issue_date_results = FIND_ISSUE_DATE(root)
+        issue_time_results = FIND_ISSUE_TIME(root)
         issue_date = (
             issue_date_results[0].text.strip() if issue_date_results else "Missing Data"
         )
@@ -796,33 +693,10 @@ def generate_tlv_xml(final_xml_string,company_abbr, source_doc):
             issue_time_results[0].text.strip() if issue_time_results else "Missing Data"
         )
         issue_date_time = issue_date + "T" + issue_time
-        tags_xpaths = [
-            (
-                1,
-                "/ubl:Invoice/cac:AccountingSupplierParty/cac:Party/cac:PartyLegalEntity/cbc:RegistrationName",
-            ),
-            (
-                2,
-                "/ubl:Invoice/cac:AccountingSupplierParty/cac:Party/cac:PartyTaxScheme/cbc:CompanyID",
-            ),
-            (3, None),
-            (4, "/ubl:Invoice/cac:LegalMonetaryTotal/cbc:TaxInclusiveAmount"),
-            (5, "/ubl:Invoice/cac:TaxTotal/cbc:TaxAmount"),
-            (
-                6,
-                "/ubl:Invoice/ext:UBLExtensions/ext:UBLExtension/ext:ExtensionContent/sig:UBLDocumentSignatures/sac:SignatureInformation/ds:Signature/ds:SignedInfo/ds:Reference/ds:DigestValue",
-            ),
-            (
-                7,
-                "/ubl:Invoice/ext:UBLExtensions/ext:UBLExtension/ext:ExtensionContent/sig:UBLDocumentSignatures/sac:SignatureInformation/ds:Signature/ds:SignatureValue",
-            ),
-            (8, None),
-            (9, None),
-        ]
         result_dict = {}
-        for tag, xpath in tags_xpaths:
-            if isinstance(xpath, str):
-                elements = root.xpath(xpath, namespaces=namespaces)
+        for tag, finder in TLV_TAG_FINDERS:
+            if finder is not None:
+                elements = finder(root)
                 if elements:
                     value = (
                         elements[0].text
@@ -833,7 +707,7 @@ def generate_tlv_xml(final_xml_string,company_abbr, source_doc):
                 else:
                     result_dict[tag] = "Not found"
             else:
-                result_dict[tag] = xpath
+                result_dict[tag] = None
         result_dict[3] = issue_date_time
         result_dict[8] = tag8_publickey(company_abbr, source_doc)
         result_dict[9] = tag9_signature_ecdsa(company_abbr, source_doc)
@@ -854,14 +728,7 @@ def update_qr_toxml(final_xml_string, qrcodeb64, company_abbr):
         # )
         # xml_tree = etree.parse(xml_file_path)
         xml_tree = etree.fromstring(final_xml_string.encode("utf-8"))
-        namespaces = {
-            "cac": "urn:oasis:names:specification:ubl:schema:xsd:CommonAggregateComponents-2",
-            "cbc": "urn:oasis:names:specification:ubl:schema:xsd:CommonBasicComponents-2",
-        }
-        qr_code_element = xml_tree.find(
-            './/cac:AdditionalDocumentReference[cbc:ID="QR"]/cac:Attachment/cbc:EmbeddedDocumentBinaryObject',
-            namespaces=namespaces,
-        )
+        qr_code_element = find_first(FIND_QR_BINARY_OBJECT, xml_tree)
         if qr_code_element is not None:
             qr_code_element.text = qrcodeb64
         else:
@@ -882,79 +749,8 @@ def update_qr_toxml(final_xml_string, qrcodeb64, company_abbr):
         )
 
 
-def structuring_signedxml(invoice_number,updated_xml_string):
-    """structuring the signed xml"""
-    try:
-        # with open(
-        #     f"{frappe.local.site}/private/files/final_xml_after_signadvance1_{invoice_number}.xml",
-        #     "r",
-        #     encoding="utf-8",
-        # ) as file:
-        #     xml_content = file.readlines()
-        indentations = {
-            29: [
-                '<xades:QualifyingProperties xmlns:xades="http://uri.etsi.org/01903/v1.3.2#" Target="signature">',
-                "</xades:QualifyingProperties>",
-            ],
-            33: [
-                '<xades:SignedProperties Id="xadesSignedProperties">',
-                "</xades:SignedProperties>",
-            ],
-            37: [
-                "<xades:SignedSignatureProperties>",
-                "</xades:SignedSignatureProperties>",
-            ],
-            41: [
-                "<xades:SigningTime>",
-                "<xades:SigningCertificate>",
-                "</xades:SigningCertificate>",
-            ],
-            45: ["<xades:Cert>", "</xades:Cert>"],
-            49: [
-                "<xades:CertDigest>",
-                "<xades:IssuerSerial>",
-                "</xades:CertDigest>",
-                "</xades:IssuerSerial>",
-            ],
-            53: [
-                '<ds:DigestMethod Algorithm="http://www.w3.org/2001/04/xmlenc#sha256"/>',
-                "<ds:DigestValue>",
-                "<ds:X509IssuerName>",
-                "<ds:X509SerialNumber>",
-            ],
-        }
-
-        def adjust_indentation(line):
-            for col, tags in indentations.items():
-                for tag in tags:
-                    if line.strip().startswith(tag):
-                        return " " * (col - 1) + line.lstrip()
-            return line
-
-        safe_invoice_number = invoice_number.replace("/", "-")
-        # adjusted_xml_content = [adjust_indentation(line) for line in xml_content]
-        adjusted_xml_content = [
-        adjust_indentation(line) for line in updated_xml_string.splitlines(keepends=True)
-        ]
-        # nosemgrep: frappe-semgrep-rules.rules.security.frappe-security-file-traversal
-        with open(
-            f"{frappe.local.site}/private/files/final_xml_after_indentadvance1_{safe_invoice_number}.xml",
-            "w",
-            encoding="utf-8",
-        ) as file:      
-            file.writelines(adjusted_xml_content)
-    
-        signed_xmlfile_name = (
-            f"{frappe.local.site}/private/files/final_xml_after_indentadvance1_{safe_invoice_number}.xml"
-        )
-        return signed_xmlfile_name
-    except (ValueError, KeyError, TypeError, frappe.ValidationError) as e:
-        frappe.throw(_(" error in structuring signed xml: " + str(e)))
-        return None
-
-
 def compliance_api_call(
-    uuid1, encoded_hash, signed_xmlfile_name, company_abbr, source_doc
+    uuid1, encoded_hash, signed_xml, company_abbr, source_doc
 ):
     """compliance api call for testing with sandbox"""
     try:
@@ -968,7 +764,7 @@ def compliance_api_call(
             {
                 "invoiceHash": encoded_hash,
                 "uuid": uuid1,
-                "invoice": xml_base64_decode(signed_xmlfile_name),
+                "invoice": xml_base64_decode(signed_xml),
             }
         )
 
@@ -986,7 +782,7 @@ def compliance_api_call(
             "Content-Type": "application/json",
         }
         # frappe.throw(get_api_url(company_abbr, base_url="compliance/invoices"))
-        response = requests.request(
+        response = zatca_request(
             "POST",
             url=get_api_url(company_abbr, base_url="compliance/invoices"),
             headers=headers,
@@ -1042,7 +838,7 @@ def production_csid(zatca_doc: dict | str, company_abbr: str):
             user=frappe.session.user,
         )
 
-        response = requests.post(
+        response = zatca_post(
             url=get_api_url(company_abbr, base_url="production/csids"),
             headers=headers,
             json=payload,
@@ -1,9 +1,15 @@
 # Copyright (c) 2025, ERPGulf and contributors
 # For license information, please see license.txt
 
-# import frappe
+import frappe
 from frappe.model.document import Document
+from frappe.query_builder import Interval
+from frappe.query_builder.functions import Now
 
 
 class ZATCAERPGulfEventLog(Document):
-	pass
+	@staticmethod
+	def clear_old_logs(days=90):
+		"""called by Log Settings, drops the events older than the retention"""
+		table = frappe.qb.DocType("ZATCA ERPGulf Event Log")
+		frappe.db.delete(table, filters=(table.creation < (Now() - Interval(days=days))))
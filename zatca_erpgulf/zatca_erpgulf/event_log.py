@@ -1,19 +1,90 @@
-from frappe.utils import now_datetime
+"""
+Buffered logging of the ZATCA API calls into ZATCA ERPGulf Event Log.
+The events of a request or background job are collected in memory and written with
+a single bulk insert and commit, once the buffer reaches its size and at the end of
+the request or job, instead of an insert and commit for every API response.
+The batch size and the longest stored response come from the site config,
+retention is set for the doctype in Log Settings
+"""
+
+from frappe.utils import cint, now_datetime
 import frappe
 
+EVENT_LOG_DOCTYPE = "ZATCA ERPGulf Event Log"
+DEFAULT_BATCH_SIZE = 50
+DEFAULT_MAX_RESPONSE_LENGTH = 20000
+OPTIONAL_FIELDS = ["custom_uuid", "status"]
+EVENT_LOG_SAVEPOINT = "zatca_event_log"
+
+
+def get_event_buffer():
+    """events logged in the current request or job and not written yet"""
+    if getattr(frappe.local, "zatca_event_buffer", None) is None:
+        frappe.local.zatca_event_buffer = []
+    return frappe.local.zatca_event_buffer
+
+
+def truncate_response(response_text):
+    """API response cut to the longest response kept in the log"""
+    max_length = cint(
+        frappe.conf.get("zatca_event_log_max_response_length")
+        or DEFAULT_MAX_RESPONSE_LENGTH
+    )
+    response_text = response_text or ""
+    if len(response_text) <= max_length:
+        return response_text
+    return response_text[:max_length] + f"... [truncated {len(response_text) - max_length} characters]"
+
+
 def log_zatca_event(invoice_number, response_text, status, uuid=None, title=None):
     """new doctype for handing logs"""
     try:
-        event_doc = frappe.get_doc({
-            "doctype": "ZATCA ERPGulf Event Log",
-            "title": title or f"ZATCA API Call for {invoice_number}",
-            "invoice_number": invoice_number,
-            "time": now_datetime(),  #
-            "api_response": response_text,  # store the API response here
-            "custom_uuid": uuid or "",
-            "status": status  # e.g., "Success", "Failed", "Warning"
-        })
-        event_doc.insert(ignore_permissions=True)
-        frappe.db.commit()
+        buffer = get_event_buffer()
+        buffer.append(
+            {
+                "title": title or f"ZATCA API Call for {invoice_number}",
+                "invoice_number": invoice_number,
+                "time": str(now_datetime()),
+                "api_response": truncate_response(response_text),  # store the API response here
+                "custom_uuid": uuid or "",
+                "status": status,  # e.g., "Success", "Failed", "Warning"
+            }
+        )
+        if len(buffer) >= cint(
+            frappe.conf.get("zatca_event_log_batch_size") or DEFAULT_BATCH_SIZE
+        ):
+            flush_zatca_events()
+    except Exception as e:
+        frappe.log_error(f"Failed to log ZATCA Event: {str(e)}", "ZATCA Event Log")
+
+
+def flush_zatca_events(*args, **kwargs):
+    """write the buffered events with one bulk insert and commit.
+    Hooked after every request and background job"""
+    buffer = getattr(frappe.local, "zatca_event_buffer", None)
+    if not buffer:
+        return
+    frappe.local.zatca_event_buffer = []
+    # a failed insert only drops the events, not the work of the request or job
+    frappe.db.savepoint(EVENT_LOG_SAVEPOINT)
+    try:
+        meta = frappe.get_meta(EVENT_LOG_DOCTYPE)
+        event_fields = ["title", "invoice_number", "time", "api_response"] + [
+            fieldname for fieldname in OPTIONAL_FIELDS if meta.has_field(fieldname)
+        ]
+        now = now_datetime()
+        user = frappe.session.user if getattr(frappe.local, "session", None) else "Administrator"
+        frappe.db.bulk_insert(
+            EVENT_LOG_DOCTYPE,
+            ["name", "creation", "modified", "owner", "modified_by", "docstatus"]
+            + event_fields,
+            [
+                [frappe.generate_hash(length=10), now, now, user, user, 0]
+                + [event[fieldname] for fieldname in event_fields]
+                for event in buffer
+            ],
+        )
+        frappe.db.commit()  # nosemgrep: frappe-semgrep-rules.rules.frappe-manual-commit
     except Exception as e:
+        frappe.db.rollback(save_point=EVENT_LOG_SAVEPOINT)
         frappe.log_error(f"Failed to log ZATCA Event: {str(e)}", "ZATCA Event Log")
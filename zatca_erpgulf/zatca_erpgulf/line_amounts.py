@@ -0,0 +1,173 @@
+"""
+Line amounts of an invoice, computed in one pass before the XML lines are emitted.
+The tax rate, tax inclusion, POS tax template and Item Tax Templates are resolved once
+per invoice instead of once per line. The amounts of every line are computed together,
+with the same rounding as before, and handed to the emitters of the invoice lines
+"""
+
+from collections import namedtuple
+from decimal import Decimal, ROUND_HALF_UP
+import frappe
+from frappe import _
+from zatca_erpgulf.zatca_erpgulf.xml_tax_data import (
+    get_item_tax_index,
+    get_item_tax_templates,
+    get_tax_for_item,
+)
+
+CENT = Decimal("0.01")
+TAX_CATEGORY_CODES = {
+    "Standard": "S",
+    "Zero Rated": "Z",
+    "Exempted": "E",
+    "Services outside scope of tax / Not subject to VAT": "O",
+}
+
+# text of the amounts of one <cac:InvoiceLine>, tax_percentage is the numeric rate
+LineAmounts = namedtuple(
+    "LineAmounts",
+    ["tax_percentage", "line_extension", "tax_amount", "rounding_amount", "price_amount"],
+)
+
+
+def get_tax_category_code(zatca_tax_category):
+    """code of a ZATCA tax category in <cac:ClassifiedTaxCategory>, None when unknown"""
+    return TAX_CATEGORY_CODES.get(zatca_tax_category)
+
+
+def get_template_tax_percentage(item_tax_template):
+    """tax rate of an Item Tax Template, 15 when it has no tax rows"""
+    return item_tax_template.taxes[0].tax_rate if item_tax_template.taxes else 15
+
+
+def get_pos_tax_row(pos_invoice_doc):
+    """first tax row of the Sales Taxes and Charges Template of the POS Profile"""
+    if not pos_invoice_doc.pos_profile:
+        frappe.throw(_("POS Profile is not set in the POS Invoice."))
+    taxes_and_charges = frappe.db.get_value(
+        "POS Profile", pos_invoice_doc.pos_profile, "taxes_and_charges"
+    )
+    taxes_template_doc = frappe.get_doc(
+        "Sales Taxes and Charges Template", taxes_and_charges
+    )
+    return taxes_template_doc.taxes[0]
+
+
+def get_sales_line_amounts(sales_invoice_doc):
+    """amounts of the sales invoice lines without Item Tax Template"""
+    tax_index = get_item_tax_index(sales_invoice_doc)
+    included_in_print_rate = sales_invoice_doc.taxes[0].included_in_print_rate
+    tax_rate = sales_invoice_doc.taxes[0].rate
+    divisor = 1 + tax_rate / 100
+    in_sar = sales_invoice_doc.currency == "SAR"
+    lines = []
+    for single_item in sales_invoice_doc.items:
+        _item_tax_amount, item_tax_percentage = get_tax_for_item(
+            tax_index, single_item.item_code
+        )
+        amount = single_item.base_amount if in_sar else single_item.amount
+        if included_in_print_rate == 1:
+            line_extension = str(abs(round(amount / divisor, 2)))
+            tax_amount = str(
+                abs(round(single_item.base_amount * tax_rate / (100 + tax_rate), 2))
+            )
+            price_amount = str(abs(round(single_item.rate / divisor, 2)))
+        else:
+            line_extension = str(abs(amount))
+            tax_amount = str(
+                Decimal(
+                    str(abs(item_tax_percentage * single_item.amount / 100))
+                ).quantize(CENT, rounding=ROUND_HALF_UP)
+            )
+            price_amount = str(abs(single_item.rate))
+        rounding_amount = str(round(float(line_extension) + float(tax_amount), 2))
+        lines.append(
+            LineAmounts(
+                item_tax_percentage,
+                line_extension,
+                tax_amount,
+                rounding_amount,
+                price_amount,
+            )
+        )
+    return lines
+
+
+def get_sales_template_line_amounts(sales_invoice_doc):
+    """amounts of the sales invoice lines with Item Tax Template"""
+    templates = get_item_tax_templates(sales_invoice_doc)
+    lines = []
+    for single_item in sales_invoice_doc.items:
+        item_tax_percentage = get_template_tax_percentage(
+            templates[single_item.item_tax_template]
+        )
+        percentage = Decimal(str(item_tax_percentage))
+        amount = Decimal(str(single_item.amount))
+        tax = percentage * amount / Decimal("100")
+        lines.append(
+            LineAmounts(
+                item_tax_percentage,
+                str(abs(single_item.amount)),
+                str(abs(tax.quantize(CENT, rounding=ROUND_HALF_UP))),
+                str(abs((amount + tax).quantize(CENT, rounding=ROUND_HALF_UP))),
+                f"{abs(single_item.rate):.6f}",
+            )
+        )
+    return lines
+
+
+def get_pos_line_amounts(pos_invoice_doc):
+    """amounts of the POS invoice lines without Item Tax Template"""
+    tax_index = get_item_tax_index(pos_invoice_doc)
+    included_in_print_rate = get_pos_tax_row(pos_invoice_doc).included_in_print_rate
+    divisor = 1 + pos_invoice_doc.taxes[0].rate / 100
+    in_sar = pos_invoice_doc.currency == "SAR"
+    lines = []
+    for single_item in pos_invoice_doc.items:
+        _item_tax_amount, item_tax_percentage = get_tax_for_item(
+            tax_index, single_item.item_code
+        )
+        amount = single_item.base_amount if in_sar else single_item.amount
+        if included_in_print_rate == 1:
+            line_extension = str(abs(round(amount / divisor, 2)))
+            price_amount = str(abs(round(single_item.rate / divisor, 2)))
+        else:
+            line_extension = str(abs(amount))
+            price_amount = str(
+                abs(single_item.price_list_rate) - abs(single_item.discount_amount)
+            )
+        tax_amount = str(
+            abs(round(item_tax_percentage * single_item.net_amount / 100, 2))
+        )
+        rounding_amount = str(round(float(line_extension) + float(tax_amount), 2))
+        lines.append(
+            LineAmounts(
+                item_tax_percentage,
+                line_extension,
+                tax_amount,
+                rounding_amount,
+                price_amount,
+            )
+        )
+    return lines
+
+
+def get_pos_template_line_amounts(pos_invoice_doc):
+    """amounts of the POS invoice lines with Item Tax Template"""
+    templates = get_item_tax_templates(pos_invoice_doc)
+    lines = []
+    for single_item in pos_invoice_doc.items:
+        item_tax_percentage = get_template_tax_percentage(
+            templates[single_item.item_tax_template]
+        )
+        tax = item_tax_percentage * single_item.amount / 100
+        lines.append(
+            LineAmounts(
+                item_tax_percentage,
+                str(abs(single_item.amount)),
+                str(abs(round(tax, 2))),
+                str(abs(round(single_item.amount + tax, 2))),
+                f"{abs(single_item.rate):.6f}",
+            )
+        )
+    return lines
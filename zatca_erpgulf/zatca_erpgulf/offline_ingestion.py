@@ -0,0 +1,249 @@
+"""
+Bulk reporting of the invoices GPOS devices signed while offline.
+After an outage a device pushes its backlog of signed invoices at once. The batch is
+grouped into signing units and handed to background jobs like a bulk resubmission,
+so the units are reported in parallel. Each job reads only the header of every signed
+xml with a streaming parse that stops at the invoice hash, checks that the ICV and
+PIH of each device's invoices follow on from one another and from the PIH last
+reported for it, and reports them in ICV order, committing after each invoice.
+Outcomes are recorded under a job handle read with get_resubmission_progress
+"""
+
+import frappe
+from frappe import _
+from frappe.utils import cint
+from lxml import etree
+from zatca_erpgulf.zatca_erpgulf.bulk_resubmission import (
+    acquire_unit_lock,
+    enqueue_invoice_units,
+    record_outcome,
+)
+from zatca_erpgulf.zatca_erpgulf.event_log import flush_zatca_events
+from zatca_erpgulf.zatca_erpgulf.signing_identity import SUPPORTED_INVOICES
+from zatca_erpgulf.zatca_erpgulf.submission_queue import (
+    UNIT_WAIT,
+    acquire_signing_unit,
+    hand_over_signing_unit,
+    release_signing_unit,
+)
+from zatca_erpgulf.zatca_erpgulf.zatca_config import MULTIPLE_SETTING, get_config
+
+CBC = "urn:oasis:names:specification:ubl:schema:xsd:CommonBasicComponents-2"
+CAC = "urn:oasis:names:specification:ubl:schema:xsd:CommonAggregateComponents-2"
+DS = "http://www.w3.org/2000/09/xmldsig#"
+UUID_TAG = f"{{{CBC}}}UUID"
+ID_TAG = f"{{{CBC}}}ID"
+BINARY_OBJECT_PATH = f".//{{{CBC}}}EmbeddedDocumentBinaryObject"
+DOCUMENT_REFERENCE_TAG = f"{{{CAC}}}AdditionalDocumentReference"
+REFERENCE_TAG = f"{{{DS}}}Reference"
+DIGEST_VALUE_TAG = f"{{{DS}}}DigestValue"
+HEADER_FIELDS = ("uuid", "digest_value")
+CHAIN_FIELDS = ("uuid", "digest_value", "icv", "pih")
+
+REPORTING_METHODS = {
+    "Sales Invoice": "zatca_erpgulf.zatca_erpgulf.sales_invoice_with_xmlqr.reporting_api_xml_sales_invoice",
+    "POS Invoice": "zatca_erpgulf.zatca_erpgulf.pos_submit_with_xml_qr.reporting_api_machine",
+}
+
+
+def read_signed_header(xml_path, fields=HEADER_FIELDS):
+    """UUID, invoice hash and with CHAIN_FIELDS the ICV and PIH of a signed invoice xml.
+    The file is parsed as a stream that stops once the fields are found, the invoice
+    lines after the signature are never read. Missing fields are left out"""
+    values = {}
+    # nosemgrep: frappe-semgrep-rules.rules.security.frappe-security-file-traversal
+    for _event, element in etree.iterparse(
+        xml_path,
+        events=("end",),
+        tag=(UUID_TAG, DOCUMENT_REFERENCE_TAG, DIGEST_VALUE_TAG),
+    ):
+        parent = element.getparent()
+        if element.tag == DIGEST_VALUE_TAG:
+            if parent.tag == REFERENCE_TAG and parent.get("Id") == "invoiceSignedData":
+                values["digest_value"] = element.text
+        elif element.tag == UUID_TAG:
+            # the UUID of the invoice itself, the ICV is a UUID one level deeper
+            if parent.getparent() is None:
+                values["uuid"] = element.text
+        else:
+            reference_id = element.findtext(ID_TAG)
+            if reference_id == "ICV":
+                values["icv"] = element.findtext(UUID_TAG)
+            elif reference_id == "PIH":
+                values["pih"] = element.findtext(BINARY_OBJECT_PATH)
+        if all(field in values for field in fields):
+            break
+    return values
+
+
+@frappe.whitelist()
+def ingest_offline_invoices(doctype: str, invoice_numbers: str):
+    """queue the reporting of a batch of invoices signed offline by GPOS devices and
+    return the job handle"""
+    if doctype not in SUPPORTED_INVOICES:
+        frappe.throw(_(f"Offline ingestion is not supported for {doctype}"))
+    frappe.has_permission(doctype, "submit", throw=True)
+    return enqueue_invoice_units(
+        "zatca_erpgulf.zatca_erpgulf.offline_ingestion.report_offline_units",
+        doctype,
+        invoice_numbers,
+    )
+
+
+def report_offline_units(units, doctype, resubmission_id):
+    """Background job reporting the offline invoices of its signing units in ICV order."""
+    frappe.flags.in_zatca_submission_job = True
+    try:
+        for unit, invoice_names in units.items():
+            drain = acquire_unit_lock(unit, invoice_names, doctype, resubmission_id)
+            if not drain:
+                continue
+            try:
+                for chain in get_device_chains(doctype, invoice_names, resubmission_id):
+                    report_chain(doctype, unit, chain, resubmission_id)
+            finally:
+                drain.release()
+    finally:
+        frappe.flags.in_zatca_submission_job = False
+        # after_job is not there on Frappe v14
+        flush_zatca_events()
+
+
+def get_skip_reason(invoice_doc):
+    """why an invoice of the batch is not reported, None when it is to be reported"""
+    if invoice_doc.custom_zatca_status in ["REPORTED", "CLEARED"]:
+        return invoice_doc.custom_zatca_status
+    if invoice_doc.docstatus != 1:
+        return _("Invoice is not submitted")
+    if not invoice_doc.custom_xml:
+        return _("Invoice has no signed xml from the device")
+    if not invoice_doc.custom_zatca_pos_name:
+        return _("ZATCA POS name is missing")
+    return None
+
+
+def get_device_chains(doctype, invoice_names, resubmission_id):
+    """invoices of a signing unit to report, one ICV ordered list per device with the
+    header of each signed xml. Invoices that are skipped or cannot be read are recorded"""
+    chains = {}
+    for invoice_name in invoice_names:
+        try:
+            invoice_doc = frappe.get_doc(doctype, invoice_name)
+            reason = get_skip_reason(invoice_doc)
+            if reason:
+                record_outcome(resubmission_id, doctype, invoice_name, "Skipped", reason)
+                continue
+            header = read_signed_header(
+                frappe.local.site + invoice_doc.custom_xml, CHAIN_FIELDS
+            )
+            missing = [field for field in CHAIN_FIELDS if not header.get(field)]
+            if missing:
+                record_outcome(
+                    resubmission_id,
+                    doctype,
+                    invoice_name,
+                    "Failed",
+                    _(f"Signed xml has no {', '.join(missing)}"),
+                )
+                continue
+            header["icv"] = cint(header["icv"])
+            chains.setdefault(invoice_doc.custom_zatca_pos_name, []).append(
+                (invoice_doc, header)
+            )
+        except (OSError, etree.XMLSyntaxError, frappe.DoesNotExistError) as e:
+            record_outcome(resubmission_id, doctype, invoice_name, "Failed", str(e))
+    for chain in chains.values():
+        chain.sort(key=lambda entry: entry[1]["icv"])
+    return list(chains.values())
+
+
+def get_reported_pih(pos_name):
+    """PIH last reported for a device, None when it shares the company chain with others"""
+    config = get_config(MULTIPLE_SETTING, pos_name)
+    if config.pih_doctype != MULTIPLE_SETTING:
+        return None
+    return frappe.db.get_value(MULTIPLE_SETTING, pos_name, "custom_pih")
+
+
+def report_chain(doctype, unit, chain, resubmission_id):
+    """report the ICV ordered invoices of one device, holding its signing unit one
+    invoice at a time. Once an invoice does not follow on from the one before it, or is
+    not reported, it and the rest of the chain fail so no gap is reported over"""
+    previous_icv = None
+    previous_hash = get_reported_pih(chain[0][0].custom_zatca_pos_name)
+    for position, (invoice_doc, header) in enumerate(chain):
+        if previous_icv is not None and header["icv"] != previous_icv + 1:
+            break_reason = _(
+                f"ICV {header['icv']} does not follow ICV {previous_icv} of the device"
+            )
+        elif previous_hash and header["pih"] != previous_hash:
+            break_reason = _(
+                f"PIH of ICV {header['icv']} is not the hash of the invoice before it"
+            )
+        else:
+            break_reason = None
+        if break_reason:
+            fail_chain(doctype, chain[position:], break_reason, resubmission_id)
+            return
+        if not acquire_signing_unit(unit, blocking_timeout=UNIT_WAIT):
+            fail_chain(
+                doctype,
+                chain[position:],
+                _(f"Signing unit {unit} is busy with another submission, try again later"),
+                resubmission_id,
+            )
+            return
+        try:
+            reported = report_offline_invoice(
+                doctype, invoice_doc, header, resubmission_id
+            )
+        finally:
+            release_signing_unit(unit)
+        hand_over_signing_unit(unit)
+        if not reported:
+            fail_chain(
+                doctype,
+                chain[position + 1 :],
+                _(f"Previous invoice {invoice_doc.name} of the device was not reported"),
+                resubmission_id,
+            )
+            return
+        previous_icv, previous_hash = header["icv"], header["digest_value"]
+
+
+def fail_chain(doctype, entries, reason, resubmission_id):
+    """record the remaining invoices of a broken chain as failed"""
+    for invoice_doc, _header in entries:
+        record_outcome(resubmission_id, doctype, invoice_doc.name, "Failed", reason)
+
+
+def report_offline_invoice(doctype, invoice_doc, header, resubmission_id):
+    """report one signed invoice and commit, an error only fails this invoice.
+    Returns whether ZATCA reported or cleared it"""
+    try:
+        frappe.get_attr(REPORTING_METHODS[doctype])(
+            header["uuid"],
+            header["digest_value"],
+            frappe.local.site + invoice_doc.custom_xml,
+            invoice_doc.name,
+            invoice_doc,
+        )
+        frappe.db.commit()
+    except Exception as e:
+        frappe.db.rollback()
+        frappe.log_error(
+            frappe.get_traceback(), f"Error reporting offline invoice {invoice_doc.name}"
+        )
+        record_outcome(resubmission_id, doctype, invoice_doc.name, "Failed", str(e))
+        return False
+    # a rejection is handled in the reporting call and leaves the invoice Not Submitted
+    zatca_status = frappe.db.get_value(doctype, invoice_doc.name, "custom_zatca_status")
+    reported = zatca_status in ["REPORTED", "CLEARED"]
+    record_outcome(
+        resubmission_id,
+        doctype,
+        invoice_doc.name,
+        "Completed" if reported else "Failed",
+        zatca_status,
+    )
+    return reported
@@ -0,0 +1,80 @@
+"""
+Cache of the supplier and customer party blocks of the invoice xml.
+The <cac:AccountingSupplierParty> of a company or cost center and the
+<cac:AccountingCustomerParty> of a customer are the same on every invoice they
+appear on, so each is built and validated once by the Sales or POS builder and kept
+in redis, ready to be appended to the invoice. The blocks are never changed once
+built. They are dropped when the Company, Cost Center, Customer or Address behind
+them is updated
+"""
+
+import frappe
+
+SUPPLIER_CACHE_KEY = "zatca_supplier_party"
+CUSTOMER_CACHE_KEY = "zatca_customer_party"
+
+
+def get_supplier_key(invoice_doc, uses_cost_center):
+    """key of the supplier block of an invoice, the cost center only counts when
+    the company reports per cost center"""
+    cost_center = invoice_doc.cost_center if uses_cost_center else ""
+    return f"{invoice_doc.doctype}::{invoice_doc.company}::{cost_center}"
+
+
+def get_customer_variant(invoice_doc):
+    """what else than the customer the customer block of an invoice depends on.
+    The invoice address is only read on Frappe v13 and the export flag only for
+    Sales Invoices, keeping them in always is simpler than telling the cases apart"""
+    return (
+        f"{invoice_doc.doctype}::{invoice_doc.customer_address or ''}"
+        f"::{invoice_doc.custom_zatca_export_invoice or 0}"
+    )
+
+
+def get_supplier_party(invoice_doc, uses_cost_center, builder):
+    """cached <cac:AccountingSupplierParty> of the invoice, built by builder on a miss"""
+    return frappe.cache().hget(
+        SUPPLIER_CACHE_KEY,
+        get_supplier_key(invoice_doc, uses_cost_center),
+        generator=lambda: builder(invoice_doc),
+    )
+
+
+def get_customer_party(invoice_doc, builder):
+    """cached <cac:AccountingCustomerParty> of the invoice, built by builder on a miss.
+    The blocks of a customer are kept together so they can be dropped together"""
+    cache = frappe.cache()
+    blocks = cache.hget(CUSTOMER_CACHE_KEY, invoice_doc.customer) or {}
+    variant = get_customer_variant(invoice_doc)
+    if variant not in blocks:
+        blocks[variant] = builder(invoice_doc)
+        cache.hset(CUSTOMER_CACHE_KEY, invoice_doc.customer, blocks)
+    return blocks[variant]
+
+
+def clear_supplier_parties(doc=None, method=None, *args, **kwargs):
+    """drop every supplier block once a Company or Cost Center changes"""
+    frappe.cache().delete_value(SUPPLIER_CACHE_KEY)
+
+
+def clear_customer_party(doc=None, method=None, old=None, new=None, merge=False):
+    """drop the blocks of a customer once it changes, under its old name too on a rename"""
+    cache = frappe.cache()
+    for name in {doc.name, old} - {None}:
+        cache.hdel(CUSTOMER_CACHE_KEY, name)
+
+
+def clear_address_parties(doc=None, method=None, *args, **kwargs):
+    """drop the blocks that may show an address once it changes: the customers it is
+    linked to and, as company and branch addresses are not told apart, every supplier"""
+    clear_supplier_parties()
+    cache = frappe.cache()
+    for link in doc.get("links") or []:
+        if link.link_doctype == "Customer":
+            cache.hdel(CUSTOMER_CACHE_KEY, link.link_name)
+
+
+def clear_all_parties():
+    """drop every block, the custom fields may have changed with the migrate"""
+    frappe.cache().delete_value(SUPPLIER_CACHE_KEY)
+    frappe.cache().delete_value(CUSTOMER_CACHE_KEY)
@@ -1,6 +1,7 @@
 """New function for print pdf a3"""
 
 from datetime import datetime
+import io
 import os
 import pikepdf
 import frappe
@@ -9,31 +10,41 @@ from frappe.utils.pdf import get_pdf
 from frappe import _
 from frappe.utils import get_site_path, get_url
 from frappe.model.document import Document
+from zatca_erpgulf.zatca_erpgulf.async_submission import enqueue_once
+from zatca_erpgulf.zatca_erpgulf.zatca_config import get_company_config
 
+PDF_A3_QUEUE = "long"
+PDF_A3_JOB_TIMEOUT = 10 * 60
+_icc_profile = None
 
-def generate_invoice_pdf(invoice, language, letterhead=None, print_format=None):
-    """Function for generating invoice PDF based on the provided print format, letterhead, and language."""
 
+def render_invoice_pdf(invoice, language, letterhead=None, print_format=None):
+    """render the print format of the invoice in the given language to PDF bytes"""
     # Set the language for the PDF generation
-    invoice_name = invoice.name
     original_language = frappe.local.lang
     frappe.local.lang = language
+    try:
+        # Generate HTML content for the invoice
+        html = frappe.get_print(
+            doctype="Sales Invoice",
+            name=invoice.name,  # Use the invoice's name directly
+            print_format=print_format,  # Use the selected print format
+            no_letterhead=not bool(letterhead),  # Use letterhead only if specified
+            letterhead=letterhead,  # Specify the letterhead if provided
+        )
+    finally:
+        # Revert back to the original language
+        frappe.local.lang = original_language
 
-    # Generate HTML content for the invoice
-    html = frappe.get_print(
-        doctype="Sales Invoice",
-        name=invoice_name,  # Use the invoice's name directly
-        print_format=print_format,  # Use the selected print format
-        no_letterhead=not bool(letterhead),  # Use letterhead only if specified
-        letterhead=letterhead,  # Specify the letterhead if provided
-    )
+    # Generate PDF content from the HTML
+    return get_pdf(html)
 
-    # Revert back to the original language
-    frappe.local.lang = original_language
 
-    # Generate PDF content from the HTML
-    pdf_content = get_pdf(html)
-    safe_invoice_name = invoice_name.replace("/", "-")
+def generate_invoice_pdf(invoice, language, letterhead=None, print_format=None):
+    """Function for generating invoice PDF based on the provided print format, letterhead, and language."""
+
+    pdf_content = render_invoice_pdf(invoice, language, letterhead, print_format)
+    safe_invoice_name = invoice.name.replace("/", "-")
     # Set the path for saving the generated PDF
     site_path = frappe.local.site  # Get the site path
     file_name = f"{safe_invoice_name}.pdf"
@@ -48,13 +59,22 @@ def generate_invoice_pdf(invoice, language, letterhead=None, print_format=None):
     return file_path
 
 
-def embed_file_in_pdf_1(input_pdf, xml_file, output_pdf):
-    """embed the pdf file"""
-    app_path = frappe.get_app_path("zatca_erpgulf")
-    icc_path = app_path + "/sRGB.icc"
+def get_icc_profile():
+    """sRGB ICC profile of the PDF/A-3 output intent, read once per process"""
+    global _icc_profile
+    if _icc_profile is None:
+        icc_path = frappe.get_app_path("zatca_erpgulf") + "/sRGB.icc"
+        with open(icc_path, "rb") as icc_file:  # nosemgrep: frappe-semgrep-rules.rules.security.frappe-security-file-traversal
+            _icc_profile = icc_file.read()
+    return _icc_profile
+
+
+def write_pdf_a3(pdf_content, xml_data, xml_file_name, output_pdf):
+    """open the rendered PDF once, embed the XML, XMP metadata and the sRGB output
+    intent and save it as PDF/A-3 in a single write"""
+    with pikepdf.open(io.BytesIO(pdf_content)) as pdf:
+        pdf.attachments["invoice.xml"] = xml_data
 
-    # frappe.throw(icc_path)
-    with pikepdf.open(input_pdf, allow_overwriting_input=True) as pdf:
         # Open metadata for editing
         with pdf.open_metadata() as metadata:
             metadata["pdf:Trapped"] = "False"
@@ -111,10 +131,6 @@ def embed_file_in_pdf_1(input_pdf, xml_file, output_pdf):
         pdf.Root["/Lang"] = pikepdf.String("en-US")
 
         # Embed the XML file
-        # nosemgrep: frappe-semgrep-rules.rules.security.frappe-security-file-traversal
-        with open(xml_file, "rb") as xml_f:
-            xml_data = xml_f.read()
-
         embedded_file_stream = pdf.make_stream(xml_data)
         embedded_file_stream.Type = "/EmbeddedFile"
         embedded_file_stream.Subtype = "/application/xml"
@@ -122,7 +138,7 @@ def embed_file_in_pdf_1(input_pdf, xml_file, output_pdf):
         embedded_file_dict = pikepdf.Dictionary(
             {
                 "/Type": "/Filespec",
-                "/F": pikepdf.String(os.path.basename(xml_file)),
+                "/F": pikepdf.String(xml_file_name),
                 "/EF": pikepdf.Dictionary({"/F": embedded_file_stream}),
                 "/Desc": "XML Invoice",
             }
@@ -136,26 +152,24 @@ def embed_file_in_pdf_1(input_pdf, xml_file, output_pdf):
             pdf.Root.Names.EmbeddedFiles.Names = pikepdf.Array()
 
         pdf.Root.Names.EmbeddedFiles.Names.append(
-            pikepdf.String(os.path.basename(xml_file))
+            pikepdf.String(xml_file_name)
         )
         pdf.Root.Names.EmbeddedFiles.Names.append(embedded_file_dict)
 
         # Set OutputIntent
-        with open(icc_path, "rb") as icc_file:  # nosemgrep: frappe-semgrep-rules.rules.security.frappe-security-file-traversal
-            icc_data = icc_file.read()
-            output_intent_dict = pikepdf.Dictionary(
-                {
-                    "/Type": "/OutputIntent",
-                    "/S": "/GTS_PDFA1",
-                    "/OutputConditionIdentifier": "sRGB",
-                    "/Info": "sRGB IEC61966-2.1",
-                    "/DestOutputProfile": pdf.make_stream(icc_data),
-                }
-            )
-            if "/OutputIntents" not in pdf.Root:
-                pdf.Root["/OutputIntents"] = pikepdf.Array([output_intent_dict])
-            else:
-                pdf.Root.OutputIntents.append(output_intent_dict)
+        output_intent_dict = pikepdf.Dictionary(
+            {
+                "/Type": "/OutputIntent",
+                "/S": "/GTS_PDFA1",
+                "/OutputConditionIdentifier": "sRGB",
+                "/Info": "sRGB IEC61966-2.1",
+                "/DestOutputProfile": pdf.make_stream(get_icc_profile()),
+            }
+        )
+        if "/OutputIntents" not in pdf.Root:
+            pdf.Root["/OutputIntents"] = pikepdf.Array([output_intent_dict])
+        else:
+            pdf.Root.OutputIntents.append(output_intent_dict)
 
         # Add PDF/A-3 compliance information
         pdf.Root["/GTS_PDFA1"] = pikepdf.Name("/PDF/A-3B")
@@ -224,7 +238,7 @@ def embed_file_in_pdf(invoice_name :str, print_format :str | None = None, letter
         # frappe.throw(str(attachments))
         if not xml_file:
             frappe.throw(_(f"No XML file found for the invoice {invoice_name}!"))
-        input_pdf = generate_invoice_pdf(
+        pdf_content = render_invoice_pdf(
             invoice_number,
             language=language,
             letterhead=letterhead,
@@ -235,47 +249,60 @@ def embed_file_in_pdf(invoice_name :str, print_format :str | None = None, letter
         final_pdf = (
             frappe.local.site + "/private/files/PDF-A3 " + safe_invoice_name + " output.pdf"
         )
-        # frappe.msgprint(f"Embedding XML into: {input_pdf}")
-        with pikepdf.Pdf.open(input_pdf, allow_overwriting_input=True) as pdf:
-            with open(xml_file, "rb") as xml_attachment: # nosemgrep: frappe-semgrep-rules.rules.security.frappe-security-file-traversal
-                pdf.attachments["invoice.xml"] = xml_attachment.read()
-            pdf.save(input_pdf)
-            embed_file_in_pdf_1(input_pdf, xml_file, final_pdf)
-
-            file_doc = frappe.get_doc(
-                {
-                    "doctype": "File",
-                    "file_url": "/private/files/PDF-A3 " + safe_invoice_name + " output.pdf",
-                    "attached_to_doctype": "Sales Invoice",
-                    "attached_to_name": invoice_name,
-                    "is_private": 1,  # Make the file private
-                }
-            )
+        with open(xml_file, "rb") as xml_attachment: # nosemgrep: frappe-semgrep-rules.rules.security.frappe-security-file-traversal
+            xml_data = xml_attachment.read()
+        write_pdf_a3(pdf_content, xml_data, os.path.basename(xml_file), final_pdf)
+
+        file_doc = frappe.get_doc(
+            {
+                "doctype": "File",
+                "file_url": "/private/files/PDF-A3 " + safe_invoice_name + " output.pdf",
+                "attached_to_doctype": "Sales Invoice",
+                "attached_to_name": invoice_name,
+                "is_private": 1,  # Make the file private
+            }
+        )
         file_doc.insert(ignore_permissions=True)
-        # frappe.msgprint(f"XML successfully embedded into: {input_pdf}")
         # frappe.throw(file_doc.file_url)
         return get_url(file_doc.file_url)
 
     except pikepdf.PdfError as e:
+        frappe.log_error(frappe.get_traceback(), "PDF-A3 XML Embed Error")
         frappe.msgprint(_(f"Error processing the PDF: {e}"))
     except FileNotFoundError as e:
+        frappe.log_error(frappe.get_traceback(), "PDF-A3 XML Embed Error")
         frappe.msgprint(_(f"File not found: {e}"))
     except IOError as e:
+        frappe.log_error(frappe.get_traceback(), "PDF-A3 XML Embed Error")
         frappe.msgprint(_(f"I/O error: {e}"))  # Step 1: Embed the XML into the input
 
 
 
 
 
+def get_pdf_a3_job_id(invoice_name):
+    """job id deduplicating the PDF/A-3 jobs of an invoice"""
+    return f"zatca_pdf_a3::{invoice_name}"
+
+
 def call_embed_pdf_on_submit(doc, method=None):
-    """Run on Sales Invoice submit only if Company setting is enabled"""
+    """Queue the PDF/A-3 of a reported or cleared Sales Invoice if the Company setting
+    is enabled"""
 
-    company_doc = frappe.get_doc("Company", doc.company)
+    company_doc = get_company_config(doc.company)
 
     # Check if auto PDF-A3 creation is enabled
     if not company_doc.custom_auto_create_pdfa3:
         return
 
+    # the xml it embeds is only there once ZATCA reported or cleared the invoice. An
+    # invoice queued behind a busy signing unit gets its PDF/A-3 from the submission job
+    if frappe.db.get_value("Sales Invoice", doc.name, "custom_zatca_status") not in [
+        "REPORTED",
+        "CLEARED",
+    ]:
+        return
+
     print_format = company_doc.custom_print_format
     letterhead = company_doc.custom_letterhead
     language = company_doc.custom_language
@@ -289,12 +316,28 @@ def call_embed_pdf_on_submit(doc, method=None):
         frappe.msgprint(_("Company Language is not set. PDF-A3 creation skipped."))
         return
 
+    # the XML attachment it embeds is only visible to the job once the submit commits
+    enqueue_once(
+        "zatca_erpgulf.zatca_erpgulf.pdf_a3.create_pdf_a3",
+        get_pdf_a3_job_id(doc.name),
+        queue=PDF_A3_QUEUE,
+        timeout=PDF_A3_JOB_TIMEOUT,
+        enqueue_after_commit=True,
+        invoice_name=doc.name,
+        print_format=print_format,
+        letterhead=letterhead,
+        language=language,
+    )
+
+
+def create_pdf_a3(invoice_name, print_format, letterhead, language):
+    """Background job creating the PDF/A-3 of a submitted Sales Invoice"""
     try:
         embed_file_in_pdf(
-            invoice_name=doc.name,
+            invoice_name=invoice_name,
             print_format=print_format,
             letterhead=letterhead,
             language=language
         )
     except Exception:
-        frappe.log_error(frappe.get_traceback(), "PDF-A3 XML Embed Error")
\ No newline at end of file
+        frappe.log_error(frappe.get_traceback(), "PDF-A3 XML Embed Error")
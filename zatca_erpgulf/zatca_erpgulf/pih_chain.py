@@ -0,0 +1,127 @@
+"""
+Single writer PIH chain of every signing unit.
+A signing unit, a Company or a ZATCA Multiple Setting with its own keys, hands the
+hash of each invoice it signs on to the next one as its PIH. The zatca_call functions
+run with the unit held, from reading the PIH into the xml to storing the hash of the
+reported or cleared invoice, so two submissions of one unit queue behind each other
+instead of signing over the same PIH, while other units sign in parallel. A request
+that finds the unit still busy after a short wait hands its invoice to the submission
+job instead of holding up the user. The PIH is read and stored as a single column of
+the Company or ZATCA Multiple Setting instead of saving the whole document, which kept
+its row locked for the rest of the request
+"""
+
+import functools
+import frappe
+from frappe import _
+from zatca_erpgulf.zatca_erpgulf.async_submission import (
+    enqueue_submission_job,
+    in_submission_job,
+    publish_progress,
+)
+from zatca_erpgulf.zatca_erpgulf.stage_timing import (
+    finish_invoice_timing,
+    start_invoice_timing,
+    timed_stage,
+)
+from zatca_erpgulf.zatca_erpgulf.submission_queue import (
+    UNIT_WAIT,
+    acquire_signing_unit,
+    release_signing_unit,
+)
+from zatca_erpgulf.zatca_erpgulf.zatca_config import (
+    MULTIPLE_SETTING,
+    get_company_config,
+    get_config,
+)
+
+# a request only waits for an invoice in flight that is about done
+REQUEST_UNIT_WAIT = 5
+
+
+def get_pih_holder(invoice_doc):
+    """doctype and name of the document holding the PIH of the invoice's signing unit.
+    Its name is the signing unit get_signing_units groups the invoice in. An Advance
+    Sales Invoice has no EGS unit of its own and chains on its company"""
+    if invoice_doc.get("custom_zatca_pos_name"):
+        config = get_config(MULTIPLE_SETTING, invoice_doc.custom_zatca_pos_name)
+    else:
+        config = get_company_config(invoice_doc.company)
+    return config.pih_doctype, config.pih_name
+
+
+def get_unit_pih(invoice_doc):
+    """PIH the invoice extends, the hash of the last invoice of its signing unit.
+    The row is read with a lock, as a plain read in a transaction opened before the unit
+    was taken would see the PIH of its snapshot instead of the one the last holder stored"""
+    pih_doctype, pih_name = get_pih_holder(invoice_doc)
+    return frappe.db.get_value(pih_doctype, pih_name, "custom_pih", for_update=True)
+
+
+def set_unit_pih(invoice_doc, encoded_hash):
+    """move the PIH of the invoice's signing unit on to the hash of the invoice"""
+    pih_doctype, pih_name = get_pih_holder(invoice_doc)
+    frappe.db.set_value(
+        pih_doctype, pih_name, "custom_pih", encoded_hash, update_modified=False
+    )
+
+
+def hold_signing_unit(doctype):
+    """run a zatca_call(invoice_number, ...) function with the signing unit of the
+    invoice held, waiting for the submission ahead of it in the same unit. A request
+    that cannot get the unit queues the submission job of the invoice instead.
+    A sampled call is timed stage by stage"""
+
+    def decorator(zatca_call):
+        @functools.wraps(zatca_call)
+        def wrapper(invoice_number, *args, **kwargs):
+            invoice = frappe.db.get_value(
+                doctype,
+                invoice_number,
+                ["company", "custom_zatca_pos_name"],
+                as_dict=True,
+            )
+            if not invoice:
+                # the call throws its own invalid invoice error
+                return zatca_call(invoice_number, *args, **kwargs)
+            unit = get_pih_holder(invoice)[1]
+            timed = start_invoice_timing(doctype, invoice_number, invoice.company, unit)
+            try:
+                in_job = in_submission_job()
+                with timed_stage("unit_wait"):
+                    held = acquire_signing_unit(
+                        unit, blocking_timeout=UNIT_WAIT if in_job else REQUEST_UNIT_WAIT
+                    )
+                if not held:
+                    if in_job:
+                        frappe.throw(
+                            _(
+                                f"Signing unit {unit} is busy with another submission, "
+                                "please try again in a moment."
+                            )
+                        )
+                    queue_busy_unit_invoice(doctype, invoice_number, unit)
+                    return None
+                try:
+                    return zatca_call(invoice_number, *args, **kwargs)
+                finally:
+                    release_signing_unit(unit)
+            finally:
+                if timed:
+                    finish_invoice_timing()
+
+        return wrapper
+
+    return decorator
+
+
+def queue_busy_unit_invoice(doctype, invoice_number, unit):
+    """hand an invoice whose signing unit is busy to the submission job, which waits
+    for the unit instead of the user"""
+    enqueue_submission_job(doctype, invoice_number, bypass_background_check=True)
+    message = _(
+        f"Signing unit {unit} is busy with another submission, the invoice is queued "
+        "for submission to ZATCA."
+    )
+    publish_progress(doctype, invoice_number, "Queued", message, after_commit=True)
+    frappe.msgprint(message)
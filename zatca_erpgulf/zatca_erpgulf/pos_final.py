@@ -11,15 +11,20 @@ for ZATCA and provides support for multiple currencies (SAR and USD).
 """
 
 import xml.etree.ElementTree as ET
-from xml.dom import minidom
+from lxml import etree
 from frappe import _
 import frappe
-import json
+from zatca_erpgulf.zatca_erpgulf.xml_tax_data import get_item_tax_templates
 from zatca_erpgulf.zatca_erpgulf.posxml import (
     get_exemption_reason_map,
-    get_tax_for_item,
     add_line_item_discount,
 )
+from zatca_erpgulf.zatca_erpgulf.line_amounts import (
+    get_pos_line_amounts,
+    get_pos_template_line_amounts,
+    get_tax_category_code,
+)
+from zatca_erpgulf.zatca_erpgulf.zatca_config import get_company_config
 
 
 ITEM_TAX_TEMPLATE = "Item Tax Template"
@@ -30,12 +35,11 @@ CBC_TAX_AMOUNT = "cbc:TaxAmount"
 def tax_data_with_template(invoice, pos_invoice_doc):
     """ "function for tax data with template"""
     try:
+        item_tax_templates = get_item_tax_templates(pos_invoice_doc)
         # Initialize tax category totals
         tax_category_totals = {}
         for item in pos_invoice_doc.items:
-            item_tax_template = frappe.get_doc(
-                ITEM_TAX_TEMPLATE, item.item_tax_template
-            )
+            item_tax_template = item_tax_templates[item.item_tax_template]
             zatca_tax_category = item_tax_template.custom_zatca_tax_category
 
             if zatca_tax_category not in tax_category_totals:
@@ -111,9 +115,7 @@ def tax_data_with_template(invoice, pos_invoice_doc):
 
         tax_category_totals = {}
         for item in pos_invoice_doc.items:
-            item_tax_template = frappe.get_doc(
-                ITEM_TAX_TEMPLATE, item.item_tax_template
-            )
+            item_tax_template = item_tax_templates[item.item_tax_template]
             zatca_tax_category = item_tax_template.custom_zatca_tax_category
 
             if zatca_tax_category not in tax_category_totals:
@@ -142,9 +144,7 @@ def tax_data_with_template(invoice, pos_invoice_doc):
         ] -= pos_invoice_doc.get("discount_amount", 0.0)
 
         for item in pos_invoice_doc.items:
-            item_tax_template = frappe.get_doc(
-                ITEM_TAX_TEMPLATE, item.item_tax_template
-            )
+            item_tax_template = item_tax_templates[item.item_tax_template]
             zatca_tax_category = item_tax_template.custom_zatca_tax_category
 
             if zatca_tax_category not in tax_category_totals:
@@ -272,29 +272,17 @@ def tax_data_with_template(invoice, pos_invoice_doc):
         frappe.throw(_(f"Data processing error in tax data with template: {str(e)}"))
 
 
-def get_tax_wise_detail(pos_invoice_doc,single_item):
-    """getting item wise tax"""
-    if int(frappe.__version__.split(".", 1)[0]) == 16 and pos_invoice_doc.item_wise_tax_details:
-        tax_rate = float(f"{pos_invoice_doc.item_wise_tax_details[0].rate:.1f}")
-        tax_amount = pos_invoice_doc.item_wise_tax_details[0].amount
-
-        # build JSON exactly like v15
-        tax_json = json.dumps({
-            single_item.item_code: [tax_rate, float(tax_amount)]
-        })
-    else:
-        tax_json = pos_invoice_doc.taxes[0].item_wise_tax_detail
-    return tax_json
-
-def item_data(invoice, pos_invoice_doc):
-    """Function for item data"""
+def iter_item_lines(pos_invoice_doc):
+    """<cac:InvoiceLine> elements without item tax template, built one line at a time"""
     try:
-        for single_item in pos_invoice_doc.items:
-            tax_json = get_tax_wise_detail(pos_invoice_doc,single_item)
-            _item_tax_amount, item_tax_percentage = get_tax_for_item(
-                tax_json, single_item.item_code
-            )
-            cac_invoiceline = ET.SubElement(invoice, "cac:InvoiceLine")
+        line_amounts = get_pos_line_amounts(pos_invoice_doc)
+        tax_category_code = get_tax_category_code(pos_invoice_doc.custom_zatca_tax_category)
+        submit_line_item_discount = (
+            get_company_config(pos_invoice_doc.company).custom_submit_line_item_discount_to_zatca
+            == 1
+        )
+        for single_item, amounts in zip(pos_invoice_doc.items, line_amounts):
+            cac_invoiceline = ET.Element("cac:InvoiceLine")
             cbc_id_10 = ET.SubElement(cac_invoiceline, "cbc:ID")
             cbc_id_10.text = str(single_item.idx)
             cbc_invoicedquantity = ET.SubElement(
@@ -306,53 +294,14 @@ def item_data(invoice, pos_invoice_doc):
                 cac_invoiceline, "cbc:LineExtensionAmount"
             )
             cbc_lineextensionamount_1.set("currencyID", pos_invoice_doc.currency)
-            pos_profile = pos_invoice_doc.pos_profile
-            if not pos_profile:
-                frappe.throw(_("POS Profile is not set in the POS Invoice."))
-            pos_profile_doc = frappe.get_doc("POS Profile", pos_profile)
-            taxes_and_charges = pos_profile_doc.taxes_and_charges
-            taxes_template_doc = frappe.get_doc(
-                "Sales Taxes and Charges Template", taxes_and_charges
-            )
-            tax_rate = taxes_template_doc.taxes[0]
-            if pos_invoice_doc.currency == "SAR":
-                if tax_rate.included_in_print_rate == 0:
-                    cbc_lineextensionamount_1.text = str(abs(single_item.base_amount))
-                elif tax_rate.included_in_print_rate == 1:
-                    cbc_lineextensionamount_1.text = str(
-                        abs(
-                            round(
-                                single_item.base_amount
-                                / (1 + pos_invoice_doc.taxes[0].rate / 100),
-                                2,
-                            )
-                        )
-                    )
-
-            else:
-                if tax_rate.included_in_print_rate == 0:
-                    cbc_lineextensionamount_1.text = str(abs(single_item.amount))
-                elif tax_rate.included_in_print_rate == 1:
-                    cbc_lineextensionamount_1.text = str(
-                        abs(
-                            round(
-                                single_item.amount
-                                / (1 + pos_invoice_doc.taxes[0].rate / 100),
-                                2,
-                            )
-                        )
-                    )
+            cbc_lineextensionamount_1.text = amounts.line_extension
             cac_taxtotal_2 = ET.SubElement(cac_invoiceline, CAC_TAX_TOTAL)
             cbc_taxamount_3 = ET.SubElement(cac_taxtotal_2, CBC_TAX_AMOUNT)
             cbc_taxamount_3.set("currencyID", pos_invoice_doc.currency)
-            cbc_taxamount_3.text = str(
-                abs(round(item_tax_percentage * single_item.net_amount / 100, 2))
-            )
+            cbc_taxamount_3.text = amounts.tax_amount
             cbc_roundingamount = ET.SubElement(cac_taxtotal_2, "cbc:RoundingAmount")
             cbc_roundingamount.set("currencyID", pos_invoice_doc.currency)
-            lineextensionamount = float(cbc_lineextensionamount_1.text)
-            taxamount = float(cbc_taxamount_3.text)
-            cbc_roundingamount.text = str(round(lineextensionamount + taxamount, 2))
+            cbc_roundingamount.text = amounts.rounding_amount
             cac_item = ET.SubElement(cac_invoiceline, "cac:Item")
             cbc_name = ET.SubElement(cac_item, "cbc:Name")
             cbc_name.text = f"{single_item.item_code}:{single_item.item_name}"
@@ -360,89 +309,47 @@ def item_data(invoice, pos_invoice_doc):
                 cac_item, "cac:ClassifiedTaxCategory"
             )
             cbc_id_11 = ET.SubElement(cac_classifiedtaxcategory, "cbc:ID")
-            if pos_invoice_doc.custom_zatca_tax_category == "Standard":
-                cbc_id_11.text = "S"
-            elif pos_invoice_doc.custom_zatca_tax_category == "Zero Rated":
-                cbc_id_11.text = "Z"
-            elif pos_invoice_doc.custom_zatca_tax_category == "Exempted":
-                cbc_id_11.text = "E"
-            elif (
-                pos_invoice_doc.custom_zatca_tax_category
-                == "Services outside scope of tax / Not subject to VAT"
-            ):
-                cbc_id_11.text = "O"
+            cbc_id_11.text = tax_category_code
             cbc_percent_2 = ET.SubElement(cac_classifiedtaxcategory, "cbc:Percent")
-            cbc_percent_2.text = f"{float(item_tax_percentage):.2f}"
+            cbc_percent_2.text = f"{float(amounts.tax_percentage):.2f}"
             cac_taxscheme_4 = ET.SubElement(cac_classifiedtaxcategory, "cac:TaxScheme")
             cbc_id_12 = ET.SubElement(cac_taxscheme_4, "cbc:ID")
             cbc_id_12.text = "VAT"
             cac_price = ET.SubElement(cac_invoiceline, "cac:Price")
             cbc_priceamount = ET.SubElement(cac_price, "cbc:PriceAmount")
             cbc_priceamount.set("currencyID", pos_invoice_doc.currency)
-            company_name = pos_invoice_doc.company
-            settings = frappe.get_doc("Company", company_name)
-            if settings.custom_submit_line_item_discount_to_zatca != 1:
-                if tax_rate.included_in_print_rate == 0:
-                    cbc_priceamount.text = str(
-                        abs(single_item.price_list_rate)
-                        - abs(single_item.discount_amount)
-                    )
-                elif tax_rate.included_in_print_rate == 1:
-                    cbc_priceamount.text = str(
-                        abs(
-                            round(
-                                single_item.rate
-                                / (1 + pos_invoice_doc.taxes[0].rate / 100),
-                                2,
-                            )
-                        )
-                    )
-            if settings.custom_submit_line_item_discount_to_zatca == 1:
-                if tax_rate.included_in_print_rate == 0:
-                    cbc_priceamount.text = str(
-                        abs(single_item.price_list_rate)
-                        - abs(single_item.discount_amount)
-                    )
-                    cbc_basequantity = ET.SubElement(
-                        cac_price, "cbc:BaseQuantity", unitCode=str(single_item.uom)
-                    )
-                    cbc_basequantity.text = "1"
-
-                    add_line_item_discount(cac_price, single_item, pos_invoice_doc)
-                elif tax_rate.included_in_print_rate == 1:
-                    cbc_priceamount.text = str(
-                        abs(
-                            round(
-                                single_item.rate
-                                / (1 + pos_invoice_doc.taxes[0].rate / 100),
-                                2,
-                            )
-                        )
-                    )
-                    cbc_basequantity = ET.SubElement(
-                        cac_price, "cbc:BaseQuantity", unitCode=str(single_item.uom)
-                    )
-                    cbc_basequantity.text = "1"
-
-                    add_line_item_discount(cac_price, single_item, pos_invoice_doc)
+            cbc_priceamount.text = amounts.price_amount
+            if submit_line_item_discount:
+                cbc_basequantity = ET.SubElement(
+                    cac_price, "cbc:BaseQuantity", unitCode=str(single_item.uom)
+                )
+                cbc_basequantity.text = "1"
 
-        return invoice
+                add_line_item_discount(cac_price, single_item, pos_invoice_doc)
+            yield cac_invoiceline
     except (AttributeError, KeyError, ValueError, TypeError) as e:
         frappe.throw(_(f"Data processing error in item data: {str(e)}"))
 
 
-def item_data_with_template(invoice, pos_invoice_doc):
-    """function for item data with template"""
+def item_data(invoice, pos_invoice_doc):
+    """Function for item data"""
+    invoice.extend(iter_item_lines(pos_invoice_doc))
+    return invoice
+
+
+def iter_item_lines_with_template(pos_invoice_doc):
+    """<cac:InvoiceLine> elements with item tax template, built one line at a time"""
     try:
-        for single_item in pos_invoice_doc.items:
-            item_tax_template = frappe.get_doc(
-                ITEM_TAX_TEMPLATE, single_item.item_tax_template
-            )
-            item_tax_percentage = (
-                item_tax_template.taxes[0].tax_rate if item_tax_template.taxes else 15
-            )
+        item_tax_templates = get_item_tax_templates(pos_invoice_doc)
+        line_amounts = get_pos_template_line_amounts(pos_invoice_doc)
+        submit_line_item_discount = (
+            get_company_config(pos_invoice_doc.company).custom_submit_line_item_discount_to_zatca
+            == 1
+        )
+        for single_item, amounts in zip(pos_invoice_doc.items, line_amounts):
+            item_tax_template = item_tax_templates[single_item.item_tax_template]
 
-            cac_invoiceline = ET.SubElement(invoice, "cac:InvoiceLine")
+            cac_invoiceline = ET.Element("cac:InvoiceLine")
             cbc_id_10 = ET.SubElement(cac_invoiceline, "cbc:ID")
             cbc_id_10.text = str(single_item.idx)
             cbc_invoicedquantity = ET.SubElement(
@@ -454,25 +361,15 @@ def item_data_with_template(invoice, pos_invoice_doc):
                 cac_invoiceline, "cbc:LineExtensionAmount"
             )
             cbc_lineextensionamount_1.set("currencyID", pos_invoice_doc.currency)
-            cbc_lineextensionamount_1.text = str(abs(single_item.amount))
+            cbc_lineextensionamount_1.text = amounts.line_extension
 
             cac_taxtotal_2 = ET.SubElement(cac_invoiceline, CAC_TAX_TOTAL)
             cbc_taxamount_3 = ET.SubElement(cac_taxtotal_2, CBC_TAX_AMOUNT)
             cbc_taxamount_3.set("currencyID", pos_invoice_doc.currency)
-            cbc_taxamount_3.text = str(
-                abs(round(item_tax_percentage * single_item.amount / 100, 2))
-            )
+            cbc_taxamount_3.text = amounts.tax_amount
             cbc_roundingamount = ET.SubElement(cac_taxtotal_2, "cbc:RoundingAmount")
             cbc_roundingamount.set("currencyID", pos_invoice_doc.currency)
-            cbc_roundingamount.text = str(
-                abs(
-                    round(
-                        single_item.amount
-                        + (item_tax_percentage * single_item.amount / 100),
-                        2,
-                    )
-                )
-            )
+            cbc_roundingamount.text = amounts.rounding_amount
 
             cac_item = ET.SubElement(cac_invoiceline, "cac:Item")
             cbc_name = ET.SubElement(cac_item, "cbc:Name")
@@ -482,58 +379,48 @@ def item_data_with_template(invoice, pos_invoice_doc):
                 cac_item, "cac:ClassifiedTaxCategory"
             )
             cbc_id_11 = ET.SubElement(cac_classifiedtaxcategory, "cbc:ID")
-            zatca_tax_category = item_tax_template.custom_zatca_tax_category
-            if zatca_tax_category == "Standard":
-                cbc_id_11.text = "S"
-            elif zatca_tax_category == "Zero Rated":
-                cbc_id_11.text = "Z"
-            elif zatca_tax_category == "Exempted":
-                cbc_id_11.text = "E"
-            elif (
-                zatca_tax_category
-                == "Services outside scope of tax / Not subject to VAT"
-            ):
-                cbc_id_11.text = "O"
+            cbc_id_11.text = get_tax_category_code(
+                item_tax_template.custom_zatca_tax_category
+            )
 
             cbc_percent_2 = ET.SubElement(cac_classifiedtaxcategory, "cbc:Percent")
-            cbc_percent_2.text = f"{float(item_tax_percentage):.2f}"
+            cbc_percent_2.text = f"{float(amounts.tax_percentage):.2f}"
             cac_taxscheme_4 = ET.SubElement(cac_classifiedtaxcategory, "cac:TaxScheme")
             cbc_id_12 = ET.SubElement(cac_taxscheme_4, "cbc:ID")
             cbc_id_12.text = "VAT"
             cac_price = ET.SubElement(cac_invoiceline, "cac:Price")
             cbc_priceamount = ET.SubElement(cac_price, "cbc:PriceAmount")
             cbc_priceamount.set("currencyID", pos_invoice_doc.currency)
-            company_name = pos_invoice_doc.company
-            settings = frappe.get_doc("Company", company_name)
-            if settings.custom_submit_line_item_discount_to_zatca != 1:
-                cbc_priceamount.text = f"{abs(single_item.rate):.6f}"
-            if settings.custom_submit_line_item_discount_to_zatca == 1:
-                cbc_priceamount.text = f"{abs(single_item.rate):.6f}"
+            cbc_priceamount.text = amounts.price_amount
+            if submit_line_item_discount:
                 cbc_basequantity = ET.SubElement(
                     cac_price, "cbc:BaseQuantity", unitCode=str(single_item.uom)
                 )
                 cbc_basequantity.text = "1"
 
                 add_line_item_discount(cac_price, single_item, pos_invoice_doc)
-
-        return invoice
+            yield cac_invoiceline
     except (AttributeError, KeyError, ValueError, TypeError) as e:
         frappe.throw(
             _(f"Data processing error in item tax with template data: {str(e)}")
         )
 
 
+def item_data_with_template(invoice, pos_invoice_doc):
+    """function for item data with template"""
+    invoice.extend(iter_item_lines_with_template(pos_invoice_doc))
+    return invoice
+
+
 def xml_structuring(invoice):
     """function for xml structuring"""
     try:
 
         # xml_file_path = f"{frappe.local.site}/private/files/xml_files_{invoice_number}.xml"
-        tree = ET.ElementTree(invoice)
-        xml_string = ET.tostring(invoice, encoding="utf-8", method="xml")
-        xml_dom = minidom.parseString(xml_string)
-        pretty_xml_string = xml_dom.toprettyxml(
-            indent="  "
-        )  # created xml into formatted xml form
+        # pretty-printed from the same lxml tree the signing steps use, no minidom copy
+        pretty_xml_string = etree.tostring(
+            xml_structuring_tree(invoice), encoding="unicode", pretty_print=True
+        )
         # final_xml_path = f"{frappe.local.site}/private/files/finalzatcaxml_{invoice_number}.xml"
         # with open(final_xml_path, "w", encoding="utf-8") as file:
         #     file.write(pretty_xml_string)
@@ -564,3 +451,23 @@ def xml_structuring(invoice):
             )
         )
         return None
+
+
+def xml_structuring_tree(invoice):
+    """
+    Xml structuring into a single lxml tree with the same layout as xml_structuring,
+    so the signing steps can work on it in place without re-parsing
+    """
+    try:
+        root = etree.fromstring(ET.tostring(invoice, encoding="utf-8", method="xml"))
+        etree.indent(root, space="  ")
+        return root
+    except etree.XMLSyntaxError:
+        frappe.throw(
+            _(
+                "Error occurred in XML parsing or formatting. "
+                "Please check the XML structure for errors. "
+                "If the problem persists, contact your system administrator."
+            )
+        )
+        return None
@@ -7,10 +7,19 @@ invoices, signing, and submission to ZATCA servers for clearance and reporting."
 
 import base64
 import json
-import requests
+from zatca_erpgulf.zatca_erpgulf.zatca_session import zatca_post
 from frappe import _
 import frappe
 from zatca_erpgulf.zatca_erpgulf.event_log import log_zatca_event
+from zatca_erpgulf.zatca_erpgulf.pih_chain import hold_signing_unit, set_unit_pih
+from zatca_erpgulf.zatca_erpgulf.stage_timing import timed_stage
+from zatca_erpgulf.zatca_erpgulf.async_submission import (
+    enqueue_invoice_submission,
+    show_gif,
+    hide_gif,
+)
+from zatca_erpgulf.zatca_erpgulf.batch_dispatcher import queue_invoice_for_batch
+from zatca_erpgulf.zatca_erpgulf.bulk_resubmission import enqueue_resubmission
 from zatca_erpgulf.zatca_erpgulf.posxml import (
     xml_tags,
     salesinvoice_data,
@@ -33,8 +42,11 @@ from zatca_erpgulf.zatca_erpgulf.pos_final import (
     tax_data_with_template,
     item_data_with_template,
     item_data,
-    xml_structuring,
+    iter_item_lines,
+    iter_item_lines_with_template,
+    xml_structuring_tree,
 )
+from zatca_erpgulf.zatca_erpgulf.xml_stream import sign_streamed_invoice, use_streaming
 from zatca_erpgulf.zatca_erpgulf.create_qr import create_qr_code
 
 from zatca_erpgulf.zatca_erpgulf.sign_invoice import (
@@ -46,22 +58,15 @@ from zatca_erpgulf.zatca_erpgulf.sign_invoice import (
 )
 
 from zatca_erpgulf.zatca_erpgulf.sign_invoice_first import (
-    removetags,
-    canonicalize_xml,
-    getinvoicehash,
-    digital_signature,
-    extract_certificate_details,
-    certificate_hash,
-    signxml_modify,
-    generate_signed_properties_hash,
-    populate_the_ubl_extensions_output,
-    generate_tlv_xml,
+    sign_xml_tree,
     structuring_signedxml,
-    get_tlv_for_value,
-    update_qr_toxml,
     compliance_api_call,
 )
 from zatca_erpgulf.zatca_erpgulf.pos_submit_with_xml_qr import submit_pos_withxmlqr
+from zatca_erpgulf.zatca_erpgulf.zatca_config import (
+    get_company_config,
+    get_installed_apps,
+)
 from zatca_erpgulf.zatca_erpgulf.pos_submit__without_xml import (
     zatca_call_pos_without_xml,
 )
@@ -79,8 +84,9 @@ ITEM_TAX_TEMPLATE_WARNING = "If any one item has an Item Tax Template,"
 CONTENT_TYPE_JSON = "application/json"
 
 
+@timed_stage("db_writes")
 def reporting_api(
-    uuid1, encoded_hash, signed_xmlfile_name, invoice_number, pos_invoice_doc
+    uuid1, encoded_hash, signed_xml, invoice_number, pos_invoice_doc
 ):
     """Function for reporting api"""
     try:
@@ -98,9 +104,6 @@ def reporting_api(
         company_doc = frappe.get_doc("Company", {"abbr": company_abbr})
 
         # Prepare the payload without JSON formatting
-        xml_base64 = xml_base64_decode(signed_xmlfile_name)
-
-        xml_cleared_data = base64.b64decode(xml_base64).decode("utf-8")
         file = frappe.get_doc(
             {
                 "doctype": "File",
@@ -108,11 +111,12 @@ def reporting_api(
                 "is_private": 1,
                 "attached_to_doctype": pos_invoice_doc.doctype,
                 "attached_to_name": pos_invoice_doc.name,
-                "content": xml_cleared_data,
+                "content": signed_xml,
             }
         )
         file.is_private = 1
-        file.save(ignore_permissions=True)
+        with timed_stage("file_write"):
+            file.save(ignore_permissions=True)
         pos_invoice_doc.db_set("custom_ksa_einvoicing_xml", file.file_url)
         if file.is_private == 0:
             frappe.db.set_value("File", file.name, "is_private", 1)
@@ -122,7 +126,7 @@ def reporting_api(
         payload = {
             "invoiceHash": encoded_hash,
             "uuid": uuid1,
-            "invoice": xml_base64_decode(signed_xmlfile_name),
+            "invoice": xml_base64_decode(signed_xml),
         }
 
         # Directly retrieve the production CSID from the company's document field
@@ -155,18 +159,14 @@ def reporting_api(
             frappe.throw(_(f"Production CSID for company {company_abbr} not found or mutiple setting page have no pcsid."))
         if company_doc.custom_send_invoice_to_zatca != "Batches":
             try:
-                frappe.publish_realtime(
-                    "show_gif",
-                    {"gif_url": "/assets/zatca_erpgulf/js/loading.gif"},
-                    user=frappe.session.user,
-                )
-                response = requests.post(
+                show_gif()
+                response = zatca_post(
                     url=get_api_url(company_abbr, base_url="invoices/reporting/single"),
                     headers=headers,
                     json=payload,
                     timeout=300,
                 )
-                frappe.publish_realtime("hide_gif", user=frappe.session.user)
+                hide_gif()
                 if response.status_code in (200, 202, 409):
                     if response.status_code == 200:
                             status_label = "Success"
@@ -209,20 +209,11 @@ def reporting_api(
                 if response.status_code in (400, 405, 406):
                     invoice_doc = frappe.get_doc("POS Invoice", invoice_number)
                     invoice_doc.db_set(
-                        "custom_uuid",
-                        "Not Submitted",
-                        commit=True,
-                        update_modified=True,
-                    )
-                    invoice_doc.db_set(
-                        "custom_zatca_status",
-                        "Not Submitted",
-                        commit=True,
-                        update_modified=True,
-                    )
-                    invoice_doc.db_set(
-                        "custom_zatca_full_response",
-                        "Not Submitted",
+                        {
+                            "custom_uuid": "Not Submitted",
+                            "custom_zatca_status": "Not Submitted",
+                            "custom_zatca_full_response": "Not Submitted",
+                        },
                         commit=True,
                         update_modified=True,
                     )
@@ -240,20 +231,11 @@ def reporting_api(
                 if response.status_code in (401, 403, 407, 451):
                     invoice_doc = frappe.get_doc("POS Invoice", invoice_number)
                     invoice_doc.db_set(
-                        "custom_uuid",
-                        "Not Submitted",
-                        commit=True,
-                        update_modified=True,
-                    )
-                    invoice_doc.db_set(
-                        "custom_zatca_status",
-                        "Not Submitted",
-                        commit=True,
-                        update_modified=True,
-                    )
-                    invoice_doc.db_set(
-                        "custom_zatca_full_response",
-                        "Not Submitted",
+                        {
+                            "custom_uuid": "Not Submitted",
+                            "custom_zatca_status": "Not Submitted",
+                            "custom_zatca_full_response": "Not Submitted",
+                        },
                         commit=True,
                         update_modified=True,
                     )
@@ -283,20 +265,17 @@ def reporting_api(
                         if zatca_settings.custom__use_company_certificate__keys != 1:
                             if zatca_settings.custom_send_pos_invoices_to_zatca_on_background:
                                 frappe.msgprint(msg)
-                            zatca_settings.custom_pih = encoded_hash
-                            zatca_settings.save(ignore_permissions=True)
+                            set_unit_pih(pos_invoice_doc, encoded_hash)
                         else:
                             linked_doc = frappe.get_doc("Company", zatca_settings.custom_linked_doctype)
                             if linked_doc.custom_send_einvoice_background:
                                 frappe.msgprint(msg)
-                            linked_doc.custom_pih = encoded_hash
-                            linked_doc.save(ignore_permissions=True)
+                            set_unit_pih(pos_invoice_doc, encoded_hash)
                     else:
                         company_doc = frappe.get_doc("Company", pos_invoice_doc.company)
                         if company_doc.custom_send_einvoice_background:
                             frappe.msgprint(msg)
-                        company_doc.custom_pih = encoded_hash
-                        company_doc.save(ignore_permissions=True)
+                        set_unit_pih(pos_invoice_doc, encoded_hash)
 
                     invoice_doc = frappe.get_doc("POS Invoice", invoice_number)
                     invoice_doc.custom_zatca_full_response = msg
@@ -311,20 +290,11 @@ def reporting_api(
                 if response.status_code not in (200, 202, 409):
                     invoice_doc = frappe.get_doc("POS Invoice", invoice_number)
                     invoice_doc.db_set(
-                        "custom_uuid",
-                        "Not Submitted",
-                        commit=True,
-                        update_modified=True,
-                    )
-                    invoice_doc.db_set(
-                        "custom_zatca_status",
-                        "Not Submitted",
-                        commit=True,
-                        update_modified=True,
-                    )
-                    invoice_doc.db_set(
-                        "custom_zatca_full_response",
-                        "Not Submitted",
+                        {
+                            "custom_uuid": "Not Submitted",
+                            "custom_zatca_status": "Not Submitted",
+                            "custom_zatca_full_response": "Not Submitted",
+                        },
                         commit=True,
                         update_modified=True,
                     )
@@ -363,16 +333,14 @@ def reporting_api(
                                 frappe.msgprint(msg)
 
                             # Update PIH data without JSON formatting
-                            zatca_settings.custom_pih = encoded_hash
-                            zatca_settings.save(ignore_permissions=True)
+                            set_unit_pih(pos_invoice_doc, encoded_hash)
                         else: 
                             linked_doc = frappe.get_doc("Company", zatca_settings.custom_linked_doctype)
                             if linked_doc.custom_send_einvoice_background:
                                 frappe.msgprint(msg)
 
                             # Update PIH data without JSON formatting
-                            linked_doc.custom_pih = encoded_hash
-                            linked_doc.save(ignore_permissions=True)
+                            set_unit_pih(pos_invoice_doc, encoded_hash)
 
                     else:
                         settings = frappe.get_doc("Company", company_name)
@@ -381,22 +349,15 @@ def reporting_api(
                             frappe.msgprint(msg)
 
                         # Update PIH data without JSON formatting
-                        company_doc.custom_pih = encoded_hash
-                        company_doc.save(ignore_permissions=True)
+                        set_unit_pih(pos_invoice_doc, encoded_hash)
 
                     invoice_doc = frappe.get_doc("POS Invoice", invoice_number)
                     invoice_doc.db_set(
-                        "custom_zatca_full_response",
-                        msg,
-                        commit=True,
-                        update_modified=True,
-                    )
-                    invoice_doc.db_set(
-                        "custom_uuid", uuid1, commit=True, update_modified=True
-                    )
-                    invoice_doc.db_set(
-                        "custom_zatca_status",
-                        "REPORTED",
+                        {
+                            "custom_zatca_full_response": msg,
+                            "custom_uuid": uuid1,
+                            "custom_zatca_status": "REPORTED",
+                        },
                         commit=True,
                         update_modified=True,
                     )
@@ -406,6 +367,8 @@ def reporting_api(
                     error_log()
             except (ValueError, TypeError, KeyError) as e:
                 frappe.throw(_(("Error in reporting API-2 Normal POS invoice" f"error: {str(e)}")))
+        else:
+            queue_invoice_for_batch(pos_invoice_doc, company_abbr, uuid1, encoded_hash)
 
     except (ValueError, TypeError, KeyError, frappe.ValidationError) as e:
         invoice_doc = frappe.get_doc("POS Invoice", invoice_number)
@@ -418,8 +381,9 @@ def reporting_api(
         frappe.throw(_(("Error in reporting API-1 " f"error: {str(e)}")))
 
 
+@timed_stage("db_writes")
 def clearance_api(
-    uuid1, encoded_hash, signed_xmlfile_name, invoice_number, pos_invoice_doc
+    uuid1, encoded_hash, signed_xml, invoice_number, pos_invoice_doc
 ):
     """Function for clearence api"""
     try:
@@ -452,7 +416,7 @@ def clearance_api(
         payload = {
             "invoiceHash": encoded_hash,
             "uuid": uuid1,
-            "invoice": xml_base64_decode(signed_xmlfile_name),
+            "invoice": xml_base64_decode(signed_xml),
         }
 
         if production_csid:
@@ -472,18 +436,14 @@ def clearance_api(
             headers = None
             frappe.throw(_(f"Production CSID for company {company_abbr} not found."))
 
-        frappe.publish_realtime(
-            "show_gif",
-            {"gif_url": "/assets/zatca_erpgulf/js/loading.gif"},
-            user=frappe.session.user,
-        )
-        response = requests.post(
+        show_gif()
+        response = zatca_post(
             url=get_api_url(company_abbr, base_url="invoices/clearance/single"),
             headers=headers,
             json=payload,
             timeout=300,
         )
-        frappe.publish_realtime("hide_gif", user=frappe.session.user)
+        hide_gif()
         if response.status_code in (200, 202, 409):
             if response.status_code == 200:
                     status_label = "Success"
@@ -526,17 +486,11 @@ def clearance_api(
         if response.status_code in (400, 405, 406, 409):
             invoice_doc = frappe.get_doc("POS Invoice", invoice_number)
             invoice_doc.db_set(
-                "custom_uuid", "Not Submitted", commit=True, update_modified=True
-            )
-            invoice_doc.db_set(
-                "custom_zatca_status",
-                "Not Submitted",
-                commit=True,
-                update_modified=True,
-            )
-            invoice_doc.db_set(
-                "custom_zatca_full_response",
-                "Not Submitted",
+                {
+                    "custom_uuid": "Not Submitted",
+                    "custom_zatca_status": "Not Submitted",
+                    "custom_zatca_full_response": "Not Submitted",
+                },
                 commit=True,
                 update_modified=True,
             )
@@ -553,17 +507,11 @@ def clearance_api(
         if response.status_code in (401, 403, 407, 451):
             invoice_doc = frappe.get_doc("POS Invoice", invoice_number)
             invoice_doc.db_set(
-                "custom_uuid", "Not Submitted", commit=True, update_modified=True
-            )
-            invoice_doc.db_set(
-                "custom_zatca_status",
-                "Not Submitted",
-                commit=True,
-                update_modified=True,
-            )
-            invoice_doc.db_set(
-                "custom_zatca_full_response",
-                "Not Submitted",
+                {
+                    "custom_uuid": "Not Submitted",
+                    "custom_zatca_status": "Not Submitted",
+                    "custom_zatca_full_response": "Not Submitted",
+                },
                 commit=True,
                 update_modified=True,
             )
@@ -580,17 +528,11 @@ def clearance_api(
         if response.status_code not in (200, 202):
             invoice_doc = frappe.get_doc("POS Invoice", invoice_number)
             invoice_doc.db_set(
-                "custom_uuid", "Not Submitted", commit=True, update_modified=True
-            )
-            invoice_doc.db_set(
-                "custom_zatca_status",
-                "Not Submitted",
-                commit=True,
-                update_modified=True,
-            )
-            invoice_doc.db_set(
-                "custom_zatca_full_response",
-                "Not Submitted",
+                {
+                    "custom_uuid": "Not Submitted",
+                    "custom_zatca_status": "Not Submitted",
+                    "custom_zatca_full_response": "Not Submitted",
+                },
                 commit=True,
                 update_modified=True,
             )
@@ -619,16 +561,14 @@ def clearance_api(
                         frappe.msgprint(msg)
 
                         # Update PIH data without JSON formatting
-                    zatca_settings.custom_pih = encoded_hash
-                    zatca_settings.save(ignore_permissions=True)
+                    set_unit_pih(pos_invoice_doc, encoded_hash)
                 else:
                     linked_doc = frappe.get_doc("Company", zatca_settings.custom_linked_doctype)
                     if linked_doc.custom_send_einvoice_background:
                         frappe.msgprint(msg)
 
                         # Update PIH data without JSON formatting
-                    linked_doc.custom_pih = encoded_hash
-                    linked_doc.save(ignore_permissions=True)
+                    set_unit_pih(pos_invoice_doc, encoded_hash)
 
             else:
                 settings = frappe.get_doc("Company", company_name)
@@ -637,16 +577,17 @@ def clearance_api(
                     frappe.msgprint(msg)
 
                     # Update PIH data without JSON formatting
-                company_doc.custom_pih = encoded_hash
-                company_doc.save(ignore_permissions=True)
+                set_unit_pih(pos_invoice_doc, encoded_hash)
 
             invoice_doc = frappe.get_doc("POS Invoice", invoice_number)
             invoice_doc.db_set(
-                "custom_zatca_full_response", msg, commit=True, update_modified=True
-            )
-            invoice_doc.db_set("custom_uuid", uuid1, commit=True, update_modified=True)
-            invoice_doc.db_set(
-                "custom_zatca_status", "CLEARED", commit=True, update_modified=True
+                {
+                    "custom_zatca_full_response": msg,
+                    "custom_uuid": uuid1,
+                    "custom_zatca_status": "CLEARED",
+                },
+                commit=True,
+                update_modified=True,
             )
 
             data = response.json()
@@ -664,7 +605,8 @@ def clearance_api(
             )
 
             file.is_private = 1  # Force private before saving
-            file.save(ignore_permissions=True)
+            with timed_stage("file_write"):
+                file.save(ignore_permissions=True)
             if file.is_private == 0:
                 frappe.db.set_value("File", file.name, "is_private", 1)
                 frappe.db.commit()
@@ -678,14 +620,10 @@ def clearance_api(
     except (ValueError, TypeError, KeyError, frappe.ValidationError) as e:
         invoice_doc = frappe.get_doc("POS Invoice", invoice_number)
         invoice_doc.db_set(
-            "custom_zatca_full_response",
-            f"Error: {str(e)}",
-            commit=True,
-            update_modified=True,
-        )
-        invoice_doc.db_set(
-            "custom_zatca_status",
-            "503 Service Unavailable",
+            {
+                "custom_zatca_full_response": f"Error: {str(e)}",
+                "custom_zatca_status": "503 Service Unavailable",
+            },
             commit=True,
             update_modified=True,
         )
@@ -694,6 +632,7 @@ def clearance_api(
 
 
 # @frappe.whitelist(allow_guest=False)
+@hold_signing_unit("POS Invoice")
 def zatca_call(
     invoice_number,
     compliance_type="0",
@@ -744,54 +683,26 @@ def zatca_call(
         else:
             invoice = tax_data_with_template(invoice, pos_invoice_doc)
 
-        if not any_item_has_tax_template:
-            invoice = item_data(invoice, pos_invoice_doc)
+        if use_streaming(pos_invoice_doc):
+            # very large invoice, the lines are signed and written one at a time
+            if not any_item_has_tax_template:
+                lines = iter_item_lines(pos_invoice_doc)
+            else:
+                lines = iter_item_lines_with_template(pos_invoice_doc)
+            encoded_hash, qrcodeb64, signed_xml = sign_streamed_invoice(
+                invoice, lines, invoice_number, company_abbr, source_doc
+            )
         else:
-            invoice = item_data_with_template(invoice, pos_invoice_doc)
-
-        file_content = xml_structuring(invoice)
-
-        # try:
-        #     with open(
-        #         f"{frappe.local.site}/private/files/finalzatcaxml_{invoice_number}.xml",
-        #         "r",
-        #         encoding="utf-8",
-        #     ) as file:
-        #         file_content = file.read()
-        # except FileNotFoundError:
-        #     frappe.throw("XML file not found")
-
-        tag_removed_xml = removetags(file_content)
-        canonicalized_xml = canonicalize_xml(tag_removed_xml)
-        hash1, encoded_hash = getinvoicehash(canonicalized_xml)
-        encoded_signature = digital_signature(hash1, company_abbr, source_doc)
-        issuer_name, serial_number = extract_certificate_details(
-            company_abbr, source_doc
-        )
-        encoded_certificate_hash = certificate_hash(company_abbr, source_doc)
-        modified_xml_string,namespaces, signing_time = signxml_modify(company_abbr,file_content, source_doc)
-        signed_properties_base64 = generate_signed_properties_hash(
-            signing_time, issuer_name, serial_number, encoded_certificate_hash
-        )
-        final_xml_string = populate_the_ubl_extensions_output(
-            modified_xml_string,
-            encoded_signature,
-            namespaces,
-            signed_properties_base64,
-            encoded_hash,
-            company_abbr,
-            source_doc,
-        )
-        tlv_data = generate_tlv_xml(final_xml_string, company_abbr, source_doc)
-
-        tagsbufsarray = []
-        for tag_num, tag_value in tlv_data.items():
-            tagsbufsarray.append(get_tlv_for_value(tag_num, tag_value))
+            if not any_item_has_tax_template:
+                invoice = item_data(invoice, pos_invoice_doc)
+            else:
+                invoice = item_data_with_template(invoice, pos_invoice_doc)
 
-        qrcodebuf = b"".join(tagsbufsarray)
-        qrcodeb64 = base64.b64encode(qrcodebuf).decode("utf-8")
-        updated_xml_string = update_qr_toxml(final_xml_string, qrcodeb64, company_abbr)
-        signed_xmlfile_name = structuring_signedxml(invoice_number,updated_xml_string)
+            root = xml_structuring_tree(invoice)
+            encoded_hash, qrcodeb64, updated_xml_string = sign_xml_tree(
+                root, company_abbr, source_doc
+            )
+            signed_xml = structuring_signedxml(invoice_number,updated_xml_string)
 
         if compliance_type == "0":
             if customer_doc.custom_b2c == 1:
@@ -799,7 +710,7 @@ def zatca_call(
                 reporting_api(
                     uuid1,
                     encoded_hash,
-                    signed_xmlfile_name,
+                    signed_xml,
                     invoice_number,
                     pos_invoice_doc,
                 )
@@ -808,14 +719,14 @@ def zatca_call(
                 clearance_api(
                     uuid1,
                     encoded_hash,
-                    signed_xmlfile_name,
+                    signed_xml,
                     invoice_number,
                     pos_invoice_doc,
                 )
                 attach_qr_image(qrcodeb64, pos_invoice_doc)
         else:
             compliance_api_call(
-                uuid1, encoded_hash, signed_xmlfile_name, company_abbr, source_doc
+                uuid1, encoded_hash, signed_xml, company_abbr, source_doc
             )
             attach_qr_image(qrcodeb64, pos_invoice_doc)
 
@@ -903,52 +814,15 @@ def zatca_call_compliance(
             item_data_with_template(invoice, pos_invoice_doc)
 
         # Generate and process the XML data
-        file_content = xml_structuring(invoice)
-        # with open(
-        #     f"{frappe.local.site}/private/files/finalzatcaxml_{invoice_number}.xml",
-        #     "r",
-        #     encoding="utf-8",
-        # ) as file:
-        #     file_content = file.read()
-
-        tag_removed_xml = removetags(file_content)
-        canonicalized_xml = canonicalize_xml(tag_removed_xml)
-        hash1, encoded_hash = getinvoicehash(canonicalized_xml)
-        encoded_signature = digital_signature(hash1, company_abbr, source_doc)
-        issuer_name, serial_number = extract_certificate_details(
-            company_abbr, source_doc
-        )
-        encoded_certificate_hash = certificate_hash(company_abbr, source_doc)
-        modified_xml_string, namespaces, signing_time = signxml_modify(company_abbr,file_content, source_doc)
-        signed_properties_base64 = generate_signed_properties_hash(
-            signing_time, issuer_name, serial_number, encoded_certificate_hash
-        )
-        final_xml_string= populate_the_ubl_extensions_output(
-            modified_xml_string,
-            encoded_signature,
-            namespaces,
-            signed_properties_base64,
-            encoded_hash,
-            company_abbr,
-            source_doc,
+        root = xml_structuring_tree(invoice)
+        encoded_hash, qrcodeb64, updated_xml_string = sign_xml_tree(
+            root, company_abbr, source_doc
         )
-
-        # Generate the TLV data and QR code
-        tlv_data = generate_tlv_xml(final_xml_string, company_abbr, source_doc)
-
-        tagsbufsarray = []
-        for tag_num, tag_value in tlv_data.items():
-            tagsbufsarray.append(get_tlv_for_value(tag_num, tag_value))
-
-        qrcodebuf = b"".join(tagsbufsarray)
-        qrcodeb64 = base64.b64encode(qrcodebuf).decode("utf-8")
-
-        updated_xml_string = update_qr_toxml(final_xml_string, qrcodeb64, company_abbr)
-        signed_xmlfile_name = structuring_signedxml(invoice_number,updated_xml_string)
+        signed_xml = structuring_signedxml(invoice_number,updated_xml_string)
 
         # Make the compliance API call
         compliance_api_call(
-            uuid1, encoded_hash, signed_xmlfile_name, company_abbr, source_doc
+            uuid1, encoded_hash, signed_xml, company_abbr, source_doc
         )
 
     except (ValueError, KeyError, TypeError, frappe.ValidationError) as e:
@@ -1301,12 +1175,10 @@ def zatca_background_on_submit(doc: "dict | str", _method:  str | None = None, b
         pos_invoice_doc = doc
         invoice_number = pos_invoice_doc.name
         pos_invoice_doc = frappe.get_doc("POS Invoice", invoice_number)
-        company_abbr = frappe.db.get_value(
-            "Company", {"name": pos_invoice_doc.company}, "abbr"
-        )
+        company_doc = get_company_config(pos_invoice_doc.company)
+        company_abbr = company_doc.abbr
 
         customer_doc = frappe.get_doc("Customer", pos_invoice_doc.customer)
-        company_doc = frappe.get_doc("Company", {"abbr": company_abbr})
         if not company_abbr:
             frappe.throw(
                 _(f"Company abbreviation for {pos_invoice_doc.company} not found.")
@@ -1393,7 +1265,6 @@ def zatca_background_on_submit(doc: "dict | str", _method:  str | None = None, b
                         )
 
         address = None
-        customer_doc = frappe.get_doc("Customer", pos_invoice_doc.customer)
         if customer_doc.custom_b2c == 0:
             if not customer_doc.custom_buyer_id:
                 frappe.throw(_(
@@ -1467,7 +1338,6 @@ def zatca_background_on_submit(doc: "dict | str", _method:  str | None = None, b
                         )
                     )
 
-        company_doc = frappe.get_doc("Company", {"abbr": company_abbr})
         if not company_doc.tax_id:
             frappe.throw(_("As per ZATCA regulation, Company Tax ID is mandatory"))
         if company_doc.tax_id and not (
@@ -1554,19 +1424,15 @@ def zatca_background_on_submit(doc: "dict | str", _method:  str | None = None, b
 
         if pos_invoice_doc.custom_zatca_status in ["REPORTED", "CLEARED"]:
             frappe.throw(_("Already submitted to Zakat and Tax Authority"))
-        company_name = pos_invoice_doc.company
-
-        # Retrieve the company document to access settings
-        settings = frappe.get_doc("Company", company_name)
         # if settings.custom_phase_1_or_2 == "Phase-2":
         #     zatca_call(
         #         invoice_number, "0", any_item_has_tax_template, company_abbr, source_doc
         #     )
         # else:
         #     create_qr_code(pos_invoice_doc, method=None)
-        settings = frappe.get_doc("Company", company_name)
+        settings = company_doc
 
-        is_gpos_installed = "gpos" in frappe.get_installed_apps()
+        is_gpos_installed = "gpos" in get_installed_apps()
         field_exists = frappe.get_meta("POS Invoice").has_field("custom_unique_id")
         if is_gpos_installed:
             if pos_invoice_doc.custom_xml and not pos_invoice_doc.custom_qr_code:
@@ -1576,6 +1442,10 @@ def zatca_background_on_submit(doc: "dict | str", _method:  str | None = None, b
                         + str(invoice_number)
                     )
                 )
+        if settings.custom_phase_1_or_2 == "Phase-2" and enqueue_invoice_submission(
+            pos_invoice_doc, settings, bypass_background_check
+        ):
+            return
         if settings.custom_phase_1_or_2 == "Phase-2":
             if field_exists and pos_invoice_doc.custom_unique_id:
                 if not pos_invoice_doc.custom_zatca_pos_name:
@@ -1640,43 +1510,10 @@ def zatca_background_on_submit(doc: "dict | str", _method:  str | None = None, b
 @frappe.whitelist()
 def resubmit_invoices_pos(invoice_numbers:str, bypass_background_check:bool=False):
     """
-    Resubmit invoices where custom_zatca_full_response contains 'RemoteDisconnected'.
-    If the invoice is already submitted, call `zatca_background_on_submit`.
-    Otherwise, submit the invoice.
+    Resubmit the selected invoices to ZATCA in background jobs.
+    Submitted invoices are sent again through `zatca_background_on_submit`, drafts are
+    submitted when the company allows it. Returns the handle of the resubmission job,
+    whose progress is published to the user and available from get_resubmission_progress.
     """
-    if isinstance(invoice_numbers, str):
-        invoice_numbers = frappe.parse_json(invoice_numbers)
-
-    results = {}
-    for invoice_number in invoice_numbers:
-        try:
-            # Fetch the Sales Invoice document
-            pos_invoice_doc = frappe.get_doc("POS Invoice", invoice_number)
-            company_doc = frappe.get_doc("Company", pos_invoice_doc.company)
-            customer_doc = frappe.get_doc("Customer", pos_invoice_doc.customer)
-
-
-            if (
-                pos_invoice_doc.docstatus == 1
-            ):  # Check if the invoice is already submitted
-                # Call the zatca_background_on_submit function
-                zatca_background_on_submit(
-                    pos_invoice_doc, bypass_background_check=True
-                )
-
-            # elif company_doc.custom_submit_or_not == 1:
-            elif (
-                pos_invoice_doc.docstatus == 0
-                and company_doc.custom_submit_or_not == 1
-                and customer_doc.custom_b2c == 1
-            ):
-                pos_invoice_doc.submit()
-                # zatca_background_on_submit(
-                #     pos_invoice_doc, bypass_background_check=True
-                # )
-
-        except (ValueError, TypeError, KeyError, frappe.ValidationError) as e:
-            frappe.throw(_(f"Error in background call: {str(e)}"))
-            # Log errors and add to the results
-
-    return results
+    # submitted invoices have always been resent bypassing the background check
+    return enqueue_resubmission("POS Invoice", invoice_numbers)
@@ -1,10 +1,12 @@
 """This file contains the function to call the ZATCA API for POS Invoices"""
 
-import base64
 from frappe import _  # pylint: disable=unused-import
 import frappe
-import requests
+from zatca_erpgulf.zatca_erpgulf.zatca_session import zatca_post
 from zatca_erpgulf.zatca_erpgulf.event_log import log_zatca_event
+from zatca_erpgulf.zatca_erpgulf.pih_chain import hold_signing_unit, set_unit_pih
+from zatca_erpgulf.zatca_erpgulf.async_submission import show_gif, hide_gif
+from zatca_erpgulf.zatca_erpgulf.batch_dispatcher import queue_invoice_for_batch
 from zatca_erpgulf.zatca_erpgulf.sales_invoice_with_xmlqr import (
     get_api_url,
     xml_base64_decode,
@@ -30,24 +32,13 @@ from zatca_erpgulf.zatca_erpgulf.pos_final import (
     tax_data_with_template,
     item_data_with_template,
     item_data,
-    xml_structuring,
+    xml_structuring_tree,
 )
 
 
 from zatca_erpgulf.zatca_erpgulf.sign_invoice_first import (
-    removetags,
-    canonicalize_xml,
-    getinvoicehash,
-    digital_signature,
-    extract_certificate_details,
-    certificate_hash,
-    signxml_modify,
-    generate_signed_properties_hash,
-    populate_the_ubl_extensions_output,
-    generate_tlv_xml,
+    sign_xml_tree,
     structuring_signedxml,
-    get_tlv_for_value,
-    update_qr_toxml,
     compliance_api_call,
 )
 
@@ -57,6 +48,7 @@ CONTENT_TYPE_JSON = "application/json"
 POS_INVOICE = "POS Invoice"
 
 
+@hold_signing_unit(POS_INVOICE)
 def zatca_call_pos_without_xml(
     invoice_number,
     compliance_type="0",
@@ -114,49 +106,11 @@ def zatca_call_pos_without_xml(
         else:
             invoice = item_data_with_template(invoice, pos_invoice_doc)
 
-        file_content = xml_structuring(invoice)
-
-        # try:
-        #     with open(
-        #         f"{frappe.local.site}/private/files/finalzatcaxml_{invoice_number}.xml",
-        #         "r",
-        #         encoding="utf-8",
-        #     ) as file:
-        #         file_content = file.read()
-        # except FileNotFoundError:
-        #     frappe.throw("XML file not found")
-
-        tag_removed_xml = removetags(file_content)
-        canonicalized_xml = canonicalize_xml(tag_removed_xml)
-        hash1, encoded_hash = getinvoicehash(canonicalized_xml)
-        encoded_signature = digital_signature(hash1, company_abbr, source_doc)
-        issuer_name, serial_number = extract_certificate_details(
-            company_abbr, source_doc
+        root = xml_structuring_tree(invoice)
+        encoded_hash, qrcodeb64, updated_xml_string = sign_xml_tree(
+            root, company_abbr, source_doc
         )
-        encoded_certificate_hash = certificate_hash(company_abbr, source_doc)
-        modified_xml_string, namespaces, signing_time = signxml_modify(company_abbr,file_content, source_doc)
-        signed_properties_base64 = generate_signed_properties_hash(
-            signing_time, issuer_name, serial_number, encoded_certificate_hash
-        )
-        final_xml_string = populate_the_ubl_extensions_output(
-            modified_xml_string,
-            encoded_signature,
-            namespaces,
-            signed_properties_base64,
-            encoded_hash,
-            company_abbr,
-            source_doc,
-        )
-        tlv_data = generate_tlv_xml(final_xml_string, company_abbr, source_doc)
-
-        tagsbufsarray = []
-        for tag_num, tag_value in tlv_data.items():
-            tagsbufsarray.append(get_tlv_for_value(tag_num, tag_value))
-
-        qrcodebuf = b"".join(tagsbufsarray)
-        qrcodeb64 = base64.b64encode(qrcodebuf).decode("utf-8")
-        updated_xml_string = update_qr_toxml(final_xml_string, qrcodeb64, company_abbr)
-        signed_xmlfile_name = structuring_signedxml(invoice_number, updated_xml_string)
+        signed_xml = structuring_signedxml(invoice_number, updated_xml_string)
 
         if compliance_type == "0":
             if customer_doc.custom_b2c == 1:
@@ -164,7 +118,7 @@ def zatca_call_pos_without_xml(
                 reporting_api_pos_without_xml(
                     uuid1,
                     encoded_hash,
-                    signed_xmlfile_name,
+                    signed_xml,
                     invoice_number,
                     pos_invoice_doc,
                 )
@@ -177,7 +131,7 @@ def zatca_call_pos_without_xml(
                 )
         else:
             compliance_api_call(
-                uuid1, encoded_hash, signed_xmlfile_name, company_abbr, source_doc
+                uuid1, encoded_hash, signed_xml, company_abbr, source_doc
             )
             attach_qr_image(qrcodeb64, pos_invoice_doc)
 
@@ -189,7 +143,7 @@ def zatca_call_pos_without_xml(
 
 
 def reporting_api_pos_without_xml(
-    uuid1, encoded_hash, signed_xmlfile_name, invoice_number, pos_invoice_doc
+    uuid1, encoded_hash, signed_xml, invoice_number, pos_invoice_doc
 ):
     """Function for reporting api"""
     try:
@@ -207,11 +161,8 @@ def reporting_api_pos_without_xml(
         payload = {
             "invoiceHash": encoded_hash,
             "uuid": uuid1,
-            "invoice": xml_base64_decode(signed_xmlfile_name),
+            "invoice": xml_base64_decode(signed_xml),
         }
-        xml_base64 = xml_base64_decode(signed_xmlfile_name)
-
-        xml_cleared_data = base64.b64decode(xml_base64).decode("utf-8")
         file = frappe.get_doc(
             {
                 "doctype": "File",
@@ -219,7 +170,7 @@ def reporting_api_pos_without_xml(
                 "attached_to_doctype": pos_invoice_doc.doctype,
                 "is_private": 1,
                 "attached_to_name": pos_invoice_doc.name,
-                "content": xml_cleared_data,
+                "content": signed_xml,
             }
         )
         file.is_private = 1
@@ -265,18 +216,14 @@ def reporting_api_pos_without_xml(
         }
         if company_doc.custom_send_invoice_to_zatca != "Batches":
             try:
-                frappe.publish_realtime(
-                    "show_gif",
-                    {"gif_url": "/assets/zatca_erpgulf/js/loading.gif"},
-                    user=frappe.session.user,
-                )
-                response = requests.post(
+                show_gif()
+                response = zatca_post(
                     url=get_api_url(company_abbr, base_url="invoices/reporting/single"),
                     headers=headers,
                     json=payload,
                     timeout=300,
                 )
-                frappe.publish_realtime("hide_gif", user=frappe.session.user)
+                hide_gif()
                 if response.status_code in (200, 202, 409):
                     if response.status_code == 200:
                             status_label = "Success"
@@ -403,20 +350,17 @@ def reporting_api_pos_without_xml(
                         if zatca_settings.custom__use_company_certificate__keys != 1:
                             if zatca_settings.custom_send_pos_invoices_to_zatca_on_background:
                                 frappe.msgprint(msg)
-                            zatca_settings.custom_pih = encoded_hash
-                            zatca_settings.save(ignore_permissions=True)
+                            set_unit_pih(pos_invoice_doc, encoded_hash)
                         else:
                             linked_doc = frappe.get_doc("Company", zatca_settings.custom_linked_doctype)
                             if linked_doc.custom_send_einvoice_background:
                                 frappe.msgprint(msg)
-                            linked_doc.custom_pih = encoded_hash
-                            linked_doc.save(ignore_permissions=True)
+                            set_unit_pih(pos_invoice_doc, encoded_hash)
                     else:
                         company_doc = frappe.get_doc("Company", pos_invoice_doc.company)
                         if company_doc.custom_send_einvoice_background:
                             frappe.msgprint(msg)
-                        company_doc.custom_pih = encoded_hash
-                        company_doc.save(ignore_permissions=True)
+                        set_unit_pih(pos_invoice_doc, encoded_hash)
 
                     invoice_doc = frappe.get_doc(POS_INVOICE, invoice_number)
                     invoice_doc.custom_zatca_full_response = msg
@@ -490,20 +434,17 @@ def reporting_api_pos_without_xml(
                                 frappe.msgprint(msg)
 
                             # Update PIH data without JSON formatting
-                            zatca_settings.custom_pih = encoded_hash
-                            zatca_settings.save(ignore_permissions=True)
+                            set_unit_pih(pos_invoice_doc, encoded_hash)
                         else:
                             linked_doc = frappe.get_doc("Company", zatca_settings.custom_linked_doctype)
                             if linked_doc.custom_send_einvoice_background:
                                 frappe.msgprint(msg)
-                            linked_doc.custom_pih = encoded_hash
-                            linked_doc.save(ignore_permissions=True)
+                            set_unit_pih(pos_invoice_doc, encoded_hash)
                     else:
                         company_doc = frappe.get_doc("Company", pos_invoice_doc.company)
                         if company_doc.custom_send_einvoice_background:
                             frappe.msgprint(msg)
-                        company_doc.custom_pih = encoded_hash
-                        company_doc.save(ignore_permissions=True)
+                        set_unit_pih(pos_invoice_doc, encoded_hash)
 
                     invoice_doc = frappe.get_doc(POS_INVOICE, invoice_number)
                     # invoice_doc.db_set(
@@ -535,6 +476,8 @@ def reporting_api_pos_without_xml(
                 frappe.throw(
                     _(("Error in reporting API-2 pos without xml " f"error: {str(e)}"))
                 )
+        else:
+            queue_invoice_for_batch(pos_invoice_doc, company_abbr, uuid1, encoded_hash)
 
     except (ValueError, TypeError, KeyError, frappe.ValidationError) as e:
         invoice_doc = frappe.get_doc("POS Invoice", invoice_number)
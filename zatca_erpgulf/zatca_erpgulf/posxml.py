@@ -17,12 +17,17 @@ import json
 from frappe.utils.data import get_time
 from frappe import _
 import frappe
+from zatca_erpgulf.zatca_erpgulf.xml_tax_data import get_item_tax_index
+from zatca_erpgulf.zatca_erpgulf.ubl_skeleton import new_invoice
+from zatca_erpgulf.zatca_erpgulf.party_data import get_customer_party, get_supplier_party
+from zatca_erpgulf.zatca_erpgulf.zatca_config import get_company_config
+from zatca_erpgulf.zatca_erpgulf.pih_chain import get_unit_pih
 
 
 def get_tax_for_item(full_string, item):
-    """Function for get tax item"""
+    """Function for get tax item, from a JSON-encoded string or an item tax index"""
     try:  # getting tax percentage and tax amount
-        data = json.loads(full_string)
+        data = full_string if isinstance(full_string, dict) else json.loads(full_string)
         tax_percentage = data.get(item, [0, 0])[0]
         tax_amount = data.get(item, [0, 0])[1]
         return tax_amount, tax_percentage
@@ -61,131 +66,9 @@ def get_issue_time(invoice_number):
 
 
 def xml_tags():
-    """Function for XML tags"""
+    """Function for XML tags, the signature scaffold is prebuilt in ubl_skeleton"""
     try:
-        invoice = ET.Element(
-            "Invoice", xmlns="urn:oasis:names:specification:ubl:schema:xsd:Invoice-2"
-        )
-        invoice.set(
-            "xmlns:cac",
-            "urn:oasis:names:specification:ubl:schema:xsd:CommonAggregateComponents-2",
-        )
-        invoice.set(
-            "xmlns:cbc",
-            "urn:oasis:names:specification:ubl:schema:xsd:CommonBasicComponents-2",
-        )
-        invoice.set(
-            "xmlns:ext",
-            "urn:oasis:names:specification:ubl:schema:xsd:CommonExtensionComponents-2",
-        )
-        ubl_extensions = ET.SubElement(invoice, "ext:UBLExtensions")
-        ubl_extension = ET.SubElement(ubl_extensions, "ext:UBLExtension")
-        extension_uri = ET.SubElement(ubl_extension, "ext:ExtensionURI")
-        extension_uri.text = "urn:oasis:names:specification:ubl:dsig:enveloped:xades"
-        extension_content = ET.SubElement(ubl_extension, "ext:ExtensionContent")
-        ubl_document_signatures = ET.SubElement(
-            extension_content, "sig:UBLDocumentSignatures"
-        )
-        ubl_document_signatures.set(
-            "xmlns:sig",
-            "urn:oasis:names:specification:ubl:schema:xsd:CommonSignatureComponents-2",
-        )
-        ubl_document_signatures.set(
-            "xmlns:sac",
-            "urn:oasis:names:specification:ubl:schema:xsd:SignatureAggregateComponents-2",
-        )
-        ubl_document_signatures.set(
-            "xmlns:sbc",
-            "urn:oasis:names:specification:ubl:schema:xsd:SignatureBasicComponents-2",
-        )
-        signature_information = ET.SubElement(
-            ubl_document_signatures, "sac:SignatureInformation"
-        )
-        id_obj = ET.SubElement(signature_information, "cbc:ID")
-        id_obj.text = "urn:oasis:names:specification:ubl:signature:1"
-        referenced_signatureid = ET.SubElement(
-            signature_information, "sbc:ReferencedSignatureID"
-        )
-        referenced_signatureid.text = (
-            "urn:oasis:names:specification:ubl:signature:Invoice"
-        )
-        signature = ET.SubElement(signature_information, "ds:Signature")
-        signature.set("Id", "signature")
-        signature.set("xmlns:ds", "http://www.w3.org/2000/09/xmldsig#")
-        signed_info = ET.SubElement(signature, "ds:SignedInfo")
-        canonicalization_method = ET.SubElement(
-            signed_info, "ds:CanonicalizationMethod"
-        )
-        canonicalization_method.set("Algorithm", "http://www.w3.org/2006/12/xml-c14n11")
-        signature_method = ET.SubElement(signed_info, "ds:SignatureMethod")
-        signature_method.set(
-            "Algorithm", "http://www.w3.org/2001/04/xmldsig-more#ecdsa-sha256"
-        )
-        reference = ET.SubElement(signed_info, "ds:Reference")
-        reference.set("Id", "invoiceSignedData")
-        reference.set("URI", "")
-        transforms = ET.SubElement(reference, "ds:Transforms")
-        transform = ET.SubElement(transforms, "ds:Transform")
-        transform.set("Algorithm", "http://www.w3.org/TR/1999/REC-xpath-19991116")
-        xpath = ET.SubElement(transform, "ds:XPath")
-        xpath.text = "not(//ancestor-or-self::ext:UBLExtensions)"
-        transform2 = ET.SubElement(transforms, "ds:Transform")
-        transform2.set("Algorithm", "http://www.w3.org/TR/1999/REC-xpath-19991116")
-        xpath2 = ET.SubElement(transform2, "ds:XPath")
-        xpath2.text = "not(//ancestor-or-self::cac:Signature)"
-        transform3 = ET.SubElement(transforms, "ds:Transform")
-        transform3.set("Algorithm", "http://www.w3.org/TR/1999/REC-xpath-19991116")
-        xpath3 = ET.SubElement(transform3, "ds:XPath")
-        xpath3.text = (
-            "not(//ancestor-or-self::cac:AdditionalDocumentReference[cbc:ID='QR'])"
-        )
-        transform4 = ET.SubElement(transforms, "ds:Transform")
-        transform4.set("Algorithm", "http://www.w3.org/2006/12/xml-c14n11")
-        diges_method = ET.SubElement(reference, "ds:DigestMethod")
-        diges_method.set("Algorithm", "http://www.w3.org/2001/04/xmlenc#sha256")
-        diges_value = ET.SubElement(reference, "ds:DigestValue")
-        diges_value.text = "O/vEnAxjLAlw8kQUy8nq/5n8IEZ0YeIyBFvdQA8+iFM="
-        reference2 = ET.SubElement(signed_info, "ds:Reference")
-        reference2.set("URI", "#xadesSignedProperties")
-        reference2.set("Type", "http://www.w3.org/2000/09/xmldsig#SignatureProperties")
-        digest_method1 = ET.SubElement(reference2, "ds:DigestMethod")
-        digest_method1.set("Algorithm", "http://www.w3.org/2001/04/xmlenc#sha256")
-        digest_value1 = ET.SubElement(reference2, "ds:DigestValue")
-        digest_value1.text = "YjQwZmEyMjM2NDU1YjQwNjM5MTFmYmVkODc4NjM2"
-        signature_value = ET.SubElement(signature, "ds:SignatureValue")
-        signature_value.text = (
-            "MEQCIDGBRHiPo6yhXIQ9df6pMEkufcGnoqYaS+O8Jn0xagBiAiBtoxpbrwf"
-        )
-        keyinfo = ET.SubElement(signature, "ds:KeyInfo")
-        x509data = ET.SubElement(keyinfo, "ds:X509Data")
-        x509certificate = ET.SubElement(x509data, "ds:X509Certificate")
-        x509certificate.text = "MIID6TCCA5CgAwIBAgITbwAAf8tem6jngr16DwABAAB"
-        object_data = ET.SubElement(signature, "ds:Object")
-        qualifyingproperties = ET.SubElement(object_data, "xades:QualifyingProperties")
-        qualifyingproperties.set("Target", "signature")
-        qualifyingproperties.set("xmlns:xades", "http://uri.etsi.org/01903/v1.3.2#")
-        signedproperties = ET.SubElement(qualifyingproperties, "xades:SignedProperties")
-        signedproperties.set("Id", "xadesSignedProperties")
-        signedsignatureproperties = ET.SubElement(
-            signedproperties, "xades:SignedSignatureProperties"
-        )
-        signingtime = ET.SubElement(signedsignatureproperties, "xades:SigningTime")
-        signingtime.text = "2024-01-24T11:36:34Z"
-        signingcertificate = ET.SubElement(
-            signedsignatureproperties, "xades:SigningCertificate"
-        )
-        cert = ET.SubElement(signingcertificate, "xades:Cert")
-        certdigest = ET.SubElement(cert, "xades:CertDigest")
-        digest_method2 = ET.SubElement(certdigest, "ds:DigestMethod")
-        digest_value2 = ET.SubElement(certdigest, "ds:DigestValue")
-        digest_method2.set("Algorithm", "http://www.w3.org/2001/04/xmlenc#sha256")
-        digest_value2.text = "YTJkM2JhYTcwZTBhZTAxOGYwODMyNzY3NTdkZDM3Yz"
-        issuerserial = ET.SubElement(cert, "xades:IssuerSerial")
-        x509issuername = ET.SubElement(issuerserial, "ds:X509IssuerName")
-        x509serialnumber = ET.SubElement(issuerserial, "ds:X509SerialNumber")
-        x509issuername.text = "CN=TSZEINVOICE-SubCA-1, DC=extgazt, DC=gov, DC=local"
-        x509serialnumber.text = "2475382886904809774818644480820936050208702411"
-        return invoice
+        return new_invoice()
     except (ET.ParseError, AttributeError, ValueError) as e:
         frappe.throw(_(f"Error in XML tags formation: {e}"))
         return None
@@ -205,7 +88,8 @@ def salesinvoice_data(invoice, invoice_number):
         cbc_issuedate = ET.SubElement(invoice, "cbc:IssueDate")
         cbc_issuedate.text = str(pos_invoice_doc.posting_date)
         cbc_issuetime = ET.SubElement(invoice, "cbc:IssueTime")
-        cbc_issuetime.text = get_issue_time(invoice_number)
+        # the invoice is already loaded, get_issue_time would load it again
+        cbc_issuetime.text = get_time(pos_invoice_doc.posting_time).strftime("%H:%M:%S")
         return invoice, uuid1, pos_invoice_doc
     except (AttributeError, ValueError, frappe.ValidationError) as e:
         frappe.throw(_(("Error occurred in SalesInvoice data: " f"{str(e)}")))
@@ -365,8 +249,6 @@ def additional_reference(invoice, company_abbr, pos_invoice_doc):
         if not company_name:
             frappe.throw(f"Company with abbreviation {company_abbr} not found.")
 
-        company_doc = frappe.get_doc("Company", company_name)
-
         # Create the first AdditionalDocumentReference element for PIH
         cac_additionaldocumentreference2 = ET.SubElement(
             invoice, "cac:AdditionalDocumentReference"
@@ -381,19 +263,7 @@ def additional_reference(invoice, company_abbr, pos_invoice_doc):
         )
         cbc_embeddeddocumentbinaryobject.set("mimeCode", "text/plain")
 
-        # Directly retrieve the PIH data without JSON parsing
-        # pih = company_doc.custom_pih  # Assuming this is already in the correct format
-        if pos_invoice_doc.custom_zatca_pos_name:
-            zatca_settings = frappe.get_doc(
-                "ZATCA Multiple Setting", pos_invoice_doc.custom_zatca_pos_name
-            )
-            if zatca_settings.custom__use_company_certificate__keys != 1:
-                pih = zatca_settings.custom_pih
-            else:
-                linked_doc = frappe.get_doc("Company", zatca_settings.custom_linked_doctype)
-                pih = linked_doc.custom_pih
-        else:
-            pih = company_doc.custom_pih
+        pih = get_unit_pih(pos_invoice_doc)
 
         cbc_embeddeddocumentbinaryobject.text = pih
 
@@ -551,15 +421,11 @@ def get_address(pos_invoice_doc, company_doc):
         return address
 
 
-def company_data(invoice, pos_invoice_doc):
-    """Function for adding company data to the POS invoice"""
+def build_supplier_party(pos_invoice_doc):
+    """Function for building the supplier party of the POS invoice, cached by party_data"""
     try:
         company_doc = frappe.get_doc("Company", pos_invoice_doc.company)
 
-        # If Company requires Cost Center but it's missing, throw an error
-        if company_doc.custom_costcenter == 1 and not pos_invoice_doc.cost_center:
-            frappe.throw(_("No Cost Center is set in the POS invoice.Give the feild"))
-
         # Determine whether to fetch data from Cost Center or Company
         if company_doc.custom_costcenter == 1:
             cost_center_doc = frappe.get_doc("Cost Center", pos_invoice_doc.cost_center)
@@ -571,9 +437,7 @@ def company_data(invoice, pos_invoice_doc):
             custom_registration_type = company_doc.custom_registration_type
             custom_company_registration = company_doc.custom_company_registration
 
-        cac_accountingsupplierparty = ET.SubElement(
-            invoice, "cac:AccountingSupplierParty"
-        )
+        cac_accountingsupplierparty = ET.Element("cac:AccountingSupplierParty")
         cac_party_1 = ET.SubElement(cac_accountingsupplierparty, "cac:Party")
         cac_partyidentification = ET.SubElement(cac_party_1, "cac:PartyIdentification")
         cbc_id_2 = ET.SubElement(cac_partyidentification, "cbc:ID")
@@ -621,20 +485,40 @@ def company_data(invoice, pos_invoice_doc):
         )
         cbc_registrationname.text = pos_invoice_doc.company
 
+        return cac_accountingsupplierparty
+    except (ET.ParseError, AttributeError, ValueError, frappe.DoesNotExistError) as e:
+        frappe.throw(_(f"Error occurred in company data: {e}"))
+        return None
+
+
+def company_data(invoice, pos_invoice_doc):
+    """Function for adding company data to the POS invoice"""
+    try:
+        company_config = get_company_config(pos_invoice_doc.company)
+
+        # If Company requires Cost Center but it's missing, throw an error
+        if company_config.custom_costcenter == 1 and not pos_invoice_doc.cost_center:
+            frappe.throw(_("No Cost Center is set in the POS invoice.Give the feild"))
+
+        invoice.append(
+            get_supplier_party(
+                pos_invoice_doc,
+                company_config.custom_costcenter == 1,
+                build_supplier_party,
+            )
+        )
         return invoice
     except (ET.ParseError, AttributeError, ValueError, frappe.DoesNotExistError) as e:
         frappe.throw(_(f"Error occurred in company data: {e}"))
         return None
 
 
-def customer_data(invoice, pos_invoice_doc):
-    """function for customer data"""
+def build_customer_party(pos_invoice_doc):
+    """function for building the customer party of the POS invoice, cached by party_data"""
     try:
         customer_doc = frappe.get_doc("Customer", pos_invoice_doc.customer)
         # frappe.throw(str(customer_doc))
-        cac_accountingcustomerparty = ET.SubElement(
-            invoice, "cac:AccountingCustomerParty"
-        )
+        cac_accountingcustomerparty = ET.Element("cac:AccountingCustomerParty")
         cac_party_2 = ET.SubElement(cac_accountingcustomerparty, "cac:Party")
         cac_partyidentification_1 = ET.SubElement(
             cac_party_2, "cac:PartyIdentification"
@@ -689,6 +573,16 @@ def customer_data(invoice, pos_invoice_doc):
             cac_partylegalentity_1, "cbc:RegistrationName"
         )
         cbc_registrationname_1.text = customer_doc.customer_name
+        return cac_accountingcustomerparty
+    except (ET.ParseError, AttributeError, ValueError, frappe.DoesNotExistError) as e:
+        frappe.throw(_(f"Error occurred in company data: {e}"))
+        return None
+
+
+def customer_data(invoice, pos_invoice_doc):
+    """function for customer data"""
+    try:
+        invoice.append(get_customer_party(pos_invoice_doc, build_customer_party))
         return invoice
     except (ET.ParseError, AttributeError, ValueError, frappe.DoesNotExistError) as e:
         frappe.throw(_(f"Error occurred in company data: {e}"))
@@ -936,29 +830,15 @@ def get_exemption_reason_map():
         ),
     }
 
-def get_tax_wise_detail(pos_invoice_doc,single_item):
-    """getting item wise tax"""
-    if int(frappe.__version__.split(".", 1)[0]) == 16 and pos_invoice_doc.item_wise_tax_details:
-        tax_rate = float(f"{pos_invoice_doc.item_wise_tax_details[0].rate:.1f}")
-        tax_amount = pos_invoice_doc.item_wise_tax_details[0].amount
-
-        # build JSON exactly like v15
-        tax_json = json.dumps({
-            single_item.item_code: [tax_rate, float(tax_amount)]
-        })
-    else:
-        tax_json = pos_invoice_doc.taxes[0].item_wise_tax_detail
-    return tax_json 
-
 def get_tax_total_from_items(pos_invoice_doc):
     """function for get tax total from items"""
     try:
         total_tax = 0
+        tax_index = get_item_tax_index(pos_invoice_doc)
         for single_item in pos_invoice_doc.items:
             # _ = item_tax_amount
-            tax_json = get_tax_wise_detail(pos_invoice_doc,single_item)
             _item_tax_amount, tax_percent = get_tax_for_item(
-                tax_json, single_item.item_code
+                tax_index, single_item.item_code
             )
             total_tax = total_tax + (single_item.net_amount * (tax_percent / 100))
         return total_tax
@@ -0,0 +1,109 @@
+"""
+Rendering of the QR code images attached to invoices.
+The module matrix comes from pyqrcode, the PNG is written directly as a 1-bit palette
+image from packed rows instead of through pyqrcode's per-pixel PyPNG writer. Every
+image is cached in redis under the hash of its content and rendering options, so a
+resubmission or a second attachment of the same invoice does not render it again.
+Render counts, cache hits and render time are kept for get_qr_metrics
+"""
+
+import hashlib
+import struct
+import time
+import zlib
+import frappe
+from frappe import _
+from pyqrcode import create as qr_create
+
+QR_CACHE_EXPIRY = 7 * 24 * 60 * 60
+QR_METRICS_KEY = "zatca_qr_metrics"
+DEFAULT_SCALE = 8
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+# palette index 0 is the background, 1 a dark module
+PNG_PALETTE = b"\xff\xff\xff\x00\x00\x00"
+
+
+def get_qr_cache_key(content, error, scale, quiet_zone):
+    """cache key of the image of a QR content and its rendering options"""
+    digest = hashlib.sha256(
+        f"{error}|{scale}|{quiet_zone}|{content}".encode("utf-8")
+    ).hexdigest()
+    return f"zatca_qr_png::{digest}"
+
+
+def get_png_chunk(chunk_type, data):
+    """length, type, data and crc of one PNG chunk"""
+    return (
+        struct.pack(">I", len(data))
+        + chunk_type
+        + data
+        + struct.pack(">I", zlib.crc32(chunk_type + data) & 0xFFFFFFFF)
+    )
+
+
+def write_qr_png(code, scale=DEFAULT_SCALE, quiet_zone=1):
+    """1-bit palette PNG of a QR module matrix, each module scale pixels wide"""
+    size = (len(code) + 2 * quiet_zone) * scale
+    row_bytes = (size + 7) // 8
+    padding = row_bytes * 8 - size
+    dark, light = "1" * scale, "0" * scale
+    border = light * quiet_zone
+    blank_line = b"\x00" + bytes(row_bytes)
+    lines = [blank_line * (scale * quiet_zone)]
+    for row in code:
+        bits = border + "".join(dark if bit else light for bit in row) + border
+        packed = int(bits + "0" * padding, 2).to_bytes(row_bytes, "big")
+        lines.append((b"\x00" + packed) * scale)
+    lines.append(blank_line * (scale * quiet_zone))
+    return b"".join(
+        [
+            PNG_SIGNATURE,
+            get_png_chunk(b"IHDR", struct.pack(">IIBBBBB", size, size, 1, 3, 0, 0, 0)),
+            get_png_chunk(b"PLTE", PNG_PALETTE),
+            get_png_chunk(b"IDAT", zlib.compress(b"".join(lines))),
+            get_png_chunk(b"IEND", b""),
+        ]
+    )
+
+
+def render_qr_png(content, error="L", scale=DEFAULT_SCALE, quiet_zone=1):
+    """PNG image of a QR code, rendered once per content and options"""
+    try:
+        cache = frappe.cache()
+        key = get_qr_cache_key(content, error, scale, quiet_zone)
+        image = cache.get_value(key)
+        if image is not None:
+            cache.hincrby(cache.make_key(QR_METRICS_KEY), "cache_hits", 1)
+            return image
+        start = time.perf_counter()
+        image = write_qr_png(qr_create(content, error=error).code, scale, quiet_zone)
+        cache.set_value(key, image, expires_in_sec=QR_CACHE_EXPIRY)
+        metrics_key = cache.make_key(QR_METRICS_KEY)
+        cache.hincrby(metrics_key, "renders", 1)
+        cache.hincrbyfloat(
+            metrics_key, "render_ms", (time.perf_counter() - start) * 1000
+        )
+        return image
+    except (ValueError, TypeError) as e:
+        frappe.throw(_(f"Error in rendering the QR code: {str(e)}"))
+        return None
+
+
+@frappe.whitelist()
+def get_qr_metrics():
+    """render count, cache hits and render time of the QR images"""
+    frappe.only_for("System Manager")
+    cache = frappe.cache()
+    # plain redis counters, RedisWrapper.hgetall would try to unpickle them
+    renders, cache_hits, render_ms = (
+        float(value or 0)
+        for value in cache.hmget(
+            cache.make_key(QR_METRICS_KEY), ["renders", "cache_hits", "render_ms"]
+        )
+    )
+    return {
+        "renders": int(renders),
+        "cache_hits": int(cache_hits),
+        "render_ms": round(render_ms, 3),
+        "avg_render_ms": round(render_ms / renders, 3) if renders else 0.0,
+    }
@@ -24,7 +24,7 @@ frappe.query_reports["Zatca Status Report"] = {
             fieldname: "status",
             label: __("Status"),
             fieldtype: "Select",
-            options: "\nReported\nCleared\n503 Service Unavailable\nIntra-company transfer\nNot Submitted",
+            options: "\nReported\nCleared\nBatched\nRejected\nFailed\n503 Service Unavailable\nIntra-company transfer\nNot Submitted",
             default: "Reported"
         }
     ],
@@ -0,0 +1,14 @@
+// Copyright (c) 2026, ERPGulf and contributors
+// For license information, please see license.txt
+
+frappe.query_reports["ZATCA Submission Timing"] = {
+    filters: [
+        {
+            fieldname: "company",
+            label: __("Company"),
+            fieldtype: "Link",
+            options: "Company",
+            reqd: 0
+        }
+    ]
+};
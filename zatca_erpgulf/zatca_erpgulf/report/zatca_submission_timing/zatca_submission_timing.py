@@ -0,0 +1,28 @@
+from frappe import _
+from zatca_erpgulf.zatca_erpgulf.stage_timing import (
+    PERCENTILES,
+    summarize_stage_timings,
+)
+
+
+def get_columns():
+    columns = [
+        {"fieldname": "company", "label": _("Company"), "fieldtype": "Link", "options": "Company", "width": 200},
+        {"fieldname": "unit", "label": _("Signing Unit"), "fieldtype": "Data", "width": 200},
+        {"fieldname": "stage", "label": _("Stage"), "fieldtype": "Data", "width": 120},
+        {"fieldname": "samples", "label": _("Samples"), "fieldtype": "Int", "width": 90},
+    ]
+    for percentile in PERCENTILES:
+        columns.append(
+            {"fieldname": f"p{percentile}_ms", "label": _(f"p{percentile} (ms)"), "fieldtype": "Float", "width": 110}
+        )
+    columns += [
+        {"fieldname": "max_ms", "label": _("Max (ms)"), "fieldtype": "Float", "width": 110},
+        {"fieldname": "avg_queries", "label": _("Avg Queries"), "fieldtype": "Float", "width": 110},
+    ]
+    return columns
+
+
+def execute(filters=None):
+    filters = filters or {}
+    return get_columns(), summarize_stage_timings(filters.get("company"))
@@ -3,9 +3,11 @@
 import base64
 from frappe import _
 import frappe
-import requests
-from lxml import etree
+from zatca_erpgulf.zatca_erpgulf.zatca_session import zatca_post
+from zatca_erpgulf.zatca_erpgulf.offline_ingestion import read_signed_header
 from zatca_erpgulf.zatca_erpgulf.event_log import log_zatca_event
+from zatca_erpgulf.zatca_erpgulf.pih_chain import set_unit_pih
+from zatca_erpgulf.zatca_erpgulf.async_submission import show_gif, hide_gif
 
 CONTENT_TYPE_JSON = "application/json"
 
@@ -85,33 +87,8 @@ def extract_uuid_and_invoicehash(file_path):
         dict: A dictionary containing UUID and DigestValue.
     """
     try:
-        # Read the file content as bytes
-        with open(frappe.local.site + file_path, "rb") as file: # nosemgrep: frappe-semgrep-rules.rules.security.frappe-security-file-traversal
-            custom_xml = file.read()
-
-        # Parse the XML string as bytes
-        tree = etree.fromstring(custom_xml)
-
-        # Define the namespaces
-        namespaces = {
-            "cbc": "urn:oasis:names:specification:ubl:schema:xsd:CommonBasicComponents-2",
-            "ds": "http://www.w3.org/2000/09/xmldsig#",
-        }
-
-        # Extract the UUID
-        uuid = tree.find("cbc:UUID", namespaces).text
-
-        # Extract the DigestValue
-        digest_value_element = tree.find(
-            ".//ds:Reference[@Id='invoiceSignedData']/ds:DigestValue", namespaces
-        )
-        digest_value = (
-            digest_value_element.text
-            if digest_value_element is not None
-            else "Not Found"
-        )
-
-        return uuid, digest_value
+        header = read_signed_header(frappe.local.site + file_path)
+        return header["uuid"], header.get("digest_value", "Not Found")
 
     except Exception as e:
         return {
@@ -167,18 +144,14 @@ def reporting_api_xml_sales_invoice(
         }
 
         try:
-            frappe.publish_realtime(
-                "show_gif",
-                {"gif_url": "/assets/zatca_erpgulf/js/loading.gif"},
-                user=frappe.session.user,
-            )
-            response = requests.post(
+            show_gif()
+            response = zatca_post(
                 url=get_api_url(company_abbr, base_url="invoices/reporting/single"),
                 headers=headers,
                 json=payload,
                 timeout=300,
             )
-            frappe.publish_realtime("hide_gif", user=frappe.session.user)
+            hide_gif()
             if response.status_code in (200, 202, 409):
                 if response.status_code == 200:
                     status_label = "Success"
@@ -299,20 +272,17 @@ def reporting_api_xml_sales_invoice(
                     if zatca_settings.custom__use_company_certificate__keys != 1:
                         if zatca_settings.custom_send_pos_invoices_to_zatca_on_background:
                             frappe.msgprint(msg)
-                        zatca_settings.custom_pih = encoded_hash
-                        zatca_settings.save(ignore_permissions=True)
+                        set_unit_pih(sales_invoice_doc, encoded_hash)
                     else:
                         linked_doc = frappe.get_doc("Company", zatca_settings.custom_linked_doctype)
                         if linked_doc.custom_send_einvoice_background:
                             frappe.msgprint(msg)
-                        linked_doc.custom_pih = encoded_hash
-                        linked_doc.save(ignore_permissions=True)
+                        set_unit_pih(sales_invoice_doc, encoded_hash)
                 else:
                     company_doc = frappe.get_doc("Company", sales_invoice_doc.company)
                     if company_doc.custom_send_einvoice_background:
                         frappe.msgprint(msg)
-                    company_doc.custom_pih = encoded_hash
-                    company_doc.save(ignore_permissions=True)
+                    set_unit_pih(sales_invoice_doc, encoded_hash)
 
                 invoice_doc = frappe.get_doc("Sales Invoice", invoice_number)
                 invoice_doc.custom_zatca_full_response = msg
@@ -380,20 +350,17 @@ def reporting_api_xml_sales_invoice(
                             frappe.msgprint(msg)
 
                         # Update PIH data without JSON formatting
-                        zatca_settings.custom_pih = encoded_hash
-                        zatca_settings.save(ignore_permissions=True)
+                        set_unit_pih(sales_invoice_doc, encoded_hash)
                     else:
                         linked_doc = frappe.get_doc("Company", zatca_settings.custom_linked_doctype)
                         if linked_doc.custom_send_einvoice_background:
                             frappe.msgprint(msg)
-                        linked_doc.custom_pih = encoded_hash
-                        linked_doc.save(ignore_permissions=True)
+                        set_unit_pih(sales_invoice_doc, encoded_hash)
                 else:
                     company_doc = frappe.get_doc("Company", sales_invoice_doc.company)
                     if company_doc.custom_send_einvoice_background:
                         frappe.msgprint(msg)
-                    company_doc.custom_pih = encoded_hash
-                    company_doc.save(ignore_permissions=True)
+                    set_unit_pih(sales_invoice_doc, encoded_hash)
 
 
                 invoice_doc = frappe.get_doc("Sales Invoice", invoice_number)
@@ -2,9 +2,16 @@
 
 from datetime import datetime, timedelta, time
 import frappe
-from frappe.utils import now_datetime, add_to_date
+from frappe.utils import now_datetime, cint
 
 from zatca_erpgulf.zatca_erpgulf.pos_sign import zatca_background_on_submit
+from zatca_erpgulf.zatca_erpgulf.zatca_config import get_company_config
+from zatca_erpgulf.zatca_erpgulf.submission_queue import (
+    drain_signing_units,
+    enqueue_signing_units,
+    get_pending_invoices,
+    get_signing_units,
+)
 
 
 def convert_to_time(time_value):
@@ -40,6 +47,7 @@ def submit_posinvoices_to_zatca_background_process():
                 "custom_start_time_session",
                 "custom_end_time_session",
                 "custom_send_invoice_to_zatca",
+                "custom_zatca_submission_workers",
             ],
         )
         # print(f"companies: {companies}", "ZATCA Background Job")
@@ -69,24 +77,7 @@ def submit_posinvoices_to_zatca_background_process():
             pass
             return
 
-        past_24_hours_time = add_to_date(now_datetime(), hours=-24)
-
-        not_submitted_invoices = frappe.get_all(
-            "POS Invoice",
-            filters=[
-                ["creation", ">=", past_24_hours_time],
-                ["docstatus", "in", [0, 1]],
-                [
-                    "custom_zatca_status",
-                    "in",
-                    
-                    ["Not Submitted", "503 Service Unavailable"],
-                     
-
-                ],
-            ],
-            fields=["name", "docstatus", "company", "customer"],
-        )
+        not_submitted_invoices = get_pending_invoices("POS Invoice")
 
         if not not_submitted_invoices:
             # frappe.log_error(
@@ -96,38 +87,26 @@ def submit_posinvoices_to_zatca_background_process():
             pass
             return
 
+        workers_by_company = {
+            company.name: cint(company.custom_zatca_submission_workers)
+            for company in companies
+        }
+        parallel_invoices = [
+            invoice
+            for invoice in not_submitted_invoices
+            if workers_by_company.get(invoice.company)
+        ]
+        if parallel_invoices:
+            enqueue_signing_units(
+                "zatca_erpgulf.zatca_erpgulf.schedule_pos.submit_pos_invoice_units",
+                get_signing_units(parallel_invoices),
+                workers_by_company,
+            )
+
         for invoice in not_submitted_invoices:
-            pos_invoice_doc = frappe.get_doc("POS Invoice", invoice["name"])
-            company_doc = frappe.get_doc("Company", pos_invoice_doc.company)
-            # print(f"Processing {pos_invoice_doc.name}", "ZATCA Background Job")
-            if company_doc.custom_phase_1_or_2 == "Phase-1":
-                # frappe.log_error(f"Skipping invoice {invoice['name']} because company is Phase-1", "ZATCA Background Debug")
+            if workers_by_company.get(invoice.company):
                 continue
-            if pos_invoice_doc.docstatus == 1:
-                zatca_background_on_submit(
-                    pos_invoice_doc, bypass_background_check=True
-                )
-                # frappe.log_error(
-                #     f"Processed {pos_invoice_doc.name}: Sent to ZATCA.",
-                #     "ZATCA Background Job",
-                # )
-            # elif company_doc.custom_submit_or_not == 1:
-            else:
-                customer_doc = frappe.get_doc("Customer", pos_invoice_doc.customer)
-
-                if (
-                    company_doc.custom_submit_or_not == 1
-                    and customer_doc.custom_b2c == 1
-                ):
-                    pos_invoice_doc.submit()
-
-                    zatca_background_on_submit(
-                        pos_invoice_doc, bypass_background_check=True
-                    )
-                # frappe.log_error(
-                #     f"Submitted {pos_invoice_doc.name} before sending to ZATCA.",
-                #     "ZATCA Background Job",
-                # )
+            submit_pending_pos_invoice(invoice["name"])
 
         # frappe.log_error(
         #     f"Processed {len(not_submitted_invoices)} invoices for ZATCA submission.",
@@ -137,4 +116,43 @@ def submit_posinvoices_to_zatca_background_process():
         frappe.log_error(frappe.get_traceback(), "ZATCA Background Job Error")
 
 
+def submit_pending_pos_invoice(invoice_name):
+    """Sign and send one pending POS invoice, submitting it first if it is still a B2C draft."""
+    pos_invoice_doc = frappe.get_doc("POS Invoice", invoice_name)
+    company_config = get_company_config(pos_invoice_doc.company)
+    # print(f"Processing {pos_invoice_doc.name}", "ZATCA Background Job")
+    if company_config.custom_phase_1_or_2 == "Phase-1":
+        # frappe.log_error(f"Skipping invoice {invoice_name} because company is Phase-1", "ZATCA Background Debug")
+        return
+    if pos_invoice_doc.docstatus == 1:
+        zatca_background_on_submit(
+            pos_invoice_doc, bypass_background_check=True
+        )
+        # frappe.log_error(
+        #     f"Processed {pos_invoice_doc.name}: Sent to ZATCA.",
+        #     "ZATCA Background Job",
+        # )
+    # elif company_doc.custom_submit_or_not == 1:
+    else:
+        if (
+            company_config.custom_submit_or_not == 1
+            and frappe.get_cached_value("Customer", pos_invoice_doc.customer, "custom_b2c")
+            == 1
+        ):
+            pos_invoice_doc.submit()
+
+            zatca_background_on_submit(
+                pos_invoice_doc, bypass_background_check=True
+            )
+        # frappe.log_error(
+        #     f"Submitted {pos_invoice_doc.name} before sending to ZATCA.",
+        #     "ZATCA Background Job",
+        # )
+
+
+def submit_pos_invoice_units(units):
+    """Background job draining its share of the POS invoice signing units."""
+    drain_signing_units(units, submit_pending_pos_invoice)
+
+
 # submit_posinvoices_to_zatca_background_process()
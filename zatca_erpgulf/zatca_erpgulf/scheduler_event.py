@@ -2,10 +2,17 @@
 
 from datetime import datetime, timedelta, time
 import frappe
-from frappe.utils import now_datetime, add_to_date
+from frappe.utils import now_datetime, cint
 
 from zatca_erpgulf.zatca_erpgulf.sign_invoice import zatca_background_on_submit
+from zatca_erpgulf.zatca_erpgulf.submission_queue import (
+    drain_signing_units,
+    enqueue_signing_units,
+    get_pending_invoices,
+    get_signing_units,
+)
 
+from zatca_erpgulf.zatca_erpgulf.zatca_config import get_company_config
 from zatca_erpgulf.zatca_erpgulf.schedule_pos import (
     submit_posinvoices_to_zatca_background_process,
 )
@@ -49,6 +56,7 @@ def submit_invoices_to_zatca_background():
                 "custom_end_time_session",
                 "custom_send_invoice_to_zatca",
                 "custom_submit_or_not",
+                "custom_zatca_submission_workers",
             ],
         )
 
@@ -94,94 +102,77 @@ def submit_invoices_to_zatca_background():
 
             return
 
-        past_24_hours_time = add_to_date(now_datetime(), hours=-24)
-        not_submitted_invoices = frappe.get_all(
-            "Sales Invoice",
-            filters=[
-                ["creation", ">=", past_24_hours_time],
-                ["docstatus", "in", [0, 1]],
-                [
-                    "custom_zatca_status",
-                    "in",
-                    ["Not Submitted", "503 Service Unavailable"],
-                
-                ],
-            ],
-            fields=["name", "docstatus", "company", "customer"],
-        )
+        not_submitted_invoices = get_pending_invoices("Sales Invoice")
+
+        workers_by_company = {
+            company.name: cint(company.custom_zatca_submission_workers)
+            for company in companies
+        }
+        parallel_invoices = [
+            invoice
+            for invoice in not_submitted_invoices
+            if workers_by_company.get(invoice.company)
+        ]
+        if parallel_invoices:
+            enqueue_signing_units(
+                "zatca_erpgulf.zatca_erpgulf.scheduler_event.submit_sales_invoice_units",
+                get_signing_units(parallel_invoices),
+                workers_by_company,
+            )
 
         for invoice in not_submitted_invoices:
-            try:
-                sales_invoice_doc = frappe.get_doc("Sales Invoice", invoice["name"])
-                company_doc = frappe.get_doc("Company", sales_invoice_doc.company)
-                if company_doc.custom_phase_1_or_2 == "Phase-1":
-                    # frappe.log_error(f"Skipping invoice {invoice['name']} because company is Phase-1", "ZATCA Background Debug")
-                    continue
-                if sales_invoice_doc.docstatus == 1:
-                    zatca_background_on_submit(
-                        sales_invoice_doc, bypass_background_check=True
-                    )
-                else:
-                    customer_doc = frappe.get_doc("Customer", sales_invoice_doc.customer)
-
-                    if (
-                        company_doc.custom_submit_or_not == 1
-                        and customer_doc.custom_b2c == 1
-                    ):
-                # elif company_doc.custom_submit_or_not == 1:
-                        sales_invoice_doc.submit()
-                        zatca_background_on_submit(
-                            sales_invoice_doc, bypass_background_check=True
-                        )
-
-                frappe.db.commit()
-            except Exception as e:
-                frappe.log_error(
-                    frappe.get_traceback(),
-                    f"Error processing invoice {invoice['name']}",
-                )
+            if workers_by_company.get(invoice.company):
+                continue
+            submit_pending_sales_invoice(invoice["name"])
 
     except Exception:
         frappe.log_error(frappe.get_traceback(), "ZATCA Background Job Error")
 
 
-def submit_invoices_to_zatca_background_process():
-    """Submit invoices to ZATCA only if at least one company falls within the time range."""
+def submit_pending_sales_invoice(invoice_name):
+    """Sign and send one pending sales invoice, submitting it first if it is still a B2C draft."""
     try:
-        past_24_hours_time = add_to_date(now_datetime(), hours=-24)
-        sales_invoices = frappe.get_all(
-            "Sales Invoice",
-            filters=[
-                ["creation", ">=", past_24_hours_time],
-                ["docstatus", "in", [0, 1]],
-                [
-                    "custom_zatca_status",
-                    "in",
-                    ["Not Submitted", "503 Service Unavailable"],
-                    
-                ],
-            ],
-            fields=["name"],
-        )
-        # print(f"sales_invoices: {sales_invoices}")
-        if sales_invoices:
-            submit_invoices_to_zatca_background()  # Process Sales Invoices
-        pos_invoices = frappe.get_all(
-            "POS Invoice",
-            filters=[
-                ["creation", ">=", past_24_hours_time],
-                ["docstatus", "in", [0, 1]],
-                [
-                    "custom_zatca_status",
-                    "in",
-                    ["Not Submitted", "503 Service Unavailable"],
-                ], 
-            ],
-            fields=["name"],
+        sales_invoice_doc = frappe.get_doc("Sales Invoice", invoice_name)
+        company_config = get_company_config(sales_invoice_doc.company)
+        if company_config.custom_phase_1_or_2 == "Phase-1":
+            # frappe.log_error(f"Skipping invoice {invoice_name} because company is Phase-1", "ZATCA Background Debug")
+            return
+        if sales_invoice_doc.docstatus == 1:
+            zatca_background_on_submit(
+                sales_invoice_doc, bypass_background_check=True
+            )
+        else:
+            if (
+                company_config.custom_submit_or_not == 1
+                and frappe.get_cached_value("Customer", sales_invoice_doc.customer, "custom_b2c")
+                == 1
+            ):
+        # elif company_doc.custom_submit_or_not == 1:
+                sales_invoice_doc.submit()
+                zatca_background_on_submit(
+                    sales_invoice_doc, bypass_background_check=True
+                )
+
+        frappe.db.commit()
+    except Exception:
+        frappe.log_error(
+            frappe.get_traceback(),
+            f"Error processing invoice {invoice_name}",
         )
 
-        if pos_invoices:
-            submit_posinvoices_to_zatca_background_process()  # Process POS Invoices
+
+def submit_sales_invoice_units(units):
+    """Background job draining its share of the sales invoice signing units."""
+    drain_signing_units(units, submit_pending_sales_invoice)
+
+
+def submit_invoices_to_zatca_background_process():
+    """Submit invoices to ZATCA only if at least one company falls within the time range."""
+    try:
+        # each scan checks the company time range first and queries the pending
+        # invoices of its doctype once, over the (custom_zatca_status, creation) index
+        submit_invoices_to_zatca_background()  # Process Sales Invoices
+        submit_posinvoices_to_zatca_background_process()  # Process POS Invoices
 
     except Exception:
         frappe.log_error(frappe.get_traceback(), "ZATCA Background Job Error")
@@ -8,14 +8,22 @@ invoices, signing, and submission to ZATCA servers for clearance and reporting.
 """
 
 import os
-import io
 import base64
 import json
 from frappe import _
 import frappe
-import requests
+from zatca_erpgulf.zatca_erpgulf.zatca_session import zatca_post
 from zatca_erpgulf.zatca_erpgulf.event_log import log_zatca_event
-from pyqrcode import create as qr_create
+from zatca_erpgulf.zatca_erpgulf.pih_chain import hold_signing_unit, set_unit_pih
+from zatca_erpgulf.zatca_erpgulf.stage_timing import timed_stage
+from zatca_erpgulf.zatca_erpgulf.async_submission import (
+    enqueue_invoice_submission,
+    show_gif,
+    hide_gif,
+)
+from zatca_erpgulf.zatca_erpgulf.batch_dispatcher import queue_invoice_for_batch
+from zatca_erpgulf.zatca_erpgulf.bulk_resubmission import enqueue_resubmission
+from zatca_erpgulf.zatca_erpgulf.qr_image import render_qr_png
 from frappe.custom.doctype.custom_field.custom_field import create_custom_fields
 from zatca_erpgulf.zatca_erpgulf.createxml import (
     xml_tags,
@@ -43,23 +51,15 @@ from zatca_erpgulf.zatca_erpgulf.create_xml_final_part import (
     item_data_advance_invoice,
     item_data_with_template_advance_invoice,
     item_data_with_template,
-    xml_structuring,
+    iter_item_lines,
+    iter_item_lines_with_template,
+    xml_structuring_tree,
 )
+from zatca_erpgulf.zatca_erpgulf.xml_stream import sign_streamed_invoice, use_streaming
 from zatca_erpgulf.zatca_erpgulf.create_qr import create_qr_code
 from zatca_erpgulf.zatca_erpgulf.sign_invoice_first import (
-    removetags,
-    canonicalize_xml,
-    getinvoicehash,
-    digital_signature,
-    extract_certificate_details,
-    certificate_hash,
-    signxml_modify,
-    generate_signed_properties_hash,
-    populate_the_ubl_extensions_output,
-    generate_tlv_xml,
+    sign_xml_tree,
     structuring_signedxml,
-    get_tlv_for_value,
-    update_qr_toxml,
     compliance_api_call,
 )
 from zatca_erpgulf.zatca_erpgulf.sales_invoice_with_xmlqr import (
@@ -75,6 +75,10 @@ from zatca_erpgulf.zatca_erpgulf.submit_xml_qr_notmultiple import (
 from zatca_erpgulf.zatca_erpgulf.zatca_background_sched import (
     zatca_call_scheduler_background,
 )
+from zatca_erpgulf.zatca_erpgulf.zatca_config import (
+    get_company_config,
+    get_installed_apps,
+)
 from zatca_erpgulf.zatca_erpgulf.pdf_a3 import (
     call_embed_pdf_on_submit
 )
@@ -82,10 +86,12 @@ REPORTED_XML = "%Reported xml file%"
 SAUDI_ARABIA = "Saudi Arabia"
 
 
-def xml_base64_decode(signed_xmlfile_name):
-    """xml base64 decode"""
+def xml_base64_decode(signed_xml):
+    """base64 of the signed xml, given as bytes from structuring_signedxml or as a file path"""
     try:
-        with open(signed_xmlfile_name, "r", encoding="utf-8") as file: # nosemgrep: frappe-semgrep-rules.rules.security.frappe-security-file-traversal
+        if isinstance(signed_xml, bytes):
+            return base64.b64encode(signed_xml).decode("utf-8")
+        with open(signed_xml, "r", encoding="utf-8") as file: # nosemgrep: frappe-semgrep-rules.rules.security.frappe-security-file-traversal
             xml = file.read().lstrip()
             base64_encoded = base64.b64encode(xml.encode("utf-8"))
             base64_decoded = base64_encoded.decode("utf-8")
@@ -156,6 +162,7 @@ def error_log():
         return None
 
 
+@timed_stage("file_write")
 def attach_qr_image(qrcodeb64, sales_invoice_doc):
     """attach the qr image"""
     try:
@@ -178,9 +185,7 @@ def attach_qr_image(qrcodeb64, sales_invoice_doc):
         qr_code = sales_invoice_doc.get("ksa_einv_qr")
         if qr_code and frappe.db.exists({"doctype": "File", "file_url": qr_code}):
             return
-        qr_image = io.BytesIO()
-        qr = qr_create(qrcodeb64, error="L")
-        qr.png(qr_image, scale=8, quiet_zone=1)
+        qr_image = render_qr_png(qrcodeb64)
 
         file_doc = frappe.get_doc(
             {
@@ -191,7 +196,7 @@ def attach_qr_image(qrcodeb64, sales_invoice_doc):
                 "attached_to_doctype": sales_invoice_doc.doctype,
                 "attached_to_name": sales_invoice_doc.name,
                 "is_private": 1,
-                "content": qr_image.getvalue(),
+                "content": qr_image,
                 "attached_to_field": "ksa_einv_qr",
             }
         )
@@ -203,8 +208,9 @@ def attach_qr_image(qrcodeb64, sales_invoice_doc):
         frappe.throw(_(("attach qr images" f"error: {str(e)}")))
 
 
+@timed_stage("db_writes")
 def reporting_api(
-    uuid1, encoded_hash, signed_xmlfile_name, invoice_number, sales_invoice_doc
+    uuid1, encoded_hash, signed_xml, invoice_number, sales_invoice_doc
 ):
     """reporting api based on the api data and payload"""
     try:
@@ -220,12 +226,9 @@ def reporting_api(
         payload = {
             "invoiceHash": encoded_hash,
             "uuid": uuid1,
-            "invoice": xml_base64_decode(signed_xmlfile_name),
+            "invoice": xml_base64_decode(signed_xml),
         }
         # production_csid = company_doc.custom_basic_auth_from_production
-        xml_base64 = xml_base64_decode(signed_xmlfile_name)
-
-        xml_cleared_data = base64.b64decode(xml_base64).decode("utf-8")
         file = frappe.get_doc(
             {
                 "doctype": "File",
@@ -233,10 +236,11 @@ def reporting_api(
                 "attached_to_doctype": sales_invoice_doc.doctype,
                 "is_private": 1,
                 "attached_to_name": sales_invoice_doc.name,
-                "content": xml_cleared_data,
+                "content": signed_xml,
             }
         )
-        file.save(ignore_permissions=True)
+        with timed_stage("file_write"):
+            file.save(ignore_permissions=True)
         sales_invoice_doc.db_set("custom_ksa_einvoicing_xml", file.file_url)
         if sales_invoice_doc.custom_zatca_pos_name:
             zatca_settings = frappe.get_doc(
@@ -264,18 +268,14 @@ def reporting_api(
             headers = None
         if company_doc.custom_send_invoice_to_zatca != "Batches":
             try:
-                frappe.publish_realtime(
-                    "show_gif",
-                    {"gif_url": "/assets/zatca_erpgulf/js/loading.gif"},
-                    user=frappe.session.user,
-                )
-                response = requests.post(
+                show_gif()
+                response = zatca_post(
                     url=get_api_url(company_abbr, base_url="invoices/reporting/single"),
                     headers=headers,
                     json=payload,
                     timeout=300,
                 )
-                frappe.publish_realtime("hide_gif", user=frappe.session.user)
+                hide_gif()
                 # Classify and log ZATCA API responses
                 if response.status_code in (200, 202, 409):
                     if response.status_code == 200:
@@ -405,20 +405,17 @@ def reporting_api(
                         if zatca_settings.custom__use_company_certificate__keys != 1:
                             if zatca_settings.custom_send_pos_invoices_to_zatca_on_background:
                                 frappe.msgprint(msg)
-                            zatca_settings.custom_pih = encoded_hash
-                            zatca_settings.save(ignore_permissions=True)
+                            set_unit_pih(sales_invoice_doc, encoded_hash)
                         else:
                             linked_doc = frappe.get_doc("Company", zatca_settings.custom_linked_doctype)
                             if linked_doc.custom_send_einvoice_background:
                                 frappe.msgprint(msg)
-                            linked_doc.custom_pih = encoded_hash
-                            linked_doc.save(ignore_permissions=True)   
+                            set_unit_pih(sales_invoice_doc, encoded_hash)
                     else:
                         company_doc = frappe.get_doc("Company", sales_invoice_doc.company)
                         if company_doc.custom_send_einvoice_background:
                             frappe.msgprint(msg)
-                        company_doc.custom_pih = encoded_hash
-                        company_doc.save(ignore_permissions=True)
+                        set_unit_pih(sales_invoice_doc, encoded_hash)
 
                     invoice_doc = frappe.get_doc("Sales Invoice", invoice_number)
                     invoice_doc.custom_zatca_full_response = msg
@@ -496,14 +493,12 @@ def reporting_api(
                                 frappe.msgprint(msg)
 
                             # Update PIH data without JSON formatting
-                            zatca_settings.custom_pih = encoded_hash
-                            zatca_settings.save(ignore_permissions=True)
+                            set_unit_pih(sales_invoice_doc, encoded_hash)
                         else:
                             linked_doc = frappe.get_doc("Company", zatca_settings.custom_linked_doctype)
                             if linked_doc.custom_send_einvoice_background:
                                 frappe.msgprint(msg)
-                            linked_doc.custom_pih = encoded_hash
-                            linked_doc.save(ignore_permissions=True)   
+                            set_unit_pih(sales_invoice_doc, encoded_hash)
 
                     else:
                         settings = frappe.get_doc("Company", company_name)
@@ -512,8 +507,7 @@ def reporting_api(
                             frappe.msgprint(msg)
 
                         # Update PIH data without JSON formatting
-                        company_doc.custom_pih = encoded_hash
-                        company_doc.save(ignore_permissions=True)
+                        set_unit_pih(sales_invoice_doc, encoded_hash)
 
                     invoice_doc = frappe.get_doc("Sales Invoice", invoice_number)
                     # invoice_doc.db_set(
@@ -543,6 +537,8 @@ def reporting_api(
                 
             except (ValueError, TypeError, KeyError, frappe.ValidationError) as e:
                 frappe.throw(_(f"Error in reporting API-2 original reporting: {str(e)}"))
+        else:
+            queue_invoice_for_batch(sales_invoice_doc, company_abbr, uuid1, encoded_hash)
 
     except (ValueError, TypeError, KeyError, frappe.ValidationError) as e:
         invoice_doc = frappe.get_doc("Sales Invoice", invoice_number)
@@ -552,8 +548,9 @@ def reporting_api(
         frappe.throw(_(f"Error in reporting API-1: {str(e)}"))
 
 
+@timed_stage("db_writes")
 def clearance_api(
-    uuid1, encoded_hash, signed_xmlfile_name, invoice_number, sales_invoice_doc
+    uuid1, encoded_hash, signed_xml, invoice_number, sales_invoice_doc
 ):
     """The clearance api with payload and headeders aand signed xml data"""
     try:
@@ -582,7 +579,7 @@ def clearance_api(
         payload = {
             "invoiceHash": encoded_hash,
             "uuid": uuid1,
-            "invoice": xml_base64_decode(signed_xmlfile_name),
+            "invoice": xml_base64_decode(signed_xml),
         }
 
         if production_csid:
@@ -598,13 +595,9 @@ def clearance_api(
         else:
             frappe.throw(_(f"Production CSID for company {company_abbr} not found."))
             headers = None
-        frappe.publish_realtime(
-            "show_gif",
-            {"gif_url": "/assets/zatca_erpgulf/js/loading.gif"},
-            user=frappe.session.user,
-        )
+        show_gif()
 
-        response = requests.post(
+        response = zatca_post(
             url=get_api_url(company_abbr, base_url="invoices/clearance/single"),
             headers=headers,
             json=payload,
@@ -651,19 +644,18 @@ def clearance_api(
                 uuid=uuid1,
                 title=title
             )
-        frappe.publish_realtime("hide_gif", user=frappe.session.user)
+        hide_gif()
         if response.status_code in (400, 405, 406):
             invoice_doc = frappe.get_doc("Sales Invoice", invoice_number)
             invoice_doc.db_set(
-                "custom_uuid", "Not Submitted", commit=True, update_modified=True
-            )
-            invoice_doc.db_set(
-                "custom_zatca_status",
-                "Not Submitted",
+                {
+                    "custom_uuid": "Not Submitted",
+                    "custom_zatca_status": "Not Submitted",
+                    "custom_zatca_full_response": "Not Submitted",
+                },
                 commit=True,
                 update_modified=True,
             )
-            invoice_doc.db_set("custom_zatca_full_response", "Not Submitted")
             frappe.throw(
                 _(
                     (
@@ -676,15 +668,14 @@ def clearance_api(
         if response.status_code in (401, 403, 407, 451):
             invoice_doc = frappe.get_doc("Sales Invoice", invoice_number)
             invoice_doc.db_set(
-                "custom_uuid", "Not Submitted", commit=True, update_modified=True
-            )
-            invoice_doc.db_set(
-                "custom_zatca_status",
-                "Not Submitted",
+                {
+                    "custom_uuid": "Not Submitted",
+                    "custom_zatca_status": "Not Submitted",
+                    "custom_zatca_full_response": "Not Submitted",
+                },
                 commit=True,
                 update_modified=True,
             )
-            invoice_doc.db_set("custom_zatca_full_response", "Not Submitted")
             frappe.throw(
                 _(
                     (
@@ -710,22 +701,19 @@ def clearance_api(
                 if zatca_settings.custom__use_company_certificate__keys != 1:
                     if zatca_settings.custom_send_pos_invoices_to_zatca_on_background:
                         frappe.msgprint(msg)
-                    zatca_settings.custom_pih = encoded_hash
-                    zatca_settings.save(ignore_permissions=True)
+                    set_unit_pih(sales_invoice_doc, encoded_hash)
                 else:
         
                     linked_doc = frappe.get_doc("Company", zatca_settings.custom_linked_doctype)
                     if linked_doc.custom_send_einvoice_background:
                         frappe.msgprint(msg)
-                    linked_doc.custom_pih = encoded_hash
-                    linked_doc.save(ignore_permissions=True)
+                    set_unit_pih(sales_invoice_doc, encoded_hash)
                     
             else:
                 company_doc = frappe.get_doc("Company", sales_invoice_doc.company)
                 if company_doc.custom_send_einvoice_background:
                     frappe.msgprint(msg)
-                company_doc.custom_pih = encoded_hash
-                company_doc.save(ignore_permissions=True)
+                set_unit_pih(sales_invoice_doc, encoded_hash)
 
             invoice_doc = frappe.get_doc("Sales Invoice", invoice_number)
             invoice_doc.custom_zatca_full_response = msg
@@ -742,15 +730,14 @@ def clearance_api(
         if response.status_code not in (200, 202, 409):
             invoice_doc = frappe.get_doc("Sales Invoice", invoice_number)
             invoice_doc.db_set(
-                "custom_uuid", "Not Submitted", commit=True, update_modified=True
-            )
-            invoice_doc.db_set(
-                "custom_zatca_status",
-                "Not Submitted",
+                {
+                    "custom_uuid": "Not Submitted",
+                    "custom_zatca_status": "Not Submitted",
+                    "custom_zatca_full_response": "Not Submitted",
+                },
                 commit=True,
                 update_modified=True,
             )
-            invoice_doc.db_set("custom_zatca_full_response", "Not Submitted")
             frappe.throw(
                 _(
                     f"Error: ZATCA server busy or not responding. Status code: {response.status_code}"
@@ -782,15 +769,13 @@ def clearance_api(
                         frappe.msgprint(msg)
 
                         # Update PIH data without JSON formatting
-                    zatca_settings.custom_pih = encoded_hash
-                    zatca_settings.save(ignore_permissions=True)
+                    set_unit_pih(sales_invoice_doc, encoded_hash)
                 else:
                         
                     linked_doc = frappe.get_doc("Company", zatca_settings.custom_linked_doctype)
                     if linked_doc.custom_send_einvoice_background:
                         frappe.msgprint(msg)
-                    linked_doc.custom_pih = encoded_hash
-                    linked_doc.save(ignore_permissions=True)
+                    set_unit_pih(sales_invoice_doc, encoded_hash)
                     
             else:
                 settings = frappe.get_doc("Company", company_name)
@@ -799,16 +784,17 @@ def clearance_api(
                     frappe.msgprint(msg)
 
                     # Update PIH data without JSON formatting
-                company_doc.custom_pih = encoded_hash
-                company_doc.save(ignore_permissions=True)
+                set_unit_pih(sales_invoice_doc, encoded_hash)
 
             invoice_doc = frappe.get_doc("Sales Invoice", invoice_number)
             invoice_doc.db_set(
-                "custom_zatca_full_response", msg, commit=True, update_modified=True
-            )
-            invoice_doc.db_set("custom_uuid", uuid1, commit=True, update_modified=True)
-            invoice_doc.db_set(
-                "custom_zatca_status", "CLEARED", commit=True, update_modified=True
+                {
+                    "custom_zatca_full_response": msg,
+                    "custom_uuid": uuid1,
+                    "custom_zatca_status": "CLEARED",
+                },
+                commit=True,
+                update_modified=True,
             )
 
             data = response.json()
@@ -824,7 +810,8 @@ def clearance_api(
                     "content": xml_cleared,
                 }
             )
-            file.save(ignore_permissions=True)
+            with timed_stage("file_write"):
+                file.save(ignore_permissions=True)
             sales_invoice_doc.db_set("custom_ksa_einvoicing_xml", file.file_url)
             success_log(response.text, uuid1, invoice_number)
             return xml_cleared
@@ -834,14 +821,10 @@ def clearance_api(
     except (ValueError, TypeError, KeyError, frappe.ValidationError) as e:
         invoice_doc = frappe.get_doc("Sales Invoice", invoice_number)
         invoice_doc.db_set(
-            "custom_zatca_full_response",
-            f"Error: {str(e)}",
-            commit=True,
-            update_modified=True,
-        )
-        invoice_doc.db_set(
-            "custom_zatca_status",
-            "503 Service Unavailable",
+            {
+                "custom_zatca_full_response": f"Error: {str(e)}",
+                "custom_zatca_status": "503 Service Unavailable",
+            },
             commit=True,
             update_modified=True,
         )
@@ -875,6 +858,7 @@ def is_qr_and_xml_attached(sales_invoice_doc):
 
 
 # @frappe.whitelist(allow_guest=False)
+@hold_signing_unit("Sales Invoice")
 def zatca_call(
     invoice_number,
     compliance_type="0",
@@ -939,6 +923,7 @@ def zatca_call(
             and sales_invoice_doc.custom_advances_copy
         )
 
+        signed_xml = None
         if is_claudion_installed and has_advance_copy:
             if not any_item_has_tax_template:
                 invoice = item_data_advance_invoice(invoice, sales_invoice_doc)
@@ -946,53 +931,27 @@ def zatca_call(
                 invoice = item_data_with_template_advance_invoice(
                     invoice, sales_invoice_doc
                 )
+        elif use_streaming(sales_invoice_doc):
+            # very large invoice, the lines are signed and written one at a time
+            if not any_item_has_tax_template:
+                lines = iter_item_lines(sales_invoice_doc)
+            else:
+                lines = iter_item_lines_with_template(sales_invoice_doc)
+            encoded_hash, qrcodeb64, signed_xml = sign_streamed_invoice(
+                invoice, lines, invoice_number, company_abbr, source_doc
+            )
         else:
             if not any_item_has_tax_template:
                 invoice = item_data(invoice, sales_invoice_doc)
             else:
                 invoice = item_data_with_template(invoice, sales_invoice_doc)
 
-        file_content=xml_structuring(invoice)
-        # try:
-        #     with open(
-        #         f"{frappe.local.site}/private/files/finalzatcaxml_{invoice_number}.xml",
-        #         "r",
-        #         encoding="utf-8",
-        #     ) as file:
-        #         file_content = file.read()
-        # except FileNotFoundError:
-        #     frappe.throw("XML file not found")
-        tag_removed_xml = removetags(file_content)
-        canonicalized_xml = canonicalize_xml(tag_removed_xml)
-        hash1, encoded_hash = getinvoicehash(canonicalized_xml)
-        encoded_signature = digital_signature(hash1, company_abbr, source_doc)
-        issuer_name, serial_number = extract_certificate_details(
-            company_abbr, source_doc
-        )
-        encoded_certificate_hash = certificate_hash(company_abbr, source_doc)
-        modified_xml_string,namespaces, signing_time = signxml_modify(company_abbr,file_content,source_doc)
-        signed_properties_base64 = generate_signed_properties_hash(
-            signing_time, issuer_name, serial_number, encoded_certificate_hash
-        )
-        final_xml_string=populate_the_ubl_extensions_output(
-            modified_xml_string,
-            encoded_signature,
-            namespaces,
-            signed_properties_base64,
-            encoded_hash,
-            company_abbr,
-            source_doc,
-        )
-        tlv_data = generate_tlv_xml(final_xml_string,company_abbr, source_doc)
-
-        tagsbufsarray = []
-        for tag_num, tag_value in tlv_data.items():
-            tagsbufsarray.append(get_tlv_for_value(tag_num, tag_value))
-
-        qrcodebuf = b"".join(tagsbufsarray)
-        qrcodeb64 = base64.b64encode(qrcodebuf).decode("utf-8")
-        updated_xml_string=update_qr_toxml(final_xml_string,qrcodeb64, company_abbr)
-        signed_xmlfile_name = structuring_signedxml(invoice_number,updated_xml_string)
+        if signed_xml is None:
+            root = xml_structuring_tree(invoice)
+            encoded_hash, qrcodeb64, updated_xml_string = sign_xml_tree(
+                root, company_abbr, source_doc
+            )
+            signed_xml = structuring_signedxml(invoice_number,updated_xml_string)
         # Example usage
         # file_path = generate_invoice_pdf(
         #     invoice_number, l anguage="en", letterhead="Sample letterhead"
@@ -1004,7 +963,7 @@ def zatca_call(
                 reporting_api(
                     uuid1,
                     encoded_hash,
-                    signed_xmlfile_name,
+                    signed_xml,
                     invoice_number,
                     sales_invoice_doc,
                 )
@@ -1013,7 +972,7 @@ def zatca_call(
                 clearance_api(
                     uuid1,
                     encoded_hash,
-                    signed_xmlfile_name,
+                    signed_xml,
                     invoice_number,
                     sales_invoice_doc,
                 )
@@ -1022,7 +981,7 @@ def zatca_call(
             compliance_api_call(
                 uuid1,
                 encoded_hash,
-                signed_xmlfile_name,
+                signed_xml,
                 company_abbr,
                 source_doc,
             )
@@ -1121,48 +1080,13 @@ def zatca_call_compliance(
         else:
             item_data_with_template(invoice, sales_invoice_doc)
         # Generate and process the XML data
-        file_content=xml_structuring(invoice)
-        # with open(
-        #     f"{frappe.local.site}/private/files/finalzatcaxml_{invoice_number}.xml",
-        #     "r",
-        #     encoding="utf-8",
-        # ) as file:
-        #     file_content = file.read()
-
-        tag_removed_xml = removetags(file_content)
-        canonicalized_xml = canonicalize_xml(tag_removed_xml)
-        hash1, encoded_hash = getinvoicehash(canonicalized_xml)
-        encoded_signature = digital_signature(hash1, company_abbr, source_doc)
-        issuer_name, serial_number = extract_certificate_details(
-            company_abbr, source_doc
-        )
-        encoded_certificate_hash = certificate_hash(company_abbr, source_doc)
-        modified_xml_string,namespaces, signing_time = signxml_modify(company_abbr,file_content, source_doc)
-        signed_properties_base64 = generate_signed_properties_hash(
-            signing_time, issuer_name, serial_number, encoded_certificate_hash
+        root = xml_structuring_tree(invoice)
+        encoded_hash, qrcodeb64, updated_xml_string = sign_xml_tree(
+            root, company_abbr, source_doc
         )
-        final_xml_string = populate_the_ubl_extensions_output(
-            modified_xml_string,
-            encoded_signature,
-            namespaces,
-            signed_properties_base64,
-            encoded_hash,
-            company_abbr,
-            source_doc,
-        )
-        # Generate the TLV data and QR code
-        tlv_data = generate_tlv_xml(final_xml_string,company_abbr, source_doc)
-        tagsbufsarray = []
-        for tag_num, tag_value in tlv_data.items():
-            tagsbufsarray.append(get_tlv_for_value(tag_num, tag_value))
-
-        qrcodebuf = b"".join(tagsbufsarray)
-        qrcodeb64 = base64.b64encode(qrcodebuf).decode("utf-8")
-
-        updated_xml_string=update_qr_toxml(final_xml_string,qrcodeb64,company_abbr)
-        signed_xmlfile_name = structuring_signedxml(invoice_number, updated_xml_string)
+        signed_xml = structuring_signedxml(invoice_number, updated_xml_string)
         value = compliance_api_call(
-            uuid1, encoded_hash, signed_xmlfile_name, company_abbr, source_doc
+            uuid1, encoded_hash, signed_xml, company_abbr, source_doc
         )
         return value
 
@@ -1603,14 +1527,12 @@ def zatca_background_on_submit(doc: "str|dict", _method: str = None, bypass_back
         sales_invoice_doc = doc
         invoice_number = sales_invoice_doc.name
         sales_invoice_doc = frappe.get_doc("Sales Invoice", invoice_number)
-        company_abbr = frappe.db.get_value(
-            "Company", {"name": sales_invoice_doc.company}, "abbr"
-        )
+        company_doc = get_company_config(sales_invoice_doc.company)
+        company_abbr = company_doc.abbr
         if not company_abbr:
             frappe.throw(
                 _(f"Company abbreviation for {sales_invoice_doc.company} not found.")
             )
-        company_doc = frappe.get_doc("Company", {"abbr": company_abbr})
         customer_doc = frappe.get_doc("Customer", sales_invoice_doc.customer)
         if company_doc.custom_zatca_invoice_enabled != 1:
             # frappe.msgprint("Zatca Invoice is not enabled. Submitting the document.")
@@ -1627,7 +1549,7 @@ def zatca_background_on_submit(doc: "str|dict", _method: str = None, bypass_back
                 return
 
         
-        is_gpos_installed = "gpos" in frappe.get_installed_apps()
+        is_gpos_installed = "gpos" in get_installed_apps()
         field_exists = frappe.get_meta("Sales Invoice").has_field("custom_offline_invoice_number")
 
         # If GPOS is installed and field exists, check its value
@@ -1794,7 +1716,6 @@ def zatca_background_on_submit(doc: "str|dict", _method: str = None, bypass_back
                 )
             )
 
-        customer_doc = frappe.get_doc("Customer", sales_invoice_doc.customer)
         if customer_doc.custom_b2c == 0:
             if not customer_doc.custom_buyer_id:
                 frappe.throw(_(
@@ -1894,7 +1815,7 @@ def zatca_background_on_submit(doc: "str|dict", _method: str = None, bypass_back
                 )
         if not customer_doc.custom_buyer_id_type and customer_doc.custom_buyer_id:
             frappe.throw(_("Buyer ID must be blank if Buyer ID Type is not set."))
-        if "claudion4saudi" in frappe.get_installed_apps():
+        if "claudion4saudi" in get_installed_apps():
             if (
                 hasattr(sales_invoice_doc, "custom_advances_copy")
                 and sales_invoice_doc.custom_advances_copy
@@ -1968,10 +1889,8 @@ def zatca_background_on_submit(doc: "str|dict", _method: str = None, bypass_back
             frappe.throw(
                 _("This invoice has already been submitted to Zakat and Tax Authority.")
             )
-        company_name = sales_invoice_doc.company
-        settings = frappe.get_doc("Company", company_name)
+        settings = company_doc
         # if settings.custom_phase_1_or_2 == "Phase-2":
-        is_gpos_installed = "gpos" in frappe.get_installed_apps()
         field_exists = frappe.get_meta("Sales Invoice").has_field("custom_unique_id")
         if is_gpos_installed:
             if sales_invoice_doc.custom_xml and not sales_invoice_doc.custom_qr_code:
@@ -1981,6 +1900,10 @@ def zatca_background_on_submit(doc: "str|dict", _method: str = None, bypass_back
                         + str(invoice_number)
                     )
                 )
+        if settings.custom_phase_1_or_2 == "Phase-2" and enqueue_invoice_submission(
+            sales_invoice_doc, settings, bypass_background_check
+        ):
+            return
         if settings.custom_phase_1_or_2 == "Phase-2":
 
             if field_exists and sales_invoice_doc.custom_unique_id:
@@ -2051,42 +1974,10 @@ def zatca_background_on_submit(doc: "str|dict", _method: str = None, bypass_back
 @frappe.whitelist()
 def resubmit_invoices(invoice_numbers:str, bypass_background_check:bool=False):
     """
-    Resubmit invoices where custom_zatca_full_response contains 'RemoteDisconnected'.
-    If the invoice is already submitted, call `zatca_background_on_submit`.
-    Otherwise, submit the invoice.
+    Resubmit the selected invoices to ZATCA in background jobs.
+    Submitted invoices are sent again through `zatca_background_on_submit`, drafts are
+    submitted when the company allows it. Returns the handle of the resubmission job,
+    whose progress is published to the user and available from get_resubmission_progress.
     """
-    if isinstance(invoice_numbers, str):
-        invoice_numbers = frappe.parse_json(invoice_numbers)
-
-    results = {}
-    for invoice_number in invoice_numbers:
-        try:
-            # Fetch the Sales Invoice document
-            sales_invoice_doc = frappe.get_doc("Sales Invoice", invoice_number)
-            company_doc = frappe.get_doc("Company", sales_invoice_doc.company)
-            customer_doc = frappe.get_doc("Customer", sales_invoice_doc.customer)
-            if (
-                sales_invoice_doc.docstatus == 1
-            ):  # Check if the invoice is already submitted
-                # Call the zatca_background_on_submit function
-                zatca_background_on_submit(
-                    sales_invoice_doc, bypass_background_check=True
-                )
-
-            # elif company_doc.custom_submit_or_not == 1:
-            elif (
-                sales_invoice_doc.docstatus == 0
-                and company_doc.custom_submit_or_not == 1
-                and customer_doc.custom_b2c == 1
-            ):
-                # Submit the invoice
-                sales_invoice_doc.submit()
-                # zatca_background_on_submit(
-                #     sales_invoice_doc, bypass_background_check=True
-                # )
-
-        except (ValueError, TypeError, KeyError, frappe.ValidationError) as e:
-            frappe.throw(_(f"Error in background call: {str(e)}"))
-            # Log errors and add to the results
-
-    return results
+    # submitted invoices have always been resent bypassing the background check
+    return enqueue_resubmission("Sales Invoice", invoice_numbers)
@@ -4,15 +4,17 @@ This module facilitates the generation, validation, and submission of
 using ERPNext
 """
 
+import copy
 import hashlib
 import base64
 import json
-import binascii
+import re
 from datetime import datetime
 from lxml import etree
 import lxml.etree as MyTree
 from frappe import _
 import frappe
+from zatca_erpgulf.zatca_erpgulf.stage_timing import timed_stage
 from cryptography import x509
 from cryptography.hazmat._oid import NameOID
 from cryptography.hazmat.backends import default_backend
@@ -20,9 +22,187 @@ from cryptography.hazmat.bindings._rust import ObjectIdentifier
 from cryptography.hazmat.primitives import serialization, hashes
 from cryptography.hazmat.primitives.asymmetric import ec
 import requests
+from zatca_erpgulf.zatca_erpgulf.zatca_session import zatca_post, zatca_request
 import asn1
+from zatca_erpgulf.zatca_erpgulf.signing_identity import (
+    get_public_key_pem,
+    get_signing_identity,
+)
+from zatca_erpgulf.zatca_erpgulf.ubl_skeleton import get_signature_node, has_skeleton
+
+SIGNATURE_NAMESPACES = {
+    "ext": "urn:oasis:names:specification:ubl:schema:xsd:CommonExtensionComponents-2",
+    "sig": "urn:oasis:names:specification:ubl:schema:xsd:CommonSignatureComponents-2",
+    "sac": "urn:oasis:names:specification:ubl:schema:xsd:SignatureAggregateComponents-2",
+    "xades": "http://uri.etsi.org/01903/v1.3.2#",
+    "ds": "http://www.w3.org/2000/09/xmldsig#",
+}
+TLV_NAMESPACES = {
+    "ubl": "urn:oasis:names:specification:ubl:schema:xsd:Invoice-2",
+    "cac": "urn:oasis:names:specification:ubl:schema:xsd:CommonAggregateComponents-2",
+    "cbc": "urn:oasis:names:specification:ubl:schema:xsd:CommonBasicComponents-2",
+    "ext": "urn:oasis:names:specification:ubl:schema:xsd:CommonExtensionComponents-2",
+    "sig": "urn:oasis:names:specification:ubl:schema:xsd:CommonSignatureComponents-2",
+    "sac": "urn:oasis:names:specification:ubl:schema:xsd:SignatureAggregateComponents-2",
+    "ds": "http://www.w3.org/2000/09/xmldsig#",
+}
+XPATH_SIGNATURE = "ext:UBLExtensions/ext:UBLExtension/ext:ExtensionContent/sig:UBLDocumentSignatures/sac:SignatureInformation/ds:Signature"
+XPATH_SIGNED_SIGNATURE_PROPERTIES = XPATH_SIGNATURE + "/ds:Object/xades:QualifyingProperties/xades:SignedProperties/xades:SignedSignatureProperties"
+XPATH_CERT_DIGEST_VALUE = XPATH_SIGNED_SIGNATURE_PROPERTIES + "/xades:SigningCertificate/xades:Cert/xades:CertDigest/ds:DigestValue"
+XPATH_SIGNING_TIME = XPATH_SIGNED_SIGNATURE_PROPERTIES + "/xades:SigningTime"
+XPATH_ISSUER_NAME = XPATH_SIGNED_SIGNATURE_PROPERTIES + "/xades:SigningCertificate/xades:Cert/xades:IssuerSerial/ds:X509IssuerName"
+XPATH_SERIAL_NUMBER = XPATH_SIGNED_SIGNATURE_PROPERTIES + "/xades:SigningCertificate/xades:Cert/xades:IssuerSerial/ds:X509SerialNumber"
+XPATH_SIGNATURE_VALUE = XPATH_SIGNATURE + "/ds:SignatureValue"
+XPATH_X509_CERTIFICATE = XPATH_SIGNATURE + "/ds:KeyInfo/ds:X509Data/ds:X509Certificate"
+XPATH_SIGNED_PROPERTIES_DIGEST = XPATH_SIGNATURE + "/ds:SignedInfo/ds:Reference[@URI='#xadesSignedProperties']/ds:DigestValue"
+XPATH_INVOICE_DIGEST = XPATH_SIGNATURE + "/ds:SignedInfo/ds:Reference[@Id='invoiceSignedData']/ds:DigestValue"
+XPATH_ISSUE_DATE = "/ubl:Invoice/cbc:IssueDate"
+XPATH_ISSUE_TIME = "/ubl:Invoice/cbc:IssueTime"
+XPATH_QR_BINARY_OBJECT = './/cac:AdditionalDocumentReference[cbc:ID="QR"]/cac:Attachment/cbc:EmbeddedDocumentBinaryObject'
+TLV_TAG_XPATHS = [
+    (
+        1,
+        "/ubl:Invoice/cac:AccountingSupplierParty/cac:Party/cac:PartyLegalEntity/cbc:RegistrationName",
+    ),
+    (
+        2,
+        "/ubl:Invoice/cac:AccountingSupplierParty/cac:Party/cac:PartyTaxScheme/cbc:CompanyID",
+    ),
+    (3, None),
+    (4, "/ubl:Invoice/cac:LegalMonetaryTotal/cbc:TaxInclusiveAmount"),
+    (5, "/ubl:Invoice/cac:TaxTotal/cbc:TaxAmount"),
+    (6, "/ubl:Invoice/" + XPATH_SIGNATURE + "/ds:SignedInfo/ds:Reference/ds:DigestValue"),
+    (7, "/ubl:Invoice/" + XPATH_SIGNATURE_VALUE),
+    (8, None),
+    (9, None),
+]
+
+# compiled once at import and shared by every invoice signed in the worker
+REMOVE_TAGS_TRANSFORM = etree.XSLT(
+    etree.fromstring(
+        """<xsl:stylesheet xmlns:xsl="http://www.w3.org/1999/XSL/Transform"
+                                    xmlns:xs="http://www.w3.org/2001/XMLSchema"
+                                    xmlns="urn:oasis:names:specification:ubl:schema:xsd:Invoice-2"
+                                    xmlns:cac="urn:oasis:names:specification:ubl:schema:xsd:CommonAggregateComponents-2"
+                                    xmlns:cbc="urn:oasis:names:specification:ubl:schema:xsd:CommonBasicComponents-2"
+                                    xmlns:ext="urn:oasis:names:specification:ubl:schema:xsd:CommonExtensionComponents-2"
+                                    exclude-result-prefixes="xs"
+                                    version="2.0">
+                                    <xsl:output omit-xml-declaration="yes" encoding="utf-8" indent="no"/>
+                                    <xsl:template match="node() | @*">
+                                        <xsl:copy>
+                                            <xsl:apply-templates select="node() | @*"/>
+                                        </xsl:copy>
+                                    </xsl:template>
+                                    <xsl:template match="//*[local-name()='Invoice']//*[local-name()='UBLExtensions']"></xsl:template>
+                                    <xsl:template match="//*[local-name()='AdditionalDocumentReference'][cbc:ID[normalize-space(text()) = 'QR']]"></xsl:template>
+                                        <xsl:template match="//*[local-name()='Invoice']/*[local-name()='Signature']"></xsl:template>
+                                    </xsl:stylesheet>"""
+    )
+)
+FIND_CERT_DIGEST_VALUE = etree.XPath(XPATH_CERT_DIGEST_VALUE, namespaces=SIGNATURE_NAMESPACES)
+FIND_SIGNING_TIME = etree.XPath(XPATH_SIGNING_TIME, namespaces=SIGNATURE_NAMESPACES)
+FIND_ISSUER_NAME = etree.XPath(XPATH_ISSUER_NAME, namespaces=SIGNATURE_NAMESPACES)
+FIND_SERIAL_NUMBER = etree.XPath(XPATH_SERIAL_NUMBER, namespaces=SIGNATURE_NAMESPACES)
+FIND_SIGNATURE_VALUE = etree.XPath(XPATH_SIGNATURE_VALUE, namespaces=SIGNATURE_NAMESPACES)
+FIND_X509_CERTIFICATE = etree.XPath(XPATH_X509_CERTIFICATE, namespaces=SIGNATURE_NAMESPACES)
+FIND_SIGNED_PROPERTIES_DIGEST = etree.XPath(
+    XPATH_SIGNED_PROPERTIES_DIGEST, namespaces=SIGNATURE_NAMESPACES
+)
+FIND_INVOICE_DIGEST = etree.XPath(XPATH_INVOICE_DIGEST, namespaces=SIGNATURE_NAMESPACES)
+FIND_ISSUE_DATE = etree.XPath(XPATH_ISSUE_DATE, namespaces=TLV_NAMESPACES)
+FIND_ISSUE_TIME = etree.XPath(XPATH_ISSUE_TIME, namespaces=TLV_NAMESPACES)
+FIND_QR_BINARY_OBJECT = etree.XPath(XPATH_QR_BINARY_OBJECT, namespaces=TLV_NAMESPACES)
+TLV_TAG_FINDERS = [
+    (tag, etree.XPath(xpath, namespaces=TLV_NAMESPACES) if xpath else None)
+    for tag, xpath in TLV_TAG_XPATHS
+]
+# TLV tags read from the signature placeholders of the skeleton
+TLV_SIGNATURE_NODES = {6: "invoice_digest", 7: "signature_value"}
+# top level elements left out of the invoice hash besides the skeleton, see REMOVE_TAGS_TRANSFORM
+FIND_UNHASHED_ELEMENTS = etree.XPath(
+    "cac:AdditionalDocumentReference[cbc:ID[normalize-space(text()) = 'QR']] | cac:Signature",
+    namespaces=TLV_NAMESPACES,
+)
+
+
+# column every XAdES line of the signed xml starts at
+SIGNED_XML_INDENTATIONS = {
+    29: [
+        '<xades:QualifyingProperties xmlns:xades="http://uri.etsi.org/01903/v1.3.2#" Target="signature">',
+        "</xades:QualifyingProperties>",
+    ],
+    33: [
+        '<xades:SignedProperties Id="xadesSignedProperties">',
+        "</xades:SignedProperties>",
+    ],
+    37: [
+        "<xades:SignedSignatureProperties>",
+        "</xades:SignedSignatureProperties>",
+    ],
+    41: [
+        "<xades:SigningTime>",
+        "<xades:SigningCertificate>",
+        "</xades:SigningCertificate>",
+    ],
+    45: ["<xades:Cert>", "</xades:Cert>"],
+    49: [
+        "<xades:CertDigest>",
+        "<xades:IssuerSerial>",
+        "</xades:CertDigest>",
+        "</xades:IssuerSerial>",
+    ],
+    53: [
+        '<ds:DigestMethod Algorithm="http://www.w3.org/2001/04/xmlenc#sha256"/>',
+        "<ds:DigestValue>",
+        "<ds:X509IssuerName>",
+        "<ds:X509SerialNumber>",
+    ],
+}
+SIGNED_XML_INDENT_COLUMNS = {
+    tag: col for col, tags in SIGNED_XML_INDENTATIONS.items() for tag in tags
+}
+SIGNED_XML_INDENT_PATTERN = re.compile(
+    r"^[^\S\n]*("
+    + "|".join(re.escape(tag) for tag in SIGNED_XML_INDENT_COLUMNS)
+    + ")",
+    re.MULTILINE,
+)
+
+
+def find_first(finder, root):
+    """first node matched by a compiled XPath, or None like Element.find"""
+    results = finder(root)
+    return results[0] if results else None
+
+
+def find_signature_node(root, name, finder):
+    """signature placeholder by its position in the skeleton,
+    by XPath when the tree was not built on it"""
+    node = get_signature_node(root, name)
+    return node if node is not None else find_first(finder, root)
+
+
+def drop_element(element):
+    """remove an element but keep its tail text in the tree, as the XSLT copy does"""
+    parent = element.getparent()
+    if element.tail:
+        previous = element.getprevious()
+        if previous is not None:
+            previous.tail = (previous.tail or "") + element.tail
+        else:
+            parent.text = (parent.text or "") + element.tail
+    parent.remove(element)
+
 
-SUPPORTED_INVOICES = ["Sales Invoice", "POS Invoice"]
+def serialize_xml_tree(root):
+    """serialize an invoice tree the way every signing step writes it"""
+    return etree.tostring(
+        root,
+        encoding="utf-8",
+        xml_declaration=True,
+        pretty_print=True,
+    ).decode("utf-8")
 
 
 def encode_customoid(custom_string):
@@ -371,7 +551,7 @@ def create_csid(zatca_doc: dict | str, company_abbr:str):
             user=frappe.session.user,
         )
 
-        response = requests.post(
+        response = zatca_post(
             url=get_api_url(company_abbr, base_url="compliance"),
             headers=headers,
             data=payload,
@@ -410,86 +590,24 @@ def create_csid(zatca_doc: dict | str, company_abbr:str):
 
 
 def create_public_key(company_abbr, source_doc):
-    """Create a public key based on the company abbreviation and source document."""
+    """Create a public key based on the company abbreviation and source document.
+    The key is written back only if it differs from the stored one"""
     try:
-        # Get the company name using the provided abbreviation
-        company_name = frappe.db.get_value("Company", {"abbr": company_abbr}, "name")
-        if not company_name:
-            frappe.throw(_(f"Company with abbreviation {company_abbr} not found."))
-
-        # Fetch the company document
-        company_doc = frappe.get_doc("Company", company_name)
-
-        # Initialize certificate_data_str based on the document type
-        certificate_data_str = ""
-
-        if source_doc:
-            if source_doc.doctype in SUPPORTED_INVOICES:
-                if source_doc.custom_zatca_pos_name:
-                    # Fetch Zatca settings and use its certificate
-
-                    zatca_settings = frappe.get_doc(
-                        "ZATCA Multiple Setting", source_doc.custom_zatca_pos_name
-                    )
-                    certificate_data_str = zatca_settings.get("custom_certficate", "")
-                else:
-                    # Use company certificate as fallback
-                    certificate_data_str = company_doc.get("custom_certificate", "")
-            elif source_doc.doctype == "Company":
-                certificate_data_str = company_doc.get("custom_certificate", "")
-            elif source_doc.doctype == "ZATCA Multiple Setting":
-                certificate_data_str = source_doc.get("custom_certficate") 
-            else:
-                frappe.throw(_(f"Unsupported document type: {source_doc.doctype}"))
-
-        if not certificate_data_str:
-            frappe.throw(_("No certificate data found."))
-
-        # Build the PEM certificate
-        cert_base64 = f"""
-        -----BEGIN CERTIFICATE-----
-        {certificate_data_str.strip()}
-        -----END CERTIFICATE-----
-        """
-        # Load the certificate and extract the public key
-        cert = x509.load_pem_x509_certificate(cert_base64.encode(), default_backend())
-        public_key = cert.public_key()
-        public_key_pem = public_key.public_bytes(
-            encoding=serialization.Encoding.PEM,
-            format=serialization.PublicFormat.SubjectPublicKeyInfo,
-        ).decode()
-        if source_doc.doctype in SUPPORTED_INVOICES:
-            if source_doc.custom_zatca_pos_name:
-                zatca_settings = frappe.get_doc(
-                    "ZATCA Multiple Setting", source_doc.custom_zatca_pos_name
-                )
-
-                if not hasattr(zatca_settings, "custom_public_key"):
-                    frappe.throw(
-                        _(
-                            "Field `custom_public_key` not found in ZATCA Multiple Setting Doctype."
-                        )
-                    )
-
-                zatca_settings.custom_public_key = public_key_pem
-                zatca_settings.save(ignore_permissions=True)
-
-            else:
-                if not hasattr(company_doc, "custom_public_key"):
-                    frappe.throw(
-                        _("Field `custom_public_key` not found in Company Doctype.")
-                    )
-
-                company_doc.custom_public_key = public_key_pem
-                company_doc.save(ignore_permissions=True)
-        elif source_doc.doctype == "Company":
-            if not hasattr(company_doc, "custom_public_key"):
-                frappe.throw(
-                    _("Field `custom_public_key` not found in Company Doctype.")
-                )
+        identity = get_signing_identity(company_abbr, source_doc)
+        public_key_pem = get_public_key_pem(identity.certificate)
+        credential_doc = identity.credential_doc
+        if credential_doc is source_doc:
+            # a ZATCA Multiple Setting passed in directly is saved by its own form
+            return
+        if not hasattr(credential_doc, "custom_public_key"):
+            frappe.throw(
+                _(f"Field `custom_public_key` not found in {credential_doc.doctype} Doctype.")
+            )
+        if credential_doc.custom_public_key == public_key_pem:
+            return
 
-            company_doc.custom_public_key = public_key_pem
-            company_doc.save(ignore_permissions=True)
+        credential_doc.custom_public_key = public_key_pem
+        credential_doc.save(ignore_permissions=True)
 
         # Ensure data is committed to the database
         frappe.db.commit()
@@ -498,39 +616,31 @@ def create_public_key(company_abbr, source_doc):
         frappe.throw(_("Error occurred while creating public key: " + str(e)))
 
 
+@timed_stage("removetags")
 def removetags(finalzatcaxml):
     """remove the unwanted tags from created xml"""
     try:
         # Code corrected by Farook K - ERPGulf
-        xml_file = MyTree.fromstring(finalzatcaxml)
-        xsl_file = MyTree.fromstring(
-            """<xsl:stylesheet xmlns:xsl="http://www.w3.org/1999/XSL/Transform"
-                                    xmlns:xs="http://www.w3.org/2001/XMLSchema"
-                                    xmlns="urn:oasis:names:specification:ubl:schema:xsd:Invoice-2"
-                                    xmlns:cac="urn:oasis:names:specification:ubl:schema:xsd:CommonAggregateComponents-2"
-                                    xmlns:cbc="urn:oasis:names:specification:ubl:schema:xsd:CommonBasicComponents-2"
-                                    xmlns:ext="urn:oasis:names:specification:ubl:schema:xsd:CommonExtensionComponents-2"
-                                    exclude-result-prefixes="xs"
-                                    version="2.0">
-                                    <xsl:output omit-xml-declaration="yes" encoding="utf-8" indent="no"/>
-                                    <xsl:template match="node() | @*">
-                                        <xsl:copy>
-                                            <xsl:apply-templates select="node() | @*"/>
-                                        </xsl:copy>
-                                    </xsl:template>
-                                    <xsl:template match="//*[local-name()='Invoice']//*[local-name()='UBLExtensions']"></xsl:template>
-                                    <xsl:template match="//*[local-name()='AdditionalDocumentReference'][cbc:ID[normalize-space(text()) = 'QR']]"></xsl:template>
-                                        <xsl:template match="//*[local-name()='Invoice']/*[local-name()='Signature']"></xsl:template>
-                                    </xsl:stylesheet>"""
-        )
-        transform = MyTree.XSLT(xsl_file.getroottree())
-        transformed_xml = transform(xml_file.getroottree())
+        if isinstance(finalzatcaxml, etree._Element):
+            if has_skeleton(finalzatcaxml):
+                # built on the skeleton: drop it by position from a copy, no XSLT pass
+                tag_removed_xml = copy.deepcopy(finalzatcaxml)
+                drop_element(tag_removed_xml[0])
+                for element in FIND_UNHASHED_ELEMENTS(tag_removed_xml):
+                    drop_element(element)
+                return tag_removed_xml
+            # single-tree pipeline: the transform leaves the input tree untouched
+            xml_file = finalzatcaxml
+        else:
+            xml_file = MyTree.fromstring(finalzatcaxml)
+        transformed_xml = REMOVE_TAGS_TRANSFORM(xml_file.getroottree())
         return transformed_xml
     except (ValueError, KeyError, TypeError, frappe.ValidationError) as e:
         frappe.throw(_("error occurred win removing tags " + str(e)))
         return None
 
 
+@timed_stage("c14n")
 def canonicalize_xml(tag_removed_xml):
     """canonicalisation of the xml"""
     try:
@@ -541,6 +651,7 @@ def canonicalize_xml(tag_removed_xml):
         return None
 
 
+@timed_stage("c14n")
 def getinvoicehash(canonicalized_xml):
     """Getting the invoice hash of the xml"""
     try:
@@ -555,42 +666,11 @@ def getinvoicehash(canonicalized_xml):
         ) from e
 
 
+@timed_stage("ecdsa_sign")
 def digital_signature(hash1, company_abbr, source_doc):
     """find digital signature of xml"""
     try:
-        company_name = frappe.db.get_value("Company", {"abbr": company_abbr}, "name")
-        if not company_name:
-            frappe.throw(_(f"Company with abbreviation {company_abbr} not found."))
-
-        company_doc = frappe.get_doc("Company", company_name)
-        # frappe.throw(f"Source doc type: {type(source_doc)}, value: {source_doc}")
-        private_key_data_str = None
-
-        if source_doc:
-            if source_doc.doctype in SUPPORTED_INVOICES:
-                # Use certificate from the company document for Sales Invoice
-                if source_doc.custom_zatca_pos_name:
-                    zatca_settings = frappe.get_doc(
-                        "ZATCA Multiple Setting", source_doc.custom_zatca_pos_name
-                    )
-                    if zatca_settings.custom__use_company_certificate__keys != 1:
-                        private_key_data_str = zatca_settings.get("custom_private_key")
-                    else:
-                        linked_doc = frappe.get_doc("Company", zatca_settings.custom_linked_doctype)
-                        private_key_data_str = linked_doc.get("custom_private_key")
-                else:
-                    private_key_data_str = company_doc.get("custom_private_key")
-            elif source_doc.doctype == "Company":
-                private_key_data_str = company_doc.get("custom_private_key")
-            elif source_doc.doctype == "ZATCA Multiple Setting":
-                private_key_data_str = source_doc.get("custom_private_key")
-
-        if not private_key_data_str:
-            frappe.throw(_("No private key data found for the company."))
-        private_key_bytes = private_key_data_str.encode("utf-8")
-        private_key = serialization.load_pem_private_key(
-            private_key_bytes, password=None, backend=default_backend()
-        )
+        private_key = get_signing_identity(company_abbr, source_doc).private_key
         hash_bytes = bytes.fromhex(hash1)
         signature = private_key.sign(hash_bytes, ec.ECDSA(hashes.SHA256()))
         encoded_signature = base64.b64encode(signature).decode()
@@ -605,55 +685,8 @@ def digital_signature(hash1, company_abbr, source_doc):
 def extract_certificate_details(company_abbr, source_doc):
     """extracting the certificate details from the certificate data"""
     try:
-        company_name = frappe.db.get_value("Company", {"abbr": company_abbr}, "name")
-        if not company_name:
-            frappe.throw(_(f"Company with abbreviation {company_abbr} not found."))
-
-        company_doc = frappe.get_doc("Company", company_name)
-        certificate_data_str = None     
-        if source_doc:
-            if source_doc.doctype in SUPPORTED_INVOICES:
-                # Use certificate from the company document for Sales Invoice
-                if source_doc.custom_zatca_pos_name:
-                    # Fetch Zatca settings and use its certificate
-                    zatca_settings = frappe.get_doc(
-                        "ZATCA Multiple Setting", source_doc.custom_zatca_pos_name
-                    )
-                    if zatca_settings.custom__use_company_certificate__keys != 1:
-                        certificate_data_str = zatca_settings.get("custom_certficate")
-                    else:
-                        linked_doc = frappe.get_doc("Company", zatca_settings.custom_linked_doctype)
-                        certificate_data_str = linked_doc.get("custom_certificate")
-                else:
-                    certificate_data_str = company_doc.get("custom_certificate")
-            elif source_doc.doctype == "Company":
-                certificate_data_str = company_doc.get("custom_certificate")
-            elif source_doc.doctype == "ZATCA Multiple Setting":
-                certificate_data_str = source_doc.get("custom_certficate")
-
-        if not certificate_data_str:
-            frappe.throw(_(f"No certificate data found for company {source_doc}"))
-
-        certificate_content = certificate_data_str.strip()
-
-        if not certificate_content:
-            frappe.throw(
-                _(f"No valid certificate content found for company {company_name}")
-            )
-        # Format the certificate string to PEM format if not already in correct PEM format
-        formatted_certificate = "-----BEGIN CERTIFICATE-----\n"
-        formatted_certificate += "\n".join(
-            certificate_content[i : i + 64]
-            for i in range(0, len(certificate_content), 64)
-        )
-        formatted_certificate += "\n-----END CERTIFICATE-----\n"
-        # Load the certificate using cryptography
-        certificate_bytes = formatted_certificate.encode("utf-8")
-        cert = x509.load_pem_x509_certificate(certificate_bytes, default_backend())
-        formatted_issuer_name = cert.issuer.rfc4514_string()
-        issuer_name = ", ".join([x.strip() for x in formatted_issuer_name.split(",")])
-        serial_number = cert.serial_number
-        return issuer_name, serial_number
+        identity = get_signing_identity(company_abbr, source_doc)
+        return identity.issuer_name, identity.serial_number
 
     except (ValueError, KeyError, TypeError, frappe.ValidationError) as e:
         frappe.throw(_("Error inextracting certificate details" + str(e)))
@@ -663,47 +696,7 @@ def extract_certificate_details(company_abbr, source_doc):
 def certificate_hash(company_abbr, source_doc):
     """Find the certificate hash and returning the value"""
     try:
-        company_name = frappe.db.get_value("Company", {"abbr": company_abbr}, "name")
-        if not company_name:
-            frappe.throw(_(f"Company with abbreviation {company_abbr} not found."))
-
-        company_doc = frappe.get_doc("Company", company_name)
-        certificate_data_str = None
-        if source_doc:
-            if source_doc.doctype in SUPPORTED_INVOICES:
-                # Use certificate from the company document for Sales Invoice
-                if source_doc.custom_zatca_pos_name:
-                    zatca_settings = frappe.get_doc(
-                        "ZATCA Multiple Setting", source_doc.custom_zatca_pos_name
-                    )
-                    if zatca_settings.custom__use_company_certificate__keys != 1:
-                        certificate_data_str = zatca_settings.get("custom_certficate", "")
-                    else:
-                        linked_doc = frappe.get_doc("Company", zatca_settings.custom_linked_doctype)
-                        certificate_data_str = linked_doc.get("custom_certificate", "")
-                else:
-                    certificate_data_str = company_doc.get("custom_certificate", "")
-            elif source_doc.doctype == "Company":
-                certificate_data_str = company_doc.get("custom_certificate", "")
-            elif source_doc.doctype == "ZATCA Multiple Setting":
-                certificate_data_str = source_doc.get("custom_certficate")
-
-        if not certificate_data_str:
-            frappe.throw(_(f"No certificate data found for company {company_name}"))
-        certificate_data = certificate_data_str.strip()
-        if not certificate_data:
-            frappe.throw(
-                _(f"No valid certificate data found for company {company_name}")
-            )
-
-        # Calculate the SHA-256 hash of the certificate data
-        certificate_data_bytes = certificate_data.encode("utf-8")
-        sha256_hash = hashlib.sha256(certificate_data_bytes).hexdigest()
-        # Encode the hash in base64
-        base64_encoded_hash = base64.b64encode(sha256_hash.encode("utf-8")).decode(
-            "utf-8"
-        )
-        return base64_encoded_hash
+        return get_signing_identity(company_abbr, source_doc).certificate_hash
 
     except (ValueError, KeyError, TypeError, frappe.ValidationError) as e:
         frappe.throw(
@@ -712,10 +705,12 @@ def certificate_hash(company_abbr, source_doc):
         return None
 
 
-def xml_base64_decode(signed_xmlfile_name):
-    """xml base64 decode"""
+def xml_base64_decode(signed_xml):
+    """base64 of the signed xml, given as bytes from structuring_signedxml or as a file path"""
     try:
-        with open(signed_xmlfile_name, "r", encoding="utf-8") as file: # nosemgrep: frappe-semgrep-rules.rules.security.frappe-security-file-traversal
+        if isinstance(signed_xml, bytes):
+            return base64.b64encode(signed_xml).decode("utf-8")
+        with open(signed_xml, "r", encoding="utf-8") as file: # nosemgrep: frappe-semgrep-rules.rules.security.frappe-security-file-traversal
             xml = file.read().lstrip()
             base64_encoded = base64.b64encode(xml.encode("utf-8"))
             base64_decoded = base64_encoded.decode("utf-8")
@@ -725,6 +720,23 @@ def xml_base64_decode(signed_xmlfile_name):
         return None
 
 
+def set_signing_properties(
+    root, encoded_certificate_hash, issuer_name, serial_number
+):
+    """set the certificate digest, signing time, issuer and serial number
+    on the signature of the given tree in place and return the signing time"""
+    element_dv = find_signature_node(root, "cert_digest", FIND_CERT_DIGEST_VALUE)
+    element_st = find_signature_node(root, "signing_time", FIND_SIGNING_TIME)
+    element_in = find_signature_node(root, "issuer_name", FIND_ISSUER_NAME)
+    element_sn = find_signature_node(root, "serial_number", FIND_SERIAL_NUMBER)
+    element_dv.text = encoded_certificate_hash
+    element_st.text = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S")
+    signing_time = element_st.text
+    element_in.text = issuer_name
+    element_sn.text = str(serial_number)
+    return signing_time
+
+
 def signxml_modify(company_abbr,finalzatcaxml,source_doc):
     """modify the signed xml by adding the values like signing time,serial number etc"""
     try:
@@ -732,57 +744,19 @@ def signxml_modify(company_abbr,finalzatcaxml,source_doc):
         issuer_name, serial_number = extract_certificate_details(
             company_abbr, source_doc
         )
-        
-        # original_invoice_xml = etree.parse(
-        #     f"{frappe.local.site}/private/files/finalzatcaxml_{invoice_number}.xml"
-        # # )
-        # original_invoice_xml = etree.fromstring(
-        #     finalzatcaxml.encode("utf-8")
-        # )       
-        # root = original_invoice_xml.getroot()
-        root_element = etree.fromstring(finalzatcaxml.encode("utf-8"))
-        original_invoice_xml = etree.ElementTree(root_element)
-        root = original_invoice_xml.getroot()
-
-        namespaces = {
-            "ext": "urn:oasis:names:specification:ubl:schema:xsd:CommonExtensionComponents-2",
-            "sig": "urn:oasis:names:specification:ubl:schema:xsd:CommonSignatureComponents-2",
-            "sac": "urn:oasis:names:specification:ubl:schema:xsd:SignatureAggregateComponents-2",
-            "xades": "http://uri.etsi.org/01903/v1.3.2#",
-            "ds": "http://www.w3.org/2000/09/xmldsig#",
-        }
-
-        xpath_dv = "ext:UBLExtensions/ext:UBLExtension/ext:ExtensionContent/sig:UBLDocumentSignatures/sac:SignatureInformation/ds:Signature/ds:Object/xades:QualifyingProperties/xades:SignedProperties/xades:SignedSignatureProperties/xades:SigningCertificate/xades:Cert/xades:CertDigest/ds:DigestValue"
-        xpath_signtime = "ext:UBLExtensions/ext:UBLExtension/ext:ExtensionContent/sig:UBLDocumentSignatures/sac:SignatureInformation/ds:Signature/ds:Object/xades:QualifyingProperties/xades:SignedProperties/xades:SignedSignatureProperties/xades:SigningTime"
-        xpath_issuername = "ext:UBLExtensions/ext:UBLExtension/ext:ExtensionContent/sig:UBLDocumentSignatures/sac:SignatureInformation/ds:Signature/ds:Object/xades:QualifyingProperties/xades:SignedProperties/xades:SignedSignatureProperties/xades:SigningCertificate/xades:Cert/xades:IssuerSerial/ds:X509IssuerName"
-        xpath_serialnum = "ext:UBLExtensions/ext:UBLExtension/ext:ExtensionContent/sig:UBLDocumentSignatures/sac:SignatureInformation/ds:Signature/ds:Object/xades:QualifyingProperties/xades:SignedProperties//xades:SignedSignatureProperties/xades:SigningCertificate/xades:Cert/xades:IssuerSerial/ds:X509SerialNumber"
-        element_dv = root.find(xpath_dv, namespaces)
-        element_st = root.find(xpath_signtime, namespaces)
-        element_in = root.find(xpath_issuername, namespaces)
-        element_sn = root.find(xpath_serialnum, namespaces)
-        element_dv.text = encoded_certificate_hash
-        element_st.text = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S")
-        signing_time = element_st.text
-        element_in.text = issuer_name
-        element_sn.text = str(serial_number)
-        modified_xml_string = etree.tostring(
-            root,
-            encoding="utf-8",
-            xml_declaration=True,
-            pretty_print=True,
-        ).decode("utf-8")
-        # with open(f"{frappe.local.site}/private/files/after_step_4_{invoice_number}.xml", "wb") as file:
-        #     original_invoice_xml.write(
-        #         file,
-        #         encoding="utf-8",
-        #         xml_declaration=True,
-        #     )
+        root = etree.fromstring(finalzatcaxml.encode("utf-8"))
+        namespaces = dict(SIGNATURE_NAMESPACES)
+        signing_time = set_signing_properties(
+            root, encoded_certificate_hash, issuer_name, serial_number
+        )
+        modified_xml_string = serialize_xml_tree(root)
         return modified_xml_string,namespaces, signing_time
     except (ValueError, KeyError, TypeError, frappe.ValidationError) as e:
         frappe.throw(_(" error in modification of xml sign part: " + str(e)))
         return None
 
 
+@timed_stage("ecdsa_sign")
 def generate_signed_properties_hash(
     signing_time, issuer_name, serial_number, encoded_certificate_hash
 ):
@@ -824,6 +798,30 @@ def generate_signed_properties_hash(
         return None
 
 
+def get_certificate_content(company_abbr, source_doc):
+    """get the stripped certificate content used in the X509Certificate of the signature"""
+    return get_signing_identity(company_abbr, source_doc).certificate_content
+
+
+def set_signature_values(
+    root, encoded_signature, certificate_content, signed_properties_base64, encoded_hash
+):
+    """set the signature value, certificate and both digest values on the given tree in place"""
+    signvalue6 = find_signature_node(root, "signature_value", FIND_SIGNATURE_VALUE)
+    x509certificate6 = find_signature_node(
+        root, "x509_certificate", FIND_X509_CERTIFICATE
+    )
+    digestvalue6 = find_signature_node(
+        root, "signed_properties_digest", FIND_SIGNED_PROPERTIES_DIGEST
+    )
+    digestvalue6_2 = find_signature_node(root, "invoice_digest", FIND_INVOICE_DIGEST)
+
+    signvalue6.text = encoded_signature
+    x509certificate6.text = certificate_content
+    digestvalue6.text = signed_properties_base64
+    digestvalue6_2.text = encoded_hash
+
+
 def populate_the_ubl_extensions_output(
     modified_xml_string,
     encoded_signature,
@@ -835,71 +833,12 @@ def populate_the_ubl_extensions_output(
 ):
     """populate the ubl extension output by giving the signature values and digest values"""
     try:
-        # updated_invoice_xml = etree.parse(
-        #     f"{frappe.local.site}/private/files/after_step_4_{invoice_number}.xml"
-        # )
-        # root3 = updated_invoice_xml.getroot()
         root3 = etree.fromstring(modified_xml_string.encode("utf-8"))
-        updated_invoice_xml = etree.ElementTree(root3)
-        company_name = frappe.db.get_value("Company", {"abbr": company_abbr}, "name")
-        if not company_name:
-            frappe.throw(_(f"Company with abbreviation {company_abbr} not found."))
-
-        company_doc = frappe.get_doc("Company", company_name)
-        certificate_data_str = None
-        if source_doc:
-            if source_doc.doctype in SUPPORTED_INVOICES:
-                # Use certificate from the company document for Sales Invoice
-                if source_doc.custom_zatca_pos_name:
-                    # Fetch Zatca settings and use its certificate
-                    zatca_settings = frappe.get_doc(
-                        "ZATCA Multiple Setting", source_doc.custom_zatca_pos_name
-                    )
-                    if zatca_settings.custom__use_company_certificate__keys != 1:
-                        certificate_data_str = zatca_settings.get("custom_certficate")
-                    else:
-                        linked_doc = frappe.get_doc("Company", zatca_settings.custom_linked_doctype)
-                        certificate_data_str = linked_doc.get("custom_certificate")
-                else:
-                    certificate_data_str = company_doc.get("custom_certificate")
-            elif source_doc.doctype == "Company":
-                certificate_data_str = company_doc.get("custom_certificate")
-            elif source_doc.doctype == "ZATCA Multiple Setting":
-                certificate_data_str = source_doc.get("custom_certficate") 
-
-        if not certificate_data_str:
-            frappe.throw(_(f"No certificate data found for company {company_name}"))
-        content = certificate_data_str.strip()
-
-        if not content:
-            frappe.throw(
-                _(f"No valid certificate content found for company {company_name}")
-            )
-
-        xpath_signvalue = "ext:UBLExtensions/ext:UBLExtension/ext:ExtensionContent/sig:UBLDocumentSignatures/sac:SignatureInformation/ds:Signature/ds:SignatureValue"
-        xpath_x509certi = "ext:UBLExtensions/ext:UBLExtension/ext:ExtensionContent/sig:UBLDocumentSignatures/sac:SignatureInformation/ds:Signature/ds:KeyInfo/ds:X509Data/ds:X509Certificate"
-        xpath_digvalue = "ext:UBLExtensions/ext:UBLExtension/ext:ExtensionContent/sig:UBLDocumentSignatures/sac:SignatureInformation/ds:Signature/ds:SignedInfo/ds:Reference[@URI='#xadesSignedProperties']/ds:DigestValue"
-        xpath_digvalue2 = "ext:UBLExtensions/ext:UBLExtension/ext:ExtensionContent/sig:UBLDocumentSignatures/sac:SignatureInformation/ds:Signature/ds:SignedInfo/ds:Reference[@Id='invoiceSignedData']/ds:DigestValue"
-
-        signvalue6 = root3.find(xpath_signvalue, namespaces)
-        x509certificate6 = root3.find(xpath_x509certi, namespaces)
-        digestvalue6 = root3.find(xpath_digvalue, namespaces)
-        digestvalue6_2 = root3.find(xpath_digvalue2, namespaces)
-
-        signvalue6.text = encoded_signature
-        x509certificate6.text = content
-        digestvalue6.text = signed_properties_base64
-        digestvalue6_2.text = encoded_hash
-        final_xml_string = etree.tostring(
-            root3,
-            encoding="utf-8",
-            xml_declaration=True,
-            pretty_print=True,
-        ).decode("utf-8")
-        # with open(
-        #     f"{frappe.local.site}/private/files/final_xml_after_sign_{invoice_number}.xml", "wb"
-        # ) as file:
-        #     updated_invoice_xml.write(file, encoding="utf-8", xml_declaration=True)
+        content = get_certificate_content(company_abbr, source_doc)
+        set_signature_values(
+            root3, encoded_signature, content, signed_properties_base64, encoded_hash
+        )
+        final_xml_string = serialize_xml_tree(root3)
         return final_xml_string
     except (ValueError, KeyError, TypeError, frappe.ValidationError) as e:
         frappe.throw(_("Error in populating UBL extension output: " + str(e)))
@@ -909,42 +848,8 @@ def populate_the_ubl_extensions_output(
 def extract_public_key_data(company_abbr, source_doc):
     """extract public key"""
     try:
-        company_name = frappe.db.get_value("Company", {"abbr": company_abbr}, "name")
-        if not company_name:
-            frappe.throw(_(f"Company with abbreviation {company_abbr} not found."))
-
-        company_doc = frappe.get_doc("Company", company_name)
-        public_key_pem = None
-        if source_doc:
-            if source_doc.doctype in SUPPORTED_INVOICES:
-                # Use certificate from the company document for Sales Invoice
-                if source_doc.custom_zatca_pos_name:
-                    # Fetch Zatca settings and use its certificate
-                    zatca_settings = frappe.get_doc(
-                        "ZATCA Multiple Setting", source_doc.custom_zatca_pos_name
-                    )
-                    if zatca_settings.custom__use_company_certificate__keys != 1:
-                        public_key_pem = zatca_settings.get("custom_public_key", "")
-                    else:
-                        linked_doc = frappe.get_doc("Company", zatca_settings.custom_linked_doctype)
-                        public_key_pem = linked_doc.get("custom_public_key", "")
-                else:
-                    public_key_pem = company_doc.get("custom_public_key", "")
-            elif source_doc.doctype == "Company":
-                public_key_pem = company_doc.get("custom_public_key", "")
-            elif source_doc.doctype == "ZATCA Multiple Setting":
-                public_key_pem = source_doc.get("custom_public_key", "")
-        if not public_key_pem:
-            frappe.throw(_(f"No public key found for company {source_doc}"))
-
-        lines = public_key_pem.splitlines()
-        key_data = "".join(lines[1:-1])
-        key_data = key_data.replace("-----BEGIN PUBLIC KEY-----", "").replace(
-            "-----END PUBLIC KEY-----", ""
-        )
-        key_data = key_data.replace(" ", "").replace("\n", "")
-
-        return key_data
+        public_key_der = get_signing_identity(company_abbr, source_doc).public_key_der
+        return base64.b64encode(public_key_der).decode("utf-8")
 
     except (ValueError, KeyError, TypeError, frappe.ValidationError) as e:
         frappe.throw(_("Error in extracting public key data: " + str(e)))
@@ -974,16 +879,9 @@ def get_tlv_for_value(tag_num, tag_value):
 
 
 def tag8_publickey(company_abbr, source_doc):
-    """tag 8 of qr from public key"""
+    """tag 8 of qr from public key, derived from the certificate in memory"""
     try:
-        create_public_key(company_abbr, source_doc)
-        base64_encoded = extract_public_key_data(company_abbr, source_doc)
-        byte_data = base64.b64decode(base64_encoded)
-        hex_data = binascii.hexlify(byte_data).decode("utf-8")
-        chunks = [hex_data[i : i + 2] for i in range(0, len(hex_data), 2)]
-        value = "".join(chunks)
-        binary_data = bytes.fromhex(value)
-        return binary_data
+        return get_signing_identity(company_abbr, source_doc).public_key_der
     except (ValueError, KeyError, TypeError, frappe.ValidationError) as e:
         frappe.throw(_("Error in tag 8 from public key: " + str(e)))
         return None
@@ -992,162 +890,82 @@ def tag8_publickey(company_abbr, source_doc):
 def tag9_signature_ecdsa(company_abbr, source_doc):
     """tag 9 of signature"""
     try:
-        company_name = frappe.db.get_value("Company", {"abbr": company_abbr}, "name")
-        if not company_name:
-            frappe.throw(_(f"Company with abbreviation {company_abbr} not found."))
-
-        company_doc = frappe.get_doc("Company", company_name)
-        certificate_content = None
-        if source_doc:
-            if source_doc.doctype in SUPPORTED_INVOICES:
-                # Use certificate from the company document for Sales Invoice
-                if source_doc.custom_zatca_pos_name:
-                    # Fetch Zatca settings and use its certificate
-                    zatca_settings = frappe.get_doc(
-                        "ZATCA Multiple Setting", source_doc.custom_zatca_pos_name
-                    )
-                    if zatca_settings.custom__use_company_certificate__keys != 1:
-                        certificate_content = zatca_settings.custom_certficate or ""
-                    else:
-                        linked_doc = frappe.get_doc("Company", zatca_settings.custom_linked_doctype)
-                        certificate_content = linked_doc.custom_certificate or ""
-                else:
-                    certificate_content = company_doc.custom_certificate or ""
-            elif source_doc.doctype == "Company":
-                certificate_content = company_doc.custom_certificate or ""
-            elif source_doc.doctype == "ZATCA Multiple Setting":
-                certificate_content = source_doc.custom_certficate
-
-        if not certificate_content:
-            frappe.throw(_(f"No certificate found for company in tag9 {company_abbr}"))
-
-        formatted_certificate = "-----BEGIN CERTIFICATE-----\n"
-        formatted_certificate += "\n".join(
-            certificate_content[i : i + 64]
-            for i in range(0, len(certificate_content), 64)
-        )
-        formatted_certificate += "\n-----END CERTIFICATE-----\n"
-
-        certificate_bytes = formatted_certificate.encode("utf-8")
-        cert = x509.load_pem_x509_certificate(certificate_bytes, default_backend())
-        signature = cert.signature
-        signature_hex = "".join("{:02x}".format(byte) for byte in signature)
-        signature_bytes = bytes.fromhex(signature_hex)
-
-        return signature_bytes
+        return get_signing_identity(company_abbr, source_doc).certificate_signature
 
     except (ValueError, KeyError, TypeError, frappe.ValidationError) as e:
         frappe.throw(_("Error in tag 9 (signaturetag): " + str(e)))
         return None
 
 
+@timed_stage("qr_tlv")
+def extract_tlv_data(root, company_abbr, source_doc):
+    """collect the TLV tag values for the qr from the signed invoice tree"""
+    issue_date_results = FIND_ISSUE_DATE(root)
+    issue_time_results = FIND_ISSUE_TIME(root)
+    issue_date = (
+        issue_date_results[0].text.strip() if issue_date_results else "Missing Data"
+    )
+    issue_time = (
+        issue_time_results[0].text.strip() if issue_time_results else "Missing Data"
+    )
+    issue_date_time = issue_date + "T" + issue_time
+    result_dict = {}
+    for tag, finder in TLV_TAG_FINDERS:
+        if finder is not None:
+            node = (
+                get_signature_node(root, TLV_SIGNATURE_NODES[tag])
+                if tag in TLV_SIGNATURE_NODES
+                else None
+            )
+            elements = [node] if node is not None else finder(root)
+            if elements:
+                value = (
+                    elements[0].text
+                    if isinstance(elements[0], etree._Element)
+                    else elements[0]
+                )
+                result_dict[tag] = value
+            else:
+                result_dict[tag] = "Not found"
+        else:
+            result_dict[tag] = None
+    result_dict[3] = issue_date_time
+    result_dict[8] = tag8_publickey(company_abbr, source_doc)
+    result_dict[9] = tag9_signature_ecdsa(company_abbr, source_doc)
+    result_dict[1] = result_dict[1].encode(
+        "utf-8"
+    )  # Handling Arabic company name in QR Code
+    return result_dict
+
+
 def generate_tlv_xml(final_xml_string,company_abbr,source_doc):
     """generate xml by adding the tlv data"""
     try:
-
-        # with open(
-        #     f"{frappe.local.site}/private/files/final_xml_after_sign_{invoice_number}.xml", "rb"
-        # ) as file:
-        #     xml_data = file.read()
-        # root = etree.fromstring(xml_data)
         root = etree.fromstring(final_xml_string.encode("utf-8"))
-        namespaces = {
-            "ubl": "urn:oasis:names:specification:ubl:schema:xsd:Invoice-2",
-            "cac": "urn:oasis:names:specification:ubl:schema:xsd:CommonAggregateComponents-2",
-            "cbc": "urn:oasis:names:specification:ubl:schema:xsd:CommonBasicComponents-2",
-            "ext": "urn:oasis:names:specification:ubl:schema:xsd:CommonExtensionComponents-2",
-            "sig": "urn:oasis:names:specification:ubl:schema:xsd:CommonSignatureComponents-2",
-            "sac": "urn:oasis:names:specification:ubl:schema:xsd:SignatureAggregateComponents-2",
-            "ds": "http://www.w3.org/2000/09/xmldsig#",
-        }
-        issue_date_xpath = "/ubl:Invoice/cbc:IssueDate"
-        issue_time_xpath = "/ubl:Invoice/cbc:IssueTime"
-        issue_date_results = root.xpath(issue_date_xpath, namespaces=namespaces)
-        issue_time_results = root.xpath(issue_time_xpath, namespaces=namespaces)
-        issue_date = (
-            issue_date_results[0].text.strip() if issue_date_results else "Missing Data"
-        )
-        issue_time = (
-            issue_time_results[0].text.strip() if issue_time_results else "Missing Data"
-        )
-        issue_date_time = issue_date + "T" + issue_time
-        tags_xpaths = [
-            (
-                1,
-                "/ubl:Invoice/cac:AccountingSupplierParty/cac:Party/cac:PartyLegalEntity/cbc:RegistrationName",
-            ),
-            (
-                2,
-                "/ubl:Invoice/cac:AccountingSupplierParty/cac:Party/cac:PartyTaxScheme/cbc:CompanyID",
-            ),
-            (3, None),
-            (4, "/ubl:Invoice/cac:LegalMonetaryTotal/cbc:TaxInclusiveAmount"),
-            (5, "/ubl:Invoice/cac:TaxTotal/cbc:TaxAmount"),
-            (
-                6,
-                "/ubl:Invoice/ext:UBLExtensions/ext:UBLExtension/ext:ExtensionContent/sig:UBLDocumentSignatures/sac:SignatureInformation/ds:Signature/ds:SignedInfo/ds:Reference/ds:DigestValue",
-            ),
-            (
-                7,
-                "/ubl:Invoice/ext:UBLExtensions/ext:UBLExtension/ext:ExtensionContent/sig:UBLDocumentSignatures/sac:SignatureInformation/ds:Signature/ds:SignatureValue",
-            ),
-            (8, None),
-            (9, None),
-        ]
-        result_dict = {}
-        for tag, xpath in tags_xpaths:
-            if isinstance(xpath, str):
-                elements = root.xpath(xpath, namespaces=namespaces)
-                if elements:
-                    value = (
-                        elements[0].text
-                        if isinstance(elements[0], etree._Element)
-                        else elements[0]
-                    )
-                    result_dict[tag] = value
-                else:
-                    result_dict[tag] = "Not found"
-            else:
-                result_dict[tag] = xpath
-        result_dict[3] = issue_date_time
-        result_dict[8] = tag8_publickey(company_abbr, source_doc)
-        result_dict[9] = tag9_signature_ecdsa(company_abbr, source_doc)
-        result_dict[1] = result_dict[1].encode(
-            "utf-8"
-        )  # Handling Arabic company name in QR Code
-        return result_dict
+        return extract_tlv_data(root, company_abbr, source_doc)
     except (ValueError, KeyError, TypeError, frappe.ValidationError) as e:
         frappe.throw(_("Error in getting the entire TLV data: " + str(e)))
         return None
 
 
+@timed_stage("qr_tlv")
+def set_qr_value(root, qrcodeb64, company_abbr):
+    """set the qr base64 on the QR additional document reference of the tree in place"""
+    qr_code_element = find_first(FIND_QR_BINARY_OBJECT, root)
+    if qr_code_element is not None:
+        qr_code_element.text = qrcodeb64
+    else:
+        frappe.msgprint(
+            _(f"QR code element not found in the XML for company {company_abbr}")
+        )
+
+
 def update_qr_toxml(final_xml_string,qrcodeb64, company_abbr):
     """updating the  alla values of qr to xml"""
     try:
-        # xml_file_path = f"{frappe.local.site}/private/files/final_xml_after_sign_{invoice_number}.xml"
-        # xml_tree = etree.parse(xml_file_path)
         xml_tree = etree.fromstring(final_xml_string.encode("utf-8"))
-        namespaces = {
-            "cac": "urn:oasis:names:specification:ubl:schema:xsd:CommonAggregateComponents-2",
-            "cbc": "urn:oasis:names:specification:ubl:schema:xsd:CommonBasicComponents-2",
-        }
-        qr_code_element = xml_tree.find(
-            './/cac:AdditionalDocumentReference[cbc:ID="QR"]/cac:Attachment/cbc:EmbeddedDocumentBinaryObject',
-            namespaces=namespaces,
-        )
-        if qr_code_element is not None:
-            qr_code_element.text = qrcodeb64
-        else:
-            frappe.msgprint(
-                _(f"QR code element not found in the XML for company {company_abbr}")
-            )
-        # xml_tree.write(xml_file_path, encoding="UTF-8", xml_declaration=True)
-        updated_xml_string = etree.tostring(
-            xml_tree,
-            encoding="utf-8",
-            xml_declaration=True,
-            pretty_print=True,
-        ).decode("utf-8")
+        set_qr_value(xml_tree, qrcodeb64, company_abbr)
+        updated_xml_string = serialize_xml_tree(xml_tree)
         return updated_xml_string
     except (ValueError, KeyError, TypeError, frappe.ValidationError) as e:
         frappe.throw(
@@ -1155,89 +973,68 @@ def update_qr_toxml(final_xml_string,qrcodeb64, company_abbr):
         )
 
 
-def structuring_signedxml(invoice_number,updated_xml_string):
-    """structuring the signed xml"""
+def sign_xml_tree(root, company_abbr, source_doc):
+    """sign the invoice tree from xml_structuring_tree in place.
+    Hashing, XAdES population, TLV extraction and QR injection all work on the
+    same tree, which is serialized once at the end. Returns the invoice hash,
+    the qr base64 and the signed xml string"""
     try:
-        # with open(
-        #     f"{frappe.local.site}/private/files/final_xml_after_sign_{invoice_number}.xml",
-        #     "r",
-        #     encoding="utf-8",
-        # ) as file:
-        #     xml_content = file.readlines()
-
-        # update_xml_string=xml_content
-        indentations = {
-            29: [
-                '<xades:QualifyingProperties xmlns:xades="http://uri.etsi.org/01903/v1.3.2#" Target="signature">',
-                "</xades:QualifyingProperties>",
-            ],
-            33: [
-                '<xades:SignedProperties Id="xadesSignedProperties">',
-                "</xades:SignedProperties>",
-            ],
-            37: [
-                "<xades:SignedSignatureProperties>",
-                "</xades:SignedSignatureProperties>",
-            ],
-            41: [
-                "<xades:SigningTime>",
-                "<xades:SigningCertificate>",
-                "</xades:SigningCertificate>",
-            ],
-            45: ["<xades:Cert>", "</xades:Cert>"],
-            49: [
-                "<xades:CertDigest>",
-                "<xades:IssuerSerial>",
-                "</xades:CertDigest>",
-                "</xades:IssuerSerial>",
-            ],
-            53: [
-                '<ds:DigestMethod Algorithm="http://www.w3.org/2001/04/xmlenc#sha256"/>',
-                "<ds:DigestValue>",
-                "<ds:X509IssuerName>",
-                "<ds:X509SerialNumber>",
-            ],
-        }
+        identity = get_signing_identity(company_abbr, source_doc)
+        tag_removed_xml = removetags(root)
+        canonicalized_xml = canonicalize_xml(tag_removed_xml)
+        hash1, encoded_hash = getinvoicehash(canonicalized_xml)
+        encoded_signature = digital_signature(hash1, company_abbr, source_doc)
+        signing_time = set_signing_properties(
+            root,
+            identity.certificate_hash,
+            identity.issuer_name,
+            identity.serial_number,
+        )
+        signed_properties_base64 = generate_signed_properties_hash(
+            signing_time,
+            identity.issuer_name,
+            identity.serial_number,
+            identity.certificate_hash,
+        )
+        set_signature_values(
+            root,
+            encoded_signature,
+            identity.certificate_content,
+            signed_properties_base64,
+            encoded_hash,
+        )
+        tlv_data = extract_tlv_data(root, company_abbr, source_doc)
+        qrcodebuf = b"".join(
+            get_tlv_for_value(tag_num, tag_value)
+            for tag_num, tag_value in tlv_data.items()
+        )
+        qrcodeb64 = base64.b64encode(qrcodebuf).decode("utf-8")
+        set_qr_value(root, qrcodeb64, company_abbr)
+        return encoded_hash, qrcodeb64, serialize_xml_tree(root)
+    except (ValueError, KeyError, TypeError, frappe.ValidationError) as e:
+        frappe.throw(_("Error in signing the invoice xml: " + str(e)))
+        return None
 
-        def adjust_indentation(line):
-            for col, tags in indentations.items():
-                for tag in tags:
-                    if line.strip().startswith(tag):
-                        return " " * (col - 1) + line.lstrip()
-            return line
-
-        # adjusted_xml_content = [adjust_indentation(line) for line in xml_content]
-        adjusted_xml_content = [
-        adjust_indentation(line) for line in updated_xml_string.splitlines(keepends=True)
-        ]
-        safe_invoice_number = invoice_number.replace("/", "-")
-        # nosemgrep: frappe-semgrep-rules.rules.security.frappe-security-file-traversal
-        with open(
-            f"{frappe.local.site}/private/files/final_xml_after_indent_{safe_invoice_number}.xml",
-            "w",
-            encoding="utf-8",
-        ) as file: 
-            file.writelines(adjusted_xml_content)
-    
-
-        # adjusted_xml_content = [adjust_indentation(line) for line in updated_xml_string]
-        # with open(
-        #     f"{frappe.local.site}/private/files/final_xml_after_indent_{invoice_number}.xml",
-        #     "w",
-        #     encoding="utf-8",
-        # ) as file:
-        #     file.writelines(adjusted_xml_content)
-        signed_xmlfile_name = (
-            f"{frappe.local.site}/private/files/final_xml_after_indent_{safe_invoice_number}.xml"
+
+def structuring_signedxml(invoice_number,updated_xml_string):
+    """structure the signed xml in memory and return it as utf-8 bytes.
+    The XAdES lines are moved to their fixed columns in a single pass"""
+    try:
+        adjusted_xml_string = SIGNED_XML_INDENT_PATTERN.sub(
+            lambda match: " " * (SIGNED_XML_INDENT_COLUMNS[match.group(1)] - 1)
+            + match.group(1),
+            updated_xml_string,
         )
-        return signed_xmlfile_name
+        return adjusted_xml_string.lstrip().encode("utf-8")
     except (ValueError, KeyError, TypeError, frappe.ValidationError) as e:
-        frappe.throw(_(" error in structuring signed xml: " + str(e)))
+        frappe.throw(
+            _(f" error in structuring signed xml of {invoice_number}: " + str(e))
+        )
         return None
 
 
 def compliance_api_call(
-    uuid1, encoded_hash, signed_xmlfile_name, company_abbr, source_doc
+    uuid1, encoded_hash, signed_xml, company_abbr, source_doc
 ):
     """compliance api call for testing with sandbox"""
     try:
@@ -1251,7 +1048,7 @@ def compliance_api_call(
             {
                 "invoiceHash": encoded_hash,
                 "uuid": uuid1,
-                "invoice": xml_base64_decode(signed_xmlfile_name),
+                "invoice": xml_base64_decode(signed_xml),
             }
         )
 
@@ -1281,7 +1078,7 @@ def compliance_api_call(
             "Content-Type": "application/json",
         }
         # frappe.throw(get_api_url(company_abbr, base_url="compliance/invoices"))
-        response = requests.request(
+        response = zatca_request(
             "POST",
             url=get_api_url(company_abbr, base_url="compliance/invoices"),
             headers=headers,
@@ -1368,7 +1165,7 @@ def production_csid(zatca_doc: dict | str, company_abbr:str):
             user=frappe.session.user,
         )
 
-        response = requests.post(
+        response = zatca_post(
             url=get_api_url(company_abbr, base_url="production/csids"),
             headers=headers,
             json=payload,
@@ -0,0 +1,253 @@
+"""
+Signing identity of a company or ZATCA Multiple Setting.
+Resolves the document that holds the keys and certificate once per request
+and derives the private key, certificate details and CSID from it on first use.
+Parsed keys and certificates are shared across requests of the worker process,
+keyed by the fingerprint of the stored text
+"""
+
+import base64
+import hashlib
+import threading
+from collections import OrderedDict
+from functools import cached_property
+import frappe
+from frappe import _
+from cryptography import x509
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import serialization
+
+SUPPORTED_INVOICES = ["Sales Invoice", "POS Invoice"]
+MULTIPLE_SETTING = "ZATCA Multiple Setting"
+# two entries per signing unit, enough for dozens of EGS units per site
+PARSED_KEY_CACHE_SIZE = 256
+CREDENTIAL_FIELDS = {
+    "Company": ("custom_certificate", "custom_private_key"),
+    MULTIPLE_SETTING: ("custom_certficate", "custom_private_key"),
+}
+
+_parsed_keys = OrderedDict()
+_parsed_keys_lock = threading.Lock()
+
+
+def get_fingerprint(text):
+    """SHA-256 of a stored key or certificate, the parsed key cache is keyed by it"""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def get_parsed(kind, text, parse):
+    """parse a stored key or certificate once per process, least recently used go first"""
+    key = (kind, get_fingerprint(text))
+    with _parsed_keys_lock:
+        parsed = _parsed_keys.get(key)
+        if parsed is not None:
+            _parsed_keys.move_to_end(key)
+            return parsed
+    parsed = parse(text)
+    with _parsed_keys_lock:
+        _parsed_keys[key] = parsed
+        while len(_parsed_keys) > PARSED_KEY_CACHE_SIZE:
+            _parsed_keys.popitem(last=False)
+    return parsed
+
+
+def evict_parsed(kind, text):
+    """drop a replaced key or certificate from the parsed key cache"""
+    with _parsed_keys_lock:
+        _parsed_keys.pop((kind, get_fingerprint(text)), None)
+
+
+def load_certificate(certificate_content):
+    """load the base64 certificate stored on a Company or ZATCA Multiple Setting"""
+    return get_parsed("certificate", certificate_content, parse_certificate)
+
+
+def load_private_key(private_key_pem):
+    """load the PEM private key stored on a Company or ZATCA Multiple Setting"""
+    return get_parsed("private_key", private_key_pem, parse_private_key)
+
+
+def parse_certificate(certificate_content):
+    """parse a base64 certificate wrapped into PEM lines"""
+    formatted_certificate = "-----BEGIN CERTIFICATE-----\n"
+    formatted_certificate += "\n".join(
+        certificate_content[i : i + 64] for i in range(0, len(certificate_content), 64)
+    )
+    formatted_certificate += "\n-----END CERTIFICATE-----\n"
+    return x509.load_pem_x509_certificate(
+        formatted_certificate.encode("utf-8"), default_backend()
+    )
+
+
+def parse_private_key(private_key_pem):
+    """parse an unencrypted PEM private key"""
+    return serialization.load_pem_private_key(
+        private_key_pem.encode("utf-8"), password=None, backend=default_backend()
+    )
+
+
+def get_public_key_pem(certificate):
+    """PEM SubjectPublicKeyInfo of the certificate public key"""
+    return (
+        certificate.public_key()
+        .public_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PublicFormat.SubjectPublicKeyInfo,
+        )
+        .decode()
+    )
+
+
+class SigningIdentity:
+    """keys, certificate and CSID of the Company or ZATCA Multiple Setting signing an invoice"""
+
+    def __init__(self, company_name, credential_doc):
+        self.company_name = company_name
+        self.credential_doc = credential_doc
+
+    def _get_field(self, company_field, setting_field):
+        if self.credential_doc.doctype == "Company":
+            return self.credential_doc.get(company_field)
+        return self.credential_doc.get(setting_field)
+
+    @cached_property
+    def certificate_content(self):
+        """stripped base64 certificate as stored on the document"""
+        certificate_data_str = self._get_field("custom_certificate", "custom_certficate")
+        if not certificate_data_str:
+            frappe.throw(_(f"No certificate data found for company {self.company_name}"))
+        content = certificate_data_str.strip()
+        if not content:
+            frappe.throw(
+                _(f"No valid certificate content found for company {self.company_name}")
+            )
+        return content
+
+    @cached_property
+    def certificate(self):
+        """parsed x509 certificate"""
+        return load_certificate(self.certificate_content)
+
+    @cached_property
+    def private_key(self):
+        """loaded EC private key"""
+        private_key_data_str = self._get_field("custom_private_key", "custom_private_key")
+        if not private_key_data_str:
+            frappe.throw(_("No private key data found for the company."))
+        return load_private_key(private_key_data_str)
+
+    @cached_property
+    def issuer_name(self):
+        """issuer of the certificate as written in the XAdES properties"""
+        formatted_issuer_name = self.certificate.issuer.rfc4514_string()
+        return ", ".join([x.strip() for x in formatted_issuer_name.split(",")])
+
+    @property
+    def serial_number(self):
+        """serial number of the certificate"""
+        return self.certificate.serial_number
+
+    @cached_property
+    def certificate_hash(self):
+        """base64 of the hex SHA-256 of the certificate content"""
+        sha256_hash = hashlib.sha256(self.certificate_content.encode("utf-8")).hexdigest()
+        return base64.b64encode(sha256_hash.encode("utf-8")).decode("utf-8")
+
+    @cached_property
+    def public_key_der(self):
+        """DER SubjectPublicKeyInfo of the certificate public key, tag 8 of the qr"""
+        return self.certificate.public_key().public_bytes(
+            encoding=serialization.Encoding.DER,
+            format=serialization.PublicFormat.SubjectPublicKeyInfo,
+        )
+
+    @property
+    def certificate_signature(self):
+        """signature of the certificate, tag 9 of the qr"""
+        return self.certificate.signature
+
+    @property
+    def csid(self):
+        """production CSID used for the Authorization header"""
+        return self._get_field(
+            "custom_basic_auth_from_production", "custom_final_auth_csid"
+        )
+
+
+def get_credential_doc(company_name, source_doc):
+    """get the Company or ZATCA Multiple Setting holding the keys for the source document"""
+    if source_doc.doctype in SUPPORTED_INVOICES:
+        if source_doc.custom_zatca_pos_name:
+            zatca_settings = frappe.get_doc(
+                MULTIPLE_SETTING, source_doc.custom_zatca_pos_name
+            )
+            if zatca_settings.custom__use_company_certificate__keys != 1:
+                return zatca_settings
+            return frappe.get_doc("Company", zatca_settings.custom_linked_doctype)
+        return frappe.get_doc("Company", company_name)
+    if source_doc.doctype == "Company":
+        return frappe.get_doc("Company", company_name)
+    if source_doc.doctype == MULTIPLE_SETTING:
+        return source_doc
+    frappe.throw(_(f"Unsupported document type: {source_doc.doctype}"))
+    return None
+
+
+def get_signing_identity(company_abbr, source_doc):
+    """get the signing identity for the source document, cached for the current request.
+    A ZATCA Multiple Setting passed in directly may carry unsaved values and is never cached"""
+    if not source_doc:
+        frappe.throw(_(f"No certificate data found for company {company_abbr}"))
+
+    if source_doc.doctype == MULTIPLE_SETTING:
+        cache_key = None
+    elif source_doc.doctype in SUPPORTED_INVOICES and source_doc.custom_zatca_pos_name:
+        cache_key = (company_abbr, source_doc.custom_zatca_pos_name)
+    else:
+        cache_key = (company_abbr, None)
+
+    identities = getattr(frappe.local, "zatca_signing_identities", None)
+    if identities is None:
+        identities = frappe.local.zatca_signing_identities = {}
+    if cache_key and cache_key in identities:
+        return identities[cache_key]
+
+    company_name = frappe.db.get_value("Company", {"abbr": company_abbr}, "name")
+    if not company_name:
+        frappe.throw(_(f"Company with abbreviation {company_abbr} not found."))
+
+    identity = SigningIdentity(company_name, get_credential_doc(company_name, source_doc))
+    if cache_key:
+        identities[cache_key] = identity
+    return identity
+
+
+def clear_signing_identity_cache(doc=None, method=None):
+    """drop the cached signing identities once a Company or ZATCA Multiple Setting changes,
+    and the parsed keys it replaced"""
+    frappe.local.zatca_signing_identities = {}
+    previous_doc = doc.get_doc_before_save() if doc else None
+    if not previous_doc:
+        return
+    certificate_field, private_key_field = CREDENTIAL_FIELDS[doc.doctype]
+    for kind, field in (("certificate", certificate_field), ("private_key", private_key_field)):
+        previous_value = (previous_doc.get(field) or "").strip()
+        if previous_value and previous_value != (doc.get(field) or "").strip():
+            evict_parsed(kind, previous_value)
+
+
+def refresh_public_key(doc, method=None):
+    """keep custom_public_key in step with the certificate, written only when the certificate changes"""
+    certificate_field = (
+        "custom_certificate" if doc.doctype == "Company" else "custom_certficate"
+    )
+    if not doc.has_value_changed(certificate_field):
+        return
+    certificate_content = (doc.get(certificate_field) or "").strip()
+    if not certificate_content:
+        return
+    try:
+        doc.custom_public_key = get_public_key_pem(load_certificate(certificate_content))
+    except ValueError:
+        # not a valid certificate yet, signing will report it
+        pass
@@ -0,0 +1,202 @@
+"""
+Opt-in timing of the stages of an invoice submission.
+A sample of the zatca_call runs, zatca_stage_timing_sample_rate (0 to 1) in the site
+config and off by default, records for its invoice the wall time and database queries
+of every stage: the wait for the signing unit, removetags, C14N and hashing, the ECDSA
+and XAdES signature, the QR TLV, file writes, the ZATCA HTTP round trip and the rest
+of reporting_api / clearance_api, mostly its database writes. A stage only counts the
+time not spent in the stages nested in it, what is left of the call is xml_build.
+The last samples of each company and signing unit are kept in redis and summarised
+as percentiles by get_stage_timings and the ZATCA Submission Timing report. Outside
+a sample a stage costs a single attribute lookup
+"""
+
+import json
+import math
+import random
+import time
+from contextlib import contextmanager
+import frappe
+from frappe.utils import flt, now_datetime
+
+TIMING_KEY = "zatca_stage_timing"
+TIMING_UNITS_KEY = "zatca_stage_timing_units"
+MAX_SAMPLES = 1000
+PERCENTILES = (50, 90, 99)
+# the zatca_call time outside the other stages
+ROOT_STAGE = "xml_build"
+STAGES = [
+    "unit_wait",
+    ROOT_STAGE,
+    "removetags",
+    "c14n",
+    "ecdsa_sign",
+    "qr_tlv",
+    "file_write",
+    "http",
+    "db_writes",
+]
+
+
+def get_active_timing():
+    """timing of the invoice sampled in the current request or job, None outside a sample"""
+    return getattr(frappe.local, "zatca_stage_timing", None)
+
+
+def start_invoice_timing(doctype, invoice_number, company, unit):
+    """start timing the submission of an invoice when it is sampled. False when it is
+    not, or when the invoice of an outer call is already being timed"""
+    if get_active_timing() is not None:
+        return False
+    sample_rate = flt(frappe.conf.get("zatca_stage_timing_sample_rate"))
+    if sample_rate <= 0 or random.random() >= sample_rate:
+        return False
+    timing = frappe._dict(
+        doctype=doctype,
+        invoice=invoice_number,
+        company=company,
+        unit=unit,
+        started=time.perf_counter(),
+        stack=[[ROOT_STAGE, time.perf_counter()]],
+        seconds={},
+        queries={},
+        # restored as it was, frappe.recorder may have wrapped it as well
+        own_sql="sql" in vars(frappe.local.db),
+        sql=frappe.local.db.sql,
+    )
+
+    def count_query(*args, **kwargs):
+        stage = timing.stack[-1][0]
+        timing.queries[stage] = timing.queries.get(stage, 0) + 1
+        return timing.sql(*args, **kwargs)
+
+    frappe.local.db.sql = count_query
+    frappe.local.zatca_stage_timing = timing
+    return True
+
+
+def charge_stage(timing, now):
+    """add the time since it last ran to the stage on top of the stack"""
+    stage = timing.stack[-1]
+    timing.seconds[stage[0]] = timing.seconds.get(stage[0], 0) + now - stage[1]
+    stage[1] = now
+
+
+def start_stage(name):
+    """enter a stage, the stage it is nested in stops counting until it ends"""
+    timing = get_active_timing()
+    if timing is None:
+        return
+    now = time.perf_counter()
+    charge_stage(timing, now)
+    timing.stack.append([name, now])
+
+
+def end_stage(name):
+    """leave a stage, and the stages an exception left open inside it"""
+    timing = get_active_timing()
+    if timing is None:
+        return
+    now = time.perf_counter()
+    while len(timing.stack) > 1:
+        charge_stage(timing, now)
+        if timing.stack.pop()[0] == name:
+            break
+    timing.stack[-1][1] = now
+
+
+@contextmanager
+def timed_stage(name):
+    """time the block or, as a decorator, the function as the given stage"""
+    start_stage(name)
+    try:
+        yield
+    finally:
+        end_stage(name)
+
+
+def finish_invoice_timing():
+    """stop timing the sampled invoice and keep its sample"""
+    timing = get_active_timing()
+    if timing is None:
+        return
+    now = time.perf_counter()
+    while timing.stack:
+        charge_stage(timing, now)
+        timing.stack.pop()
+    frappe.local.zatca_stage_timing = None
+    if timing.own_sql:
+        frappe.local.db.sql = timing.sql
+    else:
+        del frappe.local.db.sql
+    try:
+        sample = {
+            "doctype": timing.doctype,
+            "invoice": timing.invoice,
+            "time": str(now_datetime()),
+            "total_ms": round((now - timing.started) * 1000, 3),
+            "stages_ms": {
+                stage: round(seconds * 1000, 3)
+                for stage, seconds in timing.seconds.items()
+            },
+            "queries": timing.queries,
+        }
+        unit_key = f"{timing.company}::{timing.unit}"
+        cache = frappe.cache()
+        cache.lpush(f"{TIMING_KEY}::{unit_key}", json.dumps(sample))
+        cache.ltrim(f"{TIMING_KEY}::{unit_key}", 0, MAX_SAMPLES - 1)
+        cache.sadd(TIMING_UNITS_KEY, unit_key)
+    except Exception as e:
+        frappe.log_error(f"Failed to keep ZATCA stage timing: {str(e)}", "ZATCA Stage Timing")
+
+
+def get_percentile(sorted_values, percentile):
+    """nearest rank percentile of sorted values"""
+    return sorted_values[max(math.ceil(percentile / 100 * len(sorted_values)) - 1, 0)]
+
+
+def summarize_stage_timings(company=None):
+    """percentiles of the kept samples, one row per company, signing unit and stage"""
+    cache = frappe.cache()
+    rows = []
+    for unit_key in sorted(frappe.safe_decode(key) for key in cache.smembers(TIMING_UNITS_KEY)):
+        sample_company, unit = unit_key.split("::", 1)
+        if company and sample_company != company:
+            continue
+        samples = [
+            json.loads(sample)
+            for sample in cache.lrange(f"{TIMING_KEY}::{unit_key}", 0, -1)
+        ]
+        if not samples:
+            continue
+        for stage in STAGES + ["total"]:
+            if stage == "total":
+                values = sorted(sample["total_ms"] for sample in samples)
+                queries = sum(sum(sample["queries"].values()) for sample in samples)
+            else:
+                values = sorted(sample["stages_ms"].get(stage, 0) for sample in samples)
+                queries = sum(sample["queries"].get(stage, 0) for sample in samples)
+            row = {"company": sample_company, "unit": unit, "stage": stage, "samples": len(values)}
+            for percentile in PERCENTILES:
+                row[f"p{percentile}_ms"] = get_percentile(values, percentile)
+            row["max_ms"] = values[-1]
+            row["avg_queries"] = round(queries / len(samples), 2)
+            rows.append(row)
+    return rows
+
+
+@frappe.whitelist()
+def get_stage_timings(company: str = None):
+    """per stage percentiles of the sampled submissions of every company and signing unit"""
+    frappe.only_for("System Manager")
+    return summarize_stage_timings(company)
+
+
+@frappe.whitelist()
+def clear_stage_timings():
+    """drop the kept samples"""
+    frappe.only_for("System Manager")
+    cache = frappe.cache()
+    for unit_key in cache.smembers(TIMING_UNITS_KEY):
+        cache.delete_value(f"{TIMING_KEY}::{frappe.safe_decode(unit_key)}")
+    cache.delete_value(TIMING_UNITS_KEY)
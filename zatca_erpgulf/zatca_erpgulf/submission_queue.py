@@ -0,0 +1,209 @@
+"""
+Parallel background submission of pending invoices to ZATCA.
+Pending invoices are grouped into signing units, a Company or a ZATCA Multiple Setting
+with its own keys. Each unit is drained in order by a single job so its ICV/PIH chain
+stays ordered, while the units of a company are spread over its configured number of jobs.
+A draining job holds the signing unit itself one invoice at a time, so a submission from
+a request only waits for the invoice in flight
+"""
+
+import math
+import time
+import frappe
+from frappe.utils import add_to_date, cint, now_datetime
+from zatca_erpgulf.zatca_erpgulf.event_log import flush_zatca_events
+
+SUBMISSION_QUEUE = "long"
+SUBMISSION_JOB_TIMEOUT = 25 * 60
+# a signing and a clearance or reporting call, with the 300 s timeout of the call
+UNIT_HOLD_TIMEOUT = 10 * 60
+# long enough for the invoice in flight in the unit
+UNIT_WAIT = 60
+# pause of a draining job between two invoices while a submission waits for the unit,
+# longer than the 0.1 s a waiting lock sleeps between attempts
+UNIT_HANDOVER = 0.25
+PENDING_STATUSES = ["Not Submitted", "503 Service Unavailable"]
+PENDING_WINDOW_HOURS = 24
+PENDING_INDEX = "zatca_status_creation"
+
+
+def add_pending_invoice_indexes():
+    """index the pending invoice scan on (custom_zatca_status, creation), the leading
+    status column keeps the scan to the pending rows however large the table grows"""
+    for doctype in ("Sales Invoice", "POS Invoice"):
+        if frappe.db.has_column(doctype, "custom_zatca_status"):
+            frappe.db.add_index(doctype, ["custom_zatca_status", "creation"], PENDING_INDEX)
+
+
+def get_pending_invoices(doctype):
+    """draft and submitted invoices of the last 24 hours still waiting for ZATCA, oldest first"""
+    return frappe.get_all(
+        doctype,
+        filters=[
+            ["custom_zatca_status", "in", PENDING_STATUSES],
+            ["creation", ">=", add_to_date(now_datetime(), hours=-PENDING_WINDOW_HOURS)],
+            ["docstatus", "in", [0, 1]],
+        ],
+        fields=["name", "docstatus", "company", "customer", "custom_zatca_pos_name"],
+        order_by="creation asc",
+    )
+
+
+def get_signing_units(invoices):
+    """group pending invoices by the company and signing unit whose PIH chain they extend"""
+    pos_names = list(
+        {invoice.custom_zatca_pos_name for invoice in invoices if invoice.custom_zatca_pos_name}
+    )
+    setting_units = {}
+    if pos_names:
+        for setting in frappe.get_all(
+            "ZATCA Multiple Setting",
+            filters={"name": ["in", pos_names]},
+            fields=[
+                "name",
+                "custom__use_company_certificate__keys",
+                "custom_linked_doctype",
+            ],
+        ):
+            if setting.custom__use_company_certificate__keys == 1:
+                setting_units[setting.name] = setting.custom_linked_doctype
+            else:
+                setting_units[setting.name] = setting.name
+
+    units = {}
+    for invoice in invoices:
+        if invoice.custom_zatca_pos_name:
+            unit = setting_units.get(
+                invoice.custom_zatca_pos_name, invoice.custom_zatca_pos_name
+            )
+        else:
+            unit = invoice.company
+        units.setdefault((invoice.company, unit), []).append(invoice.name)
+    return units
+
+
+def enqueue_signing_units(
+    method, units, workers_by_company, timeout=SUBMISSION_JOB_TIMEOUT, **kwargs
+):
+    """spread the signing units of every company round robin over its number of jobs.
+    Extra keyword arguments are passed on to every job"""
+    shards = {}
+    slots = {}
+    for (company, unit), invoice_names in sorted(units.items()):
+        workers = max(cint(workers_by_company.get(company)), 1)
+        slot = slots.get(company, 0)
+        slots[company] = (slot + 1) % workers
+        shards.setdefault((company, slot), {})[unit] = invoice_names
+
+    for (company, slot), shard in shards.items():
+        frappe.enqueue(
+            method,
+            queue=SUBMISSION_QUEUE,
+            timeout=timeout,
+            job_name=f"{method.rsplit('.', 1)[-1]}_{company}_{slot}",
+            units=shard,
+            **kwargs,
+        )
+
+
+def get_unit_lock_key(unit):
+    """redis key of a signing unit, held from reading its PIH to storing the next one"""
+    return f"{frappe.local.site}|zatca_signing_unit|{unit}"
+
+
+def get_unit_waiting_key(unit):
+    """redis key telling a draining job that a submission waits for the signing unit"""
+    return f"{frappe.local.site}|zatca_signing_unit_waiting|{unit}"
+
+
+def get_unit_drain_key(unit):
+    """redis key guarding a signing unit against two jobs draining it at once"""
+    return f"{frappe.local.site}|zatca_signing_unit_drain|{unit}"
+
+
+def get_held_units():
+    """signing units the current request or job holds, with their lock and hold count"""
+    if getattr(frappe.local, "zatca_held_units", None) is None:
+        frappe.local.zatca_held_units = {}
+    return frappe.local.zatca_held_units
+
+
+def acquire_signing_unit(
+    unit, timeout=UNIT_HOLD_TIMEOUT, blocking=True, blocking_timeout=None
+):
+    """take the lock of a signing unit for the current request or job, False when
+    another one holds it. A unit already held here is only counted once more, so a
+    job draining a unit can run the submission that takes it again"""
+    held = get_held_units()
+    if unit in held:
+        held[unit][1] += 1
+        return True
+    cache = frappe.cache()
+    lock = cache.lock(get_unit_lock_key(unit), timeout=timeout)
+    if not lock.acquire(blocking=False):
+        if not blocking:
+            return False
+        cache.set(
+            get_unit_waiting_key(unit), 1, ex=math.ceil(blocking_timeout or timeout)
+        )
+        if not lock.acquire(blocking=True, blocking_timeout=blocking_timeout):
+            return False
+    held[unit] = [lock, 1]
+    return True
+
+
+def release_signing_unit(unit):
+    """release a signing unit, its lock goes once every hold of it is released"""
+    held = get_held_units()
+    held[unit][1] -= 1
+    if not held[unit][1]:
+        held.pop(unit)[0].release()
+
+
+def hand_over_signing_unit(unit):
+    """let a submission waiting for the unit take it before the next invoice of a drain"""
+    if frappe.cache().get(get_unit_waiting_key(unit)):
+        time.sleep(UNIT_HANDOVER)
+
+
+def acquire_unit_drain(unit, timeout=SUBMISSION_JOB_TIMEOUT, blocking_timeout=None):
+    """take a signing unit for a job draining it, None when another job drains it.
+    The lock is returned to be released once the drain is done"""
+    lock = frappe.cache().lock(get_unit_drain_key(unit), timeout=timeout)
+    if not lock.acquire(
+        blocking=blocking_timeout is not None, blocking_timeout=blocking_timeout
+    ):
+        return None
+    return lock
+
+
+def drain_signing_units(units, submit_invoice):
+    """submit the invoices of every unit in order. A unit still being drained by
+    the job of an earlier run is skipped and picked up by the next run"""
+    try:
+        for unit, invoice_names in units.items():
+            drain = acquire_unit_drain(unit)
+            if not drain:
+                continue
+            try:
+                for invoice_name in invoice_names:
+                    if not acquire_signing_unit(unit, blocking_timeout=UNIT_WAIT):
+                        # the rest of the unit is left in order for the next run
+                        break
+                    try:
+                        submit_invoice(invoice_name)
+                        frappe.db.commit()
+                    except Exception:
+                        frappe.db.rollback()
+                        frappe.log_error(
+                            frappe.get_traceback(),
+                            f"Error processing invoice {invoice_name}",
+                        )
+                    finally:
+                        release_signing_unit(unit)
+                    hand_over_signing_unit(unit)
+            finally:
+                drain.release()
+    finally:
+        # after_job is not there on Frappe v14
+        flush_zatca_events()
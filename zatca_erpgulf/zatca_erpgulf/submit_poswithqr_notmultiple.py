@@ -4,9 +4,11 @@ import base64
 import os
 from frappe import _
 import frappe
-import requests
+from zatca_erpgulf.zatca_erpgulf.zatca_session import zatca_post
 from lxml import etree
 from zatca_erpgulf.zatca_erpgulf.event_log import log_zatca_event
+from zatca_erpgulf.zatca_erpgulf.async_submission import show_gif, hide_gif
+from zatca_erpgulf.zatca_erpgulf.pih_chain import set_unit_pih
 CONTENT_TYPE_JSON = "application/json"
 NOT_SUBMITTED = "Not Submitted"
 SALES_INVOICE = "POS Invoice"
@@ -152,18 +154,14 @@ def reporting_api_xml_sales_invoice_simplified(
             "invoice": xml_base64_decode(signed_xmlfile_name),
         }
         try:
-            frappe.publish_realtime(
-                "show_gif",
-                {"gif_url": "/assets/zatca_erpgulf/js/loading.gif"},
-                user=frappe.session.user,
-            )
-            response = requests.post(
+            show_gif()
+            response = zatca_post(
                 url=get_api_url(company_abbr, base_url="invoices/reporting/single"),
                 headers=headers,
                 json=payload,
                 timeout=300,
             )
-            frappe.publish_realtime("hide_gif", user=frappe.session.user)
+            hide_gif()
             if response.status_code in (200, 202, 409):
                 if response.status_code == 200:
                         status_label = "Success"
@@ -279,21 +277,18 @@ def reporting_api_xml_sales_invoice_simplified(
                     if zatca_settings.custom__use_company_certificate__keys != 1:
                         if zatca_settings.custom_send_pos_invoices_to_zatca_on_background:
                             frappe.msgprint(msg)
-                        zatca_settings.custom_pih = encoded_hash
-                        zatca_settings.save(ignore_permissions=True)
+                        set_unit_pih(pos_invoice_doc, encoded_hash)
                     else:
                         linked_doc = frappe.get_doc("Company", zatca_settings.custom_linked_doctype)
                         if linked_doc.custom_send_einvoice_background:
                             frappe.msgprint(msg)
-                        linked_doc.custom_pih = encoded_hash
-                        linked_doc.save(ignore_permissions=True)
+                        set_unit_pih(pos_invoice_doc, encoded_hash)
 
                 else:
                     company_doc = frappe.get_doc("Company", pos_invoice_doc.company)
                     if company_doc.custom_send_einvoice_background:
                         frappe.msgprint(msg)
-                    company_doc.custom_pih = encoded_hash
-                    company_doc.save(ignore_permissions=True)
+                    set_unit_pih(pos_invoice_doc, encoded_hash)
 
                 invoice_doc = frappe.get_doc(SALES_INVOICE, invoice_number)
                 invoice_doc.custom_zatca_full_response = msg
@@ -350,20 +345,17 @@ def reporting_api_xml_sales_invoice_simplified(
                     if zatca_settings.custom__use_company_certificate__keys != 1:
                         if zatca_settings.custom_send_pos_invoices_to_zatca_on_background:
                             frappe.msgprint(msg)
-                        zatca_settings.custom_pih = encoded_hash
-                        zatca_settings.save(ignore_permissions=True)
+                        set_unit_pih(pos_invoice_doc, encoded_hash)
                     else:
                         linked_doc = frappe.get_doc("Company", zatca_settings.custom_linked_doctype)
                         if linked_doc.custom_send_einvoice_background:
                             frappe.msgprint(msg)
-                        linked_doc.custom_pih = encoded_hash
-                        linked_doc.save(ignore_permissions=True)
+                        set_unit_pih(pos_invoice_doc, encoded_hash)
                 else:
                     company_doc = frappe.get_doc("Company", pos_invoice_doc.company)
                     if company_doc.custom_send_einvoice_background:
                         frappe.msgprint(msg)
-                    company_doc.custom_pih = encoded_hash
-                    company_doc.save(ignore_permissions=True)
+                    set_unit_pih(pos_invoice_doc, encoded_hash)
 
                 invoice_doc = frappe.get_doc(SALES_INVOICE, invoice_number)
                 invoice_doc.custom_zatca_full_response = msg
@@ -3,9 +3,11 @@
 import base64
 from frappe import _
 import frappe
-import requests
+from zatca_erpgulf.zatca_erpgulf.zatca_session import zatca_post
 from lxml import etree
 from zatca_erpgulf.zatca_erpgulf.event_log import log_zatca_event
+from zatca_erpgulf.zatca_erpgulf.async_submission import show_gif, hide_gif
+from zatca_erpgulf.zatca_erpgulf.pih_chain import set_unit_pih
 CONTENT_TYPE_JSON = "application/json"
 NOT_SUBMITTED = "Not Submitted"
 SALES_INVOICE = "Sales Invoice"
@@ -155,11 +157,7 @@ def reporting_api_xml_sales_invoice_simplified(
 
         
         try:
-            frappe.publish_realtime(
-                "show_gif",
-                {"gif_url": "/assets/zatca_erpgulf/js/loading.gif"},
-                user=frappe.session.user,
-            )
+            show_gif()
             # frappe.log_error(
             #         f"Submitting to ZATCA with xml and qr...\n"
             #         f"Time: {frappe.utils.now()}\n"+
@@ -168,13 +166,13 @@ def reporting_api_xml_sales_invoice_simplified(
             #         f"Status: {sales_invoice_doc.custom_zatca_status or 'Not Set'}",
             #         "ZATCA API Submission with xml and QR"
             #     )
-            response = requests.post(
+            response = zatca_post(
                 url=get_api_url(company_abbr, base_url="invoices/reporting/single"),
                 headers=headers,
                 json=payload,
                 timeout=480,
             )
-            frappe.publish_realtime("hide_gif", user=frappe.session.user)
+            hide_gif()
             if response.status_code in (200, 202, 409):
                 if response.status_code == 200:
                         status_label = "Success"
@@ -291,20 +289,17 @@ def reporting_api_xml_sales_invoice_simplified(
                     if zatca_settings.custom__use_company_certificate__keys != 1:
                         if zatca_settings.custom_send_pos_invoices_to_zatca_on_background:
                             frappe.msgprint(msg)
-                        zatca_settings.custom_pih = encoded_hash
-                        zatca_settings.save(ignore_permissions=True)
+                        set_unit_pih(sales_invoice_doc, encoded_hash)
                     else:
                         linked_doc = frappe.get_doc("Company", zatca_settings.custom_linked_doctype)
                         if linked_doc.custom_send_einvoice_background:
                             frappe.msgprint(msg)
-                        linked_doc.custom_pih = encoded_hash
-                        linked_doc.save(ignore_permissions=True)
+                        set_unit_pih(sales_invoice_doc, encoded_hash)
                 else:
                     company_doc = frappe.get_doc("Company", sales_invoice_doc.company)
                     if company_doc.custom_send_einvoice_background:
                         frappe.msgprint(msg)
-                    company_doc.custom_pih = encoded_hash
-                    company_doc.save(ignore_permissions=True)
+                    set_unit_pih(sales_invoice_doc, encoded_hash)
 
                 invoice_doc = frappe.get_doc("Sales Invoice", invoice_number)
                 invoice_doc.custom_zatca_full_response = msg
@@ -362,20 +357,17 @@ def reporting_api_xml_sales_invoice_simplified(
                     if zatca_settings.custom__use_company_certificate__keys != 1:
                         if zatca_settings.custom_send_pos_invoices_to_zatca_on_background:
                             frappe.msgprint(msg)
-                        zatca_settings.custom_pih = encoded_hash
-                        zatca_settings.save(ignore_permissions=True)
+                        set_unit_pih(sales_invoice_doc, encoded_hash)
                     else:
                         linked_doc = frappe.get_doc("Company", zatca_settings.custom_linked_doctype)
                         if linked_doc.custom_send_einvoice_background:
                             frappe.msgprint(msg)
-                        linked_doc.custom_pih = encoded_hash
-                        linked_doc.save(ignore_permissions=True)
+                        set_unit_pih(sales_invoice_doc, encoded_hash)
                 else:
                     company_doc = frappe.get_doc("Company", sales_invoice_doc.company)
                     if company_doc.custom_send_einvoice_background:
                         frappe.msgprint(msg)
-                    company_doc.custom_pih = encoded_hash
-                    company_doc.save(ignore_permissions=True)
+                    set_unit_pih(sales_invoice_doc, encoded_hash)
 
                 invoice_doc = frappe.get_doc("Sales Invoice", invoice_number)
                 invoice_doc.custom_zatca_full_response = msg
@@ -0,0 +1,101 @@
+# Copyright (c) 2026, ERPGulf and Contributors
+# See license.txt
+
+from unittest.mock import patch
+
+import frappe
+import requests
+from frappe.tests.utils import FrappeTestCase
+
+from zatca_erpgulf.zatca_erpgulf import batch_dispatcher
+from zatca_erpgulf.zatca_erpgulf.batch_dispatcher import (
+    BATCH_FAILED,
+    BATCH_REJECTED,
+    hold_back_invoice,
+    submit_batch,
+)
+
+INVOICES = ["INV-1", "INV-2", "INV-3", "INV-4"]
+
+
+class TestSubmitBatch(FrappeTestCase):
+    def setUp(self):
+        self.sent = []
+        self.events = []
+        self.held_back = []
+        for target, replacement in (
+            ("log_zatca_event", lambda **kwargs: self.events.append(kwargs)),
+            ("hold_back_invoice", lambda *args: self.held_back.append(args)),
+        ):
+            patcher = patch.object(batch_dispatcher, target, replacement)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        for method in ("commit", "rollback"):
+            patcher = patch.object(frappe.db, method)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def submit(self, *outcomes):
+        """run a batch of INVOICES whose reports return or raise the given outcomes"""
+        outcomes = list(outcomes)
+
+        def report(doctype, invoice_name):
+            self.sent.append(invoice_name)
+            outcome = outcomes.pop(0)
+            if isinstance(outcome, Exception):
+                raise outcome
+            return outcome
+
+        with patch.object(batch_dispatcher, "report_batched_invoice", report):
+            submit_batch("Sales Invoice", "Unit", INVOICES)
+        return self.events[-1]
+
+    def test_all_reported(self):
+        summary = self.submit(200, 202, 409, 200)
+        self.assertEqual(self.sent, INVOICES)
+        self.assertEqual(summary["status"], "Batch Success")
+        self.assertIn("Reported: 4", summary["response_text"])
+
+    def test_rejection_does_not_stop_the_batch(self):
+        summary = self.submit(200, 400, 200, 200)
+        self.assertEqual(self.sent, INVOICES)
+        self.assertEqual(summary["status"], "Batch Failed")
+        self.assertIn("Rejected: 1", summary["response_text"])
+        self.assertIn("Deferred to next run: 0", summary["response_text"])
+
+    def test_server_error_defers_the_rest(self):
+        summary = self.submit(200, 503)
+        self.assertEqual(self.sent, INVOICES[:2])
+        self.assertEqual(summary["status"], "Batch Failed")
+        self.assertIn("Deferred to next run: 3", summary["response_text"])
+        self.assertFalse(self.held_back)
+
+    def test_transport_error_defers_the_rest(self):
+        summary = self.submit(200, requests.exceptions.ConnectionError())
+        self.assertEqual(self.sent, INVOICES[:2])
+        self.assertIn("Deferred to next run: 3", summary["response_text"])
+        self.assertFalse(self.held_back)
+
+    def test_permanent_error_fails_only_its_invoice(self):
+        summary = self.submit(200, frappe.ValidationError("no signed xml"), 200, 200)
+        self.assertEqual(self.sent, INVOICES)
+        self.assertEqual(len(self.held_back), 1)
+        self.assertEqual(self.held_back[0][1], "INV-2")
+        self.assertEqual(self.held_back[0][3], BATCH_FAILED)
+        self.assertIn("Failed: 1", summary["response_text"])
+        self.assertIn("Deferred to next run: 0", summary["response_text"])
+
+
+class TestHoldBackInvoice(FrappeTestCase):
+    def test_keeps_the_signed_invoice(self):
+        with patch.object(frappe.db, "set_value") as set_value, patch.object(
+            frappe.db, "get_value", return_value="uuid-1"
+        ), patch.object(batch_dispatcher, "log_zatca_event") as log_event:
+            hold_back_invoice(
+                "Sales Invoice", "INV-1", "Status Code: 400", BATCH_REJECTED, "Failed (HTTP 400)"
+            )
+        values = set_value.call_args[0][2]
+        self.assertEqual(values["custom_zatca_status"], BATCH_REJECTED)
+        # the invoices signed after it are chained to its hash, it is never signed again
+        self.assertNotIn("custom_uuid", values)
+        self.assertEqual(log_event.call_args[1]["uuid"], "uuid-1")
@@ -0,0 +1,177 @@
+# Copyright (c) 2026, ERPGulf and Contributors
+# See license.txt
+
+import os
+import tempfile
+from unittest.mock import patch
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+
+from zatca_erpgulf.zatca_erpgulf import offline_ingestion
+from zatca_erpgulf.zatca_erpgulf.offline_ingestion import (
+    CHAIN_FIELDS,
+    read_signed_header,
+    report_chain,
+)
+
+POS_NAME = "_Test ZATCA Device"
+INVOICE_UUID = "3cf5ee18-ee25-44ea-a444-2c37ba7f28be"
+
+SIGNED_XML = f"""<?xml version="1.0" encoding="UTF-8"?>
+<Invoice xmlns="urn:oasis:names:specification:ubl:schema:xsd:Invoice-2"
+    xmlns:cac="urn:oasis:names:specification:ubl:schema:xsd:CommonAggregateComponents-2"
+    xmlns:cbc="urn:oasis:names:specification:ubl:schema:xsd:CommonBasicComponents-2"
+    xmlns:ext="urn:oasis:names:specification:ubl:schema:xsd:CommonExtensionComponents-2"
+    xmlns:ds="http://www.w3.org/2000/09/xmldsig#"
+    xmlns:xades="http://uri.etsi.org/01903/v1.3.2#">
+  <ext:UBLExtensions>
+    <ext:UBLExtension>
+      <ext:ExtensionContent>
+        <ds:Signature Id="signature">
+          <ds:SignedInfo>
+            <ds:Reference Id="invoiceSignedData" URI="">
+              <ds:DigestValue>invoice-hash</ds:DigestValue>
+            </ds:Reference>
+            <ds:Reference URI="#xadesSignedProperties">
+              <ds:DigestValue>signed-properties-hash</ds:DigestValue>
+            </ds:Reference>
+          </ds:SignedInfo>
+          <ds:Object>
+            <xades:QualifyingProperties>
+              <xades:CertDigest>
+                <ds:DigestValue>certificate-hash</ds:DigestValue>
+              </xades:CertDigest>
+            </xades:QualifyingProperties>
+          </ds:Object>
+        </ds:Signature>
+      </ext:ExtensionContent>
+    </ext:UBLExtension>
+  </ext:UBLExtensions>
+  <cbc:ProfileID>reporting:1.0</cbc:ProfileID>
+  <cbc:ID>ACC-SINV-2026-00042</cbc:ID>
+  <cbc:UUID>{INVOICE_UUID}</cbc:UUID>
+  <cac:AdditionalDocumentReference>
+    <cbc:ID>ICV</cbc:ID>
+    <cbc:UUID>42</cbc:UUID>
+  </cac:AdditionalDocumentReference>
+  <cac:AdditionalDocumentReference>
+    <cbc:ID>PIH</cbc:ID>
+    <cac:Attachment>
+      <cbc:EmbeddedDocumentBinaryObject mimeCode="text/plain">previous-hash</cbc:EmbeddedDocumentBinaryObject>
+    </cac:Attachment>
+  </cac:AdditionalDocumentReference>
+</Invoice>
+"""
+
+
+def make_chain(*icvs):
+    """ICV ordered entries of a device whose every PIH is the hash of the ICV before"""
+    return [
+        (
+            frappe._dict(name=f"INV-{icv}", custom_zatca_pos_name=POS_NAME),
+            {
+                "uuid": f"uuid-{icv}",
+                "digest_value": f"hash-{icv}",
+                "icv": icv,
+                "pih": f"hash-{icv - 1}",
+            },
+        )
+        for icv in icvs
+    ]
+
+
+class TestReportChain(FrappeTestCase):
+    def setUp(self):
+        self.reported_pih = None
+        self.rejected = set()
+        self.reported = []
+        self.outcomes = {}
+
+        def report_offline_invoice(doctype, invoice_doc, header, resubmission_id):
+            self.reported.append(invoice_doc.name)
+            return invoice_doc.name not in self.rejected
+
+        def record_outcome(job_id, doctype, invoice_name, status, message=None):
+            self.outcomes[invoice_name] = (status, message)
+
+        for target, replacement in (
+            ("report_offline_invoice", report_offline_invoice),
+            ("record_outcome", record_outcome),
+            ("get_reported_pih", lambda pos_name: self.reported_pih),
+            ("acquire_signing_unit", lambda unit, blocking_timeout=None: True),
+            ("release_signing_unit", lambda unit: None),
+            ("hand_over_signing_unit", lambda unit: None),
+        ):
+            patcher = patch.object(offline_ingestion, target, replacement)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def report(self, chain):
+        report_chain("POS Invoice", POS_NAME, chain, "job")
+
+    def assertFailed(self, invoice_names, reason):
+        for invoice_name in invoice_names:
+            status, message = self.outcomes[invoice_name]
+            self.assertEqual(status, "Failed")
+            self.assertIn(reason, message)
+
+    def test_unbroken_chain_is_reported_in_order(self):
+        self.reported_pih = "hash-0"
+        self.report(make_chain(1, 2, 3))
+        self.assertEqual(self.reported, ["INV-1", "INV-2", "INV-3"])
+        self.assertFalse(self.outcomes)
+
+    def test_icv_gap_fails_the_rest_of_the_chain(self):
+        self.report(make_chain(1, 2, 4, 5))
+        self.assertEqual(self.reported, ["INV-1", "INV-2"])
+        self.assertFailed(["INV-4", "INV-5"], "ICV 4 does not follow ICV 2")
+
+    def test_wrong_pih_fails_the_rest_of_the_chain(self):
+        chain = make_chain(1, 2, 3, 4)
+        chain[2][1]["pih"] = "hash-of-another-invoice"
+        self.report(chain)
+        self.assertEqual(self.reported, ["INV-1", "INV-2"])
+        self.assertFailed(["INV-3", "INV-4"], "PIH of ICV 3")
+
+    def test_first_pih_must_extend_the_reported_pih(self):
+        self.reported_pih = "hash-7"
+        self.report(make_chain(1, 2))
+        self.assertFalse(self.reported)
+        self.assertFailed(["INV-1", "INV-2"], "PIH of ICV 1")
+
+    def test_first_pih_is_not_checked_on_a_shared_chain(self):
+        self.report(make_chain(5, 6))
+        self.assertEqual(self.reported, ["INV-5", "INV-6"])
+
+    def test_rejection_stops_the_rest_of_the_chain(self):
+        self.rejected.add("INV-2")
+        self.report(make_chain(1, 2, 3, 4))
+        self.assertEqual(self.reported, ["INV-1", "INV-2"])
+        self.assertNotIn("INV-2", self.outcomes)
+        self.assertFailed(["INV-3", "INV-4"], "INV-2 of the device was not reported")
+
+
+class TestReadSignedHeader(FrappeTestCase):
+    def setUp(self):
+        file_descriptor, self.xml_path = tempfile.mkstemp(suffix=".xml")
+        with os.fdopen(file_descriptor, "w", encoding="utf-8") as xml_file:
+            xml_file.write(SIGNED_XML)
+        self.addCleanup(os.remove, self.xml_path)
+
+    def test_invoice_uuid_and_hash(self):
+        self.assertEqual(
+            read_signed_header(self.xml_path),
+            {"uuid": INVOICE_UUID, "digest_value": "invoice-hash"},
+        )
+
+    def test_chain_fields(self):
+        self.assertEqual(
+            read_signed_header(self.xml_path, CHAIN_FIELDS),
+            {
+                "uuid": INVOICE_UUID,
+                "digest_value": "invoice-hash",
+                "icv": "42",
+                "pih": "previous-hash",
+            },
+        )
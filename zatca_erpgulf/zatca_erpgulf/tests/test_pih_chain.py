@@ -0,0 +1,95 @@
+# Copyright (c) 2026, ERPGulf and Contributors
+# See license.txt
+
+from unittest.mock import patch
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+
+from zatca_erpgulf.zatca_erpgulf import pih_chain
+from zatca_erpgulf.zatca_erpgulf.pih_chain import (
+    get_unit_pih,
+    hold_signing_unit,
+    set_unit_pih,
+)
+
+COMPANY = "_Test ZATCA Company"
+INITIAL_PIH = "PIH-0"
+
+
+class TestUnitPih(FrappeTestCase):
+    def setUp(self):
+        self.pih = INITIAL_PIH
+        self.pih_reads = []
+        self.held = []
+        self.calls = []
+
+        def get_value(doctype, name, fieldname, as_dict=False, for_update=False):
+            if doctype == "Sales Invoice":
+                return frappe._dict(company=COMPANY, custom_zatca_pos_name=None)
+            self.pih_reads.append(for_update)
+            return self.pih
+
+        def set_value(doctype, name, fieldname, value, update_modified=True):
+            self.pih = value
+
+        for target, replacement in (
+            ("get_value", get_value),
+            ("set_value", set_value),
+        ):
+            patcher = patch.object(frappe.db, target, replacement)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        for target, replacement in (
+            (
+                "get_company_config",
+                lambda company: frappe._dict(pih_doctype="Company", pih_name=company),
+            ),
+            ("acquire_signing_unit", self.acquire),
+            ("release_signing_unit", self.release),
+            ("start_invoice_timing", lambda *args: None),
+        ):
+            patcher = patch.object(pih_chain, target, replacement)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def acquire(self, unit, blocking_timeout=None):
+        self.assertFalse(self.held, "the unit is held by another submission")
+        self.held.append(unit)
+        return True
+
+    def release(self, unit):
+        self.held.remove(unit)
+
+    @staticmethod
+    def invoice_hash(invoice_number):
+        return f"hash of {invoice_number}"
+
+    def sign(self, invoice_number):
+        """the part of a zatca_call that chains the invoice on its signing unit"""
+        self.assertEqual(self.held, [COMPANY])
+        invoice = frappe._dict(company=COMPANY, custom_zatca_pos_name=None)
+        pih = get_unit_pih(invoice)
+        set_unit_pih(invoice, self.invoice_hash(invoice_number))
+        self.calls.append((invoice_number, pih))
+        return pih
+
+    def test_sequential_holders_get_consecutive_pihs(self):
+        zatca_call = hold_signing_unit("Sales Invoice")(self.sign)
+        for invoice_number in ("INV-1", "INV-2", "INV-3"):
+            zatca_call(invoice_number)
+
+        self.assertEqual(
+            self.calls,
+            [
+                ("INV-1", INITIAL_PIH),
+                ("INV-2", self.invoice_hash("INV-1")),
+                ("INV-3", self.invoice_hash("INV-2")),
+            ],
+        )
+        self.assertEqual(self.pih, self.invoice_hash("INV-3"))
+        self.assertFalse(self.held)
+
+    def test_pih_is_read_with_a_lock(self):
+        hold_signing_unit("Sales Invoice")(self.sign)("INV-1")
+        self.assertEqual(self.pih_reads, [True])
@@ -0,0 +1,175 @@
+# Copyright (c) 2026, ERPGulf and Contributors
+# See license.txt
+
+from unittest.mock import patch
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+
+from zatca_erpgulf.zatca_erpgulf import submission_queue
+from zatca_erpgulf.zatca_erpgulf.submission_queue import (
+    acquire_signing_unit,
+    drain_signing_units,
+    enqueue_signing_units,
+    get_signing_units,
+    get_unit_lock_key,
+    get_unit_waiting_key,
+    release_signing_unit,
+)
+
+COMPANY = "_Test ZATCA Company"
+OTHER_COMPANY = "_Test ZATCA Company 2"
+
+
+def invoice(name, company=COMPANY, pos_name=None):
+    return frappe._dict(name=name, company=company, custom_zatca_pos_name=pos_name)
+
+
+class FakeLock:
+    def __init__(self, cache, key):
+        self.cache = cache
+        self.key = key
+
+    def acquire(self, blocking=True, blocking_timeout=None):
+        if self.key in self.cache.locked:
+            return False
+        self.cache.locked.add(self.key)
+        return True
+
+    def release(self):
+        self.cache.locked.remove(self.key)
+
+
+class FakeCache:
+    def __init__(self):
+        self.locked = set()
+        self.values = {}
+
+    def lock(self, key, timeout=None):
+        return FakeLock(self, key)
+
+    def set(self, key, value, ex=None):
+        self.values[key] = value
+
+    def get(self, key):
+        return self.values.get(key)
+
+
+class TestSigningUnits(FrappeTestCase):
+    def test_invoices_are_grouped_by_signing_unit(self):
+        settings = [
+            frappe._dict(
+                name="POS-OWN",
+                custom__use_company_certificate__keys=0,
+                custom_linked_doctype=COMPANY,
+            ),
+            frappe._dict(
+                name="POS-SHARED",
+                custom__use_company_certificate__keys=1,
+                custom_linked_doctype=COMPANY,
+            ),
+        ]
+        invoices = [
+            invoice("INV-1"),
+            invoice("INV-2", pos_name="POS-OWN"),
+            invoice("INV-3", pos_name="POS-SHARED"),
+            invoice("INV-4"),
+            invoice("INV-5", company=OTHER_COMPANY),
+            invoice("INV-6", pos_name="POS-OWN"),
+        ]
+        with patch.object(frappe, "get_all", return_value=settings):
+            units = get_signing_units(invoices)
+
+        self.assertEqual(
+            units,
+            {
+                (COMPANY, COMPANY): ["INV-1", "INV-3", "INV-4"],
+                (COMPANY, "POS-OWN"): ["INV-2", "INV-6"],
+                (OTHER_COMPANY, OTHER_COMPANY): ["INV-5"],
+            },
+        )
+
+    def test_units_are_sharded_over_the_company_workers(self):
+        units = {
+            (COMPANY, "UNIT-A"): ["INV-1"],
+            (COMPANY, "UNIT-B"): ["INV-2"],
+            (COMPANY, "UNIT-C"): ["INV-3"],
+            (OTHER_COMPANY, "UNIT-D"): ["INV-4"],
+        }
+        with patch.object(frappe, "enqueue") as enqueue:
+            enqueue_signing_units(
+                "app.module.submit_units",
+                units,
+                {COMPANY: 2, OTHER_COMPANY: 0},
+                doctype="Sales Invoice",
+            )
+
+        jobs = {
+            call.kwargs["job_name"]: call.kwargs["units"] for call in enqueue.call_args_list
+        }
+        self.assertEqual(
+            jobs,
+            {
+                f"submit_units_{COMPANY}_0": {"UNIT-A": ["INV-1"], "UNIT-C": ["INV-3"]},
+                f"submit_units_{COMPANY}_1": {"UNIT-B": ["INV-2"]},
+                f"submit_units_{OTHER_COMPANY}_0": {"UNIT-D": ["INV-4"]},
+            },
+        )
+        for call in enqueue.call_args_list:
+            self.assertEqual(call.args, ("app.module.submit_units",))
+            self.assertEqual(call.kwargs["doctype"], "Sales Invoice")
+
+
+class TestSigningUnitLock(FrappeTestCase):
+    def setUp(self):
+        self.cache = FakeCache()
+        patcher = patch.object(frappe, "cache", lambda: self.cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        frappe.local.zatca_held_units = {}
+        self.addCleanup(setattr, frappe.local, "zatca_held_units", {})
+
+    def test_holds_are_counted_until_the_last_release(self):
+        self.assertTrue(acquire_signing_unit("UNIT-A"))
+        self.assertTrue(acquire_signing_unit("UNIT-A"))
+        self.assertEqual(self.cache.locked, {get_unit_lock_key("UNIT-A")})
+
+        release_signing_unit("UNIT-A")
+        self.assertEqual(self.cache.locked, {get_unit_lock_key("UNIT-A")})
+        release_signing_unit("UNIT-A")
+        self.assertFalse(self.cache.locked)
+        self.assertFalse(frappe.local.zatca_held_units)
+
+    def test_busy_unit(self):
+        self.cache.locked.add(get_unit_lock_key("UNIT-A"))
+
+        self.assertFalse(acquire_signing_unit("UNIT-A", blocking=False))
+        self.assertIsNone(self.cache.get(get_unit_waiting_key("UNIT-A")))
+
+        self.assertFalse(acquire_signing_unit("UNIT-A", blocking_timeout=1))
+        self.assertEqual(self.cache.get(get_unit_waiting_key("UNIT-A")), 1)
+
+        self.assertTrue(acquire_signing_unit("UNIT-B", blocking=False))
+
+    def test_drain_holds_the_unit_per_invoice(self):
+        submitted = []
+
+        def submit_invoice(invoice_name):
+            # the submission takes the unit the drain holds once more
+            self.assertTrue(acquire_signing_unit("UNIT-A"))
+            release_signing_unit("UNIT-A")
+            self.assertIn(get_unit_lock_key("UNIT-A"), self.cache.locked)
+            submitted.append(invoice_name)
+            if invoice_name == "INV-2":
+                raise frappe.ValidationError("rejected")
+
+        with patch.object(frappe.db, "commit"), patch.object(
+            frappe.db, "rollback"
+        ) as rollback, patch.object(submission_queue, "flush_zatca_events") as flush:
+            drain_signing_units({"UNIT-A": ["INV-1", "INV-2", "INV-3"]}, submit_invoice)
+
+        self.assertEqual(submitted, ["INV-1", "INV-2", "INV-3"])
+        rollback.assert_called_once()
+        flush.assert_called_once()
+        self.assertFalse(self.cache.locked)
+        self.assertFalse(frappe.local.zatca_held_units)
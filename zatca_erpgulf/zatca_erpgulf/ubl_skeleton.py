@@ -0,0 +1,218 @@
+"""
+Prebuilt UBLExtensions / XAdES signature scaffold shared by every invoice.
+The scaffold is the same for all Sales, POS and advance payment invoices, so it is
+built once per worker instead of with some sixty SubElement calls per invoice, and
+appended as is to the Invoice element xml_tags returns. It is never changed in place:
+the signing steps fill the lxml tree xml_structuring_tree parses from it, and reach the
+placeholders through their fixed child positions instead of long XPaths
+"""
+
+import xml.etree.ElementTree as ET
+
+CBC_ID = "cbc:ID"
+DS_TRANSFORM = "ds:Transform"
+XPATH_TRANSFORM = "http://www.w3.org/TR/1999/REC-xpath-19991116"
+C14N11 = "http://www.w3.org/2006/12/xml-c14n11"
+SHA256 = "http://www.w3.org/2001/04/xmlenc#sha256"
+
+NAMESPACES = {
+    "ext": "urn:oasis:names:specification:ubl:schema:xsd:CommonExtensionComponents-2",
+    "cbc": "urn:oasis:names:specification:ubl:schema:xsd:CommonBasicComponents-2",
+    "sig": "urn:oasis:names:specification:ubl:schema:xsd:CommonSignatureComponents-2",
+    "sac": "urn:oasis:names:specification:ubl:schema:xsd:SignatureAggregateComponents-2",
+    "sbc": "urn:oasis:names:specification:ubl:schema:xsd:SignatureBasicComponents-2",
+    "ds": "http://www.w3.org/2000/09/xmldsig#",
+    "xades": "http://uri.etsi.org/01903/v1.3.2#",
+}
+INVOICE_ATTRIBUTES = {
+    "xmlns": "urn:oasis:names:specification:ubl:schema:xsd:Invoice-2",
+    "xmlns:cac": "urn:oasis:names:specification:ubl:schema:xsd:CommonAggregateComponents-2",
+    "xmlns:cbc": NAMESPACES["cbc"],
+    "xmlns:ext": NAMESPACES["ext"],
+}
+
+
+def sub_element(parent, tag, text=None, **attrib):
+    """SubElement with its text set in the same call"""
+    element = ET.SubElement(parent, tag, attrib)
+    element.text = text
+    return element
+
+
+def build_ubl_extensions():
+    """the <ext:UBLExtensions> scaffold and its placeholders filled in during signing"""
+    ubl_extensions = ET.Element("ext:UBLExtensions")
+    ubl_extension = sub_element(ubl_extensions, "ext:UBLExtension")
+    sub_element(
+        ubl_extension,
+        "ext:ExtensionURI",
+        "urn:oasis:names:specification:ubl:dsig:enveloped:xades",
+    )
+    extension_content = sub_element(ubl_extension, "ext:ExtensionContent")
+    ubl_document_signatures = sub_element(
+        extension_content,
+        "sig:UBLDocumentSignatures",
+        **{
+            "xmlns:sig": NAMESPACES["sig"],
+            "xmlns:sac": NAMESPACES["sac"],
+            "xmlns:sbc": NAMESPACES["sbc"],
+        },
+    )
+    signature_information = sub_element(
+        ubl_document_signatures, "sac:SignatureInformation"
+    )
+    sub_element(
+        signature_information, CBC_ID, "urn:oasis:names:specification:ubl:signature:1"
+    )
+    sub_element(
+        signature_information,
+        "sbc:ReferencedSignatureID",
+        "urn:oasis:names:specification:ubl:signature:Invoice",
+    )
+    signature = sub_element(
+        signature_information,
+        "ds:Signature",
+        **{"Id": "signature", "xmlns:ds": NAMESPACES["ds"]},
+    )
+    signed_info = sub_element(signature, "ds:SignedInfo")
+    sub_element(signed_info, "ds:CanonicalizationMethod", Algorithm=C14N11)
+    sub_element(
+        signed_info,
+        "ds:SignatureMethod",
+        Algorithm="http://www.w3.org/2001/04/xmldsig-more#ecdsa-sha256",
+    )
+    reference = sub_element(
+        signed_info, "ds:Reference", Id="invoiceSignedData", URI=""
+    )
+    transforms = sub_element(reference, "ds:Transforms")
+    for xpath in (
+        "not(//ancestor-or-self::ext:UBLExtensions)",
+        "not(//ancestor-or-self::cac:Signature)",
+        "not(//ancestor-or-self::cac:AdditionalDocumentReference[cbc:ID='QR'])",
+    ):
+        transform = sub_element(transforms, DS_TRANSFORM, Algorithm=XPATH_TRANSFORM)
+        sub_element(transform, "ds:XPath", xpath)
+    sub_element(transforms, DS_TRANSFORM, Algorithm=C14N11)
+    sub_element(reference, "ds:DigestMethod", Algorithm=SHA256)
+    invoice_digest = sub_element(
+        reference, "ds:DigestValue", "O/vEnAxjLAlw8kQUy8nq/5n8IEZ0YeIyBFvdQA8+iFM="
+    )
+    reference2 = sub_element(
+        signed_info,
+        "ds:Reference",
+        URI="#xadesSignedProperties",
+        Type="http://www.w3.org/2000/09/xmldsig#SignatureProperties",
+    )
+    sub_element(reference2, "ds:DigestMethod", Algorithm=SHA256)
+    signed_properties_digest = sub_element(
+        reference2, "ds:DigestValue", "YjQwZmEyMjM2NDU1YjQwNjM5MTFmYmVkO="
+    )
+    signature_value = sub_element(
+        signature, "ds:SignatureValue", "MEQCIDGBRHiPo6yhXIQ9df6pMEkufcGnoqYaS+O8Jn"
+    )
+    keyinfo = sub_element(signature, "ds:KeyInfo")
+    x509data = sub_element(keyinfo, "ds:X509Data")
+    x509_certificate = sub_element(
+        x509data,
+        "ds:X509Certificate",
+        "MIID6TCCA5CgAwIBAgITbwAAf8tem6jngr16DwABAAB/yzAKBggqhkjOPQQ",
+    )
+    object_data = sub_element(signature, "ds:Object")
+    qualifyingproperties = sub_element(
+        object_data,
+        "xades:QualifyingProperties",
+        **{"Target": "signature", "xmlns:xades": NAMESPACES["xades"]},
+    )
+    signedproperties = sub_element(
+        qualifyingproperties, "xades:SignedProperties", Id="xadesSignedProperties"
+    )
+    signedsignatureproperties = sub_element(
+        signedproperties, "xades:SignedSignatureProperties"
+    )
+    signing_time = sub_element(
+        signedsignatureproperties, "xades:SigningTime", "2024-01-24T11:36:34Z"
+    )
+    signingcertificate = sub_element(
+        signedsignatureproperties, "xades:SigningCertificate"
+    )
+    cert = sub_element(signingcertificate, "xades:Cert")
+    certdigest = sub_element(cert, "xades:CertDigest")
+    sub_element(certdigest, "ds:DigestMethod", Algorithm=SHA256)
+    cert_digest = sub_element(
+        certdigest, "ds:DigestValue", "YTJkM2JhYTcwZTBhZTAxOGYwODMyNzY3"
+    )
+    issuerserial = sub_element(cert, "xades:IssuerSerial")
+    issuer_name = sub_element(
+        issuerserial,
+        "ds:X509IssuerName",
+        "CN=TSZEINVOICE-SubCA-1, DC=extgazt, DC=gov, DC=local",
+    )
+    serial_number = sub_element(
+        issuerserial,
+        "ds:X509SerialNumber",
+        "2475382886904809774818644480820936050208702411",
+    )
+    return ubl_extensions, {
+        "invoice_digest": invoice_digest,
+        "signed_properties_digest": signed_properties_digest,
+        "signature_value": signature_value,
+        "x509_certificate": x509_certificate,
+        "signing_time": signing_time,
+        "cert_digest": cert_digest,
+        "issuer_name": issuer_name,
+        "serial_number": serial_number,
+    }
+
+
+def get_child_path(parent, target):
+    """child indexes leading from parent down to target, None when it is not below it"""
+    for index, child in enumerate(parent):
+        if child is target:
+            return (index,)
+        path = get_child_path(child, target)
+        if path is not None:
+            return (index,) + path
+    return None
+
+
+def get_clark_tag(tag):
+    """{namespace}name form lxml gives the prefixed tag once the xml is parsed"""
+    prefix, name = tag.split(":")
+    return f"{{{NAMESPACES[prefix]}}}{name}"
+
+
+UBL_EXTENSIONS, _placeholders = build_ubl_extensions()
+UBL_EXTENSIONS_TAG = get_clark_tag(UBL_EXTENSIONS.tag)
+# the scaffold is the first child of the Invoice element
+SIGNATURE_NODE_PATHS = {
+    name: (0,) + get_child_path(UBL_EXTENSIONS, node)
+    for name, node in _placeholders.items()
+}
+SIGNATURE_NODE_TAGS = {
+    name: get_clark_tag(node.tag) for name, node in _placeholders.items()
+}
+del _placeholders
+
+
+def new_invoice():
+    """Invoice element with the namespaces and the shared signature scaffold"""
+    invoice = ET.Element("Invoice", INVOICE_ATTRIBUTES)
+    invoice.append(UBL_EXTENSIONS)
+    return invoice
+
+
+def has_skeleton(root):
+    """whether an lxml invoice tree starts with the scaffold"""
+    return len(root) > 0 and root[0].tag == UBL_EXTENSIONS_TAG
+
+
+def get_signature_node(root, name):
+    """placeholder of the signature in an lxml invoice tree built on the scaffold,
+    None when the tree does not have its layout"""
+    node = root
+    try:
+        for index in SIGNATURE_NODE_PATHS[name]:
+            node = node[index]
+    except IndexError:
+        return None
+    return node if node.tag == SIGNATURE_NODE_TAGS[name] else None
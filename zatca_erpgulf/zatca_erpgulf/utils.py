@@ -40,8 +40,7 @@ def arabic_number(value):
 
 
 import frappe
-import pyqrcode
-from io import BytesIO
+from zatca_erpgulf.zatca_erpgulf.qr_image import render_qr_png
 
 def generate_qr_and_attach_doctype(doctype, docname, url, file_field=None):
     if not url:
@@ -60,19 +59,15 @@ def generate_qr_and_attach_doctype(doctype, docname, url, file_field=None):
     if existing:
         return frappe.db.get_value("File", existing, "file_url")
 
-    # --- QR generation using pyqrcode ---
-    qr = pyqrcode.create(url)
-
-    buffer = BytesIO()
-    qr.png(buffer, scale=6)  # scale controls size
-    buffer.seek(0)
+    # pyqrcode defaults of the earlier rendering, error level H with a 4 module border
+    qr_image = render_qr_png(url, error="H", scale=6, quiet_zone=4)
 
     file_doc = frappe.get_doc({
         "doctype": "File",
         "file_name": filename,
         "attached_to_doctype": doctype,
         "attached_to_name": docname,
-        "content": buffer.getvalue(),
+        "content": qr_image,
         "is_private": 0
     })
     file_doc.insert(ignore_permissions=True)
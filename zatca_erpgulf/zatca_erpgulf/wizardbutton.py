@@ -2,7 +2,7 @@
 
 import json
 import base64
-import requests
+from zatca_erpgulf.zatca_erpgulf.zatca_session import zatca_request
 from frappe import _
 import frappe
 import lxml.etree as ET
@@ -127,7 +127,7 @@ def wizard_button(company_abbr, button, pos=0, machine=None):
         }
 
         # API request
-        response = requests.request(
+        response = zatca_request(
             "POST",
             url=get_api_url(company_abbr, base_url="compliance/invoices"),
             headers=headers,
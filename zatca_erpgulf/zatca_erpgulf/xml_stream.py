@@ -0,0 +1,139 @@
+"""
+Streaming signer for invoices with a large number of lines.
+The header of the invoice, everything in front of the first <cac:InvoiceLine>, is
+built and signed as a small lxml tree like any other invoice. The lines are built one
+at a time, fed to the invoice hash in their canonical form and written to the signed
+xml as they come, so only the header and a single line are held as trees at any time.
+The hash and the signed xml are the same as those of the full tree
+"""
+
+import base64
+import hashlib
+import io
+import xml.etree.ElementTree as ET
+from lxml import etree
+import frappe
+from frappe import _
+from zatca_erpgulf.zatca_erpgulf.create_xml_final_part import xml_structuring_tree
+from zatca_erpgulf.zatca_erpgulf.sign_invoice_first import (
+    canonicalize_xml,
+    digital_signature,
+    extract_tlv_data,
+    generate_signed_properties_hash,
+    get_tlv_for_value,
+    removetags,
+    serialize_xml_tree,
+    set_qr_value,
+    set_signature_values,
+    set_signing_properties,
+    sign_xml_tree,
+    structuring_signedxml,
+)
+from zatca_erpgulf.zatca_erpgulf.signing_identity import get_signing_identity
+
+# below this many lines the whole invoice is signed as one tree
+STREAMING_LINE_THRESHOLD = 500
+LINE_INDENT = "\n  "
+
+
+def use_streaming(invoice_doc):
+    """whether the lines of the invoice are streamed rather than built into the tree"""
+    return len(invoice_doc.items) >= STREAMING_LINE_THRESHOLD
+
+
+def serialize_line(invoice, line):
+    """canonical and signed xml form of one detached <cac:InvoiceLine>, without its tail.
+    The line is parsed inside an empty copy of the invoice element so its prefixes resolve
+    and its indentation and escaping come out as they do in the full tree"""
+    holder = ET.Element(invoice.tag, invoice.attrib)
+    holder.append(line)
+    holder = etree.fromstring(ET.tostring(holder))
+    etree.indent(holder, space="  ")
+    holder.text = holder[0].tail = None
+    canonical = etree.tostring(holder, method="c14n")
+    signed = etree.tostring(holder, encoding="utf-8")
+    # strip the start and end tag of the holder, its namespace URIs contain no ">"
+    return (
+        canonical[canonical.index(b">") + 1 : canonical.rindex(b"</")],
+        signed[signed.index(b">") + 1 : signed.rindex(b"</")],
+    )
+
+
+def sign_streamed_invoice(invoice, lines, invoice_number, company_abbr, source_doc):
+    """sign the header built in invoice and the <cac:InvoiceLine> elements yielded by lines.
+    Returns the invoice hash, the qr base64 and the signed xml as utf-8 bytes, like
+    sign_xml_tree followed by structuring_signedxml"""
+    try:
+        lines = iter(lines)
+        first_line = next(lines, None)
+        if first_line is None:
+            root = xml_structuring_tree(invoice)
+            encoded_hash, qrcodeb64, updated_xml_string = sign_xml_tree(
+                root, company_abbr, source_doc
+            )
+            return (
+                encoded_hash,
+                qrcodeb64,
+                structuring_signedxml(invoice_number, updated_xml_string),
+            )
+
+        root = xml_structuring_tree(invoice)
+        # the lines follow the last header element at the indentation of the root
+        root[-1].tail = LINE_INDENT
+        canonical_header = canonicalize_xml(removetags(root)).encode("utf-8")
+        closing_at = canonical_header.rindex(b"</")
+        invoice_hash = hashlib.sha256(canonical_header[:closing_at])
+        signed_lines = io.BytesIO()
+        line = first_line
+        while line is not None:
+            canonical_line, signed_line = serialize_line(invoice, line)
+            invoice_hash.update(canonical_line)
+            signed_lines.write(signed_line)
+            line = next(lines, None)
+            separator = (LINE_INDENT if line is not None else "\n").encode("utf-8")
+            invoice_hash.update(separator)
+            signed_lines.write(separator)
+        invoice_hash.update(canonical_header[closing_at:])
+        encoded_hash = base64.b64encode(invoice_hash.digest()).decode("utf-8")
+
+        identity = get_signing_identity(company_abbr, source_doc)
+        encoded_signature = digital_signature(
+            invoice_hash.hexdigest(), company_abbr, source_doc
+        )
+        signing_time = set_signing_properties(
+            root,
+            identity.certificate_hash,
+            identity.issuer_name,
+            identity.serial_number,
+        )
+        signed_properties_base64 = generate_signed_properties_hash(
+            signing_time,
+            identity.issuer_name,
+            identity.serial_number,
+            identity.certificate_hash,
+        )
+        set_signature_values(
+            root,
+            encoded_signature,
+            identity.certificate_content,
+            signed_properties_base64,
+            encoded_hash,
+        )
+        tlv_data = extract_tlv_data(root, company_abbr, source_doc)
+        qrcodebuf = b"".join(
+            get_tlv_for_value(tag_num, tag_value)
+            for tag_num, tag_value in tlv_data.items()
+        )
+        qrcodeb64 = base64.b64encode(qrcodebuf).decode("utf-8")
+        set_qr_value(root, qrcodeb64, company_abbr)
+
+        signed_header = structuring_signedxml(invoice_number, serialize_xml_tree(root))
+        closing_at = signed_header.rindex(b"</")
+        signed_xml = io.BytesIO()
+        signed_xml.write(signed_header[:closing_at])
+        signed_xml.write(signed_lines.getbuffer())
+        signed_xml.write(signed_header[closing_at:])
+        return encoded_hash, qrcodeb64, signed_xml.getvalue()
+    except (ValueError, KeyError, TypeError, frappe.ValidationError) as e:
+        frappe.throw(_("Error in signing the invoice xml: " + str(e)))
+        return None
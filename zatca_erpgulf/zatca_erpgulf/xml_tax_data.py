@@ -51,12 +51,57 @@ def get_exemption_reason_map():
     }
 
 
+def get_item_tax_index(invoice_doc):
+    """
+    Item wise tax detail of an invoice as {item_code: [tax_percentage, tax_amount]}.
+    Built from the v16 item_wise_tax_details table when present, otherwise parsed once
+    from the json of the first tax row and kept on the document flags for later lookups.
+    """
+    if int(frappe.__version__.split(".", 1)[0]) == 16 and invoice_doc.item_wise_tax_details:
+        tax_rate = float(f"{invoice_doc.item_wise_tax_details[0].rate:.1f}")
+        tax_amount = float(invoice_doc.item_wise_tax_details[0].amount)
+        return {
+            single_item.item_code: [tax_rate, tax_amount]
+            for single_item in invoice_doc.items
+        }
+
+    tax_json = invoice_doc.taxes[0].item_wise_tax_detail
+    cached = invoice_doc.flags.zatca_item_tax_index
+    if cached and cached[0] == tax_json:
+        return cached[1]
+    try:
+        tax_index = json.loads(tax_json)
+    except json.JSONDecodeError as e:
+        frappe.throw(_("JSON decoding error occurred in tax for item: " + str(e)))
+        return None
+    except TypeError as e:
+        frappe.throw(_("Type error occurred in tax for item: " + str(e)))
+        return None
+    invoice_doc.flags.zatca_item_tax_index = (tax_json, tax_index)
+    return tax_index
+
+
+def get_item_tax_templates(invoice_doc):
+    """Item Tax Templates of the invoice lines by name, each loaded once per invoice"""
+    names = tuple(item.item_tax_template for item in invoice_doc.items)
+    cached = invoice_doc.flags.zatca_item_tax_templates
+    if cached and cached[0] == names:
+        return cached[1]
+    templates = {}
+    for name in names:
+        if name not in templates:
+            templates[name] = frappe.get_doc("Item Tax Template", name)
+    invoice_doc.flags.zatca_item_tax_templates = (names, templates)
+    return templates
+
+
 def get_tax_for_item(full_string, item):
     """
-    Extracts the tax amount and tax percentage for a specific item from a JSON-encoded string.
+    Extracts the tax amount and tax percentage for a specific item from a JSON-encoded string
+    or from the item tax index of get_item_tax_index.
     """
     try:  # getting tax percentage and tax amount
-        data = json.loads(full_string)
+        data = full_string if isinstance(full_string, dict) else json.loads(full_string)
         tax_percentage = data.get(item, [0, 0])[0]
         tax_amount = data.get(item, [0, 0])[1]
         return tax_amount, tax_percentage
@@ -70,28 +115,15 @@ def get_tax_for_item(full_string, item):
         frappe.throw(_("Type error occurred in tax for item: " + str(e)))
         return None
 
-def get_tax_wise_detail(sales_invoice_doc,single_item):
-    """getting item wise tax"""
-    if int(frappe.__version__.split(".", 1)[0]) == 16 and sales_invoice_doc.item_wise_tax_details:
-        tax_rate = float(f"{sales_invoice_doc.item_wise_tax_details[0].rate:.1f}")
-        tax_amount = sales_invoice_doc.item_wise_tax_details[0].amount
-
-        # build JSON exactly like v15
-        tax_json = json.dumps({
-            single_item.item_code: [tax_rate, float(tax_amount)]
-        })
-    else:
-        tax_json = sales_invoice_doc.taxes[0].item_wise_tax_detail
-    return tax_json
 
 def get_tax_total_from_items(sales_invoice_doc):
     """Getting tax total for items"""
     try:
         total_tax = 0
+        tax_index = get_item_tax_index(sales_invoice_doc)
         for single_item in sales_invoice_doc.items:
-            tax_json = get_tax_wise_detail(sales_invoice_doc,single_item)
             _item_tax_amount, tax_percent = get_tax_for_item(
-                tax_json , single_item.item_code
+                tax_index, single_item.item_code
             )
             total_tax = total_tax + (single_item.net_amount * (tax_percent / 100))
         return total_tax
@@ -481,12 +513,11 @@ def tax_data(invoice, sales_invoice_doc):
 def tax_data_with_template(invoice, sales_invoice_doc):
     """Adding tax data with template to the xml"""
     try:
+        item_tax_templates = get_item_tax_templates(sales_invoice_doc)
         # Initialize tax category totals
         tax_category_totals = {}
         for item in sales_invoice_doc.items:
-            item_tax_template = frappe.get_doc(
-                "Item Tax Template", item.item_tax_template
-            )
+            item_tax_template = item_tax_templates[item.item_tax_template]
             zatca_tax_category = item_tax_template.custom_zatca_tax_category
 
             if zatca_tax_category not in tax_category_totals:
@@ -641,9 +672,7 @@ def tax_data_with_template(invoice, sales_invoice_doc):
 
         # Process Items and Calculate Taxable Amounts
         for item in sales_invoice_doc.items:
-            item_tax_template = frappe.get_doc(
-                "Item Tax Template", item.item_tax_template
-            )
+            item_tax_template = item_tax_templates[item.item_tax_template]
             zatca_tax_category = item_tax_template.custom_zatca_tax_category
 
             if zatca_tax_category not in tax_category_totals:
@@ -0,0 +1,104 @@
+"""
+Snapshot of the ZATCA configuration of a Company or ZATCA Multiple Setting.
+The submit hooks and the schedulers need the phase, send mode, time windows,
+environment and CSIDs for every invoice they process. The snapshot keeps them in
+redis so a backlog does not load the same Company for each invoice, and is dropped
+whenever the document is updated
+"""
+
+import frappe
+from frappe import _
+
+CONFIG_CACHE_KEY = "zatca_config"
+MULTIPLE_SETTING = "ZATCA Multiple Setting"
+
+CONFIG_FIELDS = {
+    "Company": [
+        "name",
+        "abbr",
+        "tax_id",
+        "custom_zatca_invoice_enabled",
+        "custom_phase_1_or_2",
+        "custom_send_invoice_to_zatca",
+        "custom_submit_or_not",
+        "custom_zatca_async_submission",
+        "custom_zatca_submission_workers",
+        "custom_zatca_batch_size",
+        "custom_zatca_batch_rate_limit",
+        "custom_start_time",
+        "custom_end_time",
+        "custom_start_time_session",
+        "custom_end_time_session",
+        "custom_costcenter",
+        "custom_submit_line_item_discount_to_zatca",
+        "custom_auto_create_pdfa3",
+        "custom_print_format",
+        "custom_letterhead",
+        "custom_language",
+        "custom_select",
+        "custom_sandbox_url",
+        "custom_simulation_url",
+        "custom_production_url",
+        "custom_basic_auth_from_csid",
+        "custom_basic_auth_from_production",
+    ],
+    MULTIPLE_SETTING: [
+        "name",
+        "custom_linked_doctype",
+        "custom__use_company_certificate__keys",
+        "custom_send_pos_invoices_to_zatca_on_background",
+        "custom_basic_auth_from_csid",
+        "custom_final_auth_csid",
+    ],
+}
+
+
+def get_config_key(doctype, name):
+    """key of a snapshot in the config cache"""
+    return f"{doctype}::{name}"
+
+
+def load_config(doctype, name):
+    """read the snapshot of a Company or ZATCA Multiple Setting from the database"""
+    config = frappe.db.get_value(doctype, name, CONFIG_FIELDS[doctype], as_dict=True)
+    if not config:
+        frappe.throw(_(f"{doctype} {name} not found."))
+    # the PIH moves on with every invoice, the snapshot only points at the document holding it
+    if doctype == "Company":
+        config.pih_doctype, config.pih_name = "Company", config.name
+    elif config.custom__use_company_certificate__keys == 1:
+        config.pih_doctype, config.pih_name = "Company", config.custom_linked_doctype
+    else:
+        config.pih_doctype, config.pih_name = MULTIPLE_SETTING, config.name
+    return config
+
+
+def get_config(doctype, name):
+    """cached configuration snapshot of a Company or ZATCA Multiple Setting"""
+    return frappe.cache().hget(
+        CONFIG_CACHE_KEY,
+        get_config_key(doctype, name),
+        generator=lambda: load_config(doctype, name),
+    )
+
+
+def get_company_config(company):
+    """cached configuration snapshot of a Company"""
+    return get_config("Company", company)
+
+
+def get_installed_apps():
+    """installed apps of the site, read once per request or background job"""
+    if getattr(frappe.local, "zatca_installed_apps", None) is None:
+        frappe.local.zatca_installed_apps = frappe.get_installed_apps()
+    return frappe.local.zatca_installed_apps
+
+
+def clear_config(doc=None, method=None):
+    """drop the snapshot of a Company or ZATCA Multiple Setting once it changes"""
+    frappe.cache().hdel(CONFIG_CACHE_KEY, get_config_key(doc.doctype, doc.name))
+
+
+def clear_all_config():
+    """drop every snapshot, the custom fields may have changed with the migrate"""
+    frappe.cache().delete_value(CONFIG_CACHE_KEY)
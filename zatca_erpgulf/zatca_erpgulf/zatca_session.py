@@ -0,0 +1,49 @@
+"""
+Keep-alive HTTP sessions for the ZATCA APIs.
+One pooled requests.Session per Sandbox/Simulation/Production base URL is kept for
+the life of the worker, so invoices reuse the TCP+TLS connection to the gateway
+"""
+
+import threading
+from http.cookiejar import DefaultCookiePolicy
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+from zatca_erpgulf.zatca_erpgulf.stage_timing import timed_stage
+
+POOL_CONNECTIONS = 4
+POOL_MAXSIZE = 16
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def get_zatca_session(url):
+    """get the shared session for the base URL of the given endpoint"""
+    parts = urlsplit(url)
+    base_url = f"{parts.scheme}://{parts.netloc}"
+    session = _sessions.get(base_url)
+    if session is None:
+        with _sessions_lock:
+            session = _sessions.get(base_url)
+            if session is None:
+                session = requests.Session()
+                # every call sets its own headers, nothing is carried over between companies
+                session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+                session.mount(
+                    base_url + "/",
+                    HTTPAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE),
+                )
+                _sessions[base_url] = session
+    return session
+
+
+@timed_stage("http")
+def zatca_request(method, url, **kwargs):
+    """send a request to a ZATCA endpoint over the shared session"""
+    return get_zatca_session(url).request(method, url, **kwargs)
+
+
+def zatca_post(url, **kwargs):
+    """POST to a ZATCA endpoint over the shared session"""
+    return zatca_request("POST", url, **kwargs)